@@ -0,0 +1,320 @@
+"""Synthetic scaling benchmark for the Migrator pipeline.
+
+Generates a DefaultDatabaseSource tree of N databases, each with M
+migrations plus code and reference data scripts, and runs each Migrator
+phase against a LatencyDatabaseHandler (a fake handler that sleeps for
+a fixed time per call, to simulate network round trips).  For each
+phase, reports wall time, memory growth (the peak and the final RSS
+over the phase, less the RSS at its start), number of scripts, and
+handler calls by method.
+
+Results can be saved as JSON (--output) and compared against a saved
+baseline (--compare).  Handler call counts are deterministic, so any
+increase is reported as a regression; wall time regresses if it grows
+by more than --threshold, and peak memory growth if it grows by more
+than --memory-threshold.
+
+Run from the repository root:
+
+  python -m benchmarks.bench_migrator --databases 20 --migrations 500 --output new.json
+  python -m benchmarks.bench_migrator --databases 20 --migrations 500 --compare new.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from dbMigrator.migrator import Migrator
+from dbMigrator.defaultdatabasesource import DefaultDatabaseSource
+from dbMigrator.observers import JsonLinesObserver, PrometheusTextfileObserver
+from benchmarks.latencydatabasehandler import LatencyDatabaseHandler
+
+
+def make_statement(n, size):
+    """A single sql statement of roughly size bytes."""
+    prefix = "insert into t_{0} (v) values ('".format(n)
+    return prefix + "x" * max(0, size - len(prefix) - 3) + "');\n"
+
+
+def write_script(path, statements, size):
+    """Writes a .sql file of the given number of statements, totalling roughly size bytes."""
+    per_statement = max(1, size / max(1, statements))
+    with open(path, "w") as f:
+        for n in range(statements):
+            f.write(make_statement(n, per_statement))
+
+
+def write_csv(path, rows):
+    with open(path, "w") as f:
+        f.write("id,code,description\n")
+        for n in range(rows):
+            f.write("{0},C{0},Description of item {0}\n".format(n))
+
+
+def generate_tree(root, args):
+    """Writes the database folders and the .ini file to root, returns ini path."""
+    ini = ["[Server]", "host = 'localhost'", "dbname = 'system'", "user = 'u'", "password = 'p'", "", "[Databases]"]
+    for d in range(args.databases):
+        nickname = "db_{0:04d}".format(d)
+        ini.extend(["  [[{0}]]".format(nickname), "  host = 'localhost'", "  dbname = '{0}'".format(nickname),
+                    "  user = 'u'", "  password = 'p'"])
+
+        dbdir = os.path.join(root, nickname)
+        for sub in ["baseline_schema", "migrations", "code", "reference_data"]:
+            os.makedirs(os.path.join(dbdir, sub))
+
+        write_script(os.path.join(dbdir, "baseline_schema", "baseline.sql"), args.statements, args.script_size)
+        for m in range(args.migrations):
+            name = "2013{0:08d}_migration.sql".format(m)
+            write_script(os.path.join(dbdir, "migrations", name), args.statements, args.script_size)
+        for c in range(args.code):
+            name = "{0:04d}_view.sql".format(c)
+            write_script(os.path.join(dbdir, "code", name), args.statements, args.script_size)
+        for r in range(args.data):
+            name = "{0:04d}_data.sql".format(r)
+            write_script(os.path.join(dbdir, "reference_data", name), args.statements, args.script_size)
+        for r in range(args.csv):
+            write_csv(os.path.join(dbdir, "reference_data", "table_{0:04d}.csv".format(r)), args.csv_rows)
+
+    ini_path = os.path.join(root, "benchmark.ini")
+    with open(ini_path, "w") as f:
+        f.write("\n".join(ini) + "\n")
+    return ini_path
+
+
+def rss_kb():
+    """Resident set size of this process in kB: current on Linux, elsewhere
+the peak so far (which only shows a phase's growth beyond earlier
+phases' peaks)."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1024
+    except IOError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 if sys.platform == "darwin" else peak
+
+
+class RssSampler(threading.Thread):
+    """Samples rss_kb until stopped, keeping the highest value seen, so
+that a phase's peak is measured even if its memory is freed before it
+ends."""
+
+    def __init__(self, interval = 0.01):
+        super(RssSampler, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.peak = rss_kb()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, rss_kb())
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, rss_kb())
+        return self.peak
+
+
+class PhaseTimer(object):
+    """Collects per-phase results."""
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.phases = []
+
+    def run(self, name, func):
+        self.handler.reset_counts()
+        before = rss_kb()
+        sampler = RssSampler()
+        sampler.start()
+        start = time.time()
+        try:
+            scripts = func()
+        finally:
+            peak = sampler.stop()
+        elapsed = time.time() - start
+        result = {
+            "name": name,
+            "seconds": round(elapsed, 4),
+            "rss_kb": rss_kb(),
+            "peak_rss_growth_kb": peak - before,
+            "scripts": scripts,
+            "calls": dict(self.handler.calls),
+            "bytes_executed": self.handler.bytes_executed
+        }
+        self.phases.append(result)
+        result["rss_growth_kb"] = result["rss_kb"] - before
+        print "{0:<24} {1:>10.3f}s {2:>8} scripts {3:>10} calls {4:>+10} kB peak {5:>+10} kB kept".format(
+            name, elapsed, scripts, sum(result["calls"].values()), result["peak_rss_growth_kb"], result["rss_growth_kb"])
+        return result
+
+
+def run_benchmark(args):
+    root = tempfile.mkdtemp(prefix = "dbmigrator_bench_")
+    try:
+        handler = LatencyDatabaseHandler(args.latency / 1000.0)
+        timer = PhaseTimer(handler)
+
+        ini_path = generate_tree(root, args)
+        source = DefaultDatabaseSource(ini_path, root)
+        m = Migrator(source, handler)
+        logging.getLogger('dbmigrator').setLevel(logging.WARNING)
+        m.max_workers = args.jobs
+        observers = []
+        if args.observe:
+            observers = [PrometheusTextfileObserver(os.path.join(root, "dbmigrator.prom")),
+                         JsonLinesObserver(os.path.join(root, "events.jsonl"))]
+            for o in observers:
+                m.add_observer(o)
+        nicknames = sorted(source.get_connection_hashes().keys())
+
+        def list_files():
+            n = 0
+            for db in nicknames:
+                for get in [source.get_baseline_schema_files, source.get_migrations_files,
+                            source.get_code_files, source.get_reference_data_files]:
+                    n += len(get(db))
+            return n
+
+        def phase(func, count):
+            def f():
+                func(*nicknames)
+                return count
+            return f
+
+        # Code and data run with skip_unchanged, so that the second run
+        # measures checksumming and skipping.
+        def run_skipping(func, count):
+            def f():
+                m.skip_unchanged = True
+                try:
+                    func(*nicknames)
+                finally:
+                    m.skip_unchanged = False
+                return count
+            return f
+
+        dbs = len(nicknames)
+        timer.run("list_files", list_files)
+        timer.run("delete_make_new", phase(m.delete_make_new, 0))
+        timer.run("baseline_schema", phase(m.run_baseline_schema, dbs))
+        timer.run("migrations_pending", phase(m.run_migrations, dbs * args.migrations))
+        timer.run("migrations_applied", phase(m.run_migrations, dbs * args.migrations))
+        all_phases = ["baseline_schema", "migrations", "code", "reference_data"]
+        timer.run("plan", lambda: sum([len(p.scripts) + p.skipped for d in m.plan(all_phases, *nicknames).databases for p in d.phases]))
+        timer.run("code", run_skipping(m.run_code_definitions, dbs * args.code))
+        timer.run("code_unchanged", run_skipping(m.run_code_definitions, dbs * args.code))
+        timer.run("reference_data", run_skipping(m.run_reference_data, dbs * (args.data + args.csv)))
+        timer.run("reference_data_unchanged", run_skipping(m.run_reference_data, dbs * (args.data + args.csv)))
+        m.close()
+        for o in observers:
+            o.close()
+
+        return {
+            "parameters": dict([(k, v) for k, v in vars(args).items() if not (k in ("output", "compare", "threshold", "memory_threshold", "keep_tree"))]),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "phases": timer.phases
+        }
+    finally:
+        if args.keep_tree:
+            print "Tree kept at " + root
+        else:
+            shutil.rmtree(root)
+
+
+def compare(baseline, current, threshold, memory_threshold = 0.2):
+    """Prints phase-by-phase comparison, returns list of regression
+messages.  Memory is only compared with baselines that measured each
+phase's peak growth."""
+    regressions = []
+    if baseline["parameters"] != current["parameters"]:
+        print "WARNING: benchmark parameters differ from the baseline's."
+
+    base_phases = dict([(p["name"], p) for p in baseline["phases"]])
+    print ""
+    print "{0:<24} {1:>10} {2:>10} {3:>8} {4:>10} {5:>10} {6:>10} {7:>10}".format(
+        "phase", "base s", "now s", "ratio", "base calls", "now calls", "base kB", "now kB")
+    for p in current["phases"]:
+        b = base_phases.get(p["name"])
+        if b is None:
+            print "{0:<24} (not in baseline)".format(p["name"])
+            continue
+        ratio = p["seconds"] / b["seconds"] if b["seconds"] > 0 else 1.0
+        base_calls = sum(b["calls"].values())
+        now_calls = sum(p["calls"].values())
+        base_kb = b.get("peak_rss_growth_kb")
+        now_kb = p["peak_rss_growth_kb"]
+        print "{0:<24} {1:>10.3f} {2:>10.3f} {3:>8.2f} {4:>10} {5:>10} {6:>10} {7:>10}".format(
+            p["name"], b["seconds"], p["seconds"], ratio, base_calls, now_calls, "-" if base_kb is None else base_kb, now_kb)
+
+        # Ignore noise on very short phases.
+        if ratio > 1 + threshold and p["seconds"] - b["seconds"] > 0.05:
+            regressions.append("{0}: {1:.3f}s -> {2:.3f}s".format(p["name"], b["seconds"], p["seconds"]))
+        for method, count in sorted(p["calls"].items()):
+            if count > b["calls"].get(method, 0):
+                regressions.append("{0}: {1} calls {2} -> {3}".format(p["name"], method, b["calls"].get(method, 0), count))
+
+        # Ignore growth of under 1 MB, which allocator noise can account for.
+        if base_kb is not None and now_kb > max(0, base_kb) * (1 + memory_threshold) and now_kb - base_kb > 1024:
+            regressions.append("{0}: peak memory growth {1} kB -> {2} kB".format(p["name"], base_kb, now_kb))
+    return regressions
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description = "Synthetic scaling benchmark for the Migrator pipeline.")
+    parser.add_argument("--databases", type = int, default = 10, help = "number of databases")
+    parser.add_argument("--migrations", type = int, default = 200, help = "migrations per database")
+    parser.add_argument("--code", type = int, default = 50, help = "code scripts per database")
+    parser.add_argument("--data", type = int, default = 20, help = "reference data .sql scripts per database")
+    parser.add_argument("--csv", type = int, default = 2, help = "reference data .csv files per database")
+    parser.add_argument("--csv-rows", type = int, default = 1000, help = "rows per .csv file")
+    parser.add_argument("--script-size", type = int, default = 2048, help = "approximate bytes per script")
+    parser.add_argument("--statements", type = int, default = 4, help = "statements per script")
+    parser.add_argument("--latency", type = float, default = 0.0, help = "simulated ms per handler call")
+    parser.add_argument("-j", "--jobs", type = int, default = 1, help = "number of databases to migrate concurrently")
+    parser.add_argument("--observe", action = "store_true", help = "register the built-in metrics and JSON lines observers")
+    parser.add_argument("--output", help = "write results to this JSON file")
+    parser.add_argument("--compare", help = "compare results with this JSON file; exit 1 on regression")
+    parser.add_argument("--threshold", type = float, default = 0.2, help = "allowed fractional slowdown per phase (default 0.2)")
+    parser.add_argument("--memory-threshold", type = float, default = 0.2, help = "allowed fractional growth in peak memory per phase (default 0.2)")
+    parser.add_argument("--keep-tree", action = "store_true", help = "don't delete the generated source tree")
+    return parser
+
+
+def main(argv = None):
+    args = build_parser().parse_args(argv)
+    results = run_benchmark(args)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent = 2, sort_keys = True)
+        print "Results written to " + args.output
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results, args.threshold, args.memory_threshold)
+        if len(regressions) > 0:
+            print ""
+            print "REGRESSIONS:"
+            for r in regressions:
+                print "  " + r
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
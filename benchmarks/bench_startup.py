@@ -0,0 +1,139 @@
+"""Cold-start benchmark for the command line driver.
+
+Runs a driver command (by default, the postgres example with --help)
+in a fresh python process a number of times, and reports its wall time
+less that of an empty python process: the cost of the driver's own
+imports and setup, paid on every call when the migrator is run per
+tenant or per check in a deploy pipeline.
+
+The modules the command imports are also checked: database drivers
+and other slow imports (see LAZY_MODULES) should only be loaded when
+a run needs them, not for --help.  Exits 1 if the startup time is over
+--budget, or if any of them is loaded.
+
+Run from the repository root:
+
+  python -m benchmarks.bench_startup --runs 20 --budget 150
+  python -m benchmarks.bench_startup -- examples/mysql/mysql.py --help
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+"""Modules that shouldn't be imported just to start the driver."""
+LAZY_MODULES = ["psycopg2", "MySQLdb", "configobj", "multiprocessing", "pkg_resources"]
+
+DEFAULT_COMMAND = [os.path.join("examples", "postgres", "postgres.py"), "--help"]
+
+# Runs the script in argv[1] as __main__ with the remaining args, then
+# writes the names of the imported modules to the file named by
+# DBMIGRATOR_MODULES_FILE.
+PROBE = """
+import json, os, runpy, sys
+sys.argv = sys.argv[1:]
+sys.path.insert(0, os.path.dirname(os.path.abspath(sys.argv[0])))
+try:
+    runpy.run_path(sys.argv[0], run_name = "__main__")
+except SystemExit:
+    pass
+with open(os.environ["DBMIGRATOR_MODULES_FILE"], "w") as f:
+    json.dump(sorted(m for m in sys.modules if sys.modules[m] is not None), f)
+"""
+
+
+def time_runs(command, runs):
+    """Wall times, in ms, of running the command runs times."""
+    times = []
+    with open(os.devnull, "w") as devnull:
+        for n in range(runs):
+            start = time.time()
+            subprocess.call(command, stdout = devnull, stderr = devnull)
+            times.append((time.time() - start) * 1000)
+    return sorted(times)
+
+
+def median(values):
+    return values[len(values) / 2]
+
+
+def get_imported_modules(command):
+    """Names of the modules imported by running the (python script) command."""
+    fd, path = tempfile.mkstemp(suffix = ".json")
+    os.close(fd)
+    try:
+        env = dict(os.environ)
+        env["DBMIGRATOR_MODULES_FILE"] = path
+        with open(os.devnull, "w") as devnull:
+            subprocess.call([sys.executable, "-c", PROBE] + command, stdout = devnull, stderr = devnull, env = env)
+        with open(path, "r") as f:
+            content = f.read()
+        return json.loads(content) if content != "" else None
+    finally:
+        os.remove(path)
+
+
+def run_benchmark(args):
+    command = args.command or DEFAULT_COMMAND
+    python = time_runs([sys.executable, "-c", "pass"], args.runs)
+    driver = time_runs([sys.executable] + command, args.runs)
+    modules = get_imported_modules(command)
+    return {
+        "command": command,
+        "runs": args.runs,
+        "python_ms": median(python),
+        "min_ms": driver[0],
+        "median_ms": median(driver),
+        "max_ms": driver[-1],
+        "startup_ms": max(0.0, median(driver) - median(python)),
+        "modules": len(modules) if modules is not None else None,
+        "lazy_modules_loaded": [m for m in LAZY_MODULES if modules is not None and m in modules]
+    }
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description = "Cold-start benchmark for the command line driver.")
+    parser.add_argument("--runs", type = int, default = 10, help = "number of timed runs (default 10)")
+    parser.add_argument("--budget", type = float, default = 150.0, help = "allowed startup ms over an empty python process (default 150)")
+    parser.add_argument("--output", help = "write results to this JSON file")
+    parser.add_argument("command", nargs = "*", help = "driver script and args (default: {0})".format(" ".join(DEFAULT_COMMAND)))
+    return parser
+
+
+def main(argv = None):
+    args = build_parser().parse_args(argv)
+    results = run_benchmark(args)
+
+    print "{0}: median {1:.1f} ms (min {2:.1f}, max {3:.1f}) over {4} runs".format(
+        " ".join(results["command"]), results["median_ms"], results["min_ms"], results["max_ms"], results["runs"])
+    print "python -c pass: median {0:.1f} ms".format(results["python_ms"])
+    print "startup: {0:.1f} ms (budget {1:.0f}), {2} modules imported".format(results["startup_ms"], args.budget, results["modules"])
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent = 2, sort_keys = True)
+        print "Results written to " + args.output
+
+    problems = []
+    if results["modules"] is None:
+        problems.append("the command failed to run")
+    if results["startup_ms"] > args.budget:
+        problems.append("startup {0:.1f} ms is over the {1:.0f} ms budget".format(results["startup_ms"], args.budget))
+    for m in results["lazy_modules_loaded"]:
+        problems.append("{0} is imported at startup".format(m))
+    if len(problems) > 0:
+        print ""
+        print "REGRESSIONS:"
+        for p in problems:
+            print "  " + p
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+import time
+from collections import defaultdict
+
+import dbMigrator
+from dbMigrator.migrator import DatabaseHandler, ScriptContent
+
+
+class LatencyDatabaseHandler(DatabaseHandler):
+    """In-memory DatabaseHandler that sleeps for a fixed latency on every
+call (simulating a network round trip), and counts calls per method.
+
+Tracking and checksum tables are kept in memory, keyed by dbname."""
+
+    def __init__(self, latency = 0.0):
+        """latency: seconds to sleep per call."""
+        super(LatencyDatabaseHandler, self).__init__()
+        self.latency = latency
+        self.calls = defaultdict(int)
+        self.bytes_executed = 0
+        self.tracked = defaultdict(set)
+        self.checksums = defaultdict(dict)
+
+    def __call(self, name):
+        self.calls[name] += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def reset_counts(self):
+        self.calls = defaultdict(int)
+        self.bytes_executed = 0
+
+    def delete_make_new(self, system_connection_hash, database_name):
+        self.__call("delete_make_new")
+        self.tracked.pop(database_name, None)
+        self.checksums.pop(database_name, None)
+
+    def create_tracking_table(self, connection_hash):
+        self.__call("create_tracking_table")
+
+    def user_defined_tables_exist(self, connection_hash):
+        self.__call("user_defined_tables_exist")
+        return len(self.tracked[connection_hash["dbname"]]) > 0
+
+    def is_in_tracking_table(self, connection_hash, script_name):
+        self.__call("is_in_tracking_table")
+        return script_name in self.tracked[connection_hash["dbname"]]
+
+    def tracking_table_exists(self, connection_hash):
+        self.__call("tracking_table_exists")
+        return connection_hash["dbname"] in self.tracked
+
+    def get_applied_scripts(self, connection_hash):
+        self.__call("get_applied_scripts")
+        return set(self.tracked[connection_hash["dbname"]])
+
+    def record_script_in_tracking_table(self, conn_hash, script_name, duration_ms = None, rows_affected = None):
+        self.__call("record_script_in_tracking_table")
+        self.tracked[conn_hash["dbname"]].add(script_name)
+
+    def create_checksum_table(self, connection_hash):
+        self.__call("create_checksum_table")
+
+    def get_script_checksums(self, connection_hash, script_type):
+        self.__call("get_script_checksums")
+        c = self.checksums[connection_hash["dbname"]]
+        return dict([(k[1], v) for k, v in c.items() if k[0] == script_type])
+
+    def record_script_checksum(self, connection_hash, script_type, script_name, checksum):
+        self.__call("record_script_checksum")
+        self.checksums[connection_hash["dbname"]][(script_type, script_name)] = checksum
+
+    def bulk_load(self, conn_hash, data):
+        self.__call("bulk_load")
+        stream = data.open()
+        try:
+            rows = -1
+            for line in stream:
+                self.bytes_executed += len(line)
+                rows += 1
+            return max(rows, 0)
+        finally:
+            stream.close()
+
+    def execute(self, conn_hash, sql):
+        self.__call("execute")
+        self.bytes_executed += len(sql)
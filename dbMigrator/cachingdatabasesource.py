@@ -0,0 +1,223 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from migrator import DatabaseSource, ScriptContent
+
+logger = logging.getLogger('dbmigrator')
+
+
+class IndexedScriptContent(ScriptContent):
+    """Script content read from a file, whose checksum is served from a
+CachingDatabaseSource's index while the file is unchanged.  Other
+attributes (eg, a BulkLoadContent's table) are those of the wrapped
+content."""
+
+    def __init__(self, content, index):
+        self.content = content
+        self.index = index
+
+    @property
+    def is_sql(self):
+        return self.content.is_sql
+
+    def read(self):
+        return self.content.read()
+
+    def size(self):
+        return self.index.get_size(self.content.path)
+
+    def open(self):
+        return self.content.open()
+
+    def checksum(self):
+        # Only the file's content checksum is indexed.
+        return self.content.combine_checksum(self.index.get_checksum(self.content.path, self.content.content_checksum))
+
+    def execute_on(self, database_handler, conn_hash):
+        return self.content.execute_on(database_handler, conn_hash)
+
+    def __getattr__(self, name):
+        if name == "content":
+            raise AttributeError(name)
+        return getattr(self.content, name)
+
+    def __repr__(self):
+        return "IndexedScriptContent({0!r})".format(self.content)
+
+
+class SourceIndex(object):
+    """On-disk index of file path => (size, mtime, checksum).  An entry is
+used for as long as a stat of the file gives the same size and mtime,
+so unchanged files are never read to be checksummed again.  Each file
+is stat'ed at most once until clear_stats is called."""
+
+    VERSION = 1
+
+    """Files modified this recently (in seconds) aren't indexed: a further
+change within the filesystem's mtime resolution wouldn't be noticed."""
+    RACY_SECONDS = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.stats = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            if data.get("version") == SourceIndex.VERSION:
+                self.entries = dict([(str(k), (v[0], v[1], str(v[2]))) for k, v in data["files"].items()])
+        except Exception as e:
+            logger.warning("Ignoring unreadable source index %s: %s" % (self.path, e))
+
+    def __stat(self, path):
+        with self.lock:
+            st = self.stats.get(path)
+        if st is None:
+            st = os.stat(path)
+            with self.lock:
+                self.stats[path] = st
+        return st
+
+    def get_size(self, path):
+        return self.__stat(path).st_size
+
+    def get_checksum(self, path, compute_checksum):
+        """Returns the file's indexed checksum if it's unchanged, otherwise
+compute_checksum(), which is then indexed."""
+        st = self.__stat(path)
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime:
+            return entry[2]
+
+        checksum = compute_checksum()
+        with self.lock:
+            if time.time() - st.st_mtime > SourceIndex.RACY_SECONDS:
+                self.entries[path] = (st.st_size, st.st_mtime, checksum)
+            else:
+                self.entries.pop(path, None)
+            self.dirty = True
+        return checksum
+
+    def clear_stats(self):
+        """Forgets file stats, so files are stat'ed again on next use."""
+        with self.lock:
+            self.stats = {}
+
+    def save(self):
+        """Writes the index (atomically, via a temporary file) if it changed."""
+        with self.lock:
+            if not self.dirty:
+                return
+            data = { "version": SourceIndex.VERSION, "files": dict(self.entries) }
+            self.dirty = False
+        tmp = "{0}.{1}.tmp".format(self.path, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(data, f, sort_keys = True)
+        if os.name == "nt" and os.path.exists(self.path):
+            # os.rename doesn't replace existing files on Windows.
+            os.remove(self.path)
+        os.rename(tmp, self.path)
+
+
+class CachingDatabaseSource(DatabaseSource):
+    """Wraps a DatabaseSource, so that its file lists are only fetched
+(eg, globbed from disk) once per run, rather than by every Migrator
+phase, and the checksums of its script files are kept in a SourceIndex
+file across runs.
+
+Script content with a path attribute (eg, SqlScriptFile and
+DelimitedDataFile) is served as IndexedScriptContent; other content is
+returned as-is.  The run ends, and the index is saved, when
+Migrator.close calls close."""
+
+    def __init__(self, database_source, index_path):
+        """database_source: the DatabaseSource to wrap.
+index_path: the index file (created if missing)."""
+        self.database_source = database_source
+        self.index = SourceIndex(index_path)
+        self.lock = threading.Lock()
+        # (method name, database name) => result, for this run.
+        self.cache = {}
+
+    def __get_cached(self, method_name, database_name, wrap = True):
+        key = (method_name, database_name)
+        with self.lock:
+            result = self.cache.get(key)
+        if result is None:
+            result = getattr(self.database_source, method_name)(database_name)
+            if wrap:
+                result = [(name, self.__wrap(content)) for name, content in result]
+            with self.lock:
+                self.cache[key] = result
+        return list(result)
+
+    def __wrap(self, content):
+        if isinstance(content, ScriptContent) and isinstance(getattr(content, "path", None), basestring):
+            return IndexedScriptContent(content, self.index)
+        return content
+
+    def get_db_name_from_nickname(self, nickname):
+        return self.database_source.get_db_name_from_nickname(nickname)
+
+    def get_system_connection_hash(self):
+        return self.database_source.get_system_connection_hash()
+
+    def get_connection_hashes(self):
+        return self.database_source.get_connection_hashes()
+
+    def get_baseline_schema_files(self, database_name):
+        return self.__get_cached("get_baseline_schema_files", database_name)
+
+    def get_reference_data_files(self, database_name):
+        return self.__get_cached("get_reference_data_files", database_name)
+
+    def get_code_files(self, database_name):
+        return self.__get_cached("get_code_files", database_name)
+
+    def get_migrations_files(self, database_name):
+        return self.__get_cached("get_migrations_files", database_name)
+
+    def get_squashed_migrations(self, database_name):
+        return self.__get_cached("get_squashed_migrations", database_name, False)
+
+    def write_squashed_baseline(self, database_name, schema_sql, migration_names):
+        self.database_source.write_squashed_baseline(database_name, schema_sql, migration_names)
+        self.clear()
+
+    def index_checksums(self, database_name):
+        """Checksums the database's script files into the index.  Called
+before forking worker processes (see TenantMigrator), which inherit the
+index and file lists, but whose own changes to the index are lost."""
+        for method_name in ["get_baseline_schema_files", "get_migrations_files", "get_code_files", "get_reference_data_files"]:
+            for name, content in self.__get_cached(method_name, database_name):
+                if isinstance(content, IndexedScriptContent):
+                    content.checksum()
+
+    def clear(self):
+        """Forgets the file lists and stats of this run."""
+        with self.lock:
+            self.cache = {}
+        self.index.clear_stats()
+
+    def close(self):
+        """Saves the index, and ends the run (see clear)."""
+        self.index.save()
+        self.clear()
+        self.database_source.close()
+
+    def __getattr__(self, name):
+        # Anything else (eg, DefaultDatabaseSource.config) is the wrapped source's.
+        if name == "database_source":
+            raise AttributeError(name)
+        return getattr(self.database_source, name)
@@ -0,0 +1,236 @@
+import logging
+import re
+import time
+from abc import abstractmethod
+
+from migrator import ScriptContent
+
+logger = logging.getLogger('dbmigrator')
+
+
+class ChunkedMigrationException(Exception):
+    pass
+
+
+def sql_literal(value):
+    """The checkpoint value (a string, integer or None) as a sql literal."""
+    if value is None:
+        return "NULL"
+    if isinstance(value, (int, long)):
+        return str(value)
+    return "'{0}'".format(value.replace("'", "''"))
+
+
+class ChunkedMigration(ScriptContent):
+    """A data migration (eg, a backfill of a new column) run over a table
+in chunks of its integer key column, start <= key < end, chunk_size
+keys at a time, sleeping sleep seconds between chunks to
+throttle the load on the server.  Subclasses implement run_chunk.
+
+Each chunk runs on its own, and progress is saved after each in the
+__chunked_migrations table, so a migration that's interrupted resumes
+from the last finished chunk when run again (the chunk that was
+running is run again, so chunks must be safe to re-run).  If the
+script has changed since, it starts over.  Rows added beyond the
+table's last key while the migration runs are migrated before it
+finishes.  Migrations are recorded as applied by the ScriptRunner only
+once all chunks are done.
+
+Settings (see SETTINGS) are set as attributes by subclasses; table is
+required."""
+
+    is_sql = False
+
+    CHECKPOINT_TABLE = "__chunked_migrations"
+
+    """Settings, and their types."""
+    SETTINGS = { "table": str, "key": str, "chunk_size": int, "sleep": float, "progress_interval": float }
+
+    IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)?$")
+
+    def __init__(self, name):
+        """name: the script name, which identifies its saved progress."""
+        self.name = name
+        self.table = None
+        # Integer key column chunks are ranges of.
+        self.key = "id"
+        # Keys per chunk.
+        self.chunk_size = 10000
+        # Seconds to sleep between chunks.
+        self.sleep = 0
+        # Seconds between progress log messages.
+        self.progress_interval = 30
+
+    @abstractmethod
+    def run_chunk(self, database_handler, conn_hash, start, end):
+        """Migrates the rows with start <= key < end.  Returns the number of
+rows affected (or None, if not known)."""
+        pass
+
+    def load(self):
+        """Called before the migration is run, for subclasses that only
+read their settings when needed."""
+        pass
+
+    def check_settings(self):
+        if self.table is None:
+            raise ChunkedMigrationException("No table given for chunked migration " + self.name)
+        for name in [self.table, self.key]:
+            if not ChunkedMigration.IDENTIFIER.match(name):
+                raise ChunkedMigrationException("Bad identifier {0!r} for chunked migration {1}".format(name, self.name))
+        if self.chunk_size < 1:
+            raise ChunkedMigrationException("chunk_size must be at least 1")
+
+    def __create_checkpoint_table(self, database_handler, conn_hash):
+        sql = """create table if not exists {0}
+(
+  script_name varchar(255) not null primary key,
+  checksum varchar(64) not null,
+  next_key bigint,
+  end_key bigint,
+  rows_affected bigint not null
+)""".format(ChunkedMigration.CHECKPOINT_TABLE)
+        database_handler.execute(conn_hash, sql)
+
+    def get_checkpoint(self, database_handler, conn_hash):
+        """Returns (checksum, next key, end key, rows affected) of the saved
+progress, or None."""
+        sql = "select checksum, next_key, end_key, rows_affected from {0} where script_name = {1}".format(
+            ChunkedMigration.CHECKPOINT_TABLE, sql_literal(self.name))
+        rows = database_handler.query(conn_hash, sql)
+        if len(rows) == 0:
+            return None
+        checksum, next_key, end_key, rows_affected = rows[0]
+        return (checksum, self.__int(next_key), self.__int(end_key), int(rows_affected))
+
+    def __save_checkpoint(self, database_handler, conn_hash, next_key, end_key, rows_affected):
+        sql = "update {0} set next_key = {1}, end_key = {2}, rows_affected = {3} where script_name = {4}".format(
+            ChunkedMigration.CHECKPOINT_TABLE, sql_literal(next_key), sql_literal(end_key), rows_affected, sql_literal(self.name))
+        database_handler.execute(conn_hash, sql)
+
+    def __start(self, database_handler, conn_hash, checksum, next_key, end_key):
+        t, name = ChunkedMigration.CHECKPOINT_TABLE, sql_literal(self.name)
+        database_handler.execute(conn_hash, "delete from {0} where script_name = {1}".format(t, name))
+        sql = "insert into {0} (script_name, checksum, next_key, end_key, rows_affected) values ({1}, {2}, {3}, {4}, 0)".format(
+            t, name, sql_literal(checksum), sql_literal(next_key), sql_literal(end_key))
+        database_handler.execute(conn_hash, sql)
+
+    def __int(self, value):
+        if value is None:
+            return None
+        if isinstance(value, float) and value != int(value):
+            raise ChunkedMigrationException("Key {0} of {1} isn't an integer".format(self.key, self.table))
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise ChunkedMigrationException("Key {0} of {1} isn't an integer: {2!r}".format(self.key, self.table, value))
+
+    def get_key_range(self, database_handler, conn_hash):
+        """Returns the table's (min key, max key), (None, None) if it's empty."""
+        sql = "select min({0}), max({0}) from {1}".format(self.key, self.table)
+        lowest, highest = database_handler.query(conn_hash, sql)[0]
+        return (self.__int(lowest), self.__int(highest))
+
+    def __log_progress(self, next_key, end_key, rows_affected):
+        msg = "Chunked migration {0}: {1} rows affected".format(self.name, rows_affected)
+        if next_key is not None and end_key is not None:
+            msg += ", up to key {0} of {1}".format(min(next_key - 1, end_key), end_key)
+        logger.info(msg)
+
+    def execute_on(self, database_handler, conn_hash):
+        """Runs (or resumes) the migration.  Returns the total rows affected."""
+        self.load()
+        self.check_settings()
+        self.__create_checkpoint_table(database_handler, conn_hash)
+        checksum = self.checksum()
+        checkpoint = self.get_checkpoint(database_handler, conn_hash)
+        if checkpoint is not None and checkpoint[0] != checksum:
+            logger.warning("Restarting chunked migration %s, it has changed since it was interrupted" % self.name)
+            checkpoint = None
+
+        if checkpoint is None:
+            next_key, end_key = self.get_key_range(database_handler, conn_hash)
+            rows_affected = 0
+            logger.info("Starting chunked migration %s of %s" % (self.name, self.table))
+            self.__start(database_handler, conn_hash, checksum, next_key, end_key)
+        else:
+            next_key, end_key, rows_affected = checkpoint[1:]
+            logger.info("Resuming chunked migration %s from key %s" % (self.name, next_key))
+
+        last_logged = time.time()
+        while True:
+            while next_key is not None and next_key <= end_key:
+                end = next_key + self.chunk_size
+                rows_affected += self.run_chunk(database_handler, conn_hash, next_key, end) or 0
+                next_key = end
+                self.__save_checkpoint(database_handler, conn_hash, next_key, end_key, rows_affected)
+                if time.time() - last_logged >= self.progress_interval:
+                    self.__log_progress(next_key, end_key, rows_affected)
+                    last_logged = time.time()
+                if self.sleep > 0 and next_key <= end_key:
+                    time.sleep(self.sleep)
+
+            # Rows may have been added beyond the end since the start.
+            lowest, highest = self.get_key_range(database_handler, conn_hash)
+            if highest is None or (end_key is not None and highest <= end_key):
+                break
+            if next_key is None:
+                next_key = lowest
+            end_key = highest
+            self.__save_checkpoint(database_handler, conn_hash, next_key, end_key, rows_affected)
+
+        self.__log_progress(next_key, end_key, rows_affected)
+        return rows_affected
+
+
+class ChunkedSqlMigration(ChunkedMigration):
+    """A sql migration run in chunks, marked by a line starting with the
+comment "-- dbmigrator: chunked", followed by its settings.  The
+script is a template run once per chunk, with {start} and {end}
+replaced by the chunk's key range, eg:
+
+-- dbmigrator: chunked table=widget key=id chunk_size=5000 sleep=0.5
+update widget set weight = 0 where weight is null and id >= {start} and id < {end};
+
+Run by the ScriptRunner for tracked scripts (ie, migrations) only."""
+
+    MARKER_PATTERN = re.compile(r"^\s*--\s*dbmigrator:\s*chunked\b(.*)$", re.IGNORECASE | re.MULTILINE)
+
+    @staticmethod
+    def is_chunked(sql):
+        return ChunkedSqlMigration.MARKER_PATTERN.search(sql) is not None
+
+    def __init__(self, name, sql):
+        super(ChunkedSqlMigration, self).__init__(name)
+        self.sql = sql
+        self.__apply_settings(ChunkedSqlMigration.MARKER_PATTERN.search(sql).group(1))
+        if not ("{start}" in sql and "{end}" in sql):
+            raise ChunkedMigrationException("Chunked migration {0} must use {{start}} and {{end}}".format(name))
+
+    def __apply_settings(self, text):
+        for setting in text.split():
+            name, _, value = setting.partition("=")
+            if not (name in ChunkedMigration.SETTINGS) or value == "":
+                raise ChunkedMigrationException("Bad chunked migration setting {0} in {1} (settings are {2})".format(
+                    setting, self.name, ", ".join(["{0}=...".format(s) for s in sorted(ChunkedMigration.SETTINGS)])))
+            try:
+                setattr(self, name, ChunkedMigration.SETTINGS[name](value))
+            except ValueError:
+                raise ChunkedMigrationException("Bad chunked migration setting {0} in {1}".format(setting, self.name))
+
+    def get_chunk_sql(self, start, end):
+        """The template for the chunk, less the marker line."""
+        sql = ChunkedSqlMigration.MARKER_PATTERN.sub("", self.sql, 1).lstrip()
+        return sql.replace("{start}", str(start)).replace("{end}", str(end))
+
+    def run_chunk(self, database_handler, conn_hash, start, end):
+        return database_handler.execute(conn_hash, self.get_chunk_sql(start, end))
+
+    def read(self):
+        return self.sql
+
+    def size(self):
+        return len(self.sql)
+
+    def __repr__(self):
+        return "ChunkedSqlMigration({0!r})".format(self.name)
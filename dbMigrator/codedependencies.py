@@ -0,0 +1,224 @@
+import logging
+import re
+import sys
+import threading
+
+logger = logging.getLogger('dbmigrator')
+
+
+class CodeDependencyException(Exception):
+    """Raised when code scripts can't be ordered (circular dependencies)."""
+    pass
+
+
+class CodeDependencyGraph(object):
+    """Dependencies between code scripts (views, functions, stored procs,
+triggers, etc), so that they can be run in an order where each object
+is created after the objects it uses, rather than in filename order.
+
+A script depends on another if it mentions (outside comments) the name
+of an object the other script creates, eg a view selecting from a view
+created by another script.  Names are matched without schema or
+quoting, so an unrelated column or variable with the same name as an
+object adds a needless dependency; that only limits how many scripts
+can run at once.  Dependencies that can't be parsed (eg, on objects
+only mentioned in strings of dynamic sql) can be declared with a
+header comment naming scripts or objects:
+
+-- depends: 10_base_views.sql, calc_totals
+
+Scripts with no dependencies between them keep their filename order."""
+
+    """Objects created by a code script: (kind, name)."""
+    DEFINITION_PATTERN = re.compile(
+        r"\bcreate\s+(?:or\s+replace\s+)?"
+        r"(?:(?:definer\s*=\s*\S+|algorithm\s*=\s*\w+|sql\s+security\s+\w+|temp|temporary|recursive|materialized|constraint)\s+)*"
+        r"(view|function|procedure|trigger|type|aggregate|sequence|event)\s+"
+        r"(?:if\s+not\s+exists\s+)?"
+        r"([\w$\"`\[\].]+)",
+        re.IGNORECASE)
+
+    DEPENDS_PATTERN = re.compile(r"^\s*--\s*depends\s*:(.*)$", re.IGNORECASE | re.MULTILINE)
+
+    COMMENT_PATTERN = re.compile(r"/\*.*?\*/|--[^\n]*", re.DOTALL)
+
+    IDENTIFIER_PATTERN = re.compile(r"[A-Za-z_][\w$]*")
+
+    def __init__(self, scripts):
+        """scripts: list of (script_name, sql)."""
+        self.script_names = sorted([s[0] for s in scripts])
+
+        # script name => set of script names it depends on, and the reverse.
+        self.dependencies = dict([(n, set()) for n in self.script_names])
+        self.dependents = dict([(n, set()) for n in self.script_names])
+
+        # Unqualified, unquoted, lowercased object name => names of the
+        # scripts creating it.
+        self.definitions = {}
+        for script_name, sql in scripts:
+            for name in CodeDependencyGraph.get_defined_objects(sql):
+                self.definitions.setdefault(name, set()).add(script_name)
+
+        for script_name, sql in scripts:
+            for name in CodeDependencyGraph.get_referenced_names(sql):
+                for d in self.definitions.get(name, []):
+                    self.__add_dependency(script_name, d)
+            for name in CodeDependencyGraph.get_declared_dependencies(sql):
+                self.__add_declared_dependency(script_name, name)
+
+    @staticmethod
+    def normalize_name(name):
+        """Unqualified, unquoted, lowercase object name."""
+        for c in "\"`[]":
+            name = name.replace(c, "")
+        return name.split(".")[-1].lower()
+
+    @staticmethod
+    def get_defined_objects(sql):
+        """Normalized names of the objects created by the sql."""
+        text = CodeDependencyGraph.COMMENT_PATTERN.sub(" ", sql)
+        return set([CodeDependencyGraph.normalize_name(m.group(2)) for m in CodeDependencyGraph.DEFINITION_PATTERN.finditer(text)])
+
+    @staticmethod
+    def get_referenced_names(sql):
+        """Lowercased identifiers in the sql, outside comments."""
+        text = CodeDependencyGraph.COMMENT_PATTERN.sub(" ", sql)
+        return set([i.lower() for i in CodeDependencyGraph.IDENTIFIER_PATTERN.findall(text)])
+
+    @staticmethod
+    def get_declared_dependencies(sql):
+        """Script or object names given in "-- depends:" header comments."""
+        names = []
+        for m in CodeDependencyGraph.DEPENDS_PATTERN.finditer(sql):
+            names.extend([n for n in re.split(r"[\s,]+", m.group(1)) if n != ""])
+        return names
+
+    def __add_dependency(self, script_name, dependency):
+        if script_name == dependency:
+            return
+        self.dependencies[script_name].add(dependency)
+        self.dependents[dependency].add(script_name)
+
+    def __add_declared_dependency(self, script_name, name):
+        if name in self.dependencies:
+            self.__add_dependency(script_name, name)
+            return
+        scripts = self.definitions.get(CodeDependencyGraph.normalize_name(name))
+        if scripts is None:
+            logger.warning("{0} depends on {1}, which isn't a code script or created by one".format(script_name, name))
+            return
+        for d in scripts:
+            self.__add_dependency(script_name, d)
+
+    def get_dependencies(self, script_name):
+        """Sorted names of the scripts the script directly depends on."""
+        return sorted(self.dependencies[script_name])
+
+    def get_downstream(self, script_names):
+        """The scripts, and all scripts that depend on them (directly or
+indirectly): everything that must be rerun when they change."""
+        result = set()
+        pending = list(script_names)
+        while len(pending) > 0:
+            n = pending.pop()
+            if n in result:
+                continue
+            result.add(n)
+            pending.extend(self.dependents[n])
+        return result
+
+    def get_order(self, script_names = None):
+        """Returns the scripts (all, or just the given ones) in an order that
+satisfies their dependencies, taking scripts in filename order where
+there's a choice.  Raises CodeDependencyException if there are
+circular dependencies."""
+        names = self.__get_names(script_names)
+        waiting = self.__count_dependencies(names)
+        ready = sorted([n for n in names if waiting[n] == 0])
+        order = []
+        while len(ready) > 0:
+            n = ready.pop(0)
+            order.append(n)
+            ready.extend(self.__release_dependents(n, names, waiting))
+            ready.sort()
+        if len(order) < len(names):
+            cycle = sorted([n for n in names if waiting[n] > 0])
+            raise CodeDependencyException("Circular dependencies between code scripts: " + ", ".join(cycle))
+        return order
+
+    def run(self, run_script, workers = 1, script_names = None):
+        """Calls run_script(script_name, worker) for the scripts (all, or just
+the given ones), each once the scripts it depends on have finished.
+Scripts are run on up to workers threads, numbered 0 to workers - 1
+(a single worker runs scripts on the calling thread, in get_order
+order).
+
+After a script fails no new scripts are started; the first failure is
+raised once the running scripts finish (any others are logged)."""
+        names = self.__get_names(script_names)
+        if workers <= 1:
+            for n in self.get_order(names):
+                run_script(n, 0)
+            return
+
+        self.get_order(names)
+        waiting = self.__count_dependencies(names)
+        ready = sorted([n for n in names if waiting[n] == 0])
+        running = [0]
+        failures = []
+        cond = threading.Condition()
+
+        def work(worker):
+            while True:
+                with cond:
+                    while len(ready) == 0 and running[0] > 0 and len(failures) == 0:
+                        cond.wait()
+                    if len(ready) == 0 or len(failures) > 0:
+                        cond.notify_all()
+                        return
+                    n = ready.pop(0)
+                    running[0] += 1
+                exc_info = None
+                try:
+                    run_script(n, worker)
+                except Exception:
+                    exc_info = sys.exc_info()
+                with cond:
+                    running[0] -= 1
+                    if exc_info is not None:
+                        failures.append((n, exc_info))
+                    else:
+                        ready.extend(self.__release_dependents(n, names, waiting))
+                        ready.sort()
+                    cond.notify_all()
+
+        threads = [threading.Thread(target = work, args = (i,)) for i in range(min(workers, len(names)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        if len(failures) > 0:
+            for n, exc_info in failures[1:]:
+                logger.error("Failed on %s: %s" % (n, exc_info[1]))
+            exc_info = failures[0][1]
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def __get_names(self, script_names):
+        if script_names is None:
+            return set(self.script_names)
+        return set(script_names)
+
+    def __count_dependencies(self, names):
+        """Hash of script name => number of its dependencies among names."""
+        return dict([(n, len(self.dependencies[n] & names)) for n in names])
+
+    def __release_dependents(self, script_name, names, waiting):
+        """Marks the script done, returning the dependents now ready to run."""
+        released = []
+        for d in self.dependents[script_name]:
+            if d in names:
+                waiting[d] -= 1
+                if waiting[d] == 0:
+                    released.append(d)
+        return released
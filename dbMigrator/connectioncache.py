@@ -0,0 +1,109 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger('dbmigrator')
+
+class ConnectionCache(object):
+    """Keeps one open connection per connection hash, so that a
+DatabaseHandler can reuse connections across calls instead of opening
+(and authenticating) a new one for every statement.
+
+Connections are keyed by their connection hash components (host, port,
+dbname, user, password, and session: hashes differing only in session
+get separate connections to the same database, see
+DatabaseHandler.get_session_connection_hash).  A cached connection that has been idle for
+longer than health_check_interval seconds is checked with is_alive
+before it is handed out again, and is transparently reopened if it has
+gone stale."""
+
+    KEY_COMPONENTS = ("host", "port", "dbname", "user", "password", "session")
+
+    def __init__(self, open_connection, is_alive, health_check_interval = 30):
+        """open_connection: function(connection_hash), returns a new open connection.
+is_alive: function(connection), returns False if the connection is stale.
+health_check_interval: seconds a connection may sit idle before it is checked."""
+        self.open_connection = open_connection
+        self.is_alive = is_alive
+        self.health_check_interval = health_check_interval
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.key_locks = {}
+
+    @staticmethod
+    def get_key(connection_hash):
+        """Hashable key for a connection hash."""
+        return tuple([str(connection_hash.get(k, "")) for k in ConnectionCache.KEY_COMPONENTS])
+
+    def get(self, connection_hash):
+        """Returns a healthy open connection for the connection hash,
+opening a new one if none is cached or the cached one is stale.  The
+lookup, health check and insert hold the key's lock, so that threads
+asking for the same key at once don't each open (and leak) one."""
+        key = ConnectionCache.get_key(connection_hash)
+        with self.__get_key_lock(key):
+            with self.lock:
+                entry = self.connections.get(key)
+
+            conn = None
+            if entry is not None:
+                conn, last_used = entry
+                idle = time.time() - last_used
+                if idle > self.health_check_interval and not self.__check_alive(conn):
+                    logger.debug("Reconnecting stale connection to %s" % connection_hash.get("dbname"))
+                    self.__close_quietly(conn)
+                    conn = None
+
+            if conn is None:
+                conn = self.open_connection(connection_hash)
+
+            with self.lock:
+                self.connections[key] = (conn, time.time())
+            return conn
+
+    def __get_key_lock(self, key):
+        """Lock held while getting the key's connection.  Keys have separate
+locks so that opening a connection doesn't hold up other databases."""
+        with self.lock:
+            return self.key_locks.setdefault(key, threading.Lock())
+
+    def __check_alive(self, conn):
+        try:
+            return self.is_alive(conn)
+        except Exception:
+            return False
+
+    def __close_quietly(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def discard(self, connection_hash):
+        """Closes and forgets the cached connection for the connection hash, if any."""
+        key = ConnectionCache.get_key(connection_hash)
+        with self.lock:
+            entry = self.connections.pop(key, None)
+        if entry is not None:
+            self.__close_quietly(entry[0])
+
+    def discard_database(self, database_name):
+        """Closes and forgets all cached connections to the named database
+(eg, before the database is dropped)."""
+        dbname_index = ConnectionCache.KEY_COMPONENTS.index("dbname")
+        with self.lock:
+            keys = [k for k in self.connections.keys() if k[dbname_index] == str(database_name)]
+            entries = [self.connections.pop(k) for k in keys]
+        for conn, last_used in entries:
+            self.__close_quietly(conn)
+
+    def close_all(self):
+        """Closes all cached connections."""
+        with self.lock:
+            entries = self.connections.values()
+            self.connections = {}
+        for conn, last_used in entries:
+            self.__close_quietly(conn)
+
+    def __len__(self):
+        return len(self.connections)
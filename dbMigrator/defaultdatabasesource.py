@@ -1,11 +1,174 @@
+import hashlib
 import sys
 import os
-from configobj import ConfigObj
+import re
+import shutil
+import time
 from os import listdir
 from os.path import isfile, join
 import glob
 
-from migrator import DatabaseSource
+from migrator import DatabaseSource, ScriptContent, BulkLoadContent
+from chunkedmigration import ChunkedMigration, ChunkedMigrationException
+
+
+def read_config(path):
+    """Parses the .ini file.  configobj is imported on first use, so that
+callers that never need a config (eg, for --help) don't pay for it."""
+    from configobj import ConfigObj
+    return ConfigObj(path)
+
+
+class SqlScriptFile(ScriptContent):
+    """A .sql file on disk, read only when its content is needed."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        with open(self.path, "r") as f:
+            return f.read()
+
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def open(self):
+        return open(self.path, "r")
+
+    def __repr__(self):
+        return "SqlScriptFile({0!r})".format(self.path)
+
+
+class DelimitedDataFile(BulkLoadContent):
+    """A .csv or .tsv reference data file, bulk loaded into a table.
+
+The first line of the file must be a header of column names.  By
+default the file is loaded into the table with the same name as the
+file (less extension), replacing the table's contents.  An optional
+manifest with the same name and an .ini extension (eg, currency.ini
+for currency.csv) can override this:
+
+table = other_table_name
+mode = merge          # truncate, merge, or append
+key = code, region    # key columns, required for merge
+null = NULL           # string representing NULL values"""
+
+    IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)?$")
+
+    def __init__(self, path):
+        self.path = path
+        base, ext = os.path.splitext(path)
+        self.delimiter = "\t" if ext.lower() == ".tsv" else ","
+        self.table = os.path.basename(base)
+        self.mode = "truncate"
+        self.key_columns = []
+        self.null = ""
+
+        manifest = base + ".ini"
+        if os.path.exists(manifest):
+            m = read_config(manifest)
+            self.table = m.get("table", self.table)
+            self.mode = m.get("mode", self.mode)
+            key = m.get("key", [])
+            self.key_columns = [key] if isinstance(key, basestring) else list(key)
+            self.null = m.get("null", self.null)
+
+        if not (self.mode in BulkLoadContent.MODES):
+            raise Exception("Bad mode {0} for {1}".format(self.mode, path))
+        if self.mode == "merge" and len(self.key_columns) == 0:
+            raise Exception("Merge mode requires key columns for " + path)
+        for name in [self.table] + self.key_columns:
+            self.__check_identifier(name)
+        self.columns = None
+
+    def __check_identifier(self, name):
+        if not DelimitedDataFile.IDENTIFIER.match(name):
+            raise Exception("Bad identifier {0!r} for {1}".format(name, self.path))
+
+    def get_settings(self):
+        """The load settings, from the manifest or defaults."""
+        return "table={0} mode={1} key={2} null={3!r} delimiter={4!r}".format(
+            self.table, self.mode, ",".join(self.key_columns), self.null, self.delimiter)
+
+    def combine_checksum(self, content_checksum):
+        """Includes the settings, so that a manifest change is a change."""
+        return hashlib.sha1(content_checksum + "\n" + self.get_settings()).hexdigest()
+
+    def get_columns(self):
+        """Reads the header line (only) on first call."""
+        if self.columns is None:
+            with open(self.path, "r") as f:
+                header = f.readline()
+            self.columns = [c.strip().strip('"') for c in header.rstrip("\r\n").split(self.delimiter)]
+            for c in self.columns:
+                self.__check_identifier(c)
+        return self.columns
+
+    def read(self):
+        with open(self.path, "r") as f:
+            return f.read()
+
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def open(self):
+        return open(self.path, "r")
+
+    def __repr__(self):
+        return "DelimitedDataFile({0!r})".format(self.path)
+
+
+class PythonMigrationFile(ChunkedMigration):
+    """A .py migration, run in key-range chunks (see ChunkedMigration).
+The module sets the ChunkedMigration settings it needs as globals
+(table is required), and defines the function run for each chunk:
+
+table = "widget"
+chunk_size = 5000
+
+def migrate_chunk(database_handler, conn_hash, start, end):
+    # Migrate rows with start <= id < end, return rows affected.
+    return database_handler.execute(conn_hash, "update widget ...")
+
+The module is only run when the migration is."""
+
+    def __init__(self, path):
+        super(PythonMigrationFile, self).__init__(os.path.basename(path))
+        self.path = path
+        self.migrate_chunk = None
+
+    def load(self):
+        """Runs the module, and takes its settings and migrate_chunk."""
+        if self.migrate_chunk is not None:
+            return
+        module = { "__file__": self.path, "__name__": os.path.splitext(self.name)[0] }
+        exec compile(self.read(), self.path, "exec") in module
+        for name, setting_type in ChunkedMigration.SETTINGS.items():
+            if name in module:
+                try:
+                    setattr(self, name, setting_type(module[name]))
+                except (TypeError, ValueError):
+                    raise ChunkedMigrationException("Bad {0} {1!r} in {2}".format(name, module[name], self.path))
+        if not callable(module.get("migrate_chunk")):
+            raise ChunkedMigrationException("No migrate_chunk function in " + self.path)
+        self.migrate_chunk = module["migrate_chunk"]
+
+    def run_chunk(self, database_handler, conn_hash, start, end):
+        return self.migrate_chunk(database_handler, conn_hash, start, end)
+
+    def read(self):
+        with open(self.path, "r") as f:
+            return f.read()
+
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def open(self):
+        return open(self.path, "r")
+
+    def __repr__(self):
+        return "PythonMigrationFile({0!r})".format(self.path)
+
 
 class DefaultDatabaseSource(DatabaseSource):
     """Default source for database scripts and connection data.
@@ -21,10 +184,19 @@ Can be used as-is for projects following the below directory layout:
   - db_2_name
     - etc.
 
+Scripts are .sql files.  migrations may also contain .py files, which
+are run in chunks (see PythonMigrationFile).  reference_data may also
+contain .csv and .tsv files, which are bulk loaded (see
+DelimitedDataFile).  baseline_schema may also contain
+squashed_migrations.txt, listing the migrations that have been
+squashed into the baseline (see Migrator.squash_migrations).
+
 The database folder names (db_1_name, etc) must match the database
 names used as "Database" subsection names in the .ini file.
     """
 
+    SQUASHED_MIGRATIONS_FILE = "squashed_migrations.txt"
+
     def __init__(self, ini_file, root_directory):
         """ctor.  Arguments:
 
@@ -36,8 +208,16 @@ root_directory: root directory of your databases."""
 
         if not os.path.exists(ini_file):
             raise Exception("Missing ini file at " + ini_file)
-        self.config = ConfigObj(ini_file)
+        self.ini_file = ini_file
         self.root_dir = root_directory
+        self.__config = None
+
+    @property
+    def config(self):
+        """The parsed .ini file, read on first use."""
+        if self.__config is None:
+            self.__config = read_config(self.ini_file)
+        return self.__config
 
     def get_db_name_from_nickname(self, nickname):
         return self.config["Databases"][nickname]["dbname"]
@@ -48,24 +228,66 @@ root_directory: root directory of your databases."""
     def get_connection_hashes(self):
         return self.config["Databases"]
 
-    def __get_files(self, database_name, subfolder_name):
-        mypath = os.path.join(self.root_dir, database_name, subfolder_name, "*.sql")
+    def __get_files(self, database_name, subfolder_name, extension = "sql", content_class = SqlScriptFile):
+        mypath = os.path.join(self.root_dir, database_name, subfolder_name, "*." + extension)
         ret = []
         for f in glob.glob(mypath):
             bn = os.path.basename(f)
-            with open (f, "r") as myfile:
-                data=myfile.read()
-            ret.append( (bn, data) )
+            ret.append( (bn, content_class(f)) )
         return ret
 
     def get_baseline_schema_files(self, database_name):
         return self.__get_files(database_name, "baseline_schema")
 
     def get_reference_data_files(self, database_name):
-        return self.__get_files(database_name, "reference_data")
+        ret = self.__get_files(database_name, "reference_data")
+        for ext in ["csv", "tsv"]:
+            ret.extend(self.__get_files(database_name, "reference_data", ext, DelimitedDataFile))
+        return ret
 
     def get_code_files(self, database_name):
         return self.__get_files(database_name, "code")
 
     def get_migrations_files(self, database_name):
-        return self.__get_files(database_name, "migrations")
+        ret = self.__get_files(database_name, "migrations")
+        ret.extend(self.__get_files(database_name, "migrations", "py", PythonMigrationFile))
+        return ret
+
+    def __get_squashed_migrations_path(self, database_name):
+        return os.path.join(self.root_dir, database_name, "baseline_schema", DefaultDatabaseSource.SQUASHED_MIGRATIONS_FILE)
+
+    def get_squashed_migrations(self, database_name):
+        path = self.__get_squashed_migrations_path(database_name)
+        if not os.path.exists(path):
+            return []
+        with open(path, "r") as f:
+            lines = [l.strip() for l in f]
+        return [l for l in lines if l != "" and not l.startswith("#")]
+
+    def write_squashed_baseline(self, database_name, schema_sql, migration_names):
+        """Moves the current baseline schema files to
+squashed/<timestamp>/baseline_schema, and writes the schema_sql to
+baseline_schema/squashed_baseline.sql."""
+        baseline_dir = os.path.join(self.root_dir, database_name, "baseline_schema")
+        stamp = os.path.join(self.root_dir, database_name, "squashed", time.strftime("%Y%m%d_%H%M%S"))
+        archive_root = stamp
+        n = 2
+        while os.path.exists(archive_root):
+            # Squashed more than once in the same second.
+            archive_root = "{0}_{1}".format(stamp, n)
+            n += 1
+        archive_dir = os.path.join(archive_root, "baseline_schema")
+        os.makedirs(archive_dir)
+        squashed_path = self.__get_squashed_migrations_path(database_name)
+        old_files = glob.glob(os.path.join(baseline_dir, "*.sql"))
+        if os.path.exists(squashed_path):
+            old_files.append(squashed_path)
+        for f in old_files:
+            shutil.move(f, archive_dir)
+
+        with open(os.path.join(baseline_dir, "squashed_baseline.sql"), "w") as f:
+            f.write(schema_sql)
+        with open(squashed_path, "w") as f:
+            f.write("# Migrations already in the baseline schema, recorded as applied when it is run.\n")
+            for name in migration_names:
+                f.write(name + "\n")
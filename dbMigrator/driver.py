@@ -1,9 +1,13 @@
 import sys
 import argparse
 
-from migrator import Migrator
+from cachingdatabasesource import CachingDatabaseSource
+from handlers import create_handler
+from migrator import Migrator, MigrationException
+from observers import JsonLinesObserver, PrometheusTextfileObserver
+from tenants import TenantDatabaseSource, TenantMigrator, read_tenant_file, query_tenants, get_ini_tenants
 
-class Driver:
+class Driver(object):
     """A simple command-line driver to handle migrations per user-supplied
 command line arguments (call it with "-h" for
 details).  You can create a new db, upgrade it, etc.
@@ -11,6 +15,10 @@ details).  You can create a new db, upgrade it, etc.
 The user can pass one or more database names to the command line; if
 none are specified, the driver updates the default_database.  If that
 too is blank, nothing happens.
+
+The database_handler can be given by its name in the handler registry
+(eg, "postgres"; see handlers.HANDLERS), in which case its module (and
+database driver) is only imported when a run needs it, not for --help.
     """
 
     def __init__(self, database_source, database_handler):
@@ -18,6 +26,21 @@ too is blank, nothing happens.
         self.database_handler = database_handler
         self.default_database = ""
         self.is_debug_printing = False
+        self.observers = []
+
+    @property
+    def database_handler(self):
+        if isinstance(self.__database_handler, basestring):
+            self.__database_handler = create_handler(self.__database_handler)
+        return self.__database_handler
+
+    @database_handler.setter
+    def database_handler(self, database_handler):
+        self.__database_handler = database_handler
+
+    def add_observer(self, observer):
+        """Registers a MigrationObserver with the Migrator for each run."""
+        self.observers.append(observer)
 
     class ParsingException(Exception):
         pass
@@ -37,6 +60,23 @@ program name as the first element.
         parser.add_argument("-c", "--code", help="Run code (for views, stored procs, etc)", action="store_true")
         parser.add_argument("-d", "--data", help="Load reference (bootstrap) data", action="store_true")
         parser.add_argument("-u", "--update", help="Updates database (runs migrations, code, and data)", action="store_true")
+        parser.add_argument("-j", "--jobs", help="Number of databases to migrate concurrently (default 1)", type=int, default=1)
+        parser.add_argument("--code-jobs", metavar="N", help="Run code scripts in dependency order (parsed from the sql, or from \"-- depends:\" comments), on up to N connections per database", type=int)
+        parser.add_argument("--skip-unchanged", help="Skip code and data scripts unchanged since their last run", action="store_true")
+        parser.add_argument("-f", "--force", help="With --skip-unchanged, re-run all code and data scripts anyway", action="store_true")
+        parser.add_argument("--from-template", help="With -n, copy the database(s) from cached templates that have had all scripts run (rebuilt when scripts change); -s is then unnecessary", action="store_true")
+        parser.add_argument("--plan", help="Print the scripts that would run on each database, without running them", action="store_true")
+        parser.add_argument("--plan-json", metavar="FILE", help="With --plan, also write the plan to FILE as JSON (implies --plan)")
+        parser.add_argument("--squash", help="Replace the baseline schema with a dump of the schema after all migrations (built on a scratch database), recording the migrations as squashed", action="store_true")
+        parser.add_argument("--tenants", metavar="FILE", help="Apply the scripts of the (single) db to every tenant database listed in FILE, one dbname per line (optionally followed by key=value connection overrides); -j sets the number of worker processes")
+        parser.add_argument("--tenant-query", metavar="SQL", help="As --tenants, for the tenant databases selected by SQL (dbname, and optionally host, columns)")
+        parser.add_argument("--catalog", metavar="DB", help="With --tenant-query, run the query on this db rather than the system connection")
+        parser.add_argument("--ini-tenants", help="As --tenants, for the tenant databases in the ini file's [Tenants] section", action="store_true")
+        parser.add_argument("--per-host", metavar="N", help="With tenants, migrate at most N tenants at once on any one host", type=int)
+        parser.add_argument("--retries", metavar="N", help="With tenants, retry each failed tenant up to N times (default 0)", type=int, default=0)
+        parser.add_argument("--source-index", metavar="FILE", help="Cache script file lists for the run, and keep script checksums in FILE, so unchanged files aren't read again")
+        parser.add_argument("--metrics-file", help="Write Prometheus textfile-collector metrics to this .prom file")
+        parser.add_argument("--events-file", help="Append migration events to this file as JSON lines")
         parser.add_argument('databases', metavar='db', nargs='*', help='nickname of database to manipulate')
 
         # Skipping the first entry.  Note that internally,
@@ -47,6 +87,93 @@ program name as the first element.
             args.databases.append(self.default_database)
         return args
 
+    def get_phases(self, args):
+        """Names of the phases (see MigrationPlan.PHASES) selected by the args."""
+        phases = []
+        if args.new:
+            phases.append("delete_make_new")
+        if args.schema:
+            phases.append("baseline_schema")
+        if args.migrations or args.update:
+            phases.append("migrations")
+        if args.code or args.update:
+            phases.append("code")
+        if args.data or args.update:
+            phases.append("reference_data")
+        return phases
+
+    def plan(self, migrator, args):
+        """Prints (and optionally writes as JSON) the plan for the args."""
+        plan = migrator.plan(self.get_phases(args), *args.databases)
+        print plan.format_text()
+        if args.plan_json:
+            plan.write_json(args.plan_json)
+
+    def configure(self, migrator, args):
+        """Applies the args' Migrator settings."""
+        migrator.is_debug_printing = self.is_debug_printing
+        migrator.max_workers = args.jobs
+        migrator.skip_unchanged = args.skip_unchanged
+        migrator.force = args.force
+        if args.code_jobs:
+            migrator.code_dependency_order = True
+            migrator.code_workers = args.code_jobs
+
+    def get_tenants(self, args, db_nickname):
+        """Connection hashes of the tenant databases selected by the args,
+defaulting to the db's connection settings."""
+        defaults = self.database_source.get_connection_hash(db_nickname)
+        if args.tenants:
+            return read_tenant_file(args.tenants, defaults)
+        if args.tenant_query:
+            if args.catalog:
+                conn = self.database_source.get_connection_hash(args.catalog)
+            else:
+                conn = self.database_source.get_system_connection_hash()
+            try:
+                return query_tenants(self.database_handler, conn, args.tenant_query, defaults)
+            finally:
+                self.database_handler.close_connections()
+        if not hasattr(self.database_source, "config"):
+            raise Driver.ParsingException("--ini-tenants needs a database source with an ini file config")
+        return get_ini_tenants(self.database_source.config, defaults)
+
+    def get_database_source(self, args):
+        """The database_source, wrapped in a CachingDatabaseSource if the args
+give a --source-index."""
+        if args.source_index:
+            return CachingDatabaseSource(self.database_source, args.source_index)
+        return self.database_source
+
+    def fan_out(self, args, database_source):
+        """Runs the args' phases on every tenant database (see TenantMigrator)."""
+        if len(args.databases) != 1:
+            raise Driver.ParsingException("Tenants need exactly one db, whose scripts are applied to every tenant")
+        if args.plan or args.plan_json or args.squash or args.from_template:
+            raise Driver.ParsingException("--plan, --squash and --from-template can't be used with tenants")
+        if args.metrics_file or args.events_file or len(self.observers) > 0:
+            # Tenants are migrated in worker processes, whose events observers don't see.
+            raise Driver.ParsingException("--metrics-file, --events-file and observers can't be used with tenants")
+        db_nickname = args.databases[0]
+        source = TenantDatabaseSource(database_source, db_nickname, self.get_tenants(args, db_nickname))
+        m = Migrator(source, self.database_handler)
+        self.configure(m, args)
+        m.max_workers = 1
+        if isinstance(database_source, CachingDatabaseSource) and args.jobs > 1:
+            # Checksums indexed by the worker processes would be lost.
+            database_source.index_checksums(db_nickname)
+        t = TenantMigrator(m)
+        t.processes = args.jobs
+        t.max_per_host = args.per_host
+        t.retries = args.retries
+        try:
+            summary = t.run(self.get_phases(args))
+        finally:
+            m.close()
+        print summary.format_text()
+        if len(summary.failed()) > 0:
+            raise MigrationException("{0} of {1} tenant(s) failed".format(len(summary.failed()), len(summary.results)))
+
     def main(self, command_line_args):
         """Main entry point.  Consumes command line args (clients can pass sys.argv)"""
 
@@ -55,19 +182,51 @@ program name as the first element.
             command_line_args = [ "driver.py", "--help" ]
 
         args = self.parse_args(command_line_args)
+        if args.from_template and not args.new:
+            raise Driver.ParsingException("--from-template is only used with -n")
         if (len(args.databases) == 0):
             return
 
-        m = Migrator(self.database_source, self.database_handler)
-        m.is_debug_printing = self.is_debug_printing
-        
-        if args.new:
-            m.delete_make_new(*args.databases)
-        if args.schema:
-            m.run_baseline_schema(*args.databases)
-        if args.migrations or args.update:
-            m.run_migrations(*args.databases)
-        if args.code or args.update:
-            m.run_code_definitions(*args.databases)
-        if args.data or args.update:
-            m.run_reference_data(*args.databases)
+        source = self.get_database_source(args)
+        if args.tenants or args.tenant_query or args.ini_tenants:
+            self.fan_out(args, source)
+            return
+
+        m = Migrator(source, self.database_handler)
+        self.configure(m, args)
+
+        # Observers created for command line args are closed after the run;
+        # those registered with add_observer are left to their owner.
+        owned = []
+        if args.metrics_file:
+            owned.append(PrometheusTextfileObserver(args.metrics_file))
+        if args.events_file:
+            owned.append(JsonLinesObserver(args.events_file))
+        for o in self.observers + owned:
+            m.add_observer(o)
+
+        try:
+            if args.plan or args.plan_json:
+                self.plan(m, args)
+                return
+            if args.squash:
+                m.squash_migrations(*args.databases)
+                return
+            if args.new and args.from_template:
+                m.create_from_templates(*args.databases)
+            else:
+                if args.new:
+                    m.delete_make_new(*args.databases)
+                if args.schema:
+                    m.run_baseline_schema(*args.databases)
+            if args.migrations or args.update:
+                m.run_migrations(*args.databases)
+            if args.code or args.update:
+                m.run_code_definitions(*args.databases)
+            if args.data or args.update:
+                m.run_reference_data(*args.databases)
+        finally:
+            m.close()
+            for o in owned:
+                o.close()
+
@@ -0,0 +1,71 @@
+import importlib
+import logging
+
+from migrator import MigrationException
+
+logger = logging.getLogger('dbmigrator')
+
+
+# This package, for the built-in handler modules' names.
+_PACKAGE = __name__.rpartition(".")[0]
+
+def _builtin(module, class_name):
+    return "{0}:{1}".format(".".join([p for p in [_PACKAGE, module] if p != ""]), class_name)
+
+"""Handler name => "module:ClassName" of its DatabaseHandler class.  The
+module is only imported when the handler is used, so that eg the mysql
+handler doesn't need psycopg2 installed, and --help doesn't pay for
+importing either database driver."""
+HANDLERS = {
+    "mysql": _builtin("mysqldatabasehandler", "MySqlDatabaseHandler"),
+    "postgres": _builtin("postgresdatabasehandler", "PostgresDatabaseHandler"),
+    "sqlite": _builtin("sqlitedatabasehandler", "SqliteDatabaseHandler")
+}
+
+"""Entry point group in which other packages can register handlers,
+eg in their setup.py:
+
+entry_points = { "dbmigrator.handlers": ["oracle = mypackage.oracle:OracleDatabaseHandler"] }
+
+Entry points are only searched for names not in HANDLERS."""
+ENTRY_POINT_GROUP = "dbmigrator.handlers"
+
+
+def register_handler(name, class_path):
+    """Registers (or replaces) a handler: class_path is "module:ClassName"."""
+    if not (":" in class_path):
+        raise ValueError("Handler class path must be module:ClassName, got " + class_path)
+    HANDLERS[name] = class_path
+
+
+def get_handler_names():
+    return sorted(HANDLERS.keys())
+
+
+def _find_entry_point(name):
+    try:
+        import pkg_resources
+    except ImportError:
+        return None
+    for ep in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP, name):
+        return "{0}:{1}".format(ep.module_name, ".".join(ep.attrs))
+    return None
+
+
+def get_handler_class(name):
+    """Imports and returns the DatabaseHandler class registered as name."""
+    class_path = HANDLERS.get(name) or _find_entry_point(name)
+    if class_path is None:
+        raise MigrationException("Unknown database handler {0} (known: {1})".format(name, ", ".join(get_handler_names())))
+    module_name, class_name = class_path.split(":", 1)
+    try:
+        module = importlib.import_module(module_name)
+    except ImportError as e:
+        raise MigrationException("Can't load the {0} database handler from {1}: {2}".format(name, module_name, e))
+    return getattr(module, class_name)
+
+
+def create_handler(name, *args, **kwargs):
+    """A new instance of the handler registered as name, constructed with
+the given arguments (eg, a directory for sqlite)."""
+    return get_handler_class(name)(*args, **kwargs)
@@ -1,6 +1,16 @@
+import hashlib
 import logging
 import sys
+import threading
+import time
+import Queue
 from abc import ABCMeta, abstractmethod
+from StringIO import StringIO
+
+from sqlsplitter import SqlStatementSplitter, SqlStatementException
+from observers import MigrationObserver, ObserverList
+from plan import MigrationPlan
+from codedependencies import CodeDependencyGraph
 
 
 class MigrationException(Exception):
@@ -8,6 +18,11 @@ class MigrationException(Exception):
     pass
 
 
+def elapsed_ms(start):
+    """Milliseconds since start (a time.time() value)."""
+    return int(round((time.time() - start) * 1000))
+
+
 class Migrator:
     """Facade (coordinator) - takes source files from the database_source,
 and passes them as needed to the database_handler to execute against
@@ -29,61 +44,322 @@ database_handler: database-platform-specific implementation of db manipulation r
         self.database_handler = database_handler
         self.is_debug_printing = False
 
+        # Number of databases to migrate concurrently.
+        self.max_workers = 1
+
+        # Scripts at least this many bytes are streamed to the handler a
+        # statement at a time, rather than read into memory whole.
+        self.streaming_threshold = ScriptRunner.DEFAULT_STREAMING_THRESHOLD
+
+        # If True, code and reference data scripts whose checksum matches
+        # that of their last successful run are skipped, unless force is
+        # also set.
+        self.skip_unchanged = False
+        self.force = False
+
+        self.observers = ObserverList()
+
+        # If True, code scripts are run in dependency order (see
+        # CodeDependencyGraph) rather than filename order, on up to
+        # code_workers connections per database, and with skip_unchanged
+        # only changed scripts and the scripts that depend on them are
+        # rerun.
+        self.code_dependency_order = False
+        self.code_workers = 1
+
+        # Appended to database names to name their template databases
+        # (see create_from_templates).
+        self.template_suffix = "_template"
+
+        # Appended to database names to name the scratch databases used
+        # by squash_migrations.
+        self.squash_suffix = "_squash"
+
+    def add_observer(self, observer):
+        """Registers a MigrationObserver to receive phase and script events."""
+        self.observers.add(observer)
+
+    def __run_phase(self, phase, db_nicknames, action):
+        """Runs action(), notifying observers of the phase's start and end."""
+        if not self.observers:
+            action()
+            return
+        start = time.time()
+        self.observers.notify("phase_started", phase, db_nicknames)
+        try:
+            action()
+        except:
+            exc_info = sys.exc_info()
+            self.observers.notify("phase_finished", phase, db_nicknames, elapsed_ms(start), exc_info[1])
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.observers.notify("phase_finished", phase, db_nicknames, elapsed_ms(start), None)
 
     def delete_make_new(self, *db_nicknames):
         """DELETES THE SPECIFIED DATABASE, and creates a new one.  Note again,
 this DELETES THE SPECIFIED DATABASE.  It does not perform any checks
 of that database."""
-        for db_nickname in db_nicknames:
-            db_name = self.database_source.get_db_name_from_nickname(db_nickname)
-            if (self.is_debug_printing):
-                print "Dropping and recreating {0}".format(db_name)
-            self.database_handler.delete_make_new(self.database_source.get_system_connection_hash(), db_name)
+        def delete_make_new_all():
+            for db_nickname in db_nicknames:
+                db_name = self.database_source.get_db_name_from_nickname(db_nickname)
+                if (self.is_debug_printing):
+                    print "Dropping and recreating {0}".format(db_name)
+                self.database_handler.delete_make_new(self.database_source.get_system_connection_hash(), db_name)
+        self.__run_phase("delete_make_new", db_nicknames, delete_make_new_all)
 
 
-    def __build_script_list_and_execute(self, func, db_nicknames, track_scripts):
+    def __build_script_list_and_execute(self, phase, func, db_nicknames, track_scripts, checksum_type = None):
         """Passes the list of all scripts to be executed to a ScriptRunner,
 which in turn executes the scripts."""
         s = ScriptRunner(self.database_source.get_connection_hashes(), self.database_handler)
         s.is_debug_printing = self.is_debug_printing
+        s.phase = phase
+        s.observers = self.observers
+        s.max_workers = self.max_workers
+        s.force = self.force
+        s.streaming_threshold = self.streaming_threshold
+        if phase == "code":
+            s.dependency_order = self.code_dependency_order
+            s.dependency_workers = self.code_workers
         for db_nickname in db_nicknames: 
             for tup in func(db_nickname):
                 filename, sql = tup
                 s.add_script(filename, db_nickname, sql)
-        s.execute_scripts(track_scripts)
+        if not self.skip_unchanged:
+            checksum_type = None
+        s.execute_scripts(track_scripts, checksum_type)
 
 
     def run_baseline_schema(self, *db_nicknames):
         """Runs baseline schema on empty database."""
-        for db_nickname in db_nicknames: 
-            conn = self.database_source.get_connection_hash(db_nickname)
-            if self.database_handler.user_defined_tables_exist(conn):
-                raise MigrationException("Can't run baseline script in non-empty database " + db_nickname)
+        def run():
+            for db_nickname in db_nicknames: 
+                conn = self.database_source.get_connection_hash(db_nickname)
+                if self.database_handler.user_defined_tables_exist(conn):
+                    raise MigrationException("Can't run baseline script in non-empty database " + db_nickname)
+
+            g = lambda x: self.database_source.get_baseline_schema_files(x)
+            self.__build_script_list_and_execute("baseline_schema", g, db_nicknames, False)
+            for db_nickname in db_nicknames:
+                self.__record_squashed_migrations(db_nickname)
+        self.__run_phase("baseline_schema", db_nicknames, run)
 
-        g = lambda x: self.database_source.get_baseline_schema_files(x)
-        self.__build_script_list_and_execute(g, db_nicknames, False)
+    def __record_squashed_migrations(self, db_nickname):
+        """Records the migrations squashed into the baseline schema as applied."""
+        names = self.database_source.get_squashed_migrations(db_nickname)
+        if len(names) == 0:
+            return
+        conn = self.database_source.get_connection_hash(db_nickname)
+        self.database_handler.create_tracking_table(conn)
+        for name in names:
+            self.database_handler.record_script_in_tracking_table(conn, name)
+        self.database_handler.flush_tracking_table(conn)
 
 
     def run_migrations(self, *db_nicknames):
         """Runs migrations, tracking them in tracking table."""
         g = lambda x: self.database_source.get_migrations_files(x)
-        self.__build_script_list_and_execute(g, db_nicknames, True)
+        self.__run_phase("migrations", db_nicknames,
+                         lambda: self.__build_script_list_and_execute("migrations", g, db_nicknames, True))
 
     def run_code_definitions(self, *db_nicknames):
-        """Runs code definitions (functions, stored procs, views, etc).  Not tracked in tracking table."""
+        """Runs code definitions (functions, stored procs, views, etc).  Not tracked in tracking table.
+If skip_unchanged is set, unchanged scripts are skipped (and if
+code_dependency_order is set, the scripts depending on changed ones
+are rerun)."""
         g = lambda x: self.database_source.get_code_files(x)
-        self.__build_script_list_and_execute(g, db_nicknames, False)
+        self.__run_phase("code", db_nicknames,
+                         lambda: self.__build_script_list_and_execute("code", g, db_nicknames, False, "code"))
 
     def run_reference_data(self, *db_nicknames):
-        """Runs idempotent reference data files.  Not tracked in tracking table."""
+        """Runs idempotent reference data files.  Not tracked in tracking table.
+If skip_unchanged is set, unchanged scripts are skipped."""
         g = lambda x: self.database_source.get_reference_data_files(x)
-        self.__build_script_list_and_execute(g, db_nicknames, False)
+        self.__run_phase("reference_data", db_nicknames,
+                         lambda: self.__build_script_list_and_execute("reference_data", g, db_nicknames, False, "reference_data"))
+
+    def get_scripts_checksum(self, db_nickname):
+        """Returns a hash of the names and contents of all of the database's
+baseline schema, migrations, code and reference data scripts."""
+        src = self.database_source
+        h = hashlib.sha1()
+        for phase, files in [("baseline_schema", src.get_baseline_schema_files(db_nickname)),
+                             ("migrations", src.get_migrations_files(db_nickname)),
+                             ("code", src.get_code_files(db_nickname)),
+                             ("reference_data", src.get_reference_data_files(db_nickname))]:
+            for name, content in sorted(files, key = lambda f: f[0]):
+                h.update("{0}/{1}:{2}\n".format(phase, name, ScriptContent.checksum_of(content)))
+        return h.hexdigest()
+
+    def create_from_templates(self, *db_nicknames):
+        """DELETES THE SPECIFIED DATABASES, and re-creates them as copies of
+template databases that have had the baseline schema, migrations,
+code and reference data run on them.  A template is (re)built first
+if it's missing, or if the scripts have changed since it was built
+(see get_scripts_checksum), so this gives the same result as
+delete_make_new followed by all of the other phases, but is much
+faster when the templates are current.  Requires a handler that
+supports template databases."""
+        sys_conn = self.database_source.get_system_connection_hash()
+        template_source = SuffixedDatabaseSource(self.database_source, self.template_suffix)
+        checksums = {}
+        stale = []
+        for db_nickname in db_nicknames:
+            checksums[db_nickname] = self.get_scripts_checksum(db_nickname)
+            template_name = template_source.get_db_name_from_nickname(db_nickname)
+            if self.database_handler.get_template_checksum(sys_conn, template_name) != checksums[db_nickname]:
+                stale.append(db_nickname)
+
+        if len(stale) > 0:
+            self.__build_templates(template_source, stale, checksums)
+
+        def clone_all():
+            for db_nickname in db_nicknames:
+                db_name = self.database_source.get_db_name_from_nickname(db_nickname)
+                template_name = template_source.get_db_name_from_nickname(db_nickname)
+                if (self.is_debug_printing):
+                    print "Creating {0} from template {1}".format(db_name, template_name)
+                self.database_handler.create_from_template(sys_conn, db_name, template_name)
+        self.__run_phase("delete_make_new", db_nicknames, clone_all)
+
+    def __build_templates(self, template_source, db_nicknames, checksums):
+        """Runs all phases on new template databases for the nicknames, and
+marks each with the checksum of the scripts it was built from."""
+        source = self.database_source
+        self.database_source = template_source
+        try:
+            self.delete_make_new(*db_nicknames)
+            self.run_baseline_schema(*db_nicknames)
+            self.run_migrations(*db_nicknames)
+            self.run_code_definitions(*db_nicknames)
+            self.run_reference_data(*db_nicknames)
+            sys_conn = template_source.get_system_connection_hash()
+            for db_nickname in db_nicknames:
+                template_name = template_source.get_db_name_from_nickname(db_nickname)
+                self.database_handler.mark_template(sys_conn, template_name, checksums[db_nickname])
+        finally:
+            self.database_source = source
+
+    def squash_migrations(self, *db_nicknames):
+        """Runs the baseline schema and all migrations on a scratch database
+(<dbname><squash_suffix>, left in place afterwards), and has the
+database_source replace the baseline schema with a dump of the
+resulting schema and record all of the migrations as squashed.  New
+databases then get the same schema from the baseline alone, and the
+squashed migrations are recorded as applied instead of being run.
+Existing databases are unaffected, as the migration files are kept.
+Requires handler and source support."""
+        source = self.database_source
+        scratch_source = SuffixedDatabaseSource(source, self.squash_suffix)
+        self.database_source = scratch_source
+        try:
+            self.delete_make_new(*db_nicknames)
+            self.run_baseline_schema(*db_nicknames)
+            self.run_migrations(*db_nicknames)
+        finally:
+            self.database_source = source
+
+        for db_nickname in db_nicknames:
+            conn = scratch_source.get_connection_hash(db_nickname)
+            # The tracking table doesn't exist if there were no migrations.
+            self.database_handler.create_tracking_table(conn)
+            names = sorted(self.database_handler.get_applied_scripts(conn))
+            schema_sql = self.database_handler.dump_schema(conn)
+            if (self.is_debug_printing):
+                print "Squashing {0} migrations into baseline schema of {1}".format(len(names), db_nickname)
+            source.write_squashed_baseline(db_nickname, schema_sql, names)
+
+    def plan(self, phases, *db_nicknames):
+        """Returns a MigrationPlan of the scripts that running the given
+phases (names from MigrationPlan.PHASES) would execute on each
+database, without changing anything.  Reads each database's tracking
+table once, and only script metadata (names and sizes), never script
+content.  Databases are inspected on up to max_workers threads."""
+        plan = MigrationPlan(phases)
+        entries = [plan.add_database(n, self.database_source.get_db_name_from_nickname(n), "delete_make_new" in phases)
+                   for n in db_nicknames]
+        pending = Queue.Queue()
+        for e in entries:
+            pending.put(e)
+
+        def work():
+            while True:
+                try:
+                    entry = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self.__plan_database(entry, plan.phases)
+                except Exception as e:
+                    entry.error = str(e)
+
+        workers = [threading.Thread(target = work) for i in range(max(1, min(self.max_workers, len(entries))))]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        return plan
+
+    def __plan_database(self, entry, phases):
+        """Fills in the DatabasePlan entry for the phases."""
+        db_nickname = entry.db_nickname
+        conn = self.database_source.get_connection_hash(db_nickname)
+        src = self.database_source
+
+        def add_scripts(phase_plan, files, action = "run", exclude = set()):
+            for name, content in sorted(files, key = lambda f: f[0]):
+                if name in exclude:
+                    phase_plan.skipped += 1
+                else:
+                    phase_plan.add_script(name, ScriptContent.size_of(content), action)
+
+        if "baseline_schema" in phases:
+            p = entry.add_phase("baseline_schema")
+            if not entry.recreate and self.database_handler.user_defined_tables_exist(conn):
+                p.refused = "Can't run baseline script in non-empty database " + db_nickname
+            else:
+                add_scripts(p, src.get_baseline_schema_files(db_nickname))
+
+        if "migrations" in phases:
+            applied = set()
+            if not entry.recreate and self.database_handler.tracking_table_exists(conn):
+                applied = self.database_handler.get_applied_scripts(conn)
+            if "baseline_schema" in phases:
+                applied = set(applied) | set(src.get_squashed_migrations(db_nickname))
+            add_scripts(entry.add_phase("migrations"), src.get_migrations_files(db_nickname), exclude = applied)
+
+        action = "run_if_changed" if self.skip_unchanged and not self.force else "run"
+        if "code" in phases:
+            add_scripts(entry.add_phase("code"), src.get_code_files(db_nickname), action)
+        if "reference_data" in phases:
+            add_scripts(entry.add_phase("reference_data"), src.get_reference_data_files(db_nickname), action)
+
+    def close(self):
+        """Closes connections held open by the database_handler, and closes
+the database_source.  Call once all phases of a run are done."""
+        self.database_handler.close_connections()
+        self.database_source.close()
 
 
 
 class ScriptRunnerException(Exception):
     """Custom exception"""
-    pass
+
+    def __init__(self, message, failures = None):
+        """failures: list of (db_nickname, exception) when scripts failed on
+several databases during a parallel run."""
+        super(ScriptRunnerException, self).__init__(message)
+        self.failures = failures or []
+
+
+class DeferredScriptException(Exception):
+    """Raised by a DatabaseHandler when a script whose execution it
+deferred (see DatabaseHandler.execute_tracked) fails once run.  This
+may be from a call for some other script, so the exception names the
+script that failed."""
+
+    def __init__(self, script_name, message):
+        super(DeferredScriptException, self).__init__(message)
+        self.script_name = script_name
 
 
 class QueuedScriptCollection:
@@ -93,7 +369,10 @@ class QueuedScriptCollection:
     MAX_SCRIPT_NAME_LENGTH = 255
 
     def __init__(self):
-        self.scripts = []
+        # (filename, dbname) => sql.  Hashing on the pair gives constant
+        # time duplicate checks, and the pair is the sort key.
+        self.scripts = {}
+        self.sorted_scripts = None
 
     def add_script(self, filename, dbname, sql):
         """Adds script name, db on which it is to be run, and the sql of the script."""
@@ -101,17 +380,30 @@ class QueuedScriptCollection:
             raise ScriptRunnerException("Script name {0} has length {1}, exceeds max length".format(
                 filename, filename.__len__(), QueuedScriptCollection.MAX_SCRIPT_NAME_LENGTH))
 
-        matches = [x for x in self.scripts if (x[0] == filename and x[1] == dbname)]
-        if len(matches) > 0:
+        key = (filename, dbname)
+        if key in self.scripts:
             raise ScriptRunnerException("Already have file {0} for database {1}".format(filename, dbname))
 
-        self.scripts.append( (filename, dbname, sql) )
+        self.scripts[key] = sql
+        self.sorted_scripts = None
+
+    def __len__(self):
+        return len(self.scripts)
 
     def get_sorted_scripts(self):
         """Returns scripts sorted by filename (necessary to ensure correct
 execution order).  Additional sorting on dbname is done to
 keep sorting deterministic for unit testing only."""
-        ret = sorted(self.scripts, key=lambda tup: "{0}, {1}".format(tup[0], tup[1]))
+        if self.sorted_scripts is None:
+            self.sorted_scripts = [(k[0], k[1], self.scripts[k]) for k in sorted(self.scripts.keys())]
+        return list(self.sorted_scripts)
+
+    def get_sorted_scripts_by_db(self):
+        """Returns hash of dbname => that db's scripts, sorted by filename.
+Execution order only matters within a database."""
+        ret = {}
+        for tup in self.get_sorted_scripts():
+            ret.setdefault(tup[1], []).append(tup)
         return ret
 
 
@@ -119,6 +411,11 @@ class ScriptRunner:
     """Collects and passes a set of scripts in correct order to a
 DatabaseHandler, requesting logging if needed."""
 
+    DEFAULT_STREAMING_THRESHOLD = 32 * 1024 * 1024
+
+    """Attributes set on the debug LogRecord logged for each executed script."""
+    LOG_FIELDS = ("event", "script_name", "db_nickname", "tracked", "duration_ms", "rows_affected")
+
     def __init__(self, connection_hashes, database_handler):
         """database_handler: the DatabaseHandler instance that will actually
 execute out database-platform-specific scripts."""
@@ -128,6 +425,38 @@ execute out database-platform-specific scripts."""
         self.tracking_table_created_for_connections = []
         self.connection_hashes = connection_hashes
 
+        # If > 1, scripts for different databases are run concurrently
+        # on up to this many threads (scripts for a single database are
+        # still run in order).
+        self.max_workers = 1
+
+        # Re-run scripts even if their checksums are unchanged.
+        self.force = False
+
+        # If True, untracked scripts are run in dependency order (see
+        # CodeDependencyGraph), on up to dependency_workers connections
+        # per database.
+        self.dependency_order = False
+        self.dependency_workers = 1
+
+        # ScriptContent at least this many bytes is streamed to the
+        # handler's execute_stream instead of being read whole.
+        self.streaming_threshold = ScriptRunner.DEFAULT_STREAMING_THRESHOLD
+        self.checksum_table_created_for_connections = []
+
+        # Migrator phase name passed to observers.
+        self.phase = None
+        self.observers = ObserverList()
+
+        # (dbname, script name) => (db_nickname, size, start time) of
+        # scripts the handler has deferred (see
+        # DatabaseHandler.execute_tracked) and not yet run.
+        self.deferred_scripts = {}
+
+    def add_observer(self, observer):
+        """Registers a MigrationObserver to receive script events."""
+        self.observers.add(observer)
+
     def add_script(self, filename, db_nickname, sql):
         """- filename: the name of the script to run.  Will be logged to tracking table if needed.
 - db_nickname: database on which script will be run
@@ -135,6 +464,8 @@ execute out database-platform-specific scripts."""
         if not (db_nickname in self.connection_hashes):
             raise ScriptRunnerException("Missing connection hash for " + db_nickname)
         self.queued_scripts_collection.add_script(filename, db_nickname, sql)
+        if self.observers:
+            self.observers.notify("script_queued", self.phase, db_nickname, filename, ScriptContent.size_of(sql))
 
     def clear_all_scripts(self):
         """Helper during testing only."""
@@ -146,16 +477,122 @@ execute out database-platform-specific scripts."""
             raise ScriptRunnerException("Missing connection hash for " + db_nickname)
         return self.connection_hashes[db_nickname]
 
-    def __execute(self, db_nickname, script_name, sql):
-        """Runs the sql on the database.  Errors are thrown back to the caller."""
-        conn_hash = self.__get_conn_hash(db_nickname)
+    def __execute(self, db_nickname, script_name, sql, tracked = False, conn_hash = None):
+        """Runs the sql on the database (on conn_hash, if given, rather than
+the database's connection hash), recording it (with its duration and
+rows affected) in the tracking table if tracked.  Errors are thrown
+back to the caller."""
+        if conn_hash is None:
+            conn_hash = self.__get_conn_hash(db_nickname)
         if (self.is_debug_printing):
             print "Execute {0} on {1}".format(script_name, db_nickname)
+        size = None
+        if self.observers:
+            size = ScriptContent.size_of(sql)
+            self.observers.notify("script_started", self.phase, db_nickname, script_name, size)
+        start = time.time()
         try:
-            self.database_handler.execute(conn_hash, sql)
+            if isinstance(sql, ScriptContent) and not sql.is_sql:
+                rows = sql.execute_on(self.database_handler, conn_hash)
+                if tracked:
+                    self.database_handler.record_script_in_tracking_table(conn_hash, script_name, elapsed_ms(start), rows)
+            elif self.__should_stream(sql):
+                rows = self.__execute_streamed(conn_hash, script_name, sql, tracked)
+            else:
+                sql = ScriptContent.resolve(sql)
+                chunked = self.__get_chunked_migration(script_name, sql) if tracked else None
+                if chunked is not None:
+                    rows = chunked.execute_on(self.database_handler, conn_hash)
+                    self.database_handler.record_script_in_tracking_table(conn_hash, script_name, elapsed_ms(start), rows)
+                elif tracked:
+                    rows = self.database_handler.execute_tracked(conn_hash, script_name, sql)
+                else:
+                    rows = self.database_handler.execute(conn_hash, sql)
+            if rows is DatabaseHandler.DEFERRED:
+                # Reported once the handler has run it.
+                self.deferred_scripts[(conn_hash["dbname"], script_name)] = (db_nickname, size, start)
+            self.__report_deferred(conn_hash)
         except Exception as e:
+            exc_info = sys.exc_info()
+            self.__report_deferred(conn_hash)
+            if isinstance(e, DeferredScriptException):
+                # The failure may be of a script deferred earlier.
+                db_nickname, script_name, size, start = self.__pop_deferred(
+                    conn_hash, e.script_name, (db_nickname, script_name, size, start))
+            if self.observers:
+                self.observers.notify("script_failed", self.phase, db_nickname, script_name, size, elapsed_ms(start), e)
             # From http://stackoverflow.com/questions/1350671/inner-exception-with-traceback-in-python
-            raise ScriptRunnerException("Error executing " + script_name), None, sys.exc_info()[2]
+            raise ScriptRunnerException("Error executing {0}: {1}".format(script_name, e)), None, exc_info[2]
+        if rows is DatabaseHandler.DEFERRED:
+            return
+        duration_ms = elapsed_ms(start)
+        self.__log_executed(db_nickname, script_name, tracked, duration_ms, rows)
+        if self.observers:
+            self.observers.notify("script_finished", self.phase, db_nickname, script_name, size, duration_ms, rows)
+
+    def __report_deferred(self, conn_hash):
+        """Logs, and notifies observers of, the deferred scripts that the
+handler has since run."""
+        for script_name, duration_ms, rows in self.database_handler.pop_deferred_results(conn_hash):
+            deferred = self.deferred_scripts.pop((conn_hash["dbname"], script_name), None)
+            if deferred is None:
+                continue
+            db_nickname, size, start = deferred
+            if duration_ms is None:
+                duration_ms = elapsed_ms(start)
+            self.__log_executed(db_nickname, script_name, True, duration_ms, rows)
+            if self.observers:
+                self.observers.notify("script_finished", self.phase, db_nickname, script_name, size, duration_ms, rows)
+
+    def __pop_deferred(self, conn_hash, script_name, default):
+        """Returns (db_nickname, script_name, size, start time) of the failed
+deferred script (default, if it isn't known), and forgets the
+connection's other deferred scripts, which weren't run."""
+        dbname = conn_hash["dbname"]
+        found = self.deferred_scripts.pop((dbname, script_name), None)
+        for key in [k for k in self.deferred_scripts.keys() if k[0] == dbname]:
+            del self.deferred_scripts[key]
+        if found is None:
+            return default
+        db_nickname, size, start = found
+        return (db_nickname, script_name, size, start)
+
+    def __get_chunked_migration(self, script_name, sql):
+        """A ChunkedSqlMigration for sql marked as chunked, else None."""
+        # Imported here, as chunkedmigration imports this module.
+        from chunkedmigration import ChunkedSqlMigration
+        if ChunkedSqlMigration.is_chunked(sql):
+            return ChunkedSqlMigration(script_name, sql)
+        return None
+
+    def __log_executed(self, db_nickname, script_name, tracked, duration_ms, rows_affected):
+        """Logs a structured (debug) record of the script's execution.  The
+values are also set as attributes of the LogRecord (see
+ScriptRunner.LOG_FIELDS) for handlers that export them."""
+        fields = {
+            "event": "script_executed",
+            "script_name": script_name,
+            "db_nickname": db_nickname,
+            "tracked": tracked,
+            "duration_ms": duration_ms,
+            "rows_affected": rows_affected
+        }
+        logging.getLogger('dbmigrator').debug(
+            "Executed %s on %s in %d ms (rows affected: %s)" % (script_name, db_nickname, duration_ms, rows_affected),
+            extra = fields)
+
+    def __should_stream(self, content):
+        return isinstance(content, ScriptContent) and content.size() >= self.streaming_threshold
+
+    def __execute_streamed(self, conn_hash, script_name, content, tracked):
+        """Feeds large script content to the handler a statement at a time."""
+        stream = content.open()
+        try:
+            if tracked:
+                return self.database_handler.execute_stream_tracked(conn_hash, script_name, stream)
+            return self.database_handler.execute_stream(conn_hash, stream)
+        finally:
+            stream.close()
 
     def __create_tracking_table_in_conn_if_required(self, conn_hash):
         """Creates a migration table in the connection if one hasn't been created before."""
@@ -166,19 +603,283 @@ execute out database-platform-specific scripts."""
             self.database_handler.create_tracking_table(conn_hash)
             self.tracking_table_created_for_connections.append(dbname)
 
-    def execute_scripts(self, log_to_table = False):
-        """Executes all scripts.  Creates a tracking table and logs script
-names to this table if needed."""
-        for tuple in self.queued_scripts_collection.get_sorted_scripts():
-            script_name, db_nickname, sql = tuple
-            if (log_to_table == False):
-                self.__execute(db_nickname, script_name, sql)
-            else:
-                c = self.__get_conn_hash(db_nickname)
-                self.__create_tracking_table_in_conn_if_required(c)
-                if (not self.database_handler.is_in_tracking_table(c, script_name)):
+    def __get_applied_scripts(self, conn_hash, applied_scripts):
+        """Returns the set of scripts already recorded in the connection's
+tracking table, reading the table only once per execute_scripts call."""
+        dbname = conn_hash["dbname"]
+        if not (dbname in applied_scripts):
+            self.__create_tracking_table_in_conn_if_required(conn_hash)
+            applied_scripts[dbname] = set(self.database_handler.get_applied_scripts(conn_hash))
+        return applied_scripts[dbname]
+
+    def __get_checksums(self, conn_hash, checksum_type, checksums):
+        """Returns hash of script name => checksum of its last successful run,
+reading the checksum table once per execute_scripts call."""
+        dbname = conn_hash["dbname"]
+        if not (dbname in checksums):
+            if not (dbname in self.checksum_table_created_for_connections):
+                self.database_handler.create_checksum_table(conn_hash)
+                self.checksum_table_created_for_connections.append(dbname)
+            checksums[dbname] = dict(self.database_handler.get_script_checksums(conn_hash, checksum_type))
+        return checksums[dbname]
+
+    def __execute_if_changed(self, db_nickname, script_name, sql, checksum_type, checksums):
+        """Runs the script unless its checksum is unchanged since its last run."""
+        c = self.__get_conn_hash(db_nickname)
+        previous = self.__get_checksums(c, checksum_type, checksums)
+        checksum = ScriptContent.checksum_of(sql)
+        if (not self.force and previous.get(script_name) == checksum):
+            if (self.is_debug_printing):
+                print "Skip unchanged {0} on {1}".format(script_name, db_nickname)
+            if self.observers:
+                self.observers.notify("script_skipped", self.phase, db_nickname, script_name, MigrationObserver.SKIPPED_UNCHANGED)
+            return
+        self.__execute(db_nickname, script_name, sql)
+        self.database_handler.record_script_checksum(c, checksum_type, script_name, checksum)
+        previous[script_name] = checksum
+
+    def __flush_tracking_tables(self, tracked_connections):
+        """Has the handler run any deferred scripts, and write any buffered
+tracking table rows."""
+        for db_nickname, conn_hash in tracked_connections.values():
+            try:
+                self.database_handler.flush_tracking_table(conn_hash)
+            except DeferredScriptException as e:
+                exc_info = sys.exc_info()
+                self.__report_deferred(conn_hash)
+                db_nickname, script_name, size, start = self.__pop_deferred(
+                    conn_hash, e.script_name, (db_nickname, e.script_name, None, time.time()))
+                if self.observers:
+                    self.observers.notify("script_failed", self.phase, db_nickname, script_name, size, elapsed_ms(start), e)
+                raise ScriptRunnerException("Error executing {0}: {1}".format(script_name, e)), None, exc_info[2]
+            self.__report_deferred(conn_hash)
+
+    def __execute_stream(self, scripts, log_to_table, checksum_type):
+        """Executes the (sorted) scripts in order, stopping at the first error."""
+        applied_scripts = {}
+        tracked_connections = {}
+        checksums = {}
+        try:
+            for tuple in scripts:
+                script_name, db_nickname, sql = tuple
+                if (log_to_table == False and checksum_type is not None):
+                    self.__execute_if_changed(db_nickname, script_name, sql, checksum_type, checksums)
+                elif (log_to_table == False):
                     self.__execute(db_nickname, script_name, sql)
-                    self.database_handler.record_script_in_tracking_table(c, script_name)
+                else:
+                    c = self.__get_conn_hash(db_nickname)
+                    applied = self.__get_applied_scripts(c, applied_scripts)
+                    if (not script_name in applied):
+                        tracked_connections[c["dbname"]] = (db_nickname, c)
+                        self.__execute(db_nickname, script_name, sql, True)
+                        applied.add(script_name)
+                    elif self.observers:
+                        self.observers.notify("script_skipped", self.phase, db_nickname, script_name, MigrationObserver.SKIPPED_APPLIED)
+        except:
+            # Scripts that did succeed must still be recorded.
+            exc_info = sys.exc_info()
+            try:
+                self.__flush_tracking_tables(tracked_connections)
+            except Exception as e:
+                logging.getLogger('dbmigrator').error("Flushing tracking table: %s" % e)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.__flush_tracking_tables(tracked_connections)
+
+    def __execute_in_dependency_order(self, scripts, checksum_type):
+        """Runs one database's untracked scripts in dependency order, with
+independent scripts run concurrently on up to dependency_workers
+connections.  If checksum_type is given, only the changed scripts and
+those downstream of them are run (all of them, if force is set)."""
+        db_nickname = scripts[0][1]
+        conn_hash = self.__get_conn_hash(db_nickname)
+        sql = dict([(s[0], ScriptContent.resolve(s[2])) for s in scripts])
+        graph = CodeDependencyGraph(sql.items())
+        to_run = set(sql.keys())
+        checksums = {}
+        if checksum_type is not None:
+            previous = self.__get_checksums(conn_hash, checksum_type, {})
+            checksums = dict([(n, ScriptContent.checksum_of(s)) for n, s in sql.items()])
+            if not self.force:
+                to_run = graph.get_downstream([n for n in sql.keys() if previous.get(n) != checksums[n]])
+                for n in sorted(set(sql.keys()) - to_run):
+                    if (self.is_debug_printing):
+                        print "Skip unchanged {0} on {1}".format(n, db_nickname)
+                    if self.observers:
+                        self.observers.notify("script_skipped", self.phase, db_nickname, n, MigrationObserver.SKIPPED_UNCHANGED)
+
+        sessions = [conn_hash]
+        for i in range(1, min(self.dependency_workers, len(to_run))):
+            h = self.database_handler.get_session_connection_hash(conn_hash, i)
+            if h is None:
+                break
+            sessions.append(h)
+
+        def run(script_name, worker):
+            self.__execute(db_nickname, script_name, sql[script_name], conn_hash = sessions[worker])
+            if checksum_type is not None:
+                self.database_handler.record_script_checksum(sessions[worker], checksum_type, script_name, checksums[script_name])
+        graph.run(run, len(sessions), to_run)
+
+    def __execute_streams_in_parallel(self, streams, execute_stream):
+        """Runs each database's scripts on its own worker thread.  A failure
+stops only that database's stream; all failures are raised together
+once every stream is done."""
+        pending = Queue.Queue()
+        for db_nickname in sorted(streams.keys()):
+            pending.put(db_nickname)
+        failures = []
+
+        def work():
+            while True:
+                try:
+                    db_nickname = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    execute_stream(streams[db_nickname])
+                except Exception as e:
+                    logging.getLogger('dbmigrator').error("Failed on %s" % db_nickname, exc_info = True)
+                    failures.append((db_nickname, e))
+
+        workers = [threading.Thread(target = work) for i in range(min(self.max_workers, len(streams)))]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+        if len(failures) > 0:
+            failures.sort(key = lambda f: f[0])
+            msg = "; ".join(["{0}: {1}".format(db, e) for db, e in failures])
+            raise ScriptRunnerException("Errors on {0} database(s): {1}".format(len(failures), msg), failures)
+
+    def execute_scripts(self, log_to_table = False, checksum_type = None):
+        """Executes all scripts.  Creates a tracking table and logs script
+names to this table if needed.
+
+If checksum_type is given (eg "code"), untracked scripts are skipped if
+their checksum matches the one recorded under that type for their last
+successful run (unless force is set).
+
+If dependency_order is set, untracked scripts are run in dependency
+order rather than filename order, a database at a time (or
+concurrently, if max_workers > 1)."""
+        if self.dependency_order and not log_to_table:
+            execute_stream = lambda scripts: self.__execute_in_dependency_order(scripts, checksum_type)
+        else:
+            execute_stream = lambda scripts: self.__execute_stream(scripts, log_to_table, checksum_type)
+        streams = self.queued_scripts_collection.get_sorted_scripts_by_db()
+        if self.max_workers > 1 and len(streams) > 1:
+            self.__execute_streams_in_parallel(streams, execute_stream)
+        elif self.dependency_order and not log_to_table:
+            for db_nickname in sorted(streams.keys()):
+                execute_stream(streams[db_nickname])
+        else:
+            self.__execute_stream(self.queued_scripts_collection.get_sorted_scripts(), log_to_table, checksum_type)
+
+
+class ScriptContent(object):
+    """Content of a script that is only loaded when the script is actually
+run.  DatabaseSources can return these in place of sql strings to keep
+scripts that are never executed (eg, already-applied migrations) out
+of memory."""
+
+    __metaclass__ = ABCMeta
+
+    """False for content that isn't sql (eg, bulk data), which is run
+through execute_on instead of the handler's execute."""
+    is_sql = True
+
+    @abstractmethod
+    def read(self):
+        """Returns the script's sql."""
+        pass
+
+    @abstractmethod
+    def size(self):
+        """Returns the size of the script in bytes, without reading it."""
+        pass
+
+    def open(self):
+        """Returns a file-like object to read the script's sql from.
+Sources of very large scripts should override this to avoid reading
+the whole script into memory."""
+        return StringIO(self.read())
+
+    def checksum(self):
+        """Returns a hash of the script's content (see combine_checksum)."""
+        return self.combine_checksum(self.content_checksum())
+
+    def combine_checksum(self, content_checksum):
+        """Returns the script's checksum, given its content_checksum.
+Overridden by scripts whose checksum also covers other inputs (eg,
+settings read from elsewhere)."""
+        return content_checksum
+
+    def content_checksum(self):
+        """Returns a hash of the content read from open()."""
+        h = hashlib.sha1()
+        f = self.open()
+        try:
+            for chunk in iter(lambda: f.read(1024 * 1024), ""):
+                h.update(chunk)
+        finally:
+            f.close()
+        return h.hexdigest()
+
+    @staticmethod
+    def resolve(content):
+        """Returns the sql for content that may be a ScriptContent or a plain string."""
+        if isinstance(content, ScriptContent):
+            return content.read()
+        return content
+
+    @staticmethod
+    def size_of(content):
+        """Returns the size of content that may be a ScriptContent or a plain string."""
+        if isinstance(content, ScriptContent):
+            return content.size()
+        return len(content)
+
+    @staticmethod
+    def checksum_of(content):
+        """Returns the checksum for content that may be a ScriptContent or a plain string."""
+        if isinstance(content, ScriptContent):
+            return content.checksum()
+        return hashlib.sha1(content).hexdigest()
+
+
+class BulkLoadContent(ScriptContent):
+    """Delimited data (eg, a CSV file) to be bulk loaded into a table by
+the DatabaseHandler's bulk_load, rather than run as sql.  The first
+line of the data is a header of column names.
+
+Subclasses must set:
+- table: name of the table to load
+- delimiter: field delimiter (eg, "," or "\\t")
+- mode: "truncate" (empty the table, then load), "merge" (load into a
+  staging table, then update matching rows and insert new ones), or
+  "append" (just load)
+- key_columns: list of columns matching staged rows to table rows, for "merge"
+- null: string representing NULL in the data ("" by default)
+- path: the data file's path, for bulk loaders that read files
+  themselves (eg, MySql's LOAD DATA LOCAL INFILE)"""
+
+    is_sql = False
+
+    MODES = ("truncate", "merge", "append")
+
+    null = ""
+    key_columns = []
+    path = None
+
+    @abstractmethod
+    def get_columns(self):
+        """Returns the column names given in the header line."""
+        pass
+
+    def execute_on(self, database_handler, conn_hash):
+        """Returns the number of rows loaded, if known."""
+        return database_handler.bulk_load(conn_hash, self)
 
 
 class DatabaseSource(object):
@@ -191,6 +892,9 @@ class.
 The various *_files methods should return lists of (filename, content)
 tuples [(scriptname, sql_contained_in_script), ...]  (eg, [(db.sql,
 "create table SomeTable(id int); /* etc. */")]
+
+The content can also be a ScriptContent, which is only read if the
+script is run.
     """
 
     __metaclass__ = ABCMeta
@@ -247,6 +951,63 @@ to create/destroy databases."""
         """Returns migrations for database."""
         pass
 
+    def get_squashed_migrations(self, database_name):
+        """Returns the names of the migrations whose changes are already in
+the baseline schema (see Migrator.squash_migrations).  They are
+recorded as applied when the baseline schema is run."""
+        return []
+
+    def write_squashed_baseline(self, database_name, schema_sql, migration_names):
+        """Replaces the database's baseline schema with the schema_sql, and
+its list of squashed migrations with migration_names.  Only required
+for sources used with Migrator.squash_migrations."""
+        raise NotImplementedError("{0} does not support squashing".format(self.__class__.__name__))
+
+    def close(self):
+        """Called by Migrator.close at the end of a run.  Sources that cache
+anything for the duration of a run should override this."""
+        pass
+
+
+class SuffixedDatabaseSource(DatabaseSource):
+    """Wraps a DatabaseSource, giving the same scripts for databases named
+<dbname><suffix> (eg, the template databases of
+Migrator.create_from_templates, and the scratch databases of
+Migrator.squash_migrations)."""
+
+    def __init__(self, database_source, suffix):
+        self.database_source = database_source
+        self.suffix = suffix
+
+    def get_db_name_from_nickname(self, nickname):
+        return self.database_source.get_db_name_from_nickname(nickname) + self.suffix
+
+    def get_system_connection_hash(self):
+        return self.database_source.get_system_connection_hash()
+
+    def get_connection_hashes(self):
+        hashes = {}
+        for nickname, conn in self.database_source.get_connection_hashes().items():
+            template_conn = dict(conn)
+            template_conn["dbname"] = conn["dbname"] + self.suffix
+            hashes[nickname] = template_conn
+        return hashes
+
+    def get_baseline_schema_files(self, database_name):
+        return self.database_source.get_baseline_schema_files(database_name)
+
+    def get_reference_data_files(self, database_name):
+        return self.database_source.get_reference_data_files(database_name)
+
+    def get_code_files(self, database_name):
+        return self.database_source.get_code_files(database_name)
+
+    def get_migrations_files(self, database_name):
+        return self.database_source.get_migrations_files(database_name)
+
+    def get_squashed_migrations(self, database_name):
+        return self.database_source.get_squashed_migrations(database_name)
+
 
 class DatabaseHandler(object):
     """Interface describing database operations required for the Migrator.
@@ -255,6 +1016,12 @@ server, etc)."""
 
     __metaclass__ = ABCMeta
 
+    """SqlStatementSplitter dialect used to split streamed scripts."""
+    sql_dialect = "ansi"
+
+    """Returned by execute_tracked for a script it has deferred."""
+    DEFERRED = object()
+
     @abstractmethod
     def delete_make_new(self, system_connection_hash, database_name):
         """DELETES DATABASES, and creates empty new databases."""
@@ -276,13 +1043,145 @@ server, etc)."""
         pass
 
     @abstractmethod
-    def record_script_in_tracking_table(self, conn_hash, script_name):
-        """Records a given migration script in the table created via a call to create_tracking_table."""
+    def get_applied_scripts(self, connection_hash):
+        """Returns the names of all scripts in the tracking table (assumes
+tbl is present).  Lets callers check many scripts with a single query."""
+        pass
+
+    def tracking_table_exists(self, connection_hash):
+        """Returns True if the tracking table has been created.  Only
+required for handlers used with Migrator.plan, which must not create
+it."""
+        raise NotImplementedError("{0} does not support planning".format(self.__class__.__name__))
+
+    @abstractmethod
+    def record_script_in_tracking_table(self, conn_hash, script_name, duration_ms = None, rows_affected = None):
+        """Records a given migration script in the table created via a call
+to create_tracking_table, with how long it took to run and the number
+of rows it affected (None if unknown)."""
         pass
 
     @abstractmethod
     def execute(self, conn_hash, sql):
         """Executes sql on the database.  Should handle batch separators in
-script (eg, ';' for postgres, 'GO' for mssql server)."""
+script (eg, ';' for postgres, 'GO' for mssql server).  Returns the
+number of rows affected, or None if the driver doesn't report it."""
         pass
-        
+
+    def query(self, connection_hash, sql):
+        """Returns the rows (as tuples) selected by the sql.  Only required
+for handlers used to look up tenant databases (see tenants.query_tenants)."""
+        raise NotImplementedError("{0} does not support queries".format(self.__class__.__name__))
+
+    def create_checksum_table(self, connection_hash):
+        """Creates the table of script checksums if needed.  Only required
+for handlers used with Migrator.skip_unchanged."""
+        raise NotImplementedError("{0} does not support script checksums".format(self.__class__.__name__))
+
+    def get_script_checksums(self, connection_hash, script_type):
+        """Returns hash of script name => checksum for all scripts of the
+script_type (eg, "code") in the checksum table."""
+        raise NotImplementedError("{0} does not support script checksums".format(self.__class__.__name__))
+
+    def record_script_checksum(self, connection_hash, script_type, script_name, checksum):
+        """Inserts or updates the checksum for the script in the checksum table."""
+        raise NotImplementedError("{0} does not support script checksums".format(self.__class__.__name__))
+
+    def execute_stream(self, conn_hash, stream):
+        """Executes sql read from a file-like stream, one statement at a
+time, with memory bounded by the largest statement.  Raises a
+SqlStatementException identifying the failing statement.  Returns the
+total rows affected by the statements, or None if none were reported.
+
+Each statement is run on its own, so unless the handler overrides this
+(see PostgresDatabaseHandler), a streamed script isn't atomic: the
+statements before a failing one stay applied."""
+        total = None
+        for statement in SqlStatementSplitter(self.sql_dialect).split(stream):
+            try:
+                rows = self.execute(conn_hash, statement.sql)
+            except Exception as e:
+                raise SqlStatementException(statement, e), None, sys.exc_info()[2]
+            if rows is not None:
+                total = (total or 0) + rows
+        return total
+
+    def execute_stream_tracked(self, conn_hash, script_name, stream):
+        """execute_stream for a migration script, which is then recorded (with
+its duration and rows affected) in the tracking table.  Returns the
+rows affected.  Handlers that can run streamed scripts in a transaction
+can override this to record the script in the same transaction."""
+        start = time.time()
+        rows = self.execute_stream(conn_hash, stream)
+        self.record_script_in_tracking_table(conn_hash, script_name, elapsed_ms(start), rows)
+        return rows
+
+    def bulk_load(self, conn_hash, data):
+        """Bulk loads BulkLoadContent data into its table using the
+platform's bulk loader, streaming the data rather than reading it
+whole.  Returns the number of rows loaded, or None if unknown."""
+        raise NotImplementedError("{0} does not support bulk loading".format(self.__class__.__name__))
+
+    def execute_tracked(self, conn_hash, script_name, sql):
+        """Executes a migration script and records it, with its duration
+and rows affected, in the tracking table.  Returns the rows affected.
+Handlers for platforms with transactional DDL can override this to do
+both in a single transaction.
+
+Handlers can instead defer the script, to run it later along with
+others, returning DEFERRED.  Deferred scripts must have been run by the
+time flush_tracking_table returns, their results returned by
+pop_deferred_results, and a failure raised as a DeferredScriptException
+by whichever call runs them."""
+        start = time.time()
+        rows = self.execute(conn_hash, sql)
+        self.record_script_in_tracking_table(conn_hash, script_name, elapsed_ms(start), rows)
+        return rows
+
+    def pop_deferred_results(self, conn_hash):
+        """Returns, and forgets, the (script_name, duration_ms, rows_affected)
+of the scripts deferred by execute_tracked that have since run (and
+been recorded), in order.  duration_ms is None if not known."""
+        return []
+
+    def flush_tracking_table(self, conn_hash):
+        """Runs any deferred scripts, and writes any tracking table records
+that the handler has buffered rather than written immediately.  Called
+by the ScriptRunner when it has finished running scripts on the
+connection, even on failure."""
+        pass
+
+    def dump_schema(self, connection_hash):
+        """Returns sql that re-creates the database's schema (without the
+tracking and checksum tables, or any data).  Only required for
+handlers used with Migrator.squash_migrations."""
+        raise NotImplementedError("{0} does not support schema dumps".format(self.__class__.__name__))
+
+    def get_template_checksum(self, system_connection_hash, template_name):
+        """Returns the checksum that mark_template recorded for the template
+database, or None if the database doesn't exist or wasn't marked.
+Only required for handlers used with Migrator.create_from_templates."""
+        raise NotImplementedError("{0} does not support template databases".format(self.__class__.__name__))
+
+    def mark_template(self, system_connection_hash, template_name, checksum):
+        """Records the checksum of the scripts the template database was built from."""
+        raise NotImplementedError("{0} does not support template databases".format(self.__class__.__name__))
+
+    def create_from_template(self, system_connection_hash, database_name, template_name):
+        """DELETES THE DATABASE, and creates it anew as a copy of the template database."""
+        raise NotImplementedError("{0} does not support template databases".format(self.__class__.__name__))
+
+    def get_session_connection_hash(self, connection_hash, session):
+        """Returns a connection hash for a separate connection (numbered
+session, from 1) to the same database, used to run independent code
+scripts concurrently.  Handlers that can't have several connections to
+a database open at once return None."""
+        h = dict(connection_hash)
+        h["session"] = session
+        return h
+
+    def close_connections(self):
+        """Closes any connections held open by the handler.  Handlers that
+reuse connections across calls should override this."""
+        pass
+
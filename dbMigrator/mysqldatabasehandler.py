@@ -1,100 +1,498 @@
+import contextlib
 import logging
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+import warnings
 import MySQLdb
-from warnings import filterwarnings
-from warnings import resetwarnings
+from MySQLdb.constants import CLIENT
 
-from migrator import DatabaseHandler
+from migrator import DatabaseHandler, DeferredScriptException, elapsed_ms
+from connectioncache import ConnectionCache
+from chunkedmigration import ChunkedMigration
+from mysqlonlinealter import MySqlOnlineAlter
+from sqlsplitter import SqlStatementSplitter, SqlStatementException
 logger = logging.getLogger('dbmigrator')
 
+# Warning filters are process-wide, so are only changed by one thread at
+# a time (see _ignoring_mysql_warnings).
+_warnings_lock = threading.Lock()
+
+@contextlib.contextmanager
+def _ignoring_mysql_warnings():
+    """Ignores MySQLdb warnings in the block, restoring the warning filters
+as they were after it."""
+    with _warnings_lock:
+        with warnings.catch_warnings():
+            warnings.filterwarnings('ignore', category = MySQLdb.Warning)
+            yield
+
+
 class MySqlDatabaseHandler(DatabaseHandler):
     """MySql-specific implementation of the DatabaseHandler."""
 
-    def __get_open_connection(self, connection_hash):
-        """Opens a connection to the database."""
+    sql_dialect = "mysql"
+
+    """Tracking table columns added since the table was first released."""
+    TRACKING_COLUMNS = [("duration_ms", "integer"), ("rows_affected", "bigint")]
+
+    """DELIMITER lines are mysql client syntax, which the server rejects."""
+    DELIMITER_PATTERN = re.compile(r"^\s*delimiter\s", re.IGNORECASE | re.MULTILINE)
+
+    """Compound statements (BEGIN ... END bodies) contain semicolons that
+the server doesn't treat as statement separators."""
+    COMPOUND_PATTERN = re.compile(r"\bbegin\b", re.IGNORECASE)
+
+    """Session (see DatabaseHandler.get_session_connection_hash) of the
+connection used by bulk_load, the only one opened with LOAD DATA LOCAL
+INFILE enabled."""
+    BULK_LOAD_SESSION = "bulk_load"
+
+    def __init__(self):
+        super(MySqlDatabaseHandler, self).__init__()
+        self.connections = ConnectionCache(self.__open_connection, self.__is_alive)
+
+        # Number of tracking rows to buffer before writing them with a
+        # single multi-row insert (1 = write each row immediately).
+        # MySql DDL commits implicitly, so a migration and its tracking
+        # row can't share a transaction; buffered rows are lost if the
+        # process dies before they're flushed.
+        self.tracking_batch_size = 1
+        self.tracking_buffer = {}
+
+        # Number of small pending migrations to send to the server in a
+        # single multi-statement round trip (1 = send each separately).
+        # Scripts larger than script_pack_max_bytes, and scripts with
+        # DELIMITER lines or BEGIN ... END bodies, are always sent
+        # separately.  Packed scripts are deferred (see
+        # DatabaseHandler.execute_tracked), and tracked (without a
+        # duration) once the pack has run, up to the first failure.
+        self.script_pack_size = 1
+        self.script_pack_max_bytes = 16 * 1024
+        self.script_packs = {}
+        self.packed_results = {}
+
+        # Defaults for online alters (scripts marked "-- dbmigrator:
+        # online-alter", see MySqlOnlineAlter): rows copied per chunk,
+        # seconds to sleep between chunks, and seconds between progress
+        # log messages.
+        self.online_alter_chunk_size = 10000
+        self.online_alter_sleep = 0
+        self.online_alter_progress_interval = 30
+
+    def __open_connection(self, connection_hash):
+        """Opens a new autocommit connection to the database.  Only bulk
+load connections can read local files (which a malicious server could
+otherwise request)."""
         db = MySQLdb.connect(
             host=connection_hash["host"],
             user=connection_hash["user"],
             passwd=connection_hash["password"],
-            db=connection_hash["dbname"]
+            db=connection_hash["dbname"],
+            local_infile=1 if connection_hash.get("session") == MySqlDatabaseHandler.BULK_LOAD_SESSION else 0,
+            client_flag=CLIENT.MULTI_STATEMENTS | CLIENT.MULTI_RESULTS
         )
+        db.autocommit(True)
         return db
 
+    def __is_alive(self, conn):
+        """Health check for cached connections."""
+        conn.ping()
+        return True
+
+    def __get_open_connection(self, connection_hash):
+        """Gets a (cached) open connection to the database."""
+        return self.connections.get(connection_hash)
+
+    def close_connections(self):
+        if len(self.script_packs) > 0:
+            logger.warning("Closing connections with unsent packed scripts")
+            self.script_packs = {}
+        self.packed_results = {}
+        self.connections.close_all()
+
     def delete_make_new(self, system_connection_hash, database_name):
         """Creates new database, deletes the old."""
         # MySQLdb prints warnings when using "drop database if exists",
         # these warnings add no value and can be ignored.
         # http://www.nomadjourney.com/2010/04/suppressing-mysqlmysqldb-warning-messages-from-python/
-        filterwarnings('ignore', category = MySQLdb.Warning)
-        conn = self.__get_open_connection(system_connection_hash)
-        conn.autocommit(True)
-        cursor = conn.cursor()
-        cursor.execute("drop database if exists {0}".format(database_name))
-        cursor.execute("create database {0}".format(database_name))
-        resetwarnings()
-        cursor.close()
-        conn.close()
+        self.connections.discard_database(database_name)
+        with _ignoring_mysql_warnings():
+            self.__execute(system_connection_hash, "drop database if exists {0}".format(database_name))
+            self.__execute(system_connection_hash, "create database {0}".format(database_name))
 
 
-    def __execute(self, conn_hash, sql):
-        """Executes sql, Throws on error."""
+    def __execute(self, conn_hash, sql, statement_rows = None):
+        """Executes sql, which may hold several statements, reading the
+results of all of them.  Returns the total rows affected (None if not
+reported), and appends each statement's rows affected to statement_rows
+if given.  Throws on error, with a SqlStatementException identifying
+the failing statement of a multi-statement script."""
+        if statement_rows is None:
+            statement_rows = []
         conn = self.__get_open_connection(conn_hash)
-        conn.autocommit(True)
         cursor = conn.cursor()
         try:
             cursor.execute(sql)
+            statement_rows.append(self.__rows_affected(cursor))
+            # Errors in later statements are raised on reaching their results.
+            while cursor.nextset():
+                statement_rows.append(self.__rows_affected(cursor))
+        except MySQLdb.OperationalError as e:
+            # Lost connections are reopened on the next call.
+            logger.error("Executing sql: %s"  % e)
+            self.connections.discard(conn_hash)
+            self.__raise_for_statement(sql, len(statement_rows), e)
         except Exception as e:
             logger.error("Executing sql: %s"  % e)
-            raise
+            self.__raise_for_statement(sql, len(statement_rows), e)
+        finally:
+            cursor.close()
+        return self.__total_rows(statement_rows)
+
+    def __total_rows(self, statement_rows):
+        """Sum of the rows affected, or None if none were reported."""
+        reported = [r for r in statement_rows if r is not None]
+        if len(reported) == 0:
+            return None
+        return sum(reported)
+
+    def __raise_for_statement(self, sql, index, error):
+        """Re-raises the current error as a SqlStatementException for the
+index'th (0-based) statement of the sql, if the sql holds several
+statements that can be matched to the server's, else as is."""
+        exc_info = sys.exc_info()
+        statements = []
+        if not MySqlDatabaseHandler.COMPOUND_PATTERN.search(sql):
+            statements = SqlStatementSplitter(self.sql_dialect).split_string(sql)
+        if len(statements) < 2 or index >= len(statements):
+            raise exc_info[0], exc_info[1], exc_info[2]
+        raise SqlStatementException(statements[index], error), None, exc_info[2]
+
+    def __rows_affected(self, cursor):
+        """Cursor rowcount, or None if the driver didn't report one."""
+        if cursor.rowcount is None or cursor.rowcount < 0:
+            return None
+        return cursor.rowcount
+
+    def __fetchall(self, conn_hash, sql):
+        """Returns all records for the query."""
+        conn = self.__get_open_connection(conn_hash)
+        cursor = conn.cursor()
+        try:
+            cursor.execute(sql)
+            return cursor.fetchall()
         finally:
             cursor.close()
-            conn.close()
 
     def user_defined_tables_exist(self, connection_hash):
         sql = """select table_name from information_schema.tables
         where (table_type = 'BASE TABLE' and table_schema = '{0}')
         limit 1""".format(connection_hash["dbname"])
-        conn = self.__get_open_connection(connection_hash)
-        cursor = conn.cursor()
-        cursor.execute(sql)
-        r = cursor.fetchall()
-        cursor.close()
-        conn.close()
+        r = self.__fetchall(connection_hash, sql)
         return (len(r) != 0)
 
 
     def create_tracking_table(self, connection_hash):
-        """Creates table if needed."""
+        """Creates table if needed, and adds any columns missing from tables
+created by earlier versions."""
         # Mysql raising a 'table already exists' warning,
         # regardless of the use of 'create table if not exists'.
         # This can be ignored.
-        filterwarnings('ignore', category = MySQLdb.Warning)
         # Using lowercase table name, as MySql is case-sensitive.
         sql = """create table if not exists __schema_migrations
 (
   migration_id serial primary key,
   script_name varchar(255),
-  date_applied timestamp not null default CURRENT_TIMESTAMP
+  date_applied timestamp not null default CURRENT_TIMESTAMP,
+  duration_ms integer,
+  rows_affected bigint
 )"""
-        self.__execute(connection_hash, sql)
-        resetwarnings()
+        with _ignoring_mysql_warnings():
+            self.__execute(connection_hash, sql)
+
+        # MySql has no "add column if not exists".
+        sql = """select column_name from information_schema.columns
+        where table_schema = database() and table_name = '__schema_migrations'"""
+        existing = set([row[0].lower() for row in self.__fetchall(connection_hash, sql)])
+        added = [(c, t) for c, t in MySqlDatabaseHandler.TRACKING_COLUMNS if not (c in existing)]
+        if len(added) > 0:
+            adds = ", ".join(["add column {0} {1}".format(c, t) for c, t in added])
+            self.__execute(connection_hash, "alter table __schema_migrations " + adds)
 
 
     def is_in_tracking_table(self, connection_hash, script_name):
         """Returns True if script is in tracking table (assumes tbl is present)"""
         sql = "select script_name from __schema_migrations where script_name = '{0}'".format(script_name)
+        r = self.__fetchall(connection_hash, sql)
+        return (len(r) > 0)
+
+
+    def tracking_table_exists(self, connection_hash):
+        sql = """select table_name from information_schema.tables
+        where table_schema = database() and table_name = '__schema_migrations'"""
+        r = self.__fetchall(connection_hash, sql)
+        return (len(r) != 0)
+
+
+    def get_applied_scripts(self, connection_hash):
+        """Returns set of all script names in tracking table (assumes tbl is present)"""
+        sql = "select script_name from __schema_migrations"
+        r = self.__fetchall(connection_hash, sql)
+        return set([row[0] for row in r])
+
+    def query(self, connection_hash, sql):
+        """Returns the rows (as tuples) selected by the sql."""
+        return [tuple(row) for row in self.__fetchall(connection_hash, sql)]
+
+    def create_checksum_table(self, connection_hash):
+        """Creates table of code and reference data checksums if needed."""
+        sql = """create table if not exists __script_checksums
+(
+  script_type varchar(32) not null,
+  script_name varchar(255) not null,
+  checksum varchar(64) not null,
+  date_applied timestamp not null default CURRENT_TIMESTAMP,
+  primary key (script_type, script_name)
+)"""
+        with _ignoring_mysql_warnings():
+            self.__execute(connection_hash, sql)
+
+    def dump_schema(self, connection_hash):
+        """Returns the schema from mysqldump (which must be on the path),
+without the tracking, checksum and checkpoint tables or auto_increment
+counters."""
+        hsh = connection_hash
+        db = hsh["dbname"]
+        args = ["mysqldump", "--no-data", "--compact", "--skip-add-drop-table",
+                "--ignore-table={0}.__schema_migrations".format(db),
+                "--ignore-table={0}.__script_checksums".format(db),
+                "--ignore-table={0}.{1}".format(db, MySqlOnlineAlter.CHECKPOINT_TABLE),
+                "--ignore-table={0}.{1}".format(db, ChunkedMigration.CHECKPOINT_TABLE),
+                "--host", hsh["host"], "--user", hsh["user"], db]
+        env = dict(os.environ)
+        env["MYSQL_PWD"] = hsh["password"]
+        dump = subprocess.check_output(args, env = env)
+        return re.sub(r" AUTO_INCREMENT=\d+", "", dump)
+
+    def get_script_checksums(self, connection_hash, script_type):
+        """Returns hash of script name => last run checksum for the script type."""
         conn = self.__get_open_connection(connection_hash)
         cursor = conn.cursor()
-        cursor.execute(sql)
-        r = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        return (len(r) > 0)
+        try:
+            cursor.execute("select script_name, checksum from __script_checksums where script_type = %s", [script_type])
+            return dict(cursor.fetchall())
+        finally:
+            cursor.close()
+
+    def record_script_checksum(self, connection_hash, script_type, script_name, checksum):
+        """Upserts the checksum for the script."""
+        sql = """insert into __script_checksums(script_type, script_name, checksum) values (%s, %s, %s)
+on duplicate key update checksum = values(checksum), date_applied = CURRENT_TIMESTAMP"""
+        conn = self.__get_open_connection(connection_hash)
+        cursor = conn.cursor()
+        try:
+            cursor.execute(sql, [script_type, script_name, checksum])
+        finally:
+            cursor.close()
+
+
+    def record_script_in_tracking_table(self, conn_hash, script_name, duration_ms = None, rows_affected = None):
+        """Records the script, or buffers it if tracking_batch_size > 1."""
+        self.flush_script_pack(conn_hash)
+        row = (script_name, duration_ms, rows_affected)
+        if self.tracking_batch_size <= 1:
+            self.__insert_tracking_rows(conn_hash, [row])
+            return
+        key = ConnectionCache.get_key(conn_hash)
+        buffered = self.tracking_buffer.setdefault(key, [])
+        buffered.append(row)
+        if len(buffered) >= self.tracking_batch_size:
+            self.flush_tracking_table(conn_hash)
+
+    def flush_tracking_table(self, conn_hash):
+        """Runs any packed scripts, and writes buffered tracking rows with a
+single insert."""
+        self.flush_script_pack(conn_hash)
+        buffered = self.tracking_buffer.pop(ConnectionCache.get_key(conn_hash), [])
+        if len(buffered) > 0:
+            self.__insert_tracking_rows(conn_hash, buffered)
+
+    def __insert_tracking_rows(self, conn_hash, rows):
+        """Multi-row insert into the tracking table of (script_name,
+duration_ms, rows_affected) tuples."""
+        values = ", ".join(["(%s, %s, %s)"] * len(rows))
+        sql = "insert into __schema_migrations(script_name, duration_ms, rows_affected) values " + values
+        conn = self.__get_open_connection(conn_hash)
+        cursor = conn.cursor()
+        try:
+            cursor.execute(sql, [v for row in rows for v in row])
+        finally:
+            cursor.close()
+
+    def bulk_load(self, conn_hash, data):
+        """Streams the data file into its table with LOAD DATA LOCAL INFILE,
+in a single transaction (so that a failed load leaves the table as it
+was, for transactional storage engines like InnoDB).  The table is
+emptied with a delete rather than truncate, which would commit.  Merges
+go through a temporary staging table.  Fields equal to data.null (or
+\\N) are loaded as NULL.  Runs on a separate connection (see
+BULK_LOAD_SESSION).  Returns the number of rows loaded."""
+        self.flush_script_pack(conn_hash)
+        conn_hash = dict(conn_hash)
+        conn_hash["session"] = MySqlDatabaseHandler.BULK_LOAD_SESSION
+        columns = data.get_columns()
+        variables = ["@c{0}".format(i) for i in range(len(columns))]
+        load = """load data local infile %s into table {0}
+character set utf8
+fields terminated by %s optionally enclosed by '"'
+lines terminated by '\\n'
+ignore 1 lines ({1})
+set {2}"""
+        nulls = ", ".join(["{0} = nullif({1}, %s)".format(c, v) for c, v in zip(columns, variables)])
+        target = data.table
+        if data.mode == "merge":
+            target = "__staging_" + data.table.replace(".", "_")
+            self.__execute(conn_hash, "drop temporary table if exists " + target)
+            self.__execute(conn_hash, "create temporary table {0} like {1}".format(target, data.table))
+
+        conn = self.__get_open_connection(conn_hash)
+        cursor = conn.cursor()
+        try:
+            cursor.execute("start transaction")
+            if data.mode == "truncate":
+                cursor.execute("delete from " + data.table)
+            params = [data.path, data.delimiter] + [data.null] * len(columns)
+            cursor.execute(load.format(target, ", ".join(variables), nulls), params)
+            rows = self.__rows_affected(cursor)
+            if data.mode == "merge":
+                match = " and ".join(["t.{0} = s.{0}".format(k) for k in data.key_columns])
+                others = [c for c in columns if not (c in data.key_columns)]
+                if len(others) > 0:
+                    assignments = ", ".join(["t.{0} = s.{0}".format(c) for c in others])
+                    cursor.execute("update {0} t join {1} s on {2} set {3}".format(data.table, target, match, assignments))
+                insert = "insert into {0} ({1}) select {2} from {3} s where not exists (select 1 from {0} t where {4})"
+                s_cols = ", ".join(["s." + c for c in columns])
+                cursor.execute(insert.format(data.table, ", ".join(columns), s_cols, target, match))
+            cursor.execute("commit")
+            return rows
+        except Exception as e:
+            logger.error("Bulk loading %s: %s"  % (data.table, e))
+            try:
+                cursor.execute("rollback")
+            except Exception:
+                self.connections.discard(conn_hash)
+            raise
+        finally:
+            cursor.close()
+            if data.mode == "merge":
+                try:
+                    self.__execute(conn_hash, "drop temporary table if exists " + target)
+                except Exception as e:
+                    logger.error("Dropping staging table %s: %s" % (target, e))
+
+    def can_pack(self, sql):
+        """True if the script can be sent to the server with others."""
+        return (len(sql) <= self.script_pack_max_bytes and
+                not MySqlDatabaseHandler.DELIMITER_PATTERN.search(sql) and
+                not MySqlDatabaseHandler.COMPOUND_PATTERN.search(sql) and
+                not MySqlOnlineAlter.is_online_alter(sql))
+
+    def execute_tracked(self, conn_hash, script_name, sql):
+        """Adds the script to the connection's pack if script_pack_size > 1
+and the script can be packed, returning DEFERRED; otherwise runs and
+records it."""
+        if self.script_pack_size <= 1 or not self.can_pack(sql):
+            self.flush_script_pack(conn_hash)
+            return super(MySqlDatabaseHandler, self).execute_tracked(conn_hash, script_name, sql)
+        key = ConnectionCache.get_key(conn_hash)
+        if not (key in self.script_packs):
+            # Keep tracking rows in execution order.
+            self.flush_tracking_table(conn_hash)
+        pack = self.script_packs.setdefault(key, [])
+        pack.append((script_name, sql))
+        if len(pack) >= self.script_pack_size:
+            self.flush_script_pack(conn_hash)
+        return DatabaseHandler.DEFERRED
+
+    def flush_script_pack(self, conn_hash):
+        """Runs the connection's packed scripts in a single round trip, and
+records those that succeeded (up to the first failure, when MySql stops
+executing) in the tracking table.  Their results are then returned by
+pop_deferred_results.  Throws a DeferredScriptException naming the
+script that failed."""
+        pack = self.script_packs.pop(ConnectionCache.get_key(conn_hash), [])
+        if len(pack) == 0:
+            return
+        splitter = SqlStatementSplitter(self.sql_dialect)
+        scripts = [(name, splitter.split_string(sql)) for name, sql in pack]
+        sql = ";\n".join([s.sql for name, statements in scripts for s in statements])
+        statement_rows = []
+        start = time.time()
+        try:
+            self.__execute(conn_hash, sql, statement_rows)
+        except Exception as e:
+            exc_info = sys.exc_info()
+            failed = pack[0][0]
+            try:
+                failed = self.__record_packed_scripts(conn_hash, scripts, statement_rows, elapsed_ms(start)) or pack[-1][0]
+            except Exception as record_error:
+                logger.error("Recording packed scripts: %s" % record_error)
+            raise DeferredScriptException(failed, "{0} (packed with {1} other script(s))".format(
+                e, len(pack) - 1)), None, exc_info[2]
+        self.__record_packed_scripts(conn_hash, scripts, statement_rows, elapsed_ms(start))
+
+    def pop_deferred_results(self, conn_hash):
+        """Results of the packed scripts that have run.  Their duration is
+that of the whole pack."""
+        return self.packed_results.pop(ConnectionCache.get_key(conn_hash), [])
 
+    def __record_packed_scripts(self, conn_hash, scripts, statement_rows, duration_ms):
+        """Records the scripts whose statements all ran (per statement_rows),
+with their rows affected, and adds them to the packed results.  Returns
+the name of the first script that didn't complete, if any."""
+        rows = []
+        i = 0
+        for name, statements in scripts:
+            n = len(statements)
+            if i + n > len(statement_rows):
+                break
+            rows.append((name, None, self.__total_rows(statement_rows[i:i + n])))
+            i += n
+        if len(rows) > 0:
+            self.__insert_tracking_rows(conn_hash, rows)
+            results = self.packed_results.setdefault(ConnectionCache.get_key(conn_hash), [])
+            results.extend([(name, duration_ms, rows_affected) for name, _, rows_affected in rows])
+        if len(rows) < len(scripts):
+            return scripts[len(rows)][0]
+        return None
 
-    def record_script_in_tracking_table(self, conn_hash, script_name):
-        sql = "insert into __schema_migrations(script_name) values ('{0}')"
-        self.__execute(conn_hash, sql.format(script_name))
+    def online_alter(self, conn_hash, sql):
+        """Runs (or resumes) the ALTER TABLE script as an online alter (see
+MySqlOnlineAlter).  Returns the number of rows copied."""
+        alter = MySqlOnlineAlter(self, conn_hash, sql, self.online_alter_chunk_size,
+                                 self.online_alter_sleep, self.online_alter_progress_interval)
+        return alter.run()
 
     def execute(self, conn_hash, sql):
-        self.__execute(conn_hash, sql.format(sql))
+        """Sends the script to the server in one round trip, unless it has
+DELIMITER lines, in which case it's run a statement at a time, or is
+marked as an online alter."""
+        self.flush_script_pack(conn_hash)
+        if MySqlOnlineAlter.is_online_alter(sql):
+            return self.online_alter(conn_hash, sql)
+        if MySqlDatabaseHandler.DELIMITER_PATTERN.search(sql):
+            total = None
+            for statement in SqlStatementSplitter(self.sql_dialect).split_string(sql):
+                try:
+                    rows = self.__execute(conn_hash, statement.sql)
+                except Exception as e:
+                    raise SqlStatementException(statement, e), None, sys.exc_info()[2]
+                if rows is not None:
+                    total = (total or 0) + rows
+            return total
+        return self.__execute(conn_hash, sql)
         
@@ -0,0 +1,332 @@
+import datetime
+import decimal
+import json
+import logging
+import re
+import time
+
+from sqlsplitter import SqlStatementSplitter
+
+logger = logging.getLogger('dbmigrator')
+
+
+class OnlineAlterException(Exception):
+    pass
+
+
+def quote_name(name):
+    """Backtick-quoted MySql identifier."""
+    return "`{0}`".format(name.replace("`", "``"))
+
+
+def sql_literal(value):
+    """The value as a MySql literal (for primary key values read back
+from the server, to use in the next chunk's bounds)."""
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, (int, long, float, decimal.Decimal)):
+        return str(value)
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time, datetime.timedelta)):
+        value = str(value)
+    if isinstance(value, unicode):
+        value = value.encode("utf8")
+    return "'{0}'".format(str(value).replace("\\", "\\\\").replace("'", "\\'"))
+
+
+class MySqlOnlineAlter(object):
+    """Runs an ALTER TABLE migration without locking or rebuilding the
+table in place, for tables too large to alter directly.  Used by the
+MySqlDatabaseHandler for scripts with a line starting with the comment
+"-- dbmigrator: online-alter", optionally followed by settings, eg:
+
+-- dbmigrator: online-alter chunk_size=5000 sleep=0.5
+alter table widget add column weight int, add index ix_weight (weight);
+
+The script must be a single ALTER TABLE statement.  The change is made
+to an empty shadow copy of the table, _<table>_new; triggers on the
+table mirror inserts, updates and deletes to the shadow table, while
+rows are copied over in primary key order, chunk_size rows at a time
+(sleeping sleep seconds between chunks, to throttle the load on the
+server and replicas).  The tables are then swapped with a single,
+atomic RENAME TABLE, and the old table dropped.
+
+Progress is saved after each chunk in the __online_schema_changes
+table, so an interrupted change resumes from the last copied chunk
+when the migration is run again.  The table must have a primary key,
+and mustn't be referenced by foreign keys (the rename would leave them
+pointing at the old table)."""
+
+    MARKER_PATTERN = re.compile(r"^\s*--\s*dbmigrator:\s*online-alter\b(.*)$", re.IGNORECASE | re.MULTILINE)
+
+    LEADING_COMMENTS_PATTERN = re.compile(r"^(\s*(--[^\n]*(\n|$)|/\*.*?\*/))*\s*", re.DOTALL)
+
+    ALTER_PATTERN = re.compile(r"^alter\s+table\s+(`[^`]+`|\w+)\s+(.+)$", re.IGNORECASE | re.DOTALL)
+
+    CHECKPOINT_TABLE = "__online_schema_changes"
+
+    """Settings that can be given on the marker line, and their types."""
+    SETTINGS = { "chunk_size": int, "sleep": float, "progress_interval": float }
+
+    @staticmethod
+    def is_online_alter(sql):
+        return MySqlOnlineAlter.MARKER_PATTERN.search(sql) is not None
+
+    @staticmethod
+    def parse(sql):
+        """Returns (table name, alter specification) of the script's single
+ALTER TABLE statement."""
+        statements = SqlStatementSplitter("mysql").split_string(sql)
+        if len(statements) != 1:
+            raise OnlineAlterException("Online alter scripts must be a single ALTER TABLE statement, got {0} statements".format(len(statements)))
+        statement = MySqlOnlineAlter.LEADING_COMMENTS_PATTERN.sub("", statements[0].sql, 1).strip()
+        m = MySqlOnlineAlter.ALTER_PATTERN.match(statement)
+        if m is None:
+            raise OnlineAlterException("Online alter scripts must be a single ALTER TABLE statement: " + statement[:100])
+        return (m.group(1).strip("`"), m.group(2).strip())
+
+    def __init__(self, database_handler, conn_hash, sql, chunk_size = 10000, sleep = 0, progress_interval = 30):
+        """database_handler: the handler running the migration, used to
+execute and query.
+sql: the migration script.
+chunk_size, sleep, progress_interval: defaults for the settings,
+overridden by any on the script's marker line."""
+        self.database_handler = database_handler
+        self.conn_hash = conn_hash
+        self.table, self.alter_specification = MySqlOnlineAlter.parse(sql)
+
+        # Rows copied per chunk.
+        self.chunk_size = chunk_size
+        # Seconds to sleep between chunks.
+        self.sleep = sleep
+        # Seconds between progress log messages.
+        self.progress_interval = progress_interval
+        self.__apply_settings(MySqlOnlineAlter.MARKER_PATTERN.search(sql).group(1))
+        if self.chunk_size < 1:
+            raise OnlineAlterException("chunk_size must be at least 1")
+
+        self.shadow_table = "_{0}_new".format(self.table)
+        self.old_table = "_{0}_old".format(self.table)
+        self.triggers = dict([(event, "__osc_{0}_{1}".format(self.table, event[:3])) for event in ["insert", "update", "delete"]])
+
+    def __apply_settings(self, text):
+        for setting in text.split():
+            name, _, value = setting.partition("=")
+            if not (name in MySqlOnlineAlter.SETTINGS) or value == "":
+                raise OnlineAlterException("Bad online-alter setting {0} (settings are {1})".format(
+                    setting, ", ".join(["{0}=N".format(s) for s in sorted(MySqlOnlineAlter.SETTINGS)])))
+            setattr(self, name, MySqlOnlineAlter.SETTINGS[name](value))
+
+    def __execute(self, sql):
+        return self.database_handler.execute(self.conn_hash, sql)
+
+    def __query(self, sql):
+        return self.database_handler.query(self.conn_hash, sql)
+
+    def __table_exists(self, table):
+        sql = """select count(*) from information_schema.tables
+        where table_schema = database() and table_name = {0}""".format(sql_literal(table))
+        return self.__query(sql)[0][0] > 0
+
+    def get_primary_key(self):
+        sql = """select column_name from information_schema.key_column_usage
+        where table_schema = database() and table_name = {0} and constraint_name = 'PRIMARY'
+        order by ordinal_position""".format(sql_literal(self.table))
+        key = [row[0] for row in self.__query(sql)]
+        if len(key) == 0:
+            raise OnlineAlterException("Online alter of {0} needs a primary key".format(self.table))
+        return key
+
+    def get_columns(self):
+        """Columns of the table kept by the alter, in table order (generated
+columns are left to the server)."""
+        sql = """select table_name, column_name from information_schema.columns
+        where table_schema = database() and table_name in ({0}, {1}) and extra not like '%GENERATED%'
+        order by ordinal_position""".format(sql_literal(self.table), sql_literal(self.shadow_table))
+        rows = self.__query(sql)
+        shadow = set([c.lower() for t, c in rows if t == self.shadow_table])
+        return [c for t, c in rows if t == self.table and c.lower() in shadow]
+
+    def __check_no_referencing_foreign_keys(self):
+        sql = """select table_name, constraint_name from information_schema.referential_constraints
+        where constraint_schema = database() and referenced_table_name = {0}""".format(sql_literal(self.table))
+        fks = ["{0}.{1}".format(t, c) for t, c in self.__query(sql)]
+        if len(fks) > 0:
+            raise OnlineAlterException("Can't alter {0} online, it's referenced by foreign keys {1}".format(self.table, ", ".join(fks)))
+
+    def __triggers_exist(self):
+        names = ", ".join([sql_literal(t) for t in self.triggers.values()])
+        sql = """select count(*) from information_schema.triggers
+        where trigger_schema = database() and trigger_name in ({0})""".format(names)
+        return self.__query(sql)[0][0] == len(self.triggers)
+
+    def __create_checkpoint_table(self):
+        sql = """create table if not exists {0}
+(
+  table_name varchar(64) not null primary key,
+  alter_sql text not null,
+  status varchar(16) not null,
+  last_key text,
+  rows_copied bigint not null default 0,
+  date_started timestamp not null default CURRENT_TIMESTAMP,
+  date_updated timestamp null
+)""".format(MySqlOnlineAlter.CHECKPOINT_TABLE)
+        self.__execute(sql)
+
+    def get_checkpoint(self):
+        """Returns (alter specification, status, last key literals or None,
+rows copied) of the table's saved progress, or None."""
+        sql = "select alter_sql, status, last_key, rows_copied from {0} where table_name = {1}".format(
+            MySqlOnlineAlter.CHECKPOINT_TABLE, sql_literal(self.table))
+        rows = self.__query(sql)
+        if len(rows) == 0:
+            return None
+        alter_sql, status, last_key, rows_copied = rows[0]
+        return (alter_sql, status, json.loads(last_key) if last_key else None, rows_copied)
+
+    def __save_checkpoint(self, status, last_key, rows_copied):
+        sql = "update {0} set status = {1}, last_key = {2}, rows_copied = {3}, date_updated = CURRENT_TIMESTAMP where table_name = {4}".format(
+            MySqlOnlineAlter.CHECKPOINT_TABLE, sql_literal(status),
+            sql_literal(json.dumps(last_key) if last_key is not None else None), rows_copied, sql_literal(self.table))
+        self.__execute(sql)
+
+    def __drop_triggers(self):
+        for name in sorted(self.triggers.values()):
+            self.__execute("drop trigger if exists " + quote_name(name))
+
+    def get_trigger_sql(self, columns, key):
+        """Create trigger statements mirroring changes to the shadow table."""
+        t, s = quote_name(self.table), quote_name(self.shadow_table)
+        names = ", ".join([quote_name(c) for c in columns])
+        new_values = ", ".join(["NEW." + quote_name(c) for c in columns])
+        old_key = " and ".join(["{0} <=> OLD.{0}".format(quote_name(c)) for c in key])
+        replace = "replace into {0} ({1}) values ({2})".format(s, names, new_values)
+        delete = "delete ignore from {0} where {1}".format(s, old_key)
+        create = "create trigger {0} after {1} on {2} for each row "
+        return [
+            create.format(quote_name(self.triggers["insert"]), "insert", t) + replace,
+            create.format(quote_name(self.triggers["update"]), "update", t) + "begin " + delete + "; " + replace + "; end",
+            create.format(quote_name(self.triggers["delete"]), "delete", t) + delete
+        ]
+
+    def __start(self):
+        """Creates the altered shadow table and the triggers, discarding any
+earlier attempt."""
+        self.__check_no_referencing_foreign_keys()
+        key = self.get_primary_key()
+        self.__drop_triggers()
+        self.__execute("drop table if exists " + quote_name(self.shadow_table))
+        self.__execute("create table {0} like {1}".format(quote_name(self.shadow_table), quote_name(self.table)))
+        self.__execute("alter table {0} {1}".format(quote_name(self.shadow_table), self.alter_specification))
+        for sql in self.get_trigger_sql(self.get_columns(), key):
+            self.__execute(sql)
+        sql = "replace into {0} (table_name, alter_sql, status) values ({1}, {2}, 'copying')".format(
+            MySqlOnlineAlter.CHECKPOINT_TABLE, sql_literal(self.table), sql_literal(self.alter_specification))
+        self.__execute(sql)
+
+    def get_chunk_sql(self, columns, key, lower, upper):
+        """Insert of the rows with keys > lower (key literals, None = from the
+start) and <= upper (None = to the end) into the shadow table.  Rows
+already copied by the triggers are newer, and are kept."""
+        key_list = "(" + ", ".join([quote_name(c) for c in key]) + ")"
+        where = []
+        if lower is not None:
+            where.append("{0} > ({1})".format(key_list, ", ".join(lower)))
+        if upper is not None:
+            where.append("{0} <= ({1})".format(key_list, ", ".join(upper)))
+        names = ", ".join([quote_name(c) for c in columns])
+        sql = "insert low_priority ignore into {0} ({1}) select {1} from {2} force index (primary)".format(
+            quote_name(self.shadow_table), names, quote_name(self.table))
+        if len(where) > 0:
+            sql += " where " + " and ".join(where)
+        return sql + " lock in share mode"
+
+    def __get_chunk_upper_bound(self, key, lower):
+        """Key literals of the last row of the chunk after lower, or None if
+fewer than chunk_size rows are left."""
+        names = ", ".join([quote_name(c) for c in key])
+        sql = "select {0} from {1} force index (primary)".format(names, quote_name(self.table))
+        if lower is not None:
+            sql += " where ({0}) > ({1})".format(names, ", ".join(lower))
+        sql += " order by {0} limit 1 offset {1}".format(names, self.chunk_size - 1)
+        rows = self.__query(sql)
+        if len(rows) == 0:
+            return None
+        return [sql_literal(v) for v in rows[0]]
+
+    def __estimate_rows(self):
+        sql = """select table_rows from information_schema.tables
+        where table_schema = database() and table_name = {0}""".format(sql_literal(self.table))
+        rows = self.__query(sql)
+        return rows[0][0] if len(rows) > 0 and rows[0][0] is not None else None
+
+    def __log_progress(self, rows_copied, estimate):
+        msg = "Online alter of {0}: {1} rows copied".format(self.table, rows_copied)
+        if estimate:
+            msg += " of ~{0} ({1}%)".format(estimate, min(100, rows_copied * 100 / estimate))
+        logger.info(msg)
+
+    def copy_rows(self, last_key, rows_copied):
+        """Copies the rows after last_key, chunk by chunk, saving progress
+after each.  Returns the total rows copied."""
+        columns = self.get_columns()
+        key = self.get_primary_key()
+        estimate = self.__estimate_rows()
+        last_logged = time.time()
+        while True:
+            upper = self.__get_chunk_upper_bound(key, last_key)
+            rows = self.__execute(self.get_chunk_sql(columns, key, last_key, upper))
+            rows_copied += rows or 0
+            if upper is None:
+                self.__save_checkpoint("copied", last_key, rows_copied)
+                break
+            last_key = upper
+            self.__save_checkpoint("copying", last_key, rows_copied)
+            if time.time() - last_logged >= self.progress_interval:
+                self.__log_progress(rows_copied, estimate)
+                last_logged = time.time()
+            if self.sleep > 0:
+                time.sleep(self.sleep)
+        self.__log_progress(rows_copied, estimate)
+        return rows_copied
+
+    def __swap(self):
+        self.__execute("drop table if exists " + quote_name(self.old_table))
+        self.__execute("rename table {0} to {1}, {2} to {0}".format(
+            quote_name(self.table), quote_name(self.old_table), quote_name(self.shadow_table)))
+
+    def __clean_up(self):
+        self.__drop_triggers()
+        self.__execute("drop table if exists " + quote_name(self.old_table))
+        self.__execute("delete from {0} where table_name = {1}".format(MySqlOnlineAlter.CHECKPOINT_TABLE, sql_literal(self.table)))
+
+    def run(self):
+        """Runs (or resumes) the online alter.  Returns the number of rows
+copied."""
+        self.__create_checkpoint_table()
+        checkpoint = self.get_checkpoint()
+        shadow_exists = self.__table_exists(self.shadow_table)
+        if checkpoint is not None and checkpoint[0] != self.alter_specification:
+            logger.warning("Restarting online alter of %s, its sql has changed since it was interrupted" % self.table)
+            checkpoint = None
+
+        if checkpoint is not None and checkpoint[1] == "copied" and not shadow_exists:
+            # Interrupted after the swap, which renamed the shadow table.
+            logger.info("Finishing online alter of %s" % self.table)
+            self.__clean_up()
+            return checkpoint[3]
+
+        if checkpoint is not None and shadow_exists and self.__triggers_exist():
+            alter_sql, status, last_key, rows_copied = checkpoint
+            logger.info("Resuming online alter of %s after %d rows" % (self.table, rows_copied))
+        else:
+            logger.info("Starting online alter of %s" % self.table)
+            self.__start()
+            status, last_key, rows_copied = "copying", None, 0
+
+        if status != "copied":
+            rows_copied = self.copy_rows(last_key, rows_copied)
+        self.__swap()
+        self.__clean_up()
+        return rows_copied
@@ -0,0 +1,230 @@
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('dbmigrator')
+
+
+class MigrationObserver(object):
+    """Receives lifecycle events from the Migrator and its ScriptRunners.
+Subclass and override the events of interest; all of them do nothing
+by default.  Register observers with Migrator.add_observer (or
+Driver.add_observer).
+
+Events for different databases can arrive concurrently from worker
+threads when Migrator.max_workers > 1 (and for code scripts of the
+same database, when Migrator.code_workers > 1), so observers that keep
+state must lock it.  Exceptions raised by observers are logged and otherwise
+ignored.
+
+Arguments common to several events:
+- phase: "delete_make_new", "baseline_schema", "migrations", "code" or "reference_data"
+- size: the script's size in bytes
+- duration_ms: wall-clock time, in milliseconds
+- error: the exception, or None on success"""
+
+    """script_skipped reasons."""
+    SKIPPED_APPLIED = "applied"
+    SKIPPED_UNCHANGED = "unchanged"
+
+    def phase_started(self, phase, db_nicknames):
+        pass
+
+    def phase_finished(self, phase, db_nicknames, duration_ms, error):
+        pass
+
+    def script_queued(self, phase, db_nickname, script_name, size):
+        pass
+
+    def script_skipped(self, phase, db_nickname, script_name, reason):
+        """reason: SKIPPED_APPLIED (migration already in tracking table) or
+SKIPPED_UNCHANGED (checksum matches the last run)."""
+        pass
+
+    def script_started(self, phase, db_nickname, script_name, size):
+        pass
+
+    def script_finished(self, phase, db_nickname, script_name, size, duration_ms, rows_affected):
+        """rows_affected is None if the handler doesn't report it."""
+        pass
+
+    def script_failed(self, phase, db_nickname, script_name, size, duration_ms, error):
+        pass
+
+    def close(self):
+        """Releases any resources (eg, open files)."""
+        pass
+
+
+class ObserverList(object):
+    """The observers registered on a Migrator or ScriptRunner.  Evaluates
+to False when empty, so callers can skip computing event arguments."""
+
+    def __init__(self):
+        self.observers = []
+
+    def add(self, observer):
+        self.observers.append(observer)
+
+    def notify(self, event, *args):
+        """Calls the named event method on each observer."""
+        for o in self.observers:
+            try:
+                getattr(o, event)(*args)
+            except Exception as e:
+                logger.warning("Observer %s failed on %s: %s" % (o.__class__.__name__, event, e))
+
+    def __len__(self):
+        return len(self.observers)
+
+    def __iter__(self):
+        return iter(self.observers)
+
+
+class JsonLinesObserver(MigrationObserver):
+    """Appends each event as a single-line JSON object to a file (flushed
+at the end of each phase), eg:
+
+{"ts": 1366934400.123, "event": "script_finished", "phase": "migrations", "db": "main", "script": "20130427_add_a_size.sql", "size": 40, "duration_ms": 12, "rows_affected": null}"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "a")
+        self.lock = threading.Lock()
+
+    def write(self, event, **fields):
+        fields["ts"] = round(time.time(), 3)
+        fields["event"] = event
+        if fields.get("error") is not None:
+            fields["error"] = str(fields["error"])
+        line = json.dumps(fields, sort_keys = True)
+        with self.lock:
+            self.file.write(line + "\n")
+            if event == "phase_finished":
+                self.file.flush()
+
+    def phase_started(self, phase, db_nicknames):
+        self.write("phase_started", phase = phase, dbs = list(db_nicknames))
+
+    def phase_finished(self, phase, db_nicknames, duration_ms, error):
+        self.write("phase_finished", phase = phase, dbs = list(db_nicknames), duration_ms = duration_ms, error = error)
+
+    def script_queued(self, phase, db_nickname, script_name, size):
+        self.write("script_queued", phase = phase, db = db_nickname, script = script_name, size = size)
+
+    def script_skipped(self, phase, db_nickname, script_name, reason):
+        self.write("script_skipped", phase = phase, db = db_nickname, script = script_name, reason = reason)
+
+    def script_started(self, phase, db_nickname, script_name, size):
+        self.write("script_started", phase = phase, db = db_nickname, script = script_name, size = size)
+
+    def script_finished(self, phase, db_nickname, script_name, size, duration_ms, rows_affected):
+        self.write("script_finished", phase = phase, db = db_nickname, script = script_name, size = size,
+                   duration_ms = duration_ms, rows_affected = rows_affected)
+
+    def script_failed(self, phase, db_nickname, script_name, size, duration_ms, error):
+        self.write("script_failed", phase = phase, db = db_nickname, script = script_name, size = size,
+                   duration_ms = duration_ms, error = error)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class PrometheusTextfileObserver(MigrationObserver):
+    """Writes metrics in the Prometheus text exposition format, for the
+node_exporter textfile collector.  The file is rewritten (atomically,
+via a temporary file and rename) at the end of each phase, so a scrape
+never sees a partial file.
+
+Metrics (db and phase labels, plus any extra labels given to the ctor):
+- dbmigrator_phase_duration_seconds, dbmigrator_phase_success,
+  dbmigrator_phase_last_run_timestamp_seconds: per phase
+- dbmigrator_scripts_total: per db and phase, by outcome (executed,
+  skipped, failed)
+- dbmigrator_script_duration_seconds_total, dbmigrator_script_bytes_total,
+  dbmigrator_script_rows_affected_total: per db and phase, for executed
+  scripts"""
+
+    def __init__(self, path, labels = None):
+        """path: the .prom file to write.
+labels: dict of extra labels for every metric (eg, {"env": "prod"})."""
+        self.path = path
+        self.labels = labels or {}
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.scripts = {}
+        self.totals = {}
+
+    def phase_finished(self, phase, db_nicknames, duration_ms, error):
+        with self.lock:
+            self.phases[phase] = (duration_ms / 1000.0, 0 if error else 1, time.time())
+            text = self.render()
+        self.write_atomically(text)
+
+    def __count(self, phase, db_nickname, outcome):
+        key = (db_nickname, phase, outcome)
+        with self.lock:
+            self.scripts[key] = self.scripts.get(key, 0) + 1
+
+    def script_skipped(self, phase, db_nickname, script_name, reason):
+        self.__count(phase, db_nickname, "skipped")
+
+    def script_failed(self, phase, db_nickname, script_name, size, duration_ms, error):
+        self.__count(phase, db_nickname, "failed")
+
+    def script_finished(self, phase, db_nickname, script_name, size, duration_ms, rows_affected):
+        self.__count(phase, db_nickname, "executed")
+        with self.lock:
+            t = self.totals.setdefault((db_nickname, phase), [0.0, 0, 0])
+            t[0] += duration_ms / 1000.0
+            t[1] += size or 0
+            t[2] += rows_affected or 0
+
+    @staticmethod
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+    def format_labels(self, **labels):
+        all_labels = dict(self.labels)
+        all_labels.update(labels)
+        pairs = ['{0}="{1}"'.format(k, PrometheusTextfileObserver.escape(v)) for k, v in sorted(all_labels.items())]
+        return "{" + ",".join(pairs) + "}"
+
+    def render(self):
+        """Returns the metrics text (call with lock held)."""
+        lines = []
+        def metric(name, help, kind, samples):
+            lines.append("# HELP {0} {1}".format(name, help))
+            lines.append("# TYPE {0} {1}".format(name, kind))
+            for labels, value in samples:
+                lines.append("{0}{1} {2}".format(name, self.format_labels(**labels), str(value)))
+
+        phases = sorted(self.phases.items())
+        metric("dbmigrator_phase_duration_seconds", "Wall-clock duration of the phase's last run.", "gauge",
+               [({"phase": p}, v[0]) for p, v in phases])
+        metric("dbmigrator_phase_success", "1 if the phase's last run succeeded, else 0.", "gauge",
+               [({"phase": p}, v[1]) for p, v in phases])
+        metric("dbmigrator_phase_last_run_timestamp_seconds", "Time the phase's last run finished.", "gauge",
+               [({"phase": p}, v[2]) for p, v in phases])
+        metric("dbmigrator_scripts_total", "Scripts by outcome.", "counter",
+               [({"db": k[0], "phase": k[1], "outcome": k[2]}, v) for k, v in sorted(self.scripts.items())])
+        totals = sorted(self.totals.items())
+        metric("dbmigrator_script_duration_seconds_total", "Total time spent executing scripts.", "counter",
+               [({"db": k[0], "phase": k[1]}, v[0]) for k, v in totals])
+        metric("dbmigrator_script_bytes_total", "Total size of executed scripts.", "counter",
+               [({"db": k[0], "phase": k[1]}, v[1]) for k, v in totals])
+        metric("dbmigrator_script_rows_affected_total", "Total rows affected by executed scripts, where reported.", "counter",
+               [({"db": k[0], "phase": k[1]}, v[2]) for k, v in totals])
+        return "\n".join(lines) + "\n"
+
+    def write_atomically(self, text):
+        tmp = "{0}.{1}.tmp".format(self.path, os.getpid())
+        with open(tmp, "w") as f:
+            f.write(text)
+        if os.name == "nt" and os.path.exists(self.path):
+            # os.rename doesn't replace existing files on Windows.
+            os.remove(self.path)
+        os.rename(tmp, self.path)
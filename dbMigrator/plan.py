@@ -0,0 +1,133 @@
+import json
+
+
+class PhasePlan(object):
+    """The scripts a single phase would run on a database."""
+
+    def __init__(self, phase):
+        self.phase = phase
+        # List of (script_name, size, action) tuples, in execution order.
+        self.scripts = []
+        # Number of scripts that would be skipped (migrations already applied).
+        self.skipped = 0
+        # Reason the phase would refuse to run, or None.
+        self.refused = None
+
+    def add_script(self, script_name, size, action = "run"):
+        self.scripts.append((script_name, size, action))
+
+    def total_size(self):
+        return sum([s[1] for s in self.scripts])
+
+    def to_dict(self):
+        return {
+            "phase": self.phase,
+            "scripts": [{ "name": n, "size": s, "action": a } for n, s, a in self.scripts],
+            "skipped": self.skipped,
+            "refused": self.refused
+        }
+
+
+class DatabasePlan(object):
+    """The phases that would run on a database."""
+
+    def __init__(self, db_nickname, dbname, recreate):
+        self.db_nickname = db_nickname
+        self.dbname = dbname
+        self.recreate = recreate
+        self.phases = []
+        # Error message if the database couldn't be inspected, or None.
+        self.error = None
+
+    def add_phase(self, phase):
+        p = PhasePlan(phase)
+        self.phases.append(p)
+        return p
+
+    def to_dict(self):
+        return {
+            "db": self.db_nickname,
+            "dbname": self.dbname,
+            "recreate": self.recreate,
+            "error": self.error,
+            "phases": [p.to_dict() for p in self.phases]
+        }
+
+
+class MigrationPlan(object):
+    """What a Migrator run would do, per database and phase, without
+running anything (see Migrator.plan).
+
+Script actions are "run", or "run_if_changed" for code and reference
+data when skipping unchanged scripts (their checksums aren't computed
+for a plan, as that would mean reading every script)."""
+
+    """Phase names, in the order they run."""
+    PHASES = ("delete_make_new", "baseline_schema", "migrations", "code", "reference_data")
+
+    def __init__(self, phases):
+        self.phases = [p for p in MigrationPlan.PHASES if p in phases]
+        self.databases = []
+
+    def add_database(self, db_nickname, dbname, recreate):
+        d = DatabasePlan(db_nickname, dbname, recreate)
+        self.databases.append(d)
+        return d
+
+    def refusals(self):
+        """List of (db_nickname, phase, reason) for phases that would refuse to run."""
+        return [(d.db_nickname, p.phase, p.refused) for d in self.databases for p in d.phases if p.refused]
+
+    def errors(self):
+        """List of (db_nickname, error) for databases that couldn't be inspected."""
+        return [(d.db_nickname, d.error) for d in self.databases if d.error]
+
+    def to_dict(self):
+        return {
+            "phases": self.phases,
+            "databases": [d.to_dict() for d in self.databases]
+        }
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent = 2, sort_keys = True)
+
+    @staticmethod
+    def format_size(size):
+        for unit in ["bytes", "kB", "MB"]:
+            if size < 1024:
+                return "{0} {1}".format(size, unit) if unit == "bytes" else "{0:.1f} {1}".format(size, unit)
+            size = size / 1024.0
+        return "{0:.1f} GB".format(size)
+
+    def format_text(self):
+        """Returns the plan as a human-readable report."""
+        lines = []
+        total_scripts = 0
+        total_size = 0
+        for d in self.databases:
+            lines.append("{0} ({1}){2}".format(d.db_nickname, d.dbname, ": drop and recreate" if d.recreate else ""))
+            if d.error:
+                lines.append("  ERROR: " + d.error)
+            for p in d.phases:
+                if p.refused:
+                    lines.append("  {0}: REFUSED - {1}".format(p.phase, p.refused))
+                    continue
+                summary = "  {0}: {1} script(s), {2}".format(p.phase, len(p.scripts), MigrationPlan.format_size(p.total_size()))
+                if p.skipped > 0:
+                    summary += ", {0} already applied".format(p.skipped)
+                lines.append(summary)
+                for name, size, action in p.scripts:
+                    suffix = "" if action == "run" else " [{0}]".format(action)
+                    lines.append("    {0} ({1}){2}".format(name, MigrationPlan.format_size(size), suffix))
+                total_scripts += len(p.scripts)
+                total_size += p.total_size()
+
+        summary = "Total: {0} script(s), {1}, on {2} database(s)".format(
+            total_scripts, MigrationPlan.format_size(total_size), len(self.databases))
+        if len(self.refusals()) > 0:
+            summary += "; {0} refusal(s)".format(len(self.refusals()))
+        if len(self.errors()) > 0:
+            summary += "; {0} error(s)".format(len(self.errors()))
+        lines.append(summary)
+        return "\n".join(lines)
@@ -1,87 +1,777 @@
+import itertools
 import logging
+import os
+import random
+import re
+import subprocess
+import sys
+import time
 import psycopg2
 import psycopg2.extensions
 
-from migrator import DatabaseHandler
+from migrator import DatabaseHandler, elapsed_ms
+from connectioncache import ConnectionCache
+from chunkedmigration import ChunkedMigration
+from sqlsplitter import SqlStatementSplitter, SqlStatementException
 logger = logging.getLogger('dbmigrator')
 
 class PostgresDatabaseHandler(DatabaseHandler):
-    """Postgres-specific implementation of the DatabaseHandler."""
+    """Postgres-specific implementation of the DatabaseHandler.  Requires
+PostgreSQL 9.6 or later (for "add column if not exists" and "on
+conflict"), checked when the tracking and checksum tables are
+created."""
 
-    def __get_open_connection(self, connection_hash):
-        """Opens a connection to the database."""
+    """Minimum server_version_num."""
+    MIN_SERVER_VERSION = 90600
+
+    sql_dialect = "postgres"
+
+    """Marker comment scripts can use to opt out of transactions."""
+    NO_TRANSACTION_PATTERN = re.compile(r"^\s*--\s*dbmigrator:\s*no-transaction\b", re.IGNORECASE | re.MULTILINE)
+
+    """Statements that Postgres refuses to run inside a transaction block,
+matched against the start of each statement, with its comments and
+string literals removed."""
+    NON_TRANSACTIONAL_PATTERNS = [
+        r"^(create\s+(unique\s+)?|drop\s+)index\s+concurrently\b",
+        r"^reindex\b.*\bconcurrently\b",
+        r"^reindex\s+(\(.*?\)\s*)?(database|system)\b",
+        r"^vacuum\b",
+        r"^(create|drop)\s+database\b",
+        r"^(create|drop)\s+tablespace\b",
+        r"^alter\s+system\b",
+        r"^alter\s+type\s+\S+\s+add\s+value\b"
+    ]
+
+    """Script comment lines giving settings, eg "-- dbmigrator:
+lock_timeout=2s statement_timeout=10min"."""
+    SETTINGS_COMMENT_PATTERN = re.compile(r"^\s*--\s*dbmigrator:(.*)$", re.IGNORECASE | re.MULTILINE)
+    TIMEOUT_SETTING_PATTERN = re.compile(r"\b(lock_timeout|statement_timeout)\s*=\s*(\S+)", re.IGNORECASE)
+
+    """SQLSTATE lock_not_available, raised when lock_timeout expires."""
+    LOCK_NOT_AVAILABLE = "55P03"
+
+    """Index built by a CREATE INDEX CONCURRENTLY statement."""
+    CONCURRENT_INDEX_PATTERN = re.compile(r"\bcreate\s+(?:unique\s+)?index\s+concurrently\s+(?:if\s+not\s+exists\s+)?(\"[^\"]+\"|\w+)", re.IGNORECASE)
+
+    def __init__(self):
+        super(PostgresDatabaseHandler, self).__init__()
+        self.connections = ConnectionCache(self.__open_connection, self.__is_alive)
+
+        # Run each tracked migration and the insert of its tracking
+        # row in a single transaction, so a failure can't leave a
+        # migration applied but unrecorded.
+        self.transactional_tracking = True
+
+        # Number of tracking rows to buffer before writing them with a
+        # single multi-row insert (1 = write each row immediately).
+        self.tracking_batch_size = 1
+        self.tracking_buffer = {}
+
+        # Number of tracked migrations to apply in a single transaction,
+        # each in its own savepoint (1 = a transaction per migration).
+        # If migration_batch_atomic is set, a failure rolls back the
+        # whole batch; otherwise only the failing migration is rolled
+        # back, and the ones before it are committed.
+        self.migration_batch_size = 1
+        self.migration_batch_atomic = True
+        self.migration_batches = {}
+
+        # lock_timeout and statement_timeout for each script (Postgres
+        # values, eg "5s"; None = the server's setting), which scripts
+        # can override with a "-- dbmigrator: lock_timeout=..." line.
+        # Waiting indefinitely for a lock on a busy table queues all
+        # other queries on the table behind the migration.
+        self.lock_timeout = None
+        self.statement_timeout = None
+
+        # Times to retry a script (or, outside a transaction, a
+        # statement) that timed out waiting for a lock, after waiting
+        # lock_retry_delay seconds, doubled for each further retry, with
+        # random jitter.
+        self.lock_retries = 3
+        self.lock_retry_delay = 1
+
+        # Drop invalid indexes left by failed CREATE INDEX CONCURRENTLY
+        # and REINDEX CONCURRENTLY statements (which would otherwise
+        # still be maintained on every write, and make a rerun fail).
+        self.drop_invalid_indexes = True
+
+    def __open_connection(self, connection_hash):
+        """Opens a new autocommit connection to the database."""
         template = "host='{0}' dbname='{1}' user='{2}' password='{3}'"
         hsh = connection_hash
         c = template.format(hsh["host"], hsh["dbname"], hsh["user"], hsh["password"])
-        return psycopg2.connect(c)
+        conn = psycopg2.connect(c)
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        return conn
+
+    def __is_alive(self, conn):
+        """Health check for cached connections."""
+        if conn.closed:
+            return False
+        cursor = conn.cursor()
+        try:
+            cursor.execute("select 1")
+            cursor.fetchall()
+        finally:
+            cursor.close()
+        return True
+
+    def __get_open_connection(self, connection_hash):
+        """Gets a (cached) open connection to the database."""
+        conn = self.connections.get(connection_hash)
+        if conn.closed:
+            self.connections.discard(connection_hash)
+            conn = self.connections.get(connection_hash)
+        return conn
+
+    def close_connections(self):
+        if len(self.migration_batches) > 0:
+            logger.warning("Closing connections with uncommitted migration batches")
+            self.migration_batches = {}
+        self.connections.close_all()
 
     def delete_make_new(self, system_connection_hash, database_name):
         """Creates new database, deletes the old."""
+        # Can't drop a database that we're still connected to.
+        self.connections.discard_database(database_name)
+        self.__execute(system_connection_hash, "drop database if exists {0}".format(database_name))
+        self.__execute(system_connection_hash, "create database {0}".format(database_name))
+
+
+    """pg_dump output lines that would change the settings of the session
+that later runs the dump as a baseline schema, or that psql (but not
+the server) understands."""
+    DUMP_SESSION_PATTERNS = [
+        r"^SET \w+ = .*;$",
+        r"^SELECT pg_catalog\.set_config\(.*\);$",
+        r"^\\"
+    ]
+
+    def dump_schema(self, connection_hash):
+        """Returns the schema from pg_dump (which must be on the path), without
+the tracking, checksum and checkpoint tables, owners, privileges or
+session settings."""
+        hsh = connection_hash
+        args = ["pg_dump", "--schema-only", "--no-owner", "--no-privileges",
+                "--exclude-table=__schema_migrations*", "--exclude-table=__script_checksums",
+                "--exclude-table=" + ChunkedMigration.CHECKPOINT_TABLE,
+                "--host", hsh["host"], "--username", hsh["user"], hsh["dbname"]]
+        env = dict(os.environ)
+        env["PGPASSWORD"] = hsh["password"]
+        dump = subprocess.check_output(args, env = env)
+        patterns = [re.compile(p) for p in PostgresDatabaseHandler.DUMP_SESSION_PATTERNS]
+        lines = [l for l in dump.splitlines() if not any([p.match(l) for p in patterns])]
+        return "\n".join(lines).strip() + "\n"
+
+    """Prefix of the comment marking template databases with their checksum."""
+    TEMPLATE_COMMENT_PREFIX = "dbmigrator template "
+
+    def get_template_checksum(self, system_connection_hash, template_name):
+        """Returns the checksum in the template database's comment, or None."""
+        sql = "select shobj_description(oid, 'pg_database') from pg_database where datname = %s"
         conn = self.__get_open_connection(system_connection_hash)
-        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
         cursor = conn.cursor()
-        cursor.execute("drop database if exists {0}".format(database_name))
-        cursor.execute("create database {0}".format(database_name))
-        cursor.close()
-        conn.close()
+        try:
+            cursor.execute(sql, [template_name])
+            r = cursor.fetchall()
+        finally:
+            cursor.close()
+        prefix = PostgresDatabaseHandler.TEMPLATE_COMMENT_PREFIX
+        if len(r) == 0 or r[0][0] is None or not r[0][0].startswith(prefix):
+            return None
+        return r[0][0][len(prefix):]
+
+    def mark_template(self, system_connection_hash, template_name, checksum):
+        """Records the checksum as the template database's comment."""
+        # Postgres can't copy a database that has other connections.
+        self.connections.discard_database(template_name)
+        comment = PostgresDatabaseHandler.TEMPLATE_COMMENT_PREFIX + checksum
+        self.__execute(system_connection_hash, "comment on database {0} is '{1}'".format(template_name, comment))
 
+    def create_from_template(self, system_connection_hash, database_name, template_name):
+        """Creates new database as a file-level copy of the template, deletes the old."""
+        self.connections.discard_database(database_name)
+        self.connections.discard_database(template_name)
+        self.__execute(system_connection_hash, "drop database if exists {0}".format(database_name))
+        self.__execute(system_connection_hash, "create database {0} template {1}".format(database_name, template_name))
 
-    def __execute(self, conn_hash, sql):
-        """Executes sql, Throws on error."""
+
+    def __execute(self, conn_hash, sql, timeouts = None):
+        """Executes sql, returns rows affected (None if not reported).  Throws
+on error.  timeouts (see get_timeouts) are set for the sql only."""
         conn = self.__get_open_connection(conn_hash)
-        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
         cursor = conn.cursor()
+        timeouts = timeouts or {}
+        settings = [name for name in sorted(timeouts.keys()) if timeouts[name] is not None]
         try:
+            self.__set_timeouts(cursor, timeouts)
             cursor.execute(sql)
+            return self.__rows_affected(cursor)
         except Exception as e:
             logger.error("Executing sql: %s"  % e)
+            if conn.closed:
+                self.connections.discard(conn_hash)
             raise
+        finally:
+            try:
+                if not conn.closed:
+                    for name in settings:
+                        cursor.execute("reset " + name)
+            finally:
+                cursor.close()
+
+    def __rows_affected(self, cursor):
+        """Cursor rowcount, or None if the last statement didn't report one (eg, DDL)."""
+        if cursor.rowcount is None or cursor.rowcount < 0:
+            return None
+        return cursor.rowcount
+
+    def __fetchall(self, conn_hash, sql):
+        """Returns all records for the query."""
+        conn = self.__get_open_connection(conn_hash)
+        cursor = conn.cursor()
+        try:
+            cursor.execute(sql)
+            return cursor.fetchall()
         finally:
             cursor.close()
-            conn.close()
 
     def user_defined_tables_exist(self, connection_hash):
         sql = """select table_name
         from information_schema.tables
         where (table_type = 'BASE TABLE' and table_schema not in ('pg_catalog', 'information_schema'))
         limit 1"""
-        conn = self.__get_open_connection(connection_hash)
-        cursor = conn.cursor()
-        cursor.execute(sql)
-        r = cursor.fetchall()
-        cursor.close()
-        conn.close()
+        r = self.__fetchall(connection_hash, sql)
         return (len(r) != 0)
 
 
+    def check_server_version(self, connection_hash):
+        """Throws if the server is older than MIN_SERVER_VERSION."""
+        version = int(self.__fetchall(connection_hash, "show server_version_num")[0][0])
+        if version < PostgresDatabaseHandler.MIN_SERVER_VERSION:
+            raise Exception("PostgreSQL 9.6 or later is required, server version is {0}.{1}".format(version / 10000, version / 100 % 100))
+
     def create_tracking_table(self, connection_hash):
-        """Creates table if needed."""
+        """Creates table if needed, and adds any columns missing from tables
+created by earlier versions."""
+        self.check_server_version(connection_hash)
         # Using lowercase table name, as Postgres is case-sensitive.
         sql = """create table if not exists __schema_migrations
 (
   migration_id serial primary key,
   script_name varchar(255),
-  date_applied timestamp not null default CURRENT_TIMESTAMP
+  date_applied timestamp not null default CURRENT_TIMESTAMP,
+  duration_ms integer,
+  rows_affected bigint
 )"""
         self.__execute(connection_hash, sql)
+        self.__execute(connection_hash, """alter table __schema_migrations
+  add column if not exists duration_ms integer,
+  add column if not exists rows_affected bigint""")
 
 
     def is_in_tracking_table(self, connection_hash, script_name):
         """Returns true if script is in tracking table (assumes tbl is present)"""
         sql = "select script_name from __schema_migrations where script_name = '{0}'".format(script_name)
+        r = self.__fetchall(connection_hash, sql)
+        return (len(r) > 0)
+
+
+    def tracking_table_exists(self, connection_hash):
+        sql = """select table_name from information_schema.tables
+        where table_schema = current_schema() and table_name = '__schema_migrations'"""
+        r = self.__fetchall(connection_hash, sql)
+        return (len(r) != 0)
+
+
+    def get_applied_scripts(self, connection_hash):
+        """Returns set of all script names in tracking table (assumes tbl is present)"""
+        sql = "select script_name from __schema_migrations"
+        r = self.__fetchall(connection_hash, sql)
+        return set([row[0] for row in r])
+
+    def query(self, connection_hash, sql):
+        """Returns the rows (as tuples) selected by the sql."""
+        return [tuple(row) for row in self.__fetchall(connection_hash, sql)]
+
+    def create_checksum_table(self, connection_hash):
+        """Creates table of code and reference data checksums if needed."""
+        self.check_server_version(connection_hash)
+        sql = """create table if not exists __script_checksums
+(
+  script_type varchar(32) not null,
+  script_name varchar(255) not null,
+  checksum varchar(64) not null,
+  date_applied timestamp not null default CURRENT_TIMESTAMP,
+  primary key (script_type, script_name)
+)"""
+        self.__execute(connection_hash, sql)
+
+    def get_script_checksums(self, connection_hash, script_type):
+        """Returns hash of script name => last run checksum for the script type."""
         conn = self.__get_open_connection(connection_hash)
         cursor = conn.cursor()
-        cursor.execute(sql)
-        r = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        return (len(r) > 0)
+        try:
+            cursor.execute("select script_name, checksum from __script_checksums where script_type = %s", [script_type])
+            return dict(cursor.fetchall())
+        finally:
+            cursor.close()
 
+    def record_script_checksum(self, connection_hash, script_type, script_name, checksum):
+        """Upserts the checksum for the script."""
+        sql = """insert into __script_checksums(script_type, script_name, checksum) values (%s, %s, %s)
+on conflict (script_type, script_name)
+do update set checksum = excluded.checksum, date_applied = CURRENT_TIMESTAMP"""
+        conn = self.__get_open_connection(connection_hash)
+        cursor = conn.cursor()
+        try:
+            cursor.execute(sql, [script_type, script_name, checksum])
+        finally:
+            cursor.close()
+
+
+    def record_script_in_tracking_table(self, conn_hash, script_name, duration_ms = None, rows_affected = None):
+        """Records the script, or buffers it if tracking_batch_size > 1."""
+        self.end_migration_batch(conn_hash)
+        row = (script_name, duration_ms, rows_affected)
+        if self.tracking_batch_size <= 1:
+            self.__insert_tracking_rows(conn_hash, [row])
+            return
+        key = ConnectionCache.get_key(conn_hash)
+        buffered = self.tracking_buffer.setdefault(key, [])
+        buffered.append(row)
+        if len(buffered) >= self.tracking_batch_size:
+            self.flush_tracking_table(conn_hash)
+
+    def flush_tracking_table(self, conn_hash):
+        """Commits any open migration batch, and writes buffered tracking
+rows with a single insert."""
+        self.end_migration_batch(conn_hash)
+        buffered = self.tracking_buffer.pop(ConnectionCache.get_key(conn_hash), [])
+        if len(buffered) > 0:
+            self.__insert_tracking_rows(conn_hash, buffered)
+
+    def __insert_tracking_rows(self, conn_hash, rows, cursor = None):
+        """Multi-row insert into the tracking table of (script_name,
+duration_ms, rows_affected) tuples."""
+        values = ", ".join(["(%s, %s, %s)"] * len(rows))
+        sql = "insert into __schema_migrations(script_name, duration_ms, rows_affected) values " + values
+        params = [v for row in rows for v in row]
+        if cursor is not None:
+            cursor.execute(sql, params)
+            return
+        conn = self.__get_open_connection(conn_hash)
+        cursor = conn.cursor()
+        try:
+            cursor.execute(sql, params)
+        finally:
+            cursor.close()
+
+    def bulk_load(self, conn_hash, data):
+        """Streams the data into its table with COPY FROM STDIN, in a single
+transaction.  Merges go through a temporary staging table.  Returns
+the number of rows copied."""
+        self.end_migration_batch(conn_hash)
+        columns = data.get_columns()
+        col_list = ", ".join(columns)
+        copy = "copy {0} ({1}) from stdin with (format csv, header true, delimiter '{2}', null '{3}')"
+        conn = self.__get_open_connection(conn_hash)
+        cursor = conn.cursor()
+        stream = data.open()
+        try:
+            cursor.execute("begin")
+            target = data.table
+            if data.mode == "truncate":
+                cursor.execute("truncate table " + data.table)
+            elif data.mode == "merge":
+                target = "__staging_" + data.table.replace(".", "_")
+                cursor.execute("create temporary table {0} (like {1} including defaults) on commit drop".format(target, data.table))
+            cursor.copy_expert(copy.format(target, col_list, data.delimiter, data.null.replace("'", "''")), stream)
+            rows = self.__rows_affected(cursor)
+            if data.mode == "merge":
+                self.__merge_staged_rows(cursor, target, data.table, columns, data.key_columns)
+            cursor.execute("commit")
+            return rows
+        except Exception as e:
+            logger.error("Bulk loading %s: %s"  % (data.table, e))
+            if conn.closed:
+                self.connections.discard(conn_hash)
+            else:
+                cursor.execute("rollback")
+            raise
+        finally:
+            stream.close()
+            cursor.close()
+
+    def __merge_staged_rows(self, cursor, staging, table, columns, key_columns):
+        """Updates rows of table matching staged rows on key columns, and inserts the rest."""
+        match = " and ".join(["t.{0} = s.{0}".format(k) for k in key_columns])
+        others = [c for c in columns if not (c in key_columns)]
+        if len(others) > 0:
+            assignments = ", ".join(["{0} = s.{0}".format(c) for c in others])
+            cursor.execute("update {0} t set {1} from {2} s where {3}".format(table, assignments, staging, match))
+        col_list = ", ".join(columns)
+        insert = """insert into {0} ({1})
+select {2} from {3} s
+where not exists (select 1 from {0} t where {4})"""
+        s_cols = ", ".join(["s." + c for c in columns])
+        cursor.execute(insert.format(table, col_list, s_cols, staging, match))
+
+    def get_timeouts(self, sql):
+        """Returns hash of lock_timeout and statement_timeout for the script:
+the handler's, overridden by any on the script's "-- dbmigrator:"
+comment lines."""
+        timeouts = { "lock_timeout": self.lock_timeout, "statement_timeout": self.statement_timeout }
+        for line in PostgresDatabaseHandler.SETTINGS_COMMENT_PATTERN.findall(sql):
+            for name, value in PostgresDatabaseHandler.TIMEOUT_SETTING_PATTERN.findall(line):
+                timeouts[name.lower()] = value
+        return timeouts
+
+    def __set_timeouts(self, cursor, timeouts, local = False, current = None):
+        """Sets the timeouts that are given (or, if the current ones in effect
+are given, those that differ from them, with unset ones reset to the
+default)."""
+        for name in sorted(timeouts.keys()):
+            value = timeouts[name]
+            if current is not None:
+                if value == current.get(name):
+                    continue
+                if value is None:
+                    cursor.execute("set local {0} to default".format(name))
+                    continue
+            if value is None:
+                continue
+            cursor.execute("set {0}{1} = %s".format("local " if local else "", name), [str(value)])
+
+    def __is_lock_timeout(self, error):
+        return getattr(error, "pgcode", None) == PostgresDatabaseHandler.LOCK_NOT_AVAILABLE
+
+    def __wait_to_retry(self, description, attempt, error):
+        """Sleeps before retry number attempt (from 1) of a lock timeout."""
+        delay = self.lock_retry_delay * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+        logger.warning("Lock timeout on %s, retry %d of %d in %.1fs: %s" % (description, attempt, self.lock_retries, delay, str(error).strip()))
+        time.sleep(delay)
+
+    def __get_invalid_indexes(self, conn_hash, name = None):
+        """Qualified names of the invalid indexes (with the given name, if
+any) in the search path."""
+        sql = """select c.oid::regclass::text from pg_index i join pg_class c on c.oid = i.indexrelid
+        where not i.indisvalid and pg_catalog.pg_table_is_visible(c.oid)"""
+        params = []
+        if name is not None:
+            sql += " and c.relname = %s"
+            params.append(name)
+        conn = self.__get_open_connection(conn_hash)
+        cursor = conn.cursor()
+        try:
+            cursor.execute(sql, params)
+            return set([row[0] for row in cursor.fetchall()])
+        finally:
+            cursor.close()
+
+    def __drop_indexes(self, conn_hash, indexes):
+        for index in sorted(indexes):
+            logger.warning("Dropping invalid index %s" % index)
+            self.__execute(conn_hash, "drop index concurrently if exists " + index)
 
-    def record_script_in_tracking_table(self, conn_hash, script_name):
-        sql = "insert into __schema_migrations(script_name) values ('{0}')"
-        self.__execute(conn_hash, sql.format(script_name))
+    def __execute_statement(self, conn_hash, sql, timeouts):
+        """Executes the sql outside a transaction, retrying on lock timeouts,
+and dropping invalid indexes left by a failed concurrent index build
+(including one left by an earlier run of a CREATE INDEX CONCURRENTLY,
+which would otherwise make it fail, or with "if not exists", be
+skipped)."""
+        code = SqlStatementSplitter(self.sql_dialect).code(sql)
+        concurrent = self.drop_invalid_indexes and re.search(r"\bconcurrently\b", code, re.IGNORECASE) is not None
+        name = None
+        invalid = set()
+        if concurrent:
+            m = PostgresDatabaseHandler.CONCURRENT_INDEX_PATTERN.search(code)
+            if m is not None:
+                name = m.group(1)
+                name = name[1:-1] if name.startswith('"') else name.lower()
+                self.__drop_indexes(conn_hash, self.__get_invalid_indexes(conn_hash, name))
+            invalid = self.__get_invalid_indexes(conn_hash)
+        attempt = 0
+        while True:
+            try:
+                return self.__execute(conn_hash, sql, timeouts)
+            except Exception as e:
+                exc_info = sys.exc_info()
+                if concurrent:
+                    try:
+                        # Only the statement's own leftovers: the index it
+                        # was building, or REINDEX's _ccnew/_ccold copies
+                        # (not other sessions' builds in progress).
+                        left = self.__get_invalid_indexes(conn_hash, name) - invalid
+                        if name is None:
+                            left = set([i for i in left if re.search(r"_cc(new|old)\d*\"?$", i)])
+                        self.__drop_indexes(conn_hash, left)
+                    except Exception as drop_error:
+                        logger.error("Dropping invalid indexes: %s" % drop_error)
+                if not self.__is_lock_timeout(e) or attempt >= self.lock_retries:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                attempt += 1
+                self.__wait_to_retry("statement", attempt, e)
+
+    def requires_autocommit(self, sql):
+        """True if the sql is marked no-transaction, or contains statements
+that can't run in a transaction."""
+        if PostgresDatabaseHandler.NO_TRANSACTION_PATTERN.search(sql):
+            return True
+        splitter = SqlStatementSplitter(self.sql_dialect)
+        for statement in splitter.split_string(sql):
+            code = splitter.code(statement.sql).strip()
+            for p in PostgresDatabaseHandler.NON_TRANSACTIONAL_PATTERNS:
+                if re.match(p, code, re.IGNORECASE | re.DOTALL):
+                    return True
+        return False
+
+    def execute_tracked(self, conn_hash, script_name, sql):
+        """Runs the script and inserts its tracking row in one transaction
+(if transactional_tracking is set, and the script can run in a
+transaction), or in the connection's open batch if
+migration_batch_size > 1.  Scripts that can't run in a transaction
+commit any open batch, and are run on their own.  Returns the rows
+affected."""
+        if not self.transactional_tracking or self.requires_autocommit(sql):
+            self.end_migration_batch(conn_hash)
+            start = time.time()
+            rows = self.__execute_script(conn_hash, sql, script_name)
+            self.record_script_in_tracking_table(conn_hash, script_name, elapsed_ms(start), rows)
+            return rows
+        if self.migration_batch_size > 1:
+            return self.__execute_in_batch(conn_hash, script_name, sql)
+
+        # Keep tracking rows in execution order.
+        self.flush_tracking_table(conn_hash)
+        timeouts = self.get_timeouts(sql)
+        attempt = 0
+        while True:
+            conn = self.__get_open_connection(conn_hash)
+            cursor = conn.cursor()
+            try:
+                cursor.execute("begin")
+                self.__set_timeouts(cursor, timeouts, True)
+                start = time.time()
+                cursor.execute(sql)
+                rows = self.__rows_affected(cursor)
+                self.__insert_tracking_rows(conn_hash, [(script_name, elapsed_ms(start), rows)], cursor)
+                cursor.execute("commit")
+                return rows
+            except Exception as e:
+                exc_info = sys.exc_info()
+                logger.error("Executing sql: %s"  % e)
+                if conn.closed:
+                    self.connections.discard(conn_hash)
+                else:
+                    cursor.execute("rollback")
+                if not self.__is_lock_timeout(e) or attempt >= self.lock_retries:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+            finally:
+                cursor.close()
+            attempt += 1
+            self.__wait_to_retry(script_name, attempt, e)
+
+    def __execute_in_batch(self, conn_hash, script_name, sql):
+        """Runs the script and inserts its tracking row in a savepoint of
+the connection's batch transaction (beginning one if needed).  Commits
+the batch once it holds migration_batch_size scripts."""
+        key = ConnectionCache.get_key(conn_hash)
+        batch = self.migration_batches.get(key)
+        begin = (batch is None)
+        if begin:
+            # Keep tracking rows in execution order.
+            self.flush_tracking_table(conn_hash)
+            # The batch keeps its connection, so that it can't be
+            # silently swapped for a new one by the cache.
+            batch = { "conn": self.__get_open_connection(conn_hash), "scripts": [], "timeouts": {} }
+            self.migration_batches[key] = batch
+
+        timeouts = self.get_timeouts(sql)
+        cursor = batch["conn"].cursor()
+        try:
+            if begin:
+                cursor.execute("begin")
+            cursor.execute("savepoint migration")
+            attempt = 0
+            while True:
+                # Set for the rest of the transaction, unless rolled back.
+                self.__set_timeouts(cursor, timeouts, True, batch["timeouts"])
+                try:
+                    start = time.time()
+                    cursor.execute(sql)
+                    break
+                except Exception as e:
+                    if not self.__is_lock_timeout(e) or attempt >= self.lock_retries or batch["conn"].closed:
+                        raise
+                    cursor.execute("rollback to savepoint migration")
+                    attempt += 1
+                    # Note that the locks taken by earlier scripts in the
+                    # batch are held while waiting.
+                    self.__wait_to_retry(script_name, attempt, e)
+            rows = self.__rows_affected(cursor)
+            self.__insert_tracking_rows(conn_hash, [(script_name, elapsed_ms(start), rows)], cursor)
+            cursor.execute("release savepoint migration")
+            batch["timeouts"] = timeouts
+        except Exception as e:
+            exc_info = sys.exc_info()
+            logger.error("Executing sql: %s"  % e)
+            self.__abort_migration_batch(conn_hash, cursor, script_name)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        finally:
+            cursor.close()
+
+        batch["scripts"].append(script_name)
+        if len(batch["scripts"]) >= self.migration_batch_size:
+            self.end_migration_batch(conn_hash)
+        return rows
+
+    def __abort_migration_batch(self, conn_hash, cursor, script_name):
+        """Rolls back the batch after script_name failed (or, if
+migration_batch_atomic is not set, rolls back just that script and
+commits the rest)."""
+        batch = self.migration_batches.pop(ConnectionCache.get_key(conn_hash))
+        earlier = len(batch["scripts"])
+        if batch["conn"].closed:
+            self.connections.discard(conn_hash)
+            logger.error("Connection lost; %d migration(s) batched before %s were not committed" % (earlier, script_name))
+            return
+        try:
+            if self.migration_batch_atomic:
+                cursor.execute("rollback")
+                if earlier > 0:
+                    logger.error("Rolled back %d migration(s) batched before %s" % (earlier, script_name))
+            else:
+                cursor.execute("rollback to savepoint migration")
+                cursor.execute("commit")
+        except Exception as e:
+            logger.error("Ending failed migration batch: %s" % e)
+            self.connections.discard(conn_hash)
+
+    def end_migration_batch(self, conn_hash):
+        """Commits the connection's open migration batch, if any."""
+        batch = self.migration_batches.pop(ConnectionCache.get_key(conn_hash), None)
+        if batch is None:
+            return
+        cursor = batch["conn"].cursor()
+        try:
+            cursor.execute("commit")
+        finally:
+            cursor.close()
+
+    def execute_stream(self, conn_hash, stream):
+        """Runs the statements read from the stream in a single transaction
+(see __execute_stream)."""
+        return self.__execute_stream(conn_hash, stream)
+
+    def execute_stream_tracked(self, conn_hash, script_name, stream):
+        """Runs the statements read from the stream, and inserts the script's
+tracking row, in a single transaction (if transactional_tracking is
+set)."""
+        if not self.transactional_tracking:
+            return super(PostgresDatabaseHandler, self).execute_stream_tracked(conn_hash, script_name, stream)
+        return self.__execute_stream(conn_hash, stream, script_name)
+
+    def __execute_stream(self, conn_hash, stream, script_name = None):
+        """Runs the statements read from the stream in a single transaction,
+together with the insert of the script's tracking row if script_name is
+given.  The settings on "-- dbmigrator:" lines at the top of the
+script (ie, in the first statement) apply to all of its statements.  If
+the first statement can't run in a transaction (or the script is
+marked no-transaction), the statements are run one at a time, outside
+a transaction; otherwise, later statements that can't run in a
+transaction are rejected.  Streamed scripts run in a transaction aren't
+retried on lock timeouts, as the stream can't be read again."""
+        self.end_migration_batch(conn_hash)
+        start = time.time()
+        statements = SqlStatementSplitter(self.sql_dialect).split(stream)
+        first = next(statements, None)
+        if first is None:
+            if script_name is not None:
+                self.record_script_in_tracking_table(conn_hash, script_name, elapsed_ms(start), None)
+            return None
+        timeouts = self.get_timeouts(first.sql)
+        statements = itertools.chain([first], statements)
+
+        if self.requires_autocommit(first.sql):
+            total = None
+            for statement in statements:
+                if statement.number == 2:
+                    self.__warn_not_atomic(script_name or "script")
+                try:
+                    rows = self.__execute_statement(conn_hash, statement.sql, timeouts)
+                except Exception as e:
+                    raise SqlStatementException(statement, e), None, sys.exc_info()[2]
+                if rows is not None:
+                    total = (total or 0) + rows
+            if script_name is not None:
+                self.record_script_in_tracking_table(conn_hash, script_name, elapsed_ms(start), total)
+            return total
+
+        if script_name is not None:
+            # Keep tracking rows in execution order.
+            self.flush_tracking_table(conn_hash)
+        conn = self.__get_open_connection(conn_hash)
+        cursor = conn.cursor()
+        try:
+            cursor.execute("begin")
+            self.__set_timeouts(cursor, timeouts, True)
+            total = None
+            for statement in statements:
+                if self.requires_autocommit(statement.sql):
+                    error = Exception("Can't run in the script's transaction; mark the script \"-- dbmigrator: no-transaction\" at the top")
+                    raise SqlStatementException(statement, error)
+                try:
+                    cursor.execute(statement.sql)
+                except Exception as e:
+                    raise SqlStatementException(statement, e), None, sys.exc_info()[2]
+                rows = self.__rows_affected(cursor)
+                if rows is not None:
+                    total = (total or 0) + rows
+            if script_name is not None:
+                self.__insert_tracking_rows(conn_hash, [(script_name, elapsed_ms(start), total)], cursor)
+            cursor.execute("commit")
+            return total
+        except Exception as e:
+            exc_info = sys.exc_info()
+            logger.error("Executing sql: %s"  % e)
+            if conn.closed:
+                self.connections.discard(conn_hash)
+            else:
+                cursor.execute("rollback")
+            raise exc_info[0], exc_info[1], exc_info[2]
+        finally:
+            cursor.close()
+
+    def __warn_not_atomic(self, description):
+        logger.warning("Running %s a statement at a time, outside a transaction, as it has statements that can't run in one: if a statement fails, the ones before it stay applied" % description)
 
     def execute(self, conn_hash, sql):
-        self.__execute(conn_hash, sql.format(sql))
-        
+        """Runs the script with its timeouts (see get_timeouts), retrying it
+on lock timeouts.  Scripts with statements that can't run in a
+transaction are run a statement at a time, as the server runs the
+statements of a multi-statement string in a single transaction."""
+        self.end_migration_batch(conn_hash)
+        return self.__execute_script(conn_hash, sql, "script")
+
+    def __execute_script(self, conn_hash, sql, description):
+        """Runs the sql as a whole, or if it can't run in a transaction, a
+statement at a time, warning that it isn't atomic if it has more than
+one statement."""
+        timeouts = self.get_timeouts(sql)
+        if not self.requires_autocommit(sql):
+            return self.__execute_statement(conn_hash, sql, timeouts)
+        statements = SqlStatementSplitter(self.sql_dialect).split_string(sql)
+        if len(statements) > 1:
+            self.__warn_not_atomic(description)
+        total = None
+        for statement in statements:
+            try:
+                rows = self.__execute_statement(conn_hash, statement.sql, timeouts)
+            except Exception as e:
+                raise SqlStatementException(statement, e), None, sys.exc_info()[2]
+            if rows is not None:
+                total = (total or 0) + rows
+        return total
@@ -0,0 +1,343 @@
+import csv
+import logging
+import os
+import re
+import sqlite3
+import sys
+import time
+from StringIO import StringIO
+
+from migrator import DatabaseHandler, elapsed_ms
+from connectioncache import ConnectionCache
+from chunkedmigration import ChunkedMigration
+from sqlsplitter import SqlStatement, SqlStatementSplitter, SqlStatementException
+logger = logging.getLogger('dbmigrator')
+
+class SqliteDatabaseHandler(DatabaseHandler):
+    """SQLite implementation of the DatabaseHandler, using the standard
+library's sqlite3 module.  Useful for checking, in-process and without
+a database server, that portable migrations apply cleanly and are
+tracked correctly.
+
+Databases are named by the connection hash's "dbname" (other keys are
+ignored).  They are either held in memory (the default), or stored as
+<dbname>.sqlite3 files in a directory.  In-memory databases last until
+the handler's connections are closed.
+
+Scripts are split into statements (keeping CREATE TRIGGER bodies
+whole), and run in a single transaction, unless they contain
+statements that manage transactions themselves (BEGIN, COMMIT, etc),
+VACUUM, or PRAGMA."""
+
+    """Statements (by first keyword) that can't be wrapped in a transaction."""
+    NON_TRANSACTIONAL_KEYWORDS = ("begin", "commit", "end", "rollback", "vacuum", "pragma")
+
+    """Whitespace and comments before a statement's first keyword."""
+    LEADING_COMMENTS_PATTERN = re.compile(r"(\s+|--[^\n]*|/\*.*?\*/)*", re.DOTALL)
+
+    """Rows inserted per executemany call when bulk loading."""
+    BULK_LOAD_BATCH_SIZE = 1000
+
+    def __init__(self, directory = None):
+        """directory: where database files are kept, or None for in-memory databases."""
+        super(SqliteDatabaseHandler, self).__init__()
+        self.directory = directory
+        # sqlite connections are never stale, so never health-checked.
+        self.connections = ConnectionCache(self.__open_connection, lambda conn: True, sys.maxint)
+
+    def get_database_path(self, database_name):
+        """The database's file, or ":memory:"."""
+        if self.directory is None:
+            return ":memory:"
+        return os.path.join(self.directory, database_name + ".sqlite3")
+
+    def __open_connection(self, connection_hash):
+        """Opens a new autocommit connection to the database."""
+        path = self.get_database_path(connection_hash["dbname"])
+        if self.directory is not None and not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        # Databases are only used by one thread at a time, but not
+        # necessarily the thread that opened the connection.
+        conn = sqlite3.connect(path, isolation_level = None, check_same_thread = False)
+        conn.text_factory = str
+        return conn
+
+    def __get_open_connection(self, connection_hash):
+        """Gets a (cached) open connection to the database."""
+        return self.connections.get(connection_hash)
+
+    def get_session_connection_hash(self, connection_hash, session):
+        """In-memory databases are private to their connection."""
+        if self.directory is None:
+            return None
+        return super(SqliteDatabaseHandler, self).get_session_connection_hash(connection_hash, session)
+
+    def close_connections(self):
+        self.connections.close_all()
+
+    def delete_make_new(self, system_connection_hash, database_name):
+        """Creates new database, deletes the old."""
+        self.connections.discard_database(database_name)
+        if self.directory is None:
+            return
+        path = self.get_database_path(database_name)
+        for f in [path, path + "-journal", path + "-wal", path + "-shm"]:
+            if os.path.exists(f):
+                os.remove(f)
+
+    def __split(self, stream):
+        """Generator of SqlStatements read from the stream.  Statements split
+at semicolons inside trigger bodies are rejoined."""
+        pending = None
+        for statement in SqlStatementSplitter(self.sql_dialect).split(stream):
+            if pending is None:
+                pending = statement
+            else:
+                pending = SqlStatement(pending.number, pending.offset, pending.sql + ";\n" + statement.sql)
+            if sqlite3.complete_statement(pending.sql + ";"):
+                yield pending
+                pending = None
+        if pending is not None:
+            yield pending
+
+    def strip_leading_comments(self, sql):
+        """The sql from its first keyword on.  Python 2's sqlite3 only sets
+rowcount for statements that start with INSERT, UPDATE, DELETE or
+REPLACE, so statements are run without their leading comments."""
+        return sql[SqliteDatabaseHandler.LEADING_COMMENTS_PATTERN.match(sql).end():]
+
+    def requires_autocommit(self, statements):
+        """True if any of the statements can't run in a transaction."""
+        for s in statements:
+            words = re.findall(r"^(\w+)", self.strip_leading_comments(s.sql))
+            if len(words) > 0 and words[0].lower() in SqliteDatabaseHandler.NON_TRANSACTIONAL_KEYWORDS:
+                return True
+        return False
+
+    def __run_statements(self, cursor, statements):
+        """Executes the statements, returns total rows affected (or None)."""
+        total = None
+        for s in statements:
+            try:
+                cursor.execute(self.strip_leading_comments(s.sql))
+            except Exception as e:
+                raise SqlStatementException(s, e), None, sys.exc_info()[2]
+            if cursor.rowcount is not None and cursor.rowcount >= 0:
+                total = (total or 0) + cursor.rowcount
+        return total
+
+    def __execute_in_transaction(self, conn_hash, statements, after = None):
+        """Runs the statements in a transaction (unless they can't be),
+followed by after(cursor, rows) if given.  Returns rows affected."""
+        conn = self.__get_open_connection(conn_hash)
+        cursor = conn.cursor()
+        transactional = not self.requires_autocommit(statements)
+        try:
+            if transactional:
+                cursor.execute("begin")
+            rows = self.__run_statements(cursor, statements)
+            if after is not None:
+                after(cursor, rows)
+            if transactional:
+                cursor.execute("commit")
+            return rows
+        except Exception as e:
+            logger.error("Executing sql: %s"  % e)
+            if transactional:
+                cursor.execute("rollback")
+            raise
+        finally:
+            cursor.close()
+
+    def __fetchall(self, conn_hash, sql, params = []):
+        """Returns all records for the query."""
+        conn = self.__get_open_connection(conn_hash)
+        cursor = conn.cursor()
+        try:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def __execute_one(self, conn_hash, sql, params = []):
+        """Executes a single statement in autocommit mode."""
+        conn = self.__get_open_connection(conn_hash)
+        cursor = conn.cursor()
+        try:
+            cursor.execute(sql, params)
+        finally:
+            cursor.close()
+
+    def user_defined_tables_exist(self, connection_hash):
+        sql = "select name from sqlite_master where type = 'table' and name not like 'sqlite_%' limit 1"
+        r = self.__fetchall(connection_hash, sql)
+        return (len(r) != 0)
+
+
+    def create_tracking_table(self, connection_hash):
+        """Creates table if needed, and adds any columns missing from tables
+created by earlier versions."""
+        sql = """create table if not exists __schema_migrations
+(
+  migration_id integer primary key autoincrement,
+  script_name varchar(255),
+  date_applied timestamp not null default CURRENT_TIMESTAMP,
+  duration_ms integer,
+  rows_affected bigint
+)"""
+        self.__execute_one(connection_hash, sql)
+        existing = set([row[1].lower() for row in self.__fetchall(connection_hash, "pragma table_info(__schema_migrations)")])
+        for column, column_type in [("duration_ms", "integer"), ("rows_affected", "bigint")]:
+            if not (column in existing):
+                self.__execute_one(connection_hash, "alter table __schema_migrations add column {0} {1}".format(column, column_type))
+
+
+    def tracking_table_exists(self, connection_hash):
+        sql = "select name from sqlite_master where type = 'table' and name = '__schema_migrations'"
+        r = self.__fetchall(connection_hash, sql)
+        return (len(r) != 0)
+
+
+    def is_in_tracking_table(self, connection_hash, script_name):
+        """Returns true if script is in tracking table (assumes tbl is present)"""
+        sql = "select script_name from __schema_migrations where script_name = ?"
+        r = self.__fetchall(connection_hash, sql, [script_name])
+        return (len(r) > 0)
+
+
+    def get_applied_scripts(self, connection_hash):
+        """Returns set of all script names in tracking table (assumes tbl is present)"""
+        r = self.__fetchall(connection_hash, "select script_name from __schema_migrations")
+        return set([row[0] for row in r])
+
+    def query(self, connection_hash, sql):
+        """Returns the rows (as tuples) selected by the sql."""
+        return [tuple(row) for row in self.__fetchall(connection_hash, sql)]
+
+    def record_script_in_tracking_table(self, conn_hash, script_name, duration_ms = None, rows_affected = None):
+        sql = "insert into __schema_migrations(script_name, duration_ms, rows_affected) values (?, ?, ?)"
+        self.__execute_one(conn_hash, sql, [script_name, duration_ms, rows_affected])
+
+    def dump_schema(self, connection_hash):
+        """Returns the create statements of all tables, indexes, views and
+triggers, other than the tracking, checksum and checkpoint tables."""
+        sql = """select sql from sqlite_master
+where sql is not null and name not like 'sqlite_%'
+and tbl_name not in ('__schema_migrations', '__script_checksums', '{0}')
+order by case type when 'table' then 0 when 'index' then 1 when 'view' then 2 else 3 end, rowid""".format(ChunkedMigration.CHECKPOINT_TABLE)
+        return "".join([row[0] + ";\n\n" for row in self.__fetchall(connection_hash, sql)])
+
+    def create_checksum_table(self, connection_hash):
+        """Creates table of code and reference data checksums if needed."""
+        sql = """create table if not exists __script_checksums
+(
+  script_type varchar(32) not null,
+  script_name varchar(255) not null,
+  checksum varchar(64) not null,
+  date_applied timestamp not null default CURRENT_TIMESTAMP,
+  primary key (script_type, script_name)
+)"""
+        self.__execute_one(connection_hash, sql)
+
+    def get_script_checksums(self, connection_hash, script_type):
+        """Returns hash of script name => last run checksum for the script type."""
+        sql = "select script_name, checksum from __script_checksums where script_type = ?"
+        return dict(self.__fetchall(connection_hash, sql, [script_type]))
+
+    def record_script_checksum(self, connection_hash, script_type, script_name, checksum):
+        """Upserts the checksum for the script."""
+        sql = "insert or replace into __script_checksums(script_type, script_name, checksum) values (?, ?, ?)"
+        self.__execute_one(connection_hash, sql, [script_type, script_name, checksum])
+
+    def bulk_load(self, conn_hash, data):
+        """Loads the data into its table with batched inserts, in a single
+transaction.  Merges go through a temporary staging table.  Returns the
+number of rows loaded."""
+        columns = data.get_columns()
+        col_list = ", ".join(columns)
+        target = data.table
+        if data.mode == "merge":
+            target = "__staging_" + data.table.replace(".", "_")
+        insert = "insert into {0} ({1}) values ({2})".format(target, col_list, ", ".join(["?"] * len(columns)))
+
+        conn = self.__get_open_connection(conn_hash)
+        cursor = conn.cursor()
+        stream = data.open()
+        try:
+            cursor.execute("begin")
+            if data.mode == "truncate":
+                cursor.execute("delete from " + data.table)
+            elif data.mode == "merge":
+                cursor.execute("drop table if exists temp." + target)
+                cursor.execute("create temporary table {0} as select {1} from {2} where 0".format(target, col_list, data.table))
+
+            reader = csv.reader(stream, delimiter = data.delimiter, quotechar = '"')
+            reader.next()
+            rows = 0
+            batch = []
+            for record in reader:
+                batch.append([None if v == data.null else v for v in record])
+                if len(batch) >= SqliteDatabaseHandler.BULK_LOAD_BATCH_SIZE:
+                    cursor.executemany(insert, batch)
+                    rows += len(batch)
+                    batch = []
+            if len(batch) > 0:
+                cursor.executemany(insert, batch)
+                rows += len(batch)
+
+            if data.mode == "merge":
+                self.__merge_staged_rows(cursor, target, data.table, columns, data.key_columns)
+                cursor.execute("drop table temp." + target)
+            cursor.execute("commit")
+            return rows
+        except Exception as e:
+            logger.error("Bulk loading %s: %s"  % (data.table, e))
+            cursor.execute("rollback")
+            raise
+        finally:
+            stream.close()
+            cursor.close()
+
+    def __merge_staged_rows(self, cursor, staging, table, columns, key_columns):
+        """Updates rows of table matching staged rows on key columns, and inserts the rest."""
+        # The table being updated can't be aliased, so is referred to by name.
+        t = table.split(".")[-1]
+        match = " and ".join(["s.{0} = {1}.{0}".format(k, t) for k in key_columns])
+        others = [c for c in columns if not (c in key_columns)]
+        if len(others) > 0:
+            assignments = ", ".join(["{0} = (select s.{0} from {1} s where {2})".format(c, staging, match) for c in others])
+            cursor.execute("update {0} set {1} where exists (select 1 from {2} s where {3})".format(table, assignments, staging, match))
+        insert = """insert into {0} ({1})
+select {2} from {3} s
+where not exists (select 1 from {0} where {4})"""
+        s_cols = ", ".join(["s." + c for c in columns])
+        cursor.execute(insert.format(table, ", ".join(columns), s_cols, staging, match))
+
+    def execute_stream(self, conn_hash, stream):
+        """Executes the statements read from the stream one at a time, in autocommit mode."""
+        conn = self.__get_open_connection(conn_hash)
+        cursor = conn.cursor()
+        try:
+            total = None
+            for statement in self.__split(stream):
+                rows = self.__run_statements(cursor, [statement])
+                if rows is not None:
+                    total = (total or 0) + rows
+            return total
+        finally:
+            cursor.close()
+
+    def execute_tracked(self, conn_hash, script_name, sql):
+        """Runs the script and inserts its tracking row in one transaction
+(if the script can run in a transaction).  Returns the rows affected."""
+        statements = list(self.__split(StringIO(sql)))
+        if self.requires_autocommit(statements):
+            return super(SqliteDatabaseHandler, self).execute_tracked(conn_hash, script_name, sql)
+        start = time.time()
+        def record(cursor, rows):
+            sql = "insert into __schema_migrations(script_name, duration_ms, rows_affected) values (?, ?, ?)"
+            cursor.execute(sql, [script_name, elapsed_ms(start), rows])
+        return self.__execute_in_transaction(conn_hash, statements, record)
+
+    def execute(self, conn_hash, sql):
+        return self.__execute_in_transaction(conn_hash, list(self.__split(StringIO(sql))))
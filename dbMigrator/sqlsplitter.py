@@ -0,0 +1,273 @@
+import re
+from collections import namedtuple
+from StringIO import StringIO
+
+
+# A single statement read from a script.  number is 1-based; offset is
+# the position of the statement's first non-whitespace character in the
+# script.
+SqlStatement = namedtuple("SqlStatement", ["number", "offset", "sql"])
+
+
+class SqlStatementException(Exception):
+    """Raised when a statement from a split script fails."""
+
+    def __init__(self, statement, error):
+        self.statement = statement
+        self.error = error
+        excerpt = statement.sql[:200]
+        msg = "Statement {0} at offset {1} failed: {2}\n{3}".format(statement.number, statement.offset, error, excerpt)
+        super(SqlStatementException, self).__init__(msg)
+
+
+class SqlStatementSplitter(object):
+    """Splits sql read from a file-like stream into individual statements,
+reading the stream in chunks so that memory use is bounded by the
+largest single statement rather than by the script.
+
+Statement delimiters inside quoted strings, quoted identifiers and
+comments are ignored.  Dialect-specific syntax:
+
+- postgres: dollar-quoted strings ($$ ... $$, $tag$ ... $tag$), and
+  backslash escapes in escape strings (E'...')
+- mysql: backtick identifiers, '#' comments, backslash escapes in
+  strings, and DELIMITER lines (which change the delimiter, and are not
+  themselves statements)
+- ansi: none of the above
+
+Statements consisting only of whitespace and comments are skipped."""
+
+    DIALECTS = ("ansi", "postgres", "mysql")
+
+    def __init__(self, dialect = "ansi", chunk_size = 1024 * 1024):
+        if not (dialect in SqlStatementSplitter.DIALECTS):
+            raise ValueError("Unknown sql dialect " + dialect)
+        self.dialect = dialect
+        self.chunk_size = chunk_size
+
+    def split(self, stream):
+        """Generator of SqlStatements read from the stream."""
+        return _StatementReader(stream, self.dialect, self.chunk_size).statements()
+
+    def split_string(self, sql):
+        """Returns list of SqlStatements in the sql string."""
+        return list(self.split(StringIO(sql)))
+
+    def code(self, sql):
+        """Returns the sql with its comments removed and the contents of its
+quoted strings blanked (quoted identifiers are kept), for matching
+keywords against."""
+        return _StatementReader(StringIO(sql), self.dialect, self.chunk_size).code()
+
+
+class _StatementReader(object):
+    """Scanner state for a single SqlStatementSplitter.split call."""
+
+    DOLLAR_TAG = re.compile(r"\$([A-Za-z_][A-Za-z_0-9]*)?\$")
+    IDENTIFIER_CHARS = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_$"
+    DELIMITER_LINE = re.compile(r"delimiter[ \t]+(\S+)[ \t]*(\r?\n|$)", re.IGNORECASE)
+    WHITESPACE = " \t\r\n"
+
+    def __init__(self, stream, dialect, chunk_size):
+        self.stream = stream
+        self.dialect = dialect
+        self.chunk_size = chunk_size
+        self.buf = ""          # Text read, from at or before the current statement.
+        self.start = 0         # Index in buf of the current statement.
+        self.base = 0          # Stream offset of buf[0].
+        self.eof = False
+        self.set_delimiter(";")
+
+    def set_delimiter(self, delimiter):
+        self.delimiter = delimiter
+        specials = "'\"-/" + delimiter[0] + self.WHITESPACE
+        if self.dialect == "postgres":
+            specials += "$"
+        if self.dialect == "mysql":
+            specials += "`#"
+        # Runs of characters that can't start a delimiter, quote or comment.
+        self.ordinary = re.compile("[^" + re.escape(specials) + "]+")
+
+    def ensure(self, n):
+        """Reads until buf has at least n characters; False if the stream ends first."""
+        while len(self.buf) < n and not self.eof:
+            chunk = self.stream.read(self.chunk_size)
+            if not chunk:
+                self.eof = True
+            else:
+                self.buf += chunk
+        return len(self.buf) >= n
+
+    def find(self, sub, start):
+        """Index of sub in buf at or after start, reading more as needed; -1 if not found."""
+        while True:
+            idx = self.buf.find(sub, start)
+            if idx >= 0 or self.eof:
+                return idx
+            start = max(start, len(self.buf) - len(sub) + 1)
+            self.ensure(len(self.buf) + 1)
+
+    def search(self, pattern, start):
+        """Index of the first match of the compiled pattern (which must match
+single characters) at or after start, reading more as needed; -1 if
+not found."""
+        while True:
+            m = pattern.search(self.buf, start)
+            if m or self.eof:
+                return m.start() if m else -1
+            start = max(start, len(self.buf))
+            self.ensure(len(self.buf) + 1)
+
+    def compact(self):
+        """Drops the consumed text before the current statement from buf.
+Done before reading more, rather than on each statement, as it copies
+the rest of buf."""
+        self.buf = self.buf[self.start:]
+        self.base += self.start
+        self.start = 0
+
+    def is_escape_string(self, i):
+        """True if the quote at i starts a postgres escape string (E'...')."""
+        if self.dialect != "postgres" or i - 1 < self.start or not (self.buf[i - 1] in "eE"):
+            return False
+        return i - 2 < self.start or not (self.buf[i - 2] in self.IDENTIFIER_CHARS)
+
+    def end_of_quoted(self, quote, start, backslashes = False):
+        """Index just past the closing quote for a quoted section whose
+content starts at start (or end of buf if unterminated).  backslashes:
+if backslash escapes apply (always, in mysql strings)."""
+        if backslashes or (self.dialect == "mysql" and quote != "`"):
+            stop = re.compile("[\\\\" + quote + "]")
+        else:
+            stop = re.compile(re.escape(quote))
+        i = start
+        while True:
+            q = self.search(stop, i)
+            if q < 0:
+                return len(self.buf)
+            if self.buf[q] == "\\":
+                i = q + 2
+                continue
+            if self.ensure(q + 2) and self.buf[q + 1] == quote:
+                # Doubled quote is an escaped quote.
+                i = q + 2
+                continue
+            return q + 1
+
+    def end_of_comment(self, i):
+        """Index just past the comment starting at i, or None if no comment starts there."""
+        self.ensure(i + 2)
+        pair = self.buf[i:i + 2]
+        if pair == "--" or (self.dialect == "mysql" and self.buf[i] == "#"):
+            nl = self.find("\n", i)
+            return len(self.buf) if nl < 0 else nl + 1
+        if pair == "/*":
+            close = self.find("*/", i + 2)
+            return len(self.buf) if close < 0 else close + 2
+        return None
+
+    def emit(self, end, skip, has_code):
+        """Consumes buf up to end (plus skip delimiter characters), returns statement text and offset."""
+        text = self.buf[self.start:end]
+        stripped = text.lstrip()
+        offset = self.base + end - len(stripped)
+        self.start = end + skip
+        if not has_code:
+            return None
+        return (offset, stripped.rstrip())
+
+    def code(self):
+        parts = []
+        i = 0
+        while self.ensure(i + 1):
+            c = self.buf[i]
+            if c in "-/#":
+                end = self.end_of_comment(i)
+                if end is not None:
+                    parts.append(" ")
+                    i = end
+                    continue
+            if c == "'":
+                i = self.end_of_quoted(c, i + 1, self.is_escape_string(i))
+                parts.append("''")
+                continue
+            if c == "$" and self.dialect == "postgres":
+                self.ensure(i + 64)
+                m = self.DOLLAR_TAG.match(self.buf, i)
+                if m:
+                    close = self.find(m.group(0), m.end())
+                    i = len(self.buf) if close < 0 else close + len(m.group(0))
+                    parts.append("''")
+                    continue
+            if c == '"' or (c == "`" and self.dialect == "mysql"):
+                end = self.end_of_quoted(c, i + 1)
+            else:
+                m = self.ordinary.match(self.buf, i)
+                end = m.end() if m else i + 1
+            parts.append(self.buf[i:end])
+            i = end
+        return "".join(parts)
+
+    def statements(self):
+        number = 0
+        i = 0
+        has_code = False
+        while True:
+            if i >= len(self.buf) and self.start > 0:
+                i -= self.start
+                self.compact()
+            if not self.ensure(i + 1):
+                st = self.emit(len(self.buf), 0, has_code)
+                if st is not None:
+                    yield SqlStatement(number + 1, st[0], st[1])
+                return
+
+            c = self.buf[i]
+
+            if self.dialect == "mysql" and not has_code and c in "dD":
+                nl = self.find("\n", i)
+                line_end = len(self.buf) if nl < 0 else nl + 1
+                m = self.DELIMITER_LINE.match(self.buf, i, line_end)
+                if m:
+                    self.emit(line_end, 0, False)
+                    self.set_delimiter(m.group(1))
+                    i = self.start
+                    continue
+
+            if c == self.delimiter[0]:
+                self.ensure(i + len(self.delimiter))
+                if self.buf.startswith(self.delimiter, i):
+                    st = self.emit(i, len(self.delimiter), has_code)
+                    if st is not None:
+                        number += 1
+                        yield SqlStatement(number, st[0], st[1])
+                    i = self.start
+                    has_code = False
+                    continue
+
+            if c in self.WHITESPACE:
+                i += 1
+                continue
+
+            if c in "-/#":
+                end = self.end_of_comment(i)
+                if end is not None:
+                    i = end
+                    continue
+
+            has_code = True
+
+            if c in "'\"" or (c == "`" and self.dialect == "mysql"):
+                i = self.end_of_quoted(c, i + 1, c == "'" and self.is_escape_string(i))
+                continue
+
+            if c == "$" and self.dialect == "postgres":
+                self.ensure(i + 64)
+                m = self.DOLLAR_TAG.match(self.buf, i)
+                if m:
+                    close = self.find(m.group(0), m.end())
+                    i = len(self.buf) if close < 0 else close + len(m.group(0))
+                    continue
+
+            m = self.ordinary.match(self.buf, i)
+            i = m.end() if m else i + 1
@@ -0,0 +1,421 @@
+import logging
+import Queue
+import threading
+import time
+
+from migrator import DatabaseSource, MigrationException, elapsed_ms
+from plan import MigrationPlan
+
+logger = logging.getLogger('dbmigrator')
+
+
+class TenantDatabaseSource(DatabaseSource):
+    """Applies the scripts of a single database of a DatabaseSource to
+many tenant databases (eg, one database per customer), without a
+folder or ini entry per tenant.
+
+Tenants are nicknamed by their dbname (by their "nickname" key, if
+given).  Use read_tenant_file, query_tenants or get_ini_tenants to
+build the tenant list."""
+
+    def __init__(self, database_source, db_nickname, tenants):
+        """database_source: source of the scripts, eg a DefaultDatabaseSource.
+db_nickname: the database in database_source whose scripts are applied
+to every tenant.
+tenants: list of connection hashes, one per tenant database."""
+        self.database_source = database_source
+        self.db_nickname = db_nickname
+        self.tenants = {}
+        for t in tenants:
+            nickname = t.get("nickname", t["dbname"])
+            if nickname in self.tenants:
+                raise MigrationException("Duplicate tenant " + nickname)
+            self.tenants[nickname] = t
+
+    def get_tenant_nicknames(self):
+        return sorted(self.tenants.keys())
+
+    def get_db_name_from_nickname(self, nickname):
+        return self.tenants[nickname]["dbname"]
+
+    def get_system_connection_hash(self):
+        return self.database_source.get_system_connection_hash()
+
+    def get_connection_hashes(self):
+        return self.tenants
+
+    def get_baseline_schema_files(self, database_name):
+        return self.database_source.get_baseline_schema_files(self.db_nickname)
+
+    def get_reference_data_files(self, database_name):
+        return self.database_source.get_reference_data_files(self.db_nickname)
+
+    def get_code_files(self, database_name):
+        return self.database_source.get_code_files(self.db_nickname)
+
+    def get_migrations_files(self, database_name):
+        return self.database_source.get_migrations_files(self.db_nickname)
+
+    def get_squashed_migrations(self, database_name):
+        return self.database_source.get_squashed_migrations(self.db_nickname)
+
+    def close(self):
+        self.database_source.close()
+
+
+def tenant_connection_hash(defaults, dbname, **overrides):
+    """Copy of the defaults connection hash for the tenant database."""
+    h = dict(defaults)
+    h.pop("nickname", None)
+    h["dbname"] = dbname
+    h.update(overrides)
+    return h
+
+
+def read_tenant_file(path, defaults):
+    """Reads tenant databases from a file with one per line: the dbname,
+optionally followed by key=value overrides of the defaults connection
+hash (eg, "cust_042 host=db7").  Blank lines and # comments are
+ignored."""
+    tenants = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.split("#")[0].strip()
+            if line == "":
+                continue
+            fields = line.split()
+            overrides = {}
+            for kv in fields[1:]:
+                if not ("=" in kv):
+                    raise MigrationException("Bad tenant line in {0}: {1}".format(path, line))
+                k, v = kv.split("=", 1)
+                overrides[k] = v
+            tenants.append(tenant_connection_hash(defaults, fields[0], **overrides))
+    return tenants
+
+
+def query_tenants(database_handler, connection_hash, sql, defaults):
+    """Reads tenant databases with a query (eg, against a catalog database)
+selecting the dbname, and optionally the host, of each tenant."""
+    tenants = []
+    for row in database_handler.query(connection_hash, sql):
+        overrides = {}
+        if len(row) > 1 and row[1] is not None:
+            overrides["host"] = row[1]
+        tenants.append(tenant_connection_hash(defaults, row[0], **overrides))
+    return tenants
+
+
+def get_ini_tenants(config, defaults):
+    """Reads tenant databases from the [Tenants] section of a ConfigObj
+(eg, DefaultDatabaseSource.config).  Each key is a tenant nickname;
+its value is either the dbname, or a subsection of overrides of the
+defaults connection hash:
+
+[Tenants]
+cust_001 = cust_001
+  [[cust_002]]
+  dbname = cust_002
+  host = db7"""
+    if not ("Tenants" in config):
+        raise MigrationException("No [Tenants] section in config")
+    tenants = []
+    for nickname, value in config["Tenants"].items():
+        if isinstance(value, basestring):
+            tenants.append(tenant_connection_hash(defaults, value, nickname = nickname))
+        else:
+            h = tenant_connection_hash(defaults, value.get("dbname", nickname), nickname = nickname)
+            h.update(value)
+            tenants.append(h)
+    return tenants
+
+
+class TenantResult(object):
+    """Outcome of running the phases on one tenant database."""
+
+    def __init__(self, nickname, host):
+        self.nickname = nickname
+        self.host = host
+        self.attempts = 0
+        # Error message of the last attempt, or None if it succeeded.
+        self.error = None
+        self.duration_ms = 0
+
+
+class FanOutSummary(object):
+    """Results of a TenantMigrator run, per tenant."""
+
+    def __init__(self):
+        self.results = []
+        self.duration_ms = 0
+
+    def failed(self):
+        return [r for r in self.results if r.error is not None]
+
+    def retried(self):
+        return [r for r in self.results if r.attempts > 1]
+
+    def format_text(self):
+        """Returns the summary as a human-readable report."""
+        lines = ["{0} tenant(s) in {1}: {2} succeeded, {3} failed, {4} retried".format(
+            len(self.results), TenantMigrator.format_duration(self.duration_ms / 1000.0),
+            len(self.results) - len(self.failed()), len(self.failed()), len(self.retried()))]
+        for r in sorted(self.retried(), key = lambda r: r.nickname):
+            if r.error is None:
+                lines.append("  RETRIED {0} ({1}): succeeded on attempt {2}".format(r.nickname, r.host, r.attempts))
+        for r in sorted(self.failed(), key = lambda r: r.nickname):
+            lines.append("  FAILED {0} ({1}) after {2} attempt(s): {3}".format(r.nickname, r.host, r.attempts, r.error))
+        return "\n".join(lines)
+
+
+def _run_in_worker(migrator, nickname, phases, results):
+    results.put(_run_tenant(migrator, nickname, phases))
+
+def _run_tenant(migrator, nickname, phases):
+    """Runs the phases on one tenant.  Returns (nickname, error message or
+None, duration_ms)."""
+    start = time.time()
+    error = None
+    try:
+        for phase in phases:
+            getattr(migrator, TenantMigrator.PHASE_METHODS[phase])(nickname)
+    except Exception as e:
+        logger.error("Failed on tenant %s: %s" % (nickname, e))
+        error = str(e) or e.__class__.__name__
+    finally:
+        # Tenants can run into the hundreds, so don't keep their
+        # connections open.
+        try:
+            migrator.database_handler.close_connections()
+        except Exception as e:
+            logger.warning("Closing connections for tenant %s: %s" % (nickname, e))
+    return (nickname, error, elapsed_ms(start))
+
+
+class _InProcessPool(object):
+    """Stand-in for multiprocessing.Pool, running tasks immediately."""
+
+    def __init__(self, migrator):
+        self.migrator = migrator
+
+    def apply_async(self, nickname, phases, callback):
+        callback(_run_tenant(self.migrator, nickname, phases))
+
+    def close(self):
+        pass
+
+    def terminate(self):
+        pass
+
+    def join(self):
+        pass
+
+
+class _ProcessPool(object):
+    """Worker processes forked with the Migrator, one per tenant attempt.
+A multiprocessing.Pool loses the task of a worker that dies (eg, killed
+for running out of memory), and never calls back; here a monitor thread
+calls back with a failure for a worker that exits without a result."""
+
+    def __init__(self, migrator):
+        # Imported here, as it's slow to import and most runs don't fan out.
+        import multiprocessing
+        self.multiprocessing = multiprocessing
+        self.migrator = migrator
+        self.results = multiprocessing.Queue()
+        # nickname: (process, callback, start time) of running workers.
+        self.workers = {}
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.monitor = threading.Thread(target = self.__monitor)
+        self.monitor.daemon = True
+        self.monitor.start()
+
+    def apply_async(self, nickname, phases, callback):
+        process = self.multiprocessing.Process(target = _run_in_worker, args = (self.migrator, nickname, phases, self.results))
+        process.daemon = True
+        start = time.time()
+        process.start()
+        with self.lock:
+            self.workers[nickname] = (process, callback, start)
+
+    def __finish(self, result):
+        with self.lock:
+            process, callback, start = self.workers.pop(result[0])
+        process.join()
+        callback(result)
+
+    def __monitor(self):
+        while not self.closed.is_set() or len(self.workers) > 0:
+            try:
+                self.__finish(self.results.get(True, 0.1))
+                continue
+            except Queue.Empty:
+                pass
+            with self.lock:
+                dead = [n for n, w in self.workers.items() if not w[0].is_alive()]
+            if len(dead) == 0:
+                continue
+            # A worker's result is sent before it exits, so collect any
+            # sent since the wait above first.
+            while True:
+                try:
+                    result = self.results.get(False)
+                except Queue.Empty:
+                    break
+                if result[0] in dead:
+                    dead.remove(result[0])
+                self.__finish(result)
+            for n in dead:
+                process, callback, start = self.workers[n]
+                self.__finish((n, "Worker process died (exit code {0})".format(process.exitcode), elapsed_ms(start)))
+
+    def close(self):
+        self.closed.set()
+
+    def terminate(self):
+        self.closed.set()
+        with self.lock:
+            for process, callback, start in self.workers.values():
+                process.terminate()
+
+    def join(self):
+        self.monitor.join()
+
+
+class TenantMigrator(object):
+    """Runs Migrator phases on every tenant database of a
+TenantDatabaseSource, on a pool of worker processes.
+
+Each tenant has its phases run in turn by one worker.  At most
+processes tenants are migrated at once, and at most max_per_host on
+any one database server.  A tenant that fails is retried (all its
+phases; migrations already applied are skipped) up to retries times,
+waiting retry_delay seconds, doubled for each further retry.  Progress,
+with an estimate of the time remaining, is logged as tenants finish.
+
+Worker processes are forked from the current process, one for each
+attempt at a tenant, inheriting the Migrator and its database_handler
+(whose connections are closed first).  A worker process that dies
+without finishing (eg, killed for running out of memory) fails its
+tenant's attempt.  Migrator observers are not notified of events in the
+worker processes."""
+
+    """Migrator method run for each phase name (see MigrationPlan.PHASES)."""
+    PHASE_METHODS = {
+        "delete_make_new": "delete_make_new",
+        "baseline_schema": "run_baseline_schema",
+        "migrations": "run_migrations",
+        "code": "run_code_definitions",
+        "reference_data": "run_reference_data"
+    }
+
+    def __init__(self, migrator):
+        """migrator: a Migrator whose database_source is a TenantDatabaseSource."""
+        self.migrator = migrator
+
+        # Number of tenants to migrate at once (1 = one at a time, in
+        # this process).
+        self.processes = 1
+
+        # Number of tenants to migrate at once on the same host (None =
+        # no limit other than processes).
+        self.max_per_host = None
+
+        self.retries = 0
+        self.retry_delay = 5
+
+    @staticmethod
+    def format_duration(seconds):
+        seconds = int(round(seconds))
+        if seconds < 60:
+            return "{0}s".format(seconds)
+        if seconds < 3600:
+            return "{0}m {1:02d}s".format(seconds / 60, seconds % 60)
+        return "{0}h {1:02d}m".format(seconds / 3600, (seconds % 3600) / 60)
+
+    def __get_host(self, nickname):
+        conn = self.migrator.database_source.get_connection_hash(nickname)
+        host = str(conn.get("host", ""))
+        if conn.get("port"):
+            host += ":" + str(conn["port"])
+        return host
+
+    def __create_pool(self):
+        if self.processes <= 1:
+            return _InProcessPool(self.migrator)
+        # Forked workers mustn't share the parent's connections.
+        self.migrator.database_handler.close_connections()
+        return _ProcessPool(self.migrator)
+
+    def __log_progress(self, done, failed, total, start):
+        elapsed = time.time() - start
+        msg = "Tenants: {0}/{1} done, {2} failed".format(done, total, failed)
+        if done < total:
+            msg += ", ETA {0}".format(TenantMigrator.format_duration(elapsed / done * (total - done)))
+        logger.info(msg)
+
+    def run(self, phases, *tenant_nicknames):
+        """Runs the phases (names, see MigrationPlan.PHASES) on the tenants
+(all of them, if none are given).  Returns a FanOutSummary; failures
+are not raised."""
+        source = self.migrator.database_source
+        if len(tenant_nicknames) == 0:
+            tenant_nicknames = source.get_tenant_nicknames()
+        phases = [p for p in MigrationPlan.PHASES if p in phases]
+
+        results = {}
+        # (not before time, nickname), in the order to start them.
+        pending = []
+        for n in tenant_nicknames:
+            results[n] = TenantResult(n, self.__get_host(n))
+            pending.append((0, n))
+        running = {}
+        finished = Queue.Queue()
+        done = 0
+        failed = 0
+        start = time.time()
+
+        pool = self.__create_pool()
+        try:
+            while len(pending) > 0 or sum(running.values()) > 0:
+                now = time.time()
+                for item in list(pending):
+                    if sum(running.values()) >= self.processes:
+                        break
+                    not_before, n = item
+                    host = results[n].host
+                    if not_before > now or (self.max_per_host is not None and running.get(host, 0) >= self.max_per_host):
+                        continue
+                    pending.remove(item)
+                    running[host] = running.get(host, 0) + 1
+                    results[n].attempts += 1
+                    pool.apply_async(n, phases, finished.put)
+
+                try:
+                    n, error, duration_ms = finished.get(True, 0.5)
+                except Queue.Empty:
+                    continue
+                r = results[n]
+                running[r.host] -= 1
+                r.error = error
+                r.duration_ms += duration_ms
+                if error is not None and r.attempts <= self.retries:
+                    delay = self.retry_delay * (2 ** (r.attempts - 1))
+                    logger.warning("Retrying tenant %s in %ds (attempt %d failed: %s)" % (n, delay, r.attempts, error))
+                    pending.append((time.time() + delay, n))
+                    continue
+                done += 1
+                if error is not None:
+                    failed += 1
+                self.__log_progress(done, failed, len(results), start)
+        except:
+            pool.terminate()
+            raise
+        pool.close()
+        pool.join()
+
+        summary = FanOutSummary()
+        summary.results = [results[n] for n in sorted(results.keys())]
+        summary.duration_ms = elapsed_ms(start)
+        return summary
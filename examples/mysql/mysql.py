@@ -6,7 +6,6 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
 import dbMigrator
 from dbMigrator.driver import Driver
 from dbMigrator.defaultdatabasesource import DefaultDatabaseSource
-from dbMigrator.mysqldatabasehandler import MySqlDatabaseHandler
 
 
 class MySqlExample:
@@ -43,7 +42,7 @@ Execute bootstrap_data.sql on mysql_test
 
         dds = DefaultDatabaseSource(inifile, d)
 
-        driver = Driver(dds, MySqlDatabaseHandler())
+        driver = Driver(dds, "mysql")
         driver.default_database = "mysql_test"
         driver.is_debug_printing = True
 
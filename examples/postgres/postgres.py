@@ -6,7 +6,6 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
 import dbMigrator
 from dbMigrator.driver import Driver
 from dbMigrator.defaultdatabasesource import DefaultDatabaseSource
-from dbMigrator.postgresdatabasehandler import PostgresDatabaseHandler
 
 
 class PostgresExample:
@@ -41,7 +40,7 @@ Execute bootstrap_data.sql on postgres_test
 
         dds = DefaultDatabaseSource(inifile, d)
 
-        driver = Driver(dds, PostgresDatabaseHandler())
+        driver = Driver(dds, "postgres")
         driver.default_database = "postgres_test"
         driver.is_debug_printing = True
 
@@ -1,6 +1,6 @@
 import unittest
 import dbMigrator
-from dbMigrator.migrator import DatabaseHandler
+from dbMigrator.migrator import DatabaseHandler, DeferredScriptException
 
 
 class FakeDatabaseHandler(DatabaseHandler):
@@ -11,6 +11,21 @@ class FakeDatabaseHandler(DatabaseHandler):
         self.call_history = []
         self.fail_on = []
         self.contains_userdefined_tables = False
+        # Scripts recorded per connection.
+        self.tracked = {}
+        self.flushed = []
+        # Checksums per connection, keyed by (script type, script name).
+        self.checksums = {}
+        # (duration_ms, rows_affected) recorded per connection and script.
+        self.timings = {}
+        # Rows affected to report for given sql.
+        self.rowcounts = {}
+        # Checksums of template databases.
+        self.templates = {}
+        # If > 1, tracked scripts are deferred and run this many at a time.
+        self.pack_size = 1
+        self.packs = {}
+        self.pack_results = {}
 
     def delete_make_new(self, system_connection_hash, database_name):
         self.call_history.append("create " + database_name)
@@ -25,19 +40,83 @@ class FakeDatabaseHandler(DatabaseHandler):
         self.call_history.append("create_track_tbl in " + connection_hash["conn"])
 
     def is_in_tracking_table(self, connection_hash, script_name):
-        msg = "check " + script_name + " in " + connection_hash["conn"]
-        ret = (msg in self.call_history)
-        self.call_history.append(msg)
-        return ret
+        self.call_history.append("check " + script_name + " in " + connection_hash["conn"])
+        return script_name in self.tracked.get(connection_hash["conn"], set())
+
+    def tracking_table_exists(self, connection_hash):
+        self.call_history.append("tracking_tbl_exists in " + connection_hash["conn"])
+        return connection_hash["conn"] in self.tracked
 
-    def record_script_in_tracking_table(self, conn_hash, script_name):
+    def get_applied_scripts(self, connection_hash):
+        self.call_history.append("get_applied in " + connection_hash["conn"])
+        return set(self.tracked.get(connection_hash["conn"], set()))
+
+    def record_script_in_tracking_table(self, conn_hash, script_name, duration_ms = None, rows_affected = None):
         self.call_history.append("record " + script_name + " in " + conn_hash["conn"])
+        self.tracked.setdefault(conn_hash["conn"], set()).add(script_name)
+        self.timings.setdefault(conn_hash["conn"], {})[script_name] = (duration_ms, rows_affected)
+
+    def create_checksum_table(self, connection_hash):
+        self.call_history.append("create_checksum_tbl in " + connection_hash["conn"])
+
+    def get_script_checksums(self, connection_hash, script_type):
+        self.call_history.append("get_checksums " + script_type + " in " + connection_hash["conn"])
+        c = self.checksums.get(connection_hash["conn"], {})
+        return dict([(k[1], v) for k, v in c.items() if k[0] == script_type])
+
+    def record_script_checksum(self, connection_hash, script_type, script_name, checksum):
+        self.call_history.append("checksum " + script_type + " " + script_name + " in " + connection_hash["conn"])
+        self.checksums.setdefault(connection_hash["conn"], {})[(script_type, script_name)] = checksum
+
+    def bulk_load(self, conn_hash, data):
+        self.call_history.append("bulk_load " + data.table + " in " + conn_hash["conn"])
+
+    def dump_schema(self, connection_hash):
+        self.call_history.append("dump " + connection_hash["dbname"])
+        return "schema of " + connection_hash["dbname"]
+
+    def get_template_checksum(self, system_connection_hash, template_name):
+        return self.templates.get(template_name)
+
+    def mark_template(self, system_connection_hash, template_name, checksum):
+        self.call_history.append("mark " + template_name)
+        self.templates[template_name] = checksum
+
+    def create_from_template(self, system_connection_hash, database_name, template_name):
+        self.call_history.append("create " + database_name + " from " + template_name)
+
+    def flush_tracking_table(self, conn_hash):
+        self.run_pack(conn_hash)
+        self.flushed.append(conn_hash["conn"])
+
+    def execute_tracked(self, conn_hash, script_name, sql):
+        if self.pack_size <= 1:
+            return super(FakeDatabaseHandler, self).execute_tracked(conn_hash, script_name, sql)
+        pack = self.packs.setdefault(conn_hash["conn"], [])
+        pack.append((script_name, sql))
+        if len(pack) >= self.pack_size:
+            self.run_pack(conn_hash)
+        return DatabaseHandler.DEFERRED
+
+    def run_pack(self, conn_hash):
+        pack = self.packs.pop(conn_hash["conn"], [])
+        for script_name, sql in pack:
+            try:
+                rows = self.execute(conn_hash, sql)
+            except Exception as e:
+                raise DeferredScriptException(script_name, "{0} (packed with {1} other script(s))".format(e, len(pack) - 1))
+            self.record_script_in_tracking_table(conn_hash, script_name, None, rows)
+            self.pack_results.setdefault(conn_hash["conn"], []).append((script_name, None, rows))
+
+    def pop_deferred_results(self, conn_hash):
+        return self.pack_results.pop(conn_hash["conn"], [])
 
     def execute(self, conn_hash, sql):
         if (sql in self.fail_on):
             raise Exception("bad sql")
         msg = "execute " + sql + " in " + conn_hash["conn"]
         self.call_history.append(msg)
+        return self.rowcounts.get(sql)
 
     def get_history(self):
         return "; ".join(self.call_history)
@@ -0,0 +1,234 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import dbMigrator
+from dbMigrator.cachingdatabasesource import CachingDatabaseSource, IndexedScriptContent, SourceIndex
+from dbMigrator.defaultdatabasesource import DefaultDatabaseSource, SqlScriptFile, DelimitedDataFile
+from dbMigrator.migrator import Migrator, DatabaseSource, ScriptContent
+from dbMigrator.sqlitedatabasehandler import SqliteDatabaseHandler
+
+
+class CountingFile(ScriptContent):
+    """A script file that counts how often it's read."""
+
+    reads = 0
+
+    def __init__(self, path):
+        self.path = path
+    def read(self):
+        CountingFile.reads += 1
+        with open(self.path) as f:
+            return f.read()
+    def size(self):
+        return os.path.getsize(self.path)
+
+
+class CountingSource(DatabaseSource):
+    """Lists the .sql files in <root>/<db>/<phase>, counting the listings."""
+
+    def __init__(self, root):
+        self.root = root
+        self.listings = 0
+        self.closed = False
+    def get_db_name_from_nickname(self, nickname):
+        return nickname
+    def get_system_connection_hash(self):
+        return { "dbname": "sys" }
+    def get_connection_hashes(self):
+        return { "db": { "dbname": "db" } }
+    def list(self, database_name, phase):
+        self.listings += 1
+        d = os.path.join(self.root, database_name, phase)
+        return [(f, CountingFile(os.path.join(d, f))) for f in sorted(os.listdir(d))] if os.path.exists(d) else []
+    def get_baseline_schema_files(self, database_name):
+        return self.list(database_name, "baseline_schema")
+    def get_reference_data_files(self, database_name):
+        return [("inline.sql", "select 1")]
+    def get_code_files(self, database_name):
+        return self.list(database_name, "code")
+    def get_migrations_files(self, database_name):
+        return self.list(database_name, "migrations")
+    def close(self):
+        self.closed = True
+
+
+class CachingDatabaseSource_Tests(unittest.TestCase):
+
+    longMessage = True
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.index_path = os.path.join(self.root, "index.json")
+        self.write("db/migrations/001.sql", "create table a(i int);")
+        self.write("db/code/v.sql", "create view v as select * from a;")
+        self.inner = CountingSource(self.root)
+        self.source = CachingDatabaseSource(self.inner, self.index_path)
+        CountingFile.reads = 0
+
+    def write(self, relpath, content, age = 60):
+        """Writes the file, with an mtime age seconds ago."""
+        path = os.path.join(self.root, relpath)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write(content)
+        t = time.time() - age
+        os.utime(path, (t, t))
+
+    def checksums(self, source):
+        return [ScriptContent.checksum_of(c) for n, c in source.get_code_files("db") + source.get_migrations_files("db")]
+
+    def test_file_lists_are_fetched_once_per_run(self):
+        for i in range(3):
+            self.assertEqual(["001.sql"], [f[0] for f in self.source.get_migrations_files("db")])
+        self.assertEqual(1, self.inner.listings)
+        self.source.close()
+        self.write("db/migrations/002.sql", "create table b(i int);")
+        self.assertEqual(["001.sql", "002.sql"], [f[0] for f in self.source.get_migrations_files("db")], "next run")
+        self.assertTrue(self.inner.closed, "wrapped source closed")
+
+    def test_file_content_is_served_lazily_with_wrapped_content_attributes(self):
+        files = self.source.get_migrations_files("db")
+        content = files[0][1]
+        self.assertTrue(isinstance(content, IndexedScriptContent))
+        self.assertEqual(0, CountingFile.reads, "not read yet")
+        self.assertEqual("create table a(i int);", ScriptContent.resolve(content))
+        self.assertEqual(22, content.size())
+        self.assertEqual(os.path.join(self.root, "db", "migrations", "001.sql"), content.path)
+        self.assertEqual([("inline.sql", "select 1")], self.source.get_reference_data_files("db"), "strings as-is")
+
+    def test_checksums_of_unchanged_files_are_served_from_index_across_runs(self):
+        expected = self.checksums(self.source)
+        self.assertEqual(2, CountingFile.reads)
+        self.assertEqual(expected, self.checksums(self.source), "same run")
+        self.source.close()
+        self.assertEqual(expected, self.checksums(CachingDatabaseSource(CountingSource(self.root), self.index_path)), "next run")
+        self.assertEqual(2, CountingFile.reads, "not read again")
+
+    def test_changed_file_is_checksummed_again(self):
+        before = self.checksums(self.source)
+        self.source.close()
+        self.write("db/code/v.sql", "create view v as select i from a;")
+        after = self.checksums(CachingDatabaseSource(CountingSource(self.root), self.index_path))
+        self.assertNotEqual(before[0], after[0], "changed")
+        self.assertEqual(before[1], after[1], "unchanged")
+        self.assertEqual(3, CountingFile.reads)
+
+    def test_recently_modified_files_are_not_indexed(self):
+        self.write("db/code/v.sql", "create view v as select 2;", age = 0)
+        self.checksums(self.source)
+        self.source.close()
+        with open(self.index_path) as f:
+            files = json.load(f)["files"]
+        self.assertEqual([os.path.join(self.root, "db", "migrations", "001.sql")], files.keys())
+
+    def test_unreadable_index_is_ignored(self):
+        with open(self.index_path, "w") as f:
+            f.write("{not json")
+        logging.getLogger('dbmigrator').setLevel(logging.CRITICAL)
+        source = CachingDatabaseSource(CountingSource(self.root), self.index_path)
+        self.assertEqual(2, len(self.checksums(source)))
+        source.close()
+        with open(self.index_path) as f:
+            self.assertEqual(SourceIndex.VERSION, json.load(f)["version"], "rewritten")
+
+    def test_checksums_can_be_indexed_up_front(self):
+        self.source.index_checksums("db")
+        self.assertEqual(2, CountingFile.reads)
+        self.checksums(self.source)
+        self.assertEqual(2, CountingFile.reads, "served from index")
+        self.source.close()
+        with open(self.index_path) as f:
+            self.assertEqual(2, len(json.load(f)["files"]))
+
+    def test_index_is_not_written_if_unchanged(self):
+        self.source.close()
+        self.assertFalse(os.path.exists(self.index_path))
+
+
+class CachingDatabaseSource_DefaultSourceTests(unittest.TestCase):
+    """Wraps a DefaultDatabaseSource for SQLite runs."""
+
+    longMessage = True
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        with open(os.path.join(self.root, "db.ini"), "w") as f:
+            f.write("[Server]\ndbname = sys\n[Databases]\n  [[db]]\n  dbname = db\n")
+        for relpath, content in [("db/migrations/001.sql", "create table widget(id int primary key, name varchar(10))"),
+                                 ("db/code/v.sql", "drop view if exists v; create view v as select name from widget"),
+                                 ("db/reference_data/widget.csv", "id,name\n1,gear\n")]:
+            os.makedirs(os.path.dirname(os.path.join(self.root, relpath)))
+            with open(os.path.join(self.root, relpath), "w") as f:
+                f.write(content)
+            # Old enough to be indexed (see SourceIndex.RACY_SECONDS).
+            os.utime(os.path.join(self.root, relpath), (time.time() - 60, time.time() - 60))
+        self.index_path = os.path.join(self.root, "index.json")
+        dds = DefaultDatabaseSource(os.path.join(self.root, "db.ini"), self.root)
+        self.source = CachingDatabaseSource(dds, self.index_path)
+        self.handler = SqliteDatabaseHandler()
+        logging.getLogger('dbmigrator').setLevel(logging.CRITICAL)
+
+    def tearDown(self):
+        self.handler.close_connections()
+
+    def test_bulk_load_content_is_wrapped(self):
+        data = self.source.get_reference_data_files("db")[0][1]
+        self.assertFalse(data.is_sql)
+        self.assertEqual("widget", data.table)
+        self.assertEqual(["id", "name"], data.get_columns())
+        self.assertEqual("sys", self.source.config["Server"]["dbname"], "other attributes delegated")
+
+    def test_update_of_unchanged_tree_reads_no_scripts(self):
+        reads = []
+        for cls in [SqlScriptFile, DelimitedDataFile]:
+            for name in ["read", "open"]:
+                method = getattr(cls, name)
+                def counted(content, method = method):
+                    reads.append(content.path)
+                    return method(content)
+                setattr(cls, name, counted)
+                self.addCleanup(setattr, cls, name, method)
+        for i in range(2):
+            del reads[:]
+            m = Migrator(self.source, self.handler)
+            m.skip_unchanged = True
+            m.run_migrations("db")
+            m.run_code_definitions("db")
+            m.run_reference_data("db")
+            self.source.close()
+        self.assertEqual([], reads, "second run")
+        conn = { "dbname": "db" }
+        self.assertEqual([("gear",)], self.handler.query(conn, "select * from v"))
+        self.assertEqual(["v.sql", "widget.csv"], sorted(self.handler.get_script_checksums(conn, "code").keys() +
+                                                         self.handler.get_script_checksums(conn, "reference_data").keys()))
+
+
+    def test_manifest_change_of_unchanged_data_file_is_a_change(self):
+        m = Migrator(self.source, self.handler)
+        m.skip_unchanged = True
+        m.run_migrations("db")
+        m.run_reference_data("db")
+        self.source.close()
+        conn = { "dbname": "db" }
+        before = self.handler.get_script_checksums(conn, "reference_data")["widget.csv"]
+        with open(os.path.join(self.root, "db/reference_data/widget.ini"), "w") as f:
+            f.write("mode = merge\nkey = id\n")
+        m = Migrator(self.source, self.handler)
+        m.skip_unchanged = True
+        m.run_reference_data("db")
+        self.source.close()
+        self.assertNotEqual(before, self.handler.get_script_checksums(conn, "reference_data")["widget.csv"], "reloaded")
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+import logging
+import unittest
+
+import dbMigrator
+from dbMigrator import chunkedmigration
+from dbMigrator.chunkedmigration import ChunkedMigration, ChunkedSqlMigration, ChunkedMigrationException
+from dbMigrator.migrator import ScriptRunner, ScriptRunnerException
+from dbMigrator.sqlitedatabasehandler import SqliteDatabaseHandler
+
+
+class FailingMigration(ChunkedSqlMigration):
+    """Fails on the chunk starting at fail_at."""
+
+    def __init__(self, name, sql, fail_at):
+        super(FailingMigration, self).__init__(name, sql)
+        self.fail_at = fail_at
+        self.chunks = []
+
+    def run_chunk(self, database_handler, conn_hash, start, end):
+        if start == self.fail_at:
+            raise Exception("connection lost")
+        self.chunks.append((start, end))
+        return super(FailingMigration, self).run_chunk(database_handler, conn_hash, start, end)
+
+
+class ChunkedMigration_Tests(unittest.TestCase):
+
+    longMessage = True
+
+    def setUp(self):
+        self.handler = SqliteDatabaseHandler()
+        self.conn_hash = { "dbname": "db" }
+        self.addCleanup(self.handler.close_connections)
+        self.handler.execute(self.conn_hash, "create table widget(id integer primary key, weight int)")
+        self.add_widgets(1, 25)
+        self.sql = "-- dbmigrator: chunked table=widget chunk_size=10\nupdate widget set weight = id where id >= {start} and id < {end};\n"
+        logging.getLogger('dbmigrator').setLevel(logging.CRITICAL)
+
+    def add_widgets(self, first, last):
+        values = ", ".join(["({0})".format(i) for i in range(first, last + 1)])
+        self.handler.execute(self.conn_hash, "insert into widget(id) values " + values)
+
+    def get_unmigrated(self):
+        return self.handler.query(self.conn_hash, "select count(*) from widget where weight is null")[0][0]
+
+    def get_checkpoint(self, name = "a.sql"):
+        return ChunkedSqlMigration(name, self.sql).get_checkpoint(self.handler, self.conn_hash)
+
+    def run_failing(self, fail_at):
+        m = FailingMigration("a.sql", self.sql, fail_at)
+        self.assertRaises(Exception, m.execute_on, self.handler, self.conn_hash)
+        return m
+
+    def test_subclasses_must_implement_run_chunk(self):
+        class NoChunks(ChunkedMigration):
+            def read(self):
+                return ""
+            def size(self):
+                return 0
+        self.assertRaises(TypeError, NoChunks, "a.py")
+
+    def test_marker_is_detected(self):
+        self.assertTrue(ChunkedSqlMigration.is_chunked(self.sql))
+        self.assertTrue(ChunkedSqlMigration.is_chunked("/* backfill */\n-- DbMigrator: Chunked table=t\nupdate t set c = 1"))
+        self.assertFalse(ChunkedSqlMigration.is_chunked("update t set c = 1 -- dbmigrator: chunked table=t"))
+
+    def test_settings_are_read_from_marker_line(self):
+        m = ChunkedSqlMigration("a.sql", "-- dbmigrator: chunked table=s.widget key=widget_id chunk_size=500 sleep=0.5\nupdate {start} {end}")
+        self.assertEqual(("s.widget", "widget_id", 500, 0.5), (m.table, m.key, m.chunk_size, m.sleep))
+        self.assertRaises(ChunkedMigrationException, ChunkedSqlMigration, "a.sql", "-- dbmigrator: chunked table=t chunks=5\n{start} {end}")
+        self.assertRaises(ChunkedMigrationException, ChunkedSqlMigration, "a.sql", "-- dbmigrator: chunked table=t sleep=x\n{start} {end}")
+        self.assertRaises(ChunkedMigrationException, ChunkedSqlMigration, "a.sql", "-- dbmigrator: chunked table=t\nupdate t set c = 1")
+
+    def test_bad_settings_throw_when_run(self):
+        for settings in ["chunk_size=10", "table=widget;drop", "table=widget key=id,1", "table=widget chunk_size=0"]:
+            m = ChunkedSqlMigration("a.sql", "-- dbmigrator: chunked " + settings + "\nselect {start}, {end}")
+            self.assertRaises(ChunkedMigrationException, m.execute_on, self.handler, self.conn_hash)
+
+    def test_chunk_sql_is_template_with_key_range(self):
+        m = ChunkedSqlMigration("a.sql", "-- dbmigrator: lock_timeout=1s\n" + self.sql)
+        self.assertEqual("-- dbmigrator: lock_timeout=1s\n\nupdate widget set weight = id where id >= 11 and id < 21;\n", m.get_chunk_sql(11, 21))
+
+    def test_rows_are_migrated_in_key_range_chunks(self):
+        m = FailingMigration("a.sql", self.sql, None)
+        self.assertEqual(25, m.execute_on(self.handler, self.conn_hash))
+        self.assertEqual([(1, 11), (11, 21), (21, 31)], m.chunks)
+        self.assertEqual(0, self.get_unmigrated())
+        self.assertEqual((m.checksum(), 31, 25, 25), self.get_checkpoint(), "done")
+
+    def test_interrupted_migration_resumes_from_last_finished_chunk(self):
+        self.run_failing(11)
+        self.assertEqual(15, self.get_unmigrated())
+        self.assertEqual(11, self.get_checkpoint()[1])
+        m = FailingMigration("a.sql", self.sql, None)
+        self.assertEqual(25, m.execute_on(self.handler, self.conn_hash), "rows of both runs")
+        self.assertEqual([(11, 21), (21, 31)], m.chunks)
+        self.assertEqual(0, self.get_unmigrated())
+
+    def test_changed_migration_starts_over(self):
+        self.run_failing(21)
+        self.sql = self.sql.replace("chunk_size=10", "chunk_size=20")
+        m = FailingMigration("a.sql", self.sql, None)
+        m.execute_on(self.handler, self.conn_hash)
+        self.assertEqual([(1, 21), (21, 41)], m.chunks)
+
+    def test_rows_added_beyond_last_key_are_migrated(self):
+        class AddingMigration(FailingMigration):
+            def run_chunk(s, database_handler, conn_hash, start, end):
+                if start == 1:
+                    self.add_widgets(26, 32)
+                return super(AddingMigration, s).run_chunk(database_handler, conn_hash, start, end)
+        m = AddingMigration("a.sql", self.sql, None)
+        self.assertEqual(32, m.execute_on(self.handler, self.conn_hash))
+        self.assertEqual([(1, 11), (11, 21), (21, 31), (31, 41)], m.chunks)
+        self.assertEqual(0, self.get_unmigrated())
+
+    def test_empty_table_runs_no_chunks(self):
+        self.handler.execute(self.conn_hash, "delete from widget")
+        m = FailingMigration("a.sql", self.sql, None)
+        self.assertEqual(0, m.execute_on(self.handler, self.conn_hash))
+        self.assertEqual([], m.chunks)
+
+    def test_sleeps_between_chunks(self):
+        sleeps = []
+        original = chunkedmigration.time.sleep
+        chunkedmigration.time.sleep = sleeps.append
+        self.addCleanup(setattr, chunkedmigration.time, "sleep", original)
+        ChunkedSqlMigration("a.sql", self.sql.replace("chunk_size=10", "chunk_size=10 sleep=0.25")).execute_on(self.handler, self.conn_hash)
+        self.assertEqual([0.25, 0.25], sleeps, "not after the last chunk")
+
+    def test_non_integer_keys_throw(self):
+        self.handler.execute(self.conn_hash, "create table tag(name varchar(10) primary key, n int); insert into tag(name) values ('a')")
+        m = ChunkedSqlMigration("a.sql", "-- dbmigrator: chunked table=tag key=name\nupdate tag set n = 1 where name >= {start} and name < {end}")
+        self.assertRaises(ChunkedMigrationException, m.execute_on, self.handler, self.conn_hash)
+
+    def test_checkpoint_table_is_not_in_dumped_schema(self):
+        ChunkedSqlMigration("a.sql", self.sql).execute_on(self.handler, self.conn_hash)
+        self.assertFalse(ChunkedMigration.CHECKPOINT_TABLE in self.handler.dump_schema(self.conn_hash))
+
+
+class ScriptRunner_ChunkedMigration_Tests(unittest.TestCase):
+
+    longMessage = True
+
+    def setUp(self):
+        self.handler = SqliteDatabaseHandler()
+        self.conn_hash = { "dbname": "db" }
+        self.addCleanup(self.handler.close_connections)
+        self.handler.execute(self.conn_hash, "create table widget(id integer primary key, weight int)")
+        self.handler.execute(self.conn_hash, "insert into widget(id) values (1), (2), (3), (4), (5)")
+        logging.getLogger('dbmigrator').setLevel(logging.CRITICAL)
+
+    def run_script(self, name, sql, tracked = True):
+        runner = ScriptRunner({ "db": self.conn_hash }, self.handler)
+        runner.add_script(name, "db", sql)
+        runner.execute_scripts(tracked)
+
+    def get_applied(self):
+        return self.handler.get_applied_scripts(self.conn_hash)
+
+    def test_marked_migration_is_recorded_when_all_chunks_are_done(self):
+        sql = "-- dbmigrator: chunked table=widget chunk_size=2\nupdate widget set weight = 1 where id >= {start} and id < {end}"
+        self.run_script("a.sql", sql)
+        self.assertEqual(set(["a.sql"]), self.get_applied())
+        self.assertEqual([(5,)], self.handler.query(self.conn_hash, "select rows_affected from __schema_migrations"))
+        self.assertEqual([(1, 5)], self.handler.query(self.conn_hash, "select weight, count(*) from widget group by weight"))
+
+    def test_failed_migration_is_not_recorded_and_resumes(self):
+        sql = "-- dbmigrator: chunked table=widget chunk_size=2\nupdate widget set weight = 10 / (id - 3) where id >= {start} and id < {end}"
+        self.handler.execute(self.conn_hash, "create trigger no_div before update on widget when new.weight is null begin select raise(abort, 'divide by zero'); end")
+        self.assertRaises(ScriptRunnerException, self.run_script, "a.sql", sql)
+        self.assertEqual(set(), self.get_applied(), "not recorded")
+        self.assertEqual(3, ChunkedSqlMigration("a.sql", sql).get_checkpoint(self.handler, self.conn_hash)[1], "first chunk done")
+        self.handler.execute(self.conn_hash, "drop trigger no_div")
+        self.run_script("a.sql", sql)
+        self.assertEqual(set(["a.sql"]), self.get_applied())
+
+    def test_untracked_scripts_are_not_chunked(self):
+        sql = "-- dbmigrator: chunked table=widget\nupdate widget set weight = 1 where id >= {start} and id < {end}"
+        self.assertRaises(ScriptRunnerException, self.run_script, "a.sql", sql, False)
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
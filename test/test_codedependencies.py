@@ -0,0 +1,135 @@
+import threading
+import time
+import unittest
+
+import dbMigrator
+from dbMigrator.codedependencies import CodeDependencyGraph, CodeDependencyException
+
+
+class CodeDependencyGraph_Tests(unittest.TestCase):
+
+    longMessage = True
+
+    def setUp(self):
+        # vC selects from vB, which selects from vA; fn_total is
+        # independent, and trg uses it.
+        self.scripts = [
+            ("vA.sql", "create or replace view vA as select 1 as x"),
+            ("vB.sql", "create view public.\"vB\" as select x from vA"),
+            ("vC.sql", "drop view if exists vC;\ncreate view vC as select * from public.vb"),
+            ("fn_total.sql", "create function fn_total() returns int as $$ select 1 $$ language sql"),
+            ("trg.sql", "create trigger trg after insert on t for each row execute procedure FN_TOTAL()")
+        ]
+        self.graph = CodeDependencyGraph(self.scripts)
+
+    def test_objects_created_by_script_are_found(self):
+        self.assertEqual(set(["va"]), CodeDependencyGraph.get_defined_objects(self.scripts[0][1]))
+        self.assertEqual(set(["vb"]), CodeDependencyGraph.get_defined_objects(self.scripts[1][1]))
+        sql = "CREATE DEFINER=`root`@`%` PROCEDURE `db`.`sp_x`() begin end"
+        self.assertEqual(set(["sp_x"]), CodeDependencyGraph.get_defined_objects(sql))
+        sql = "create materialized view if not exists mv as select 1"
+        self.assertEqual(set(["mv"]), CodeDependencyGraph.get_defined_objects(sql))
+
+    def test_dependencies_are_parsed_from_sql(self):
+        self.assertEqual([], self.graph.get_dependencies("vA.sql"))
+        self.assertEqual(["vA.sql"], self.graph.get_dependencies("vB.sql"))
+        self.assertEqual(["vB.sql"], self.graph.get_dependencies("vC.sql"))
+        self.assertEqual(["fn_total.sql"], self.graph.get_dependencies("trg.sql"))
+
+    def test_names_in_comments_are_not_dependencies(self):
+        g = CodeDependencyGraph([
+            ("a.sql", "create view a as select 1"),
+            ("b.sql", "-- unlike a\n/* or a */ create view b as select 2")
+        ])
+        self.assertEqual([], g.get_dependencies("b.sql"))
+
+    def test_dependencies_can_be_declared_by_script_or_object(self):
+        g = CodeDependencyGraph([
+            ("a.sql", "create view a as select 1"),
+            ("b.sql", "create function b() returns int as 'select 1' language sql"),
+            ("c.sql", "-- depends: a.sql, B\ncreate function c() returns void as $$ begin execute 'select * from ' || 'a'; end $$ language plpgsql")
+        ])
+        self.assertEqual(["a.sql", "b.sql"], g.get_dependencies("c.sql"))
+
+    def test_unknown_declared_dependency_is_ignored(self):
+        g = CodeDependencyGraph([("a.sql", "-- depends: some_table\ncreate view a as select 1")])
+        self.assertEqual([], g.get_dependencies("a.sql"))
+
+    def test_order_satisfies_dependencies_then_filename(self):
+        self.assertEqual(["fn_total.sql", "trg.sql", "vA.sql", "vB.sql", "vC.sql"], self.graph.get_order())
+        g = CodeDependencyGraph([
+            ("10_a.sql", "create view a as select * from z"),
+            ("20_b.sql", "create view b as select 1"),
+            ("30_z.sql", "create view z as select 1")
+        ])
+        self.assertEqual(["20_b.sql", "30_z.sql", "10_a.sql"], g.get_order())
+
+    def test_order_of_some_scripts(self):
+        self.assertEqual(["vB.sql", "vC.sql"], self.graph.get_order(["vC.sql", "vB.sql"]))
+
+    def test_circular_dependencies_are_reported(self):
+        g = CodeDependencyGraph([
+            ("a.sql", "create view a as select * from b"),
+            ("b.sql", "create view b as select * from a"),
+            ("c.sql", "create view c as select 1")
+        ])
+        with self.assertRaises(CodeDependencyException) as ctx:
+            g.get_order()
+        self.assertTrue("a.sql, b.sql" in str(ctx.exception), str(ctx.exception))
+        self.assertRaises(CodeDependencyException, g.run, lambda n, w: None, 2)
+
+    def test_downstream_includes_indirect_dependents(self):
+        self.assertEqual(set(["vA.sql", "vB.sql", "vC.sql"]), self.graph.get_downstream(["vA.sql"]))
+        self.assertEqual(set(["vC.sql"]), self.graph.get_downstream(["vC.sql"]))
+        self.assertEqual(set(), self.graph.get_downstream([]))
+
+    def test_single_worker_runs_in_order_on_calling_thread(self):
+        ran = []
+        self.graph.run(lambda n, w: ran.append((n, w, threading.current_thread())))
+        self.assertEqual(self.graph.get_order(), [r[0] for r in ran])
+        self.assertEqual(set([0]), set([r[1] for r in ran]))
+        self.assertEqual(set([threading.current_thread()]), set([r[2] for r in ran]))
+
+    def test_workers_run_independent_scripts_concurrently_after_dependencies(self):
+        lock = threading.Lock()
+        started = {}
+        finished = {}
+        workers = set()
+        def run(name, worker):
+            with lock:
+                started[name] = time.time()
+                workers.add(worker)
+            time.sleep(0.05)
+            with lock:
+                finished[name] = time.time()
+
+        self.graph.run(run, 3)
+        self.assertEqual(5, len(finished), "all run")
+        for n in started:
+            for d in self.graph.get_dependencies(n):
+                self.assertTrue(finished[d] <= started[n], "{0} started before {1} finished".format(n, d))
+        self.assertTrue(started["vA.sql"] < finished["fn_total.sql"], "independent scripts overlap")
+        self.assertTrue(workers <= set([0, 1, 2]), str(workers))
+
+    def test_failure_stops_dependents_and_is_raised(self):
+        ran = []
+        def run(name, worker):
+            if name == "vA.sql":
+                raise ValueError("bad view")
+            ran.append(name)
+        with self.assertRaises(ValueError):
+            self.graph.run(run, 2)
+        self.assertFalse("vB.sql" in ran, "dependent not run")
+        self.assertFalse("vC.sql" in ran, "indirect dependent not run")
+
+    def test_only_given_scripts_are_run(self):
+        ran = []
+        self.graph.run(lambda n, w: ran.append(n), 2, ["vB.sql", "vC.sql"])
+        self.assertEqual(["vB.sql", "vC.sql"], ran)
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import threading
+import time
+import unittest
+
+import dbMigrator
+from dbMigrator.connectioncache import ConnectionCache
+
+
+class FakeConnection(object):
+    """Records whether it has been closed."""
+    def __init__(self, name):
+        self.name = name
+        self.closed = False
+        self.alive = True
+    def close(self):
+        self.closed = True
+
+
+class ConnectionCache_Tests(unittest.TestCase):
+
+    longMessage = True
+
+    def setUp(self):
+        self.opened = []
+        self.cache = ConnectionCache(self.open_connection, lambda c: c.alive)
+
+    def open_connection(self, connection_hash):
+        c = FakeConnection(connection_hash["dbname"])
+        self.opened.append(c)
+        return c
+
+    def hsh(self, dbname, host = "localhost"):
+        return { "host": host, "dbname": dbname, "user": "u", "password": "p" }
+
+    def test_connection_is_reused_for_same_hash(self):
+        a = self.cache.get(self.hsh("db1"))
+        b = self.cache.get(self.hsh("db1"))
+        self.assertTrue(a is b, "same connection")
+        self.assertEqual(1, len(self.opened), "opened once")
+
+    def test_different_hashes_get_different_connections(self):
+        a = self.cache.get(self.hsh("db1"))
+        b = self.cache.get(self.hsh("db2"))
+        c = self.cache.get(self.hsh("db1", host = "otherhost"))
+        self.assertEqual(3, len(self.opened), "opened three")
+        self.assertEqual(3, len(self.cache), "all cached")
+
+    def test_sessions_get_separate_connections(self):
+        a = self.cache.get(self.hsh("db1"))
+        h = self.hsh("db1")
+        h["session"] = 1
+        b = self.cache.get(h)
+        self.assertFalse(a is b, "separate")
+        self.assertTrue(b is self.cache.get(h), "session connection reused")
+        self.cache.discard_database("db1")
+        self.assertEqual(0, len(self.cache), "all discarded")
+
+    def test_stale_connection_is_reopened_after_health_check(self):
+        self.cache.health_check_interval = -1
+        a = self.cache.get(self.hsh("db1"))
+        a.alive = False
+        b = self.cache.get(self.hsh("db1"))
+        self.assertFalse(a is b, "reconnected")
+        self.assertTrue(a.closed, "stale connection closed")
+
+    def test_health_check_skipped_for_recently_used_connection(self):
+        self.cache.health_check_interval = 1000
+        a = self.cache.get(self.hsh("db1"))
+        a.alive = False
+        b = self.cache.get(self.hsh("db1"))
+        self.assertTrue(a is b, "not checked")
+
+    def test_failing_health_check_counts_as_stale(self):
+        def explode(c):
+            raise Exception("gone")
+        self.cache.is_alive = explode
+        self.cache.health_check_interval = -1
+        a = self.cache.get(self.hsh("db1"))
+        b = self.cache.get(self.hsh("db1"))
+        self.assertFalse(a is b, "reconnected")
+
+    def test_discard_database_closes_only_that_database(self):
+        a = self.cache.get(self.hsh("db1"))
+        b = self.cache.get(self.hsh("db2"))
+        self.cache.discard_database("db1")
+        self.assertTrue(a.closed, "db1 closed")
+        self.assertFalse(b.closed, "db2 still open")
+        self.assertFalse(a is self.cache.get(self.hsh("db1")), "reopened")
+
+    def test_close_all(self):
+        a = self.cache.get(self.hsh("db1"))
+        b = self.cache.get(self.hsh("db2"))
+        self.cache.close_all()
+        self.assertTrue(a.closed and b.closed, "all closed")
+        self.assertEqual(0, len(self.cache), "none cached")
+
+    def test_concurrent_gets_open_one_connection(self):
+        def slow_open(connection_hash):
+            time.sleep(0.1)
+            return self.open_connection(connection_hash)
+        self.cache = ConnectionCache(slow_open, lambda c: c.alive)
+        got = []
+        threads = [threading.Thread(target = lambda: got.append(self.cache.get(self.hsh("db1")))) for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(1, len(self.opened), "opened once")
+        self.assertTrue(all([c is got[0] for c in got]), "same connection")
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,15 @@
+import logging
 import unittest
 import sys
 import os
 import inspect
+import shutil
+import tempfile
 
 import dbMigrator
-from dbMigrator.defaultdatabasesource import DefaultDatabaseSource
+from dbMigrator.defaultdatabasesource import DefaultDatabaseSource, DelimitedDataFile
+from dbMigrator.migrator import Migrator, ScriptContent, BulkLoadContent
+from dbMigrator.sqlitedatabasehandler import SqliteDatabaseHandler
 
 class DefaultDatabaseSource_Tests(unittest.TestCase):
 
@@ -27,7 +32,32 @@ class DefaultDatabaseSource_Tests(unittest.TestCase):
         self.assertReturnsFiles(["Db.sql"], self.dds.get_baseline_schema_files("db_files"), "baseline")
         self.assertReturnsFiles(["10_vX.sql"], self.dds.get_code_files("db_files"), "code")
         self.assertReturnsFiles(["20130427_add_a_size.sql", "20130428_create_Widget.sql"], self.dds.get_migrations_files("db_files"), "migrations")
-        self.assertReturnsFiles(["bootstrap_data.sql"], self.dds.get_reference_data_files("db_files"), "data")
+        self.assertReturnsFiles(["bootstrap_data.sql", "currency.csv", "widget.tsv"], self.dds.get_reference_data_files("db_files"), "data")
+
+    def test_script_content_is_read_on_demand(self):
+        files = dict(self.dds.get_migrations_files("db_files"))
+        content = files["20130427_add_a_size.sql"]
+        self.assertTrue(isinstance(content, ScriptContent), "lazy")
+        self.assertTrue("alter table a add column size int" in content.read(), "content")
+        self.assertEqual(len(content.read()), content.size(), "size")
+
+    def test_csv_data_file_defaults(self):
+        files = dict(self.dds.get_reference_data_files("db_files"))
+        data = files["currency.csv"]
+        self.assertTrue(isinstance(data, BulkLoadContent), "bulk load")
+        self.assertEqual("currency", data.table, "table from file name")
+        self.assertEqual("truncate", data.mode, "mode")
+        self.assertEqual(",", data.delimiter, "delimiter")
+        self.assertEqual(["code", "name"], data.get_columns(), "columns from header")
+
+    def test_tsv_data_file_with_manifest(self):
+        files = dict(self.dds.get_reference_data_files("db_files"))
+        data = files["widget.tsv"]
+        self.assertEqual("Widget", data.table, "table from manifest")
+        self.assertEqual("merge", data.mode, "mode")
+        self.assertEqual(["id"], data.key_columns, "key")
+        self.assertEqual("\t", data.delimiter, "delimiter")
+        self.assertEqual(["id", "name"], data.get_columns(), "columns from header")
 
     def test_connections(self):
         c = self.dds.get_system_connection_hash()
@@ -36,6 +66,115 @@ class DefaultDatabaseSource_Tests(unittest.TestCase):
         self.assertTrue(c is not None, "have db connection")
         self.assertTrue(len(c.keys()) > 0, "have db connection hash components")
 
+class DelimitedDataFile_Tests(unittest.TestCase):
+
+    longMessage = True
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, "widget.csv")
+        self.write("widget.csv", "id,name\n1,gear\n")
+
+    def write(self, name, content):
+        with open(os.path.join(self.dir, name), "w") as f:
+            f.write(content)
+
+    def test_checksum_includes_manifest_settings(self):
+        before = DelimitedDataFile(self.path).checksum()
+        self.assertEqual(before, DelimitedDataFile(self.path).checksum(), "stable")
+        self.write("widget.ini", "null = NULL\n")
+        after = DelimitedDataFile(self.path).checksum()
+        self.assertNotEqual(before, after, "manifest added")
+        self.write("widget.ini", "null = NULL\n# just a comment\n")
+        self.assertEqual(after, DelimitedDataFile(self.path).checksum(), "same settings")
+
+
+class DefaultDatabaseSource_SquashTests(unittest.TestCase):
+    """Squashes a tree of scripts for a SQLite database."""
+
+    longMessage = True
+
+    def write(self, relpath, content):
+        path = os.path.join(self.root, relpath)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write(content)
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.write("db.ini", "[Server]\ndbname = sys\n[Databases]\n  [[db]]\n  dbname = db\n  [[new]]\n  dbname = new\n")
+        for db in ["db", "new"]:
+            self.write(db + "/baseline_schema/Db.sql", "create table a(i int);")
+            self.write(db + "/migrations/001_add_b.sql", "create table b(i int);")
+            self.write(db + "/migrations/002_drop_a.sql", "drop table a; create index ix_b on b(i);")
+        self.source = DefaultDatabaseSource(os.path.join(self.root, "db.ini"), self.root)
+        self.handler = SqliteDatabaseHandler()
+        self.migrator = Migrator(self.source, self.handler)
+        logging.getLogger('dbmigrator').setLevel(logging.CRITICAL)
+
+    def tearDown(self):
+        self.migrator.close()
+
+    def get_tables(self, dbname):
+        conn = self.handler.connections.get({ "dbname": dbname })
+        r = conn.execute("select name from sqlite_master where type in ('table', 'index') order by name")
+        return [row[0] for row in r.fetchall() if not row[0].startswith("__") and not row[0].startswith("sqlite_")]
+
+    def test_config_is_read_on_first_use(self):
+        source = DefaultDatabaseSource(os.path.join(self.root, "db.ini"), self.root)
+        self.write("db.ini", "[Server]\ndbname = other\n[Databases]\n")
+        self.assertEqual({ "dbname": "other" }, source.get_system_connection_hash())
+
+    def test_python_migration_is_run_in_chunks(self):
+        self.write("db/migrations/003_add_w.sql", "create table w(id integer primary key, v int); insert into w(id) values (1), (2), (3), (4), (5);")
+        self.write("db/migrations/004_fill_w.py", "\n".join([
+            "table = 'w'",
+            "chunk_size = 2",
+            "def migrate_chunk(database_handler, conn_hash, start, end):",
+            "    return database_handler.execute(conn_hash, 'update w set v = id where id >= %d and id < %d' % (start, end))"]))
+        self.assertEqual(["001_add_b.sql", "002_drop_a.sql", "003_add_w.sql", "004_fill_w.py"], sorted([f[0] for f in self.source.get_migrations_files("db")]))
+        self.migrator.run_baseline_schema("db")
+        self.migrator.run_migrations("db")
+        conn_hash = { "dbname": "db" }
+        self.assertTrue("004_fill_w.py" in self.handler.get_applied_scripts(conn_hash))
+        self.assertEqual([(15, 5)], self.handler.query(conn_hash, "select sum(v), count(*) from w"))
+        self.assertEqual([(7, 5)], self.handler.query(conn_hash, "select next_key, rows_affected from __chunked_migrations"), "3 chunks")
+
+    def test_python_migration_without_migrate_chunk_throws(self):
+        self.write("db/migrations/003_fill.py", "table = 'b'\n")
+        self.migrator.run_baseline_schema("db")
+        self.assertRaises(Exception, self.migrator.run_migrations, "db")
+        self.assertFalse("003_fill.py" in self.handler.get_applied_scripts({ "dbname": "db" }))
+
+    def test_squash_writes_new_baseline_and_archives_old(self):
+        self.migrator.squash_migrations("db")
+        self.assertEqual(["squashed_baseline.sql"], [f[0] for f in self.source.get_baseline_schema_files("db")])
+        self.assertEqual(["001_add_b.sql", "002_drop_a.sql"], self.source.get_squashed_migrations("db"))
+        self.assertEqual(2, len(self.source.get_migrations_files("db")), "migrations kept")
+        archived = os.listdir(os.path.join(self.root, "db", "squashed"))
+        self.assertEqual(1, len(archived))
+        self.assertEqual(["Db.sql"], os.listdir(os.path.join(self.root, "db", "squashed", archived[0], "baseline_schema")))
+
+    def test_new_database_from_squashed_baseline_matches_replayed_migrations(self):
+        self.migrator.run_baseline_schema("new")
+        self.migrator.run_migrations("new")
+        self.migrator.squash_migrations("db")
+        self.migrator.run_baseline_schema("db")
+        self.migrator.run_migrations("db")
+        self.assertEqual(["b", "ix_b"], self.get_tables("db"))
+        self.assertEqual(self.get_tables("new"), self.get_tables("db"), "same schema")
+        self.assertEqual(set(["001_add_b.sql", "002_drop_a.sql"]), self.handler.get_applied_scripts({ "dbname": "db" }))
+
+    def test_squashing_again_keeps_earlier_squashed_migrations(self):
+        self.migrator.squash_migrations("db")
+        self.write("db/migrations/003_add_c.sql", "create table c(i int);")
+        self.migrator.squash_migrations("db")
+        self.assertEqual(["001_add_b.sql", "002_drop_a.sql", "003_add_c.sql"], self.source.get_squashed_migrations("db"))
+
+
 def main():
     unittest.main()
 
@@ -1,8 +1,15 @@
+import json
+import os
+import shutil
+import tempfile
 import unittest
 
 import dbMigrator
+from dbMigrator.cachingdatabasesource import CachingDatabaseSource
 from dbMigrator.driver import Driver
 from dbMigrator.migrator import DatabaseSource, DatabaseHandler
+from dbMigrator.observers import MigrationObserver
+from dbMigrator.sqlitedatabasehandler import SqliteDatabaseHandler
 
 class FakeDatabaseSource(DatabaseSource):
     """Fake script provider.  See DatabaseSource for notes on class function."""
@@ -26,6 +33,8 @@ class FakeDatabaseHandler(DatabaseHandler):
     def __init__(self):
         # Stores history for checking in test.
         self.hist = []
+        self.connections_closed = False
+        self.checksums = {}
     def delete_make_new(self, system_connection_hash, database_name):
         self.hist.append("create " + database_name)
     def create_tracking_table(self, connection_hash):
@@ -34,10 +43,28 @@ class FakeDatabaseHandler(DatabaseHandler):
         return False
     def is_in_tracking_table(self, connection_hash, script_name):
         return False
-    def record_script_in_tracking_table(self, conn_hash, script_name):
+    def get_applied_scripts(self, connection_hash):
+        return set()
+    def tracking_table_exists(self, connection_hash):
+        return False
+    def create_checksum_table(self, connection_hash):
+        pass
+    def get_script_checksums(self, connection_hash, script_type):
+        return self.checksums.get(script_type, {})
+    def record_script_checksum(self, connection_hash, script_type, script_name, checksum):
+        self.checksums.setdefault(script_type, {})[script_name] = checksum
+    def record_script_in_tracking_table(self, conn_hash, script_name, duration_ms = None, rows_affected = None):
         self.hist.append("recording " + script_name + " in " + conn_hash["conn"])
     def execute(self, conn_hash, sql):
         self.hist.append("executing " + sql + " in " + conn_hash["conn"])
+    def get_template_checksum(self, system_connection_hash, template_name):
+        return self.checksums.get("template", {}).get(template_name)
+    def mark_template(self, system_connection_hash, template_name, checksum):
+        self.checksums.setdefault("template", {})[template_name] = checksum
+    def create_from_template(self, system_connection_hash, database_name, template_name):
+        self.hist.append("create " + database_name + " from " + template_name)
+    def close_connections(self):
+        self.connections_closed = True
 
     
 class DriverTests(unittest.TestCase):
@@ -124,6 +151,160 @@ class DriverTests(unittest.TestCase):
                     'executing data in 1_c']
         self.assert_db_history_equals(expected)
 
+    def test_jobs_defaults_to_one(self):
+        self.assertEqual(1, self.driver.parse_args(["program.py", "db1"]).jobs)
+        self.assertEqual(4, self.driver.parse_args(["program.py", "-j", "4", "db1"]).jobs)
+
+    def test_upgrade_several_databases_in_parallel(self):
+        self.driver.default_database = ""
+        self.call_driver_with_args(["-u", "-j", "2", "db1", "db2"])
+        for c in ["1_c", "2_c"]:
+            expected = ['create tracking in ' + c,
+                        'executing migration in ' + c,
+                        'recording migration.sql in ' + c,
+                        'executing code in ' + c,
+                        'executing data in ' + c]
+            self.assertEqual(expected, [h for h in self.fake_db_handler.hist if h.endswith(c)])
+
+    def test_code_jobs_runs_code_in_dependency_order(self):
+        self.assertEqual(None, self.driver.parse_args(["program.py", "db1"]).code_jobs)
+        self.driver.default_database = ""
+        self.call_driver_with_args(["-c", "--code-jobs", "2", "db1", "db2"])
+        expected = ['executing code in 1_c',
+                    'executing code in 2_c']
+        self.assert_db_history_equals(expected)
+
+    def test_skip_unchanged_skips_code_and_data_on_second_update(self):
+        self.driver.default_database = ""
+        self.call_driver_with_args(["-u", "--skip-unchanged", "db1"])
+        self.fake_db_handler.hist = []
+        self.call_driver_with_args(["-u", "--skip-unchanged", "db1"])
+        expected = ['create tracking in 1_c',
+                    'executing migration in 1_c',
+                    'recording migration.sql in 1_c']
+        self.assert_db_history_equals(expected)
+
+    def test_force_reruns_unchanged_code_and_data(self):
+        self.driver.default_database = ""
+        self.call_driver_with_args(["-u", "--skip-unchanged", "db1"])
+        self.fake_db_handler.hist = []
+        self.call_driver_with_args(["-u", "--skip-unchanged", "--force", "db1"])
+        self.assertTrue('executing code in 1_c' in self.fake_db_handler.hist, "code")
+        self.assertTrue('executing data in 1_c' in self.fake_db_handler.hist, "data")
+
+    def test_connections_are_closed_after_run(self):
+        self.driver.default_database = ""
+        self.call_driver_with_args(["-u", "db1"])
+        self.assertTrue(self.fake_db_handler.connections_closed)
+
+    def test_registered_observers_receive_events(self):
+        class PhaseRecorder(MigrationObserver):
+            def __init__(self):
+                self.phases = []
+            def phase_finished(self, phase, db_nicknames, duration_ms, error):
+                self.phases.append(phase)
+        r = PhaseRecorder()
+        self.driver.add_observer(r)
+        self.driver.default_database = ""
+        self.call_driver_with_args(["-u", "db1"])
+        self.assertEqual(["migrations", "code", "reference_data"], r.phases)
+
+    def test_metrics_and_events_files(self):
+        d = tempfile.mkdtemp()
+        try:
+            metrics = os.path.join(d, "dbmigrator.prom")
+            events = os.path.join(d, "events.jsonl")
+            self.driver.default_database = ""
+            self.call_driver_with_args(["-u", "--metrics-file", metrics, "--events-file", events, "db1"])
+            with open(metrics) as f:
+                self.assertTrue('dbmigrator_phase_success{phase="code"} 1' in f.read().splitlines())
+            with open(events) as f:
+                names = [json.loads(line)["event"] for line in f]
+            self.assertEqual("phase_started", names[0])
+            self.assertEqual("phase_finished", names[-1])
+        finally:
+            shutil.rmtree(d)
+
+    def test_handler_can_be_given_by_name(self):
+        d = Driver(self.fake_db_source, "sqlite")
+        self.assertTrue(isinstance(d.database_handler, SqliteDatabaseHandler))
+        self.assertTrue(d.database_handler is d.database_handler, "created once")
+
+    def test_source_index_wraps_database_source(self):
+        args = self.driver.parse_args(["driver.py", "-u", "--source-index", "index.json", "db1"])
+        source = self.driver.get_database_source(args)
+        self.assertTrue(isinstance(source, CachingDatabaseSource))
+        self.assertEqual([('code.sql', 'code')], source.get_code_files("db1"))
+        args = self.driver.parse_args(["driver.py", "-u", "db1"])
+        self.assertTrue(self.driver.get_database_source(args) is self.fake_db_source)
+
+    def test_new_database_from_template(self):
+        self.driver.default_database = ""
+        self.call_driver_with_args(["-nsm", "--from-template", "db1"])
+        self.fake_db_handler.hist = []
+        self.call_driver_with_args(["-nsm", "--from-template", "db1"])
+        expected = ['create db1 from db1_template',
+                    'create tracking in 1_c',
+                    'executing migration in 1_c',
+                    'recording migration.sql in 1_c']
+        self.assert_db_history_equals(expected)
+
+    def test_from_template_without_new_throws(self):
+        self.assertRaises(Driver.ParsingException, self.call_driver_with_args, ["-m", "--from-template", "db1"])
+        self.assertEqual([], self.fake_db_handler.hist, "nothing run")
+
+    def test_plan_does_not_execute(self):
+        self.driver.default_database = ""
+        self.call_driver_with_args(["-nsu", "--plan", "db1"])
+        self.assertEqual([], self.fake_db_handler.hist)
+
+    def test_plan_json_is_written(self):
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, "plan.json")
+            self.driver.default_database = ""
+            self.call_driver_with_args(["-u", "--plan-json", path, "db1", "db2"])
+            with open(path) as f:
+                plan = json.load(f)
+            self.assertEqual(["migrations", "code", "reference_data"], plan["phases"])
+            self.assertEqual(["db1", "db2"], [db["db"] for db in plan["databases"]])
+            self.assertEqual([{ "name": "migration.sql", "size": 9, "action": "run" }], plan["databases"][0]["phases"][0]["scripts"])
+            self.assertEqual([], self.fake_db_handler.hist)
+        finally:
+            shutil.rmtree(d)
+
+    def test_tenants_get_the_db_scripts(self):
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, "tenants.txt")
+            with open(path, "w") as f:
+                f.write("t1 conn=t1_c\nt2 conn=t2_c\n")
+            self.driver.default_database = ""
+            self.call_driver_with_args(["-m", "--tenants", path, "db1"])
+            for c in ["t1_c", "t2_c"]:
+                expected = ['create tracking in ' + c,
+                            'executing migration in ' + c,
+                            'recording migration.sql in ' + c]
+                self.assertEqual(expected, [h for h in self.fake_db_handler.hist if h.endswith(c)])
+            self.assertRaises(Driver.ParsingException, self.call_driver_with_args, ["-m", "--tenants", path, "db1", "db2"])
+        finally:
+            shutil.rmtree(d)
+
+    def test_tenants_reject_metrics_events_and_observers(self):
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, "tenants.txt")
+            with open(path, "w") as f:
+                f.write("t1 conn=t1_c\n")
+            self.driver.default_database = ""
+            for extra in [["--metrics-file", os.path.join(d, "m.prom")], ["--events-file", os.path.join(d, "e.jsonl")]]:
+                self.assertRaises(Driver.ParsingException, self.call_driver_with_args, ["-m", "--tenants", path, "db1"] + extra)
+            self.driver.add_observer(MigrationObserver())
+            self.assertRaises(Driver.ParsingException, self.call_driver_with_args, ["-m", "--tenants", path, "db1"])
+            self.assertEqual([], self.fake_db_handler.hist, "nothing run")
+        finally:
+            shutil.rmtree(d)
+
 
 def main():
     unittest.main()
@@ -0,0 +1,89 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import dbMigrator
+from dbMigrator import handlers
+from dbMigrator.handlers import get_handler_class, create_handler, register_handler, get_handler_names
+from dbMigrator.migrator import MigrationException
+from dbMigrator.sqlitedatabasehandler import SqliteDatabaseHandler
+
+
+class Handlers_Tests(unittest.TestCase):
+
+    longMessage = True
+
+    def setUp(self):
+        saved = dict(handlers.HANDLERS)
+        def restore():
+            handlers.HANDLERS.clear()
+            handlers.HANDLERS.update(saved)
+        self.addCleanup(restore)
+
+    def test_builtin_handlers_are_registered(self):
+        self.assertEqual(["mysql", "postgres", "sqlite"], get_handler_names())
+        self.assertTrue(get_handler_class("sqlite") is SqliteDatabaseHandler)
+
+    def test_handler_is_created_with_args(self):
+        d = tempfile.mkdtemp()
+        try:
+            h = create_handler("sqlite", d)
+            self.assertTrue(isinstance(h, SqliteDatabaseHandler))
+            h.execute({ "dbname": "x" }, "create table t(i int)")
+            h.close_connections()
+            self.assertTrue(os.path.exists(os.path.join(d, "x.sqlite3")))
+        finally:
+            os.remove(os.path.join(d, "x.sqlite3"))
+            os.rmdir(d)
+
+    def test_unknown_handler_throws(self):
+        with self.assertRaises(MigrationException) as ctx:
+            get_handler_class("oracle")
+        self.assertTrue("mysql, postgres, sqlite" in str(ctx.exception), str(ctx.exception))
+
+    def test_handlers_can_be_registered(self):
+        register_handler("fake", "test.fakedatabasehandler:FakeDatabaseHandler")
+        self.assertEqual("FakeDatabaseHandler", get_handler_class("fake").__name__)
+        self.assertRaises(ValueError, register_handler, "bad", "fakedatabasehandler.FakeDatabaseHandler")
+
+    def test_missing_module_throws(self):
+        register_handler("missing", "no_such_module:Handler")
+        self.assertRaises(MigrationException, get_handler_class, "missing")
+
+
+class Startup_Tests(unittest.TestCase):
+    """Checks the modules imported by the examples' --help."""
+
+    longMessage = True
+
+    def get_help_modules(self, example):
+        root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+        code = "; ".join([
+            "import sys",
+            "sys.path.insert(0, {0!r})".format(os.path.join(root, "examples", example)),
+            "import {0}".format(example),
+            "sys.argv = ['{0}.py', '--help']".format(example),
+            "exec('try: {0}.main()\\nexcept SystemExit: pass')".format(example),
+            "import json",
+            "sys.stderr.write(json.dumps([m for m in sys.modules if sys.modules[m] is not None]))"])
+        p = subprocess.Popen([sys.executable, "-c", code], stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        out, err = p.communicate()
+        self.assertEqual(0, p.returncode, err)
+        self.assertTrue("usage:" in out, out)
+        return json.loads(err)
+
+    def test_help_does_not_import_database_drivers_or_config(self):
+        for example, module in [("postgres", "psycopg2"), ("mysql", "MySQLdb")]:
+            modules = self.get_help_modules(example)
+            for m in [module, "configobj", "multiprocessing", "dbMigrator.{0}databasehandler".format(example)]:
+                self.assertFalse(m in modules, "{0} imported by {1} --help".format(m, example))
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,5 @@
+import logging
+import time
 import unittest
 
 import dbMigrator
@@ -7,6 +9,9 @@ from dbMigrator.migrator import ScriptRunner
 from dbMigrator.migrator import QueuedScriptCollection
 from dbMigrator.migrator import ScriptRunnerException
 from dbMigrator.migrator import DatabaseSource
+from dbMigrator.migrator import ScriptContent
+from dbMigrator.migrator import BulkLoadContent
+from dbMigrator.observers import MigrationObserver
 from fakedatabasehandler import FakeDatabaseHandler
 
 
@@ -23,6 +28,8 @@ class FakeDatabaseSource(DatabaseSource):
         self.code = {}
         self.migrations = {}
         self.reference_data = {}
+        self.squashed = {}
+        self.written_baselines = {}
 
     def get_db_name_from_nickname(self, nickname):
         return self.connections[nickname]["dbname"]
@@ -38,6 +45,59 @@ class FakeDatabaseSource(DatabaseSource):
         return self.migrations[database_name]
     def get_reference_data_files(self, database_name):
         return self.reference_data[database_name]
+    def get_squashed_migrations(self, database_name):
+        return self.squashed.get(database_name, [])
+    def write_squashed_baseline(self, database_name, schema_sql, migration_names):
+        self.written_baselines[database_name] = (schema_sql, migration_names)
+
+
+class CountingScriptContent(ScriptContent):
+    """Lazy script content that counts how often it's read."""
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.reads = 0
+    def read(self):
+        self.reads += 1
+        return self.sql
+    def size(self):
+        return len(self.sql)
+
+
+class FakeBulkLoadContent(BulkLoadContent):
+    """Bulk data for a table."""
+
+    def __init__(self, table):
+        self.table = table
+        self.delimiter = ","
+        self.mode = "truncate"
+    def get_columns(self):
+        return ["a"]
+    def read(self):
+        return "a\n1\n"
+    def size(self):
+        return 4
+
+
+class EventRecorder(MigrationObserver):
+    """Records events as strings."""
+
+    def __init__(self):
+        self.events = []
+    def phase_started(self, phase, db_nicknames):
+        self.events.append("start " + phase)
+    def phase_finished(self, phase, db_nicknames, duration_ms, error):
+        self.events.append("end " + phase + (" failed" if error else ""))
+    def script_queued(self, phase, db_nickname, script_name, size):
+        self.events.append("queued {0} {1} ({2})".format(script_name, db_nickname, size))
+    def script_skipped(self, phase, db_nickname, script_name, reason):
+        self.events.append("skipped {0} {1} {2}".format(script_name, db_nickname, reason))
+    def script_started(self, phase, db_nickname, script_name, size):
+        self.events.append("started {0} {1}".format(script_name, db_nickname))
+    def script_finished(self, phase, db_nickname, script_name, size, duration_ms, rows_affected):
+        self.events.append("finished {0} {1}".format(script_name, db_nickname))
+    def script_failed(self, phase, db_nickname, script_name, size, duration_ms, error):
+        self.events.append("failed {0} {1}".format(script_name, db_nickname))
 
 
 class MigratorTests(unittest.TestCase):
@@ -126,11 +186,11 @@ class MigratorTests(unittest.TestCase):
         expected = [
             'create db_1',
             'create_track_tbl in db_1',
-            'check mig1.txt in db_1',
+            'get_applied in db_1',
             'execute mig1_sql in db_1',
             'record mig1.txt in db_1',
-            'check mig2.txt in db_1',
-            'execute mig2_sql in db_1'
+            'execute mig2_sql in db_1',
+            'record mig2.txt in db_1'
         ]
         self.assert_db_history_contains(expected, "db_1 run")
         unexpected = ["create db_2", "execute c_sql in db_2", "execute d_sql in db_2"]
@@ -154,6 +214,299 @@ class MigratorTests(unittest.TestCase):
         unexpected = ["create db_2", "execute c_sql in db_2", "execute d_sql in db_2"]
         self.assert_db_history_does_not_contain(unexpected, "db_2 not run")
 
+    def test_unchanged_code_is_skipped_if_skipping_unchanged(self):
+        self.migrator.skip_unchanged = True
+        self.migrator.run_code_definitions("1")
+        self.fake_db_handler.call_history = []
+        self.fake_db_source.code["1"] = [("code1.txt", "code1_sql"), ("code2.txt", "code2_changed_sql")]
+        self.migrator.run_code_definitions("1")
+        self.assertEqual(['create_checksum_tbl in db_1',
+                          'get_checksums code in db_1',
+                          'execute code2_changed_sql in db_1',
+                          'checksum code code2.txt in db_1'],
+                         self.fake_db_handler.call_history)
+
+    def test_code_and_data_checksums_are_kept_separately(self):
+        self.migrator.skip_unchanged = True
+        self.fake_db_source.reference_data["1"] = [("code1.txt", "code1_sql")]
+        self.migrator.run_code_definitions("1")
+        self.migrator.run_reference_data("1")
+        r = [x for x in self.fake_db_handler.call_history if x == 'execute code1_sql in db_1']
+        self.assertEqual(2, len(r), "ran as code and as data")
+        self.assert_db_history_contains(['checksum reference_data code1.txt in db_1'], "data checksum")
+
+    def test_force_reruns_unchanged_code(self):
+        self.migrator.skip_unchanged = True
+        self.migrator.run_code_definitions("1")
+        self.migrator.force = True
+        self.migrator.run_code_definitions("1")
+        r = [x for x in self.fake_db_handler.call_history if x == 'execute code1_sql in db_1']
+        self.assertEqual(2, len(r), "re-run")
+
+    def test_unchanged_code_is_rerun_if_not_skipping_unchanged(self):
+        self.migrator.run_code_definitions("1")
+        self.migrator.run_code_definitions("1")
+        r = [x for x in self.fake_db_handler.call_history if x == 'execute code1_sql in db_1']
+        self.assertEqual(2, len(r), "re-run")
+        self.assert_db_history_does_not_contain(['create_checksum_tbl in db_1'], "no checksums")
+
+    def test_failed_script_checksum_is_not_recorded(self):
+        self.migrator.skip_unchanged = True
+        self.fake_db_handler.simulate_exception_on("code2_sql")
+        self.assertRaises(ScriptRunnerException, self.migrator.run_code_definitions, "1")
+        self.assert_db_history_contains(['checksum code code1.txt in db_1'], "first ok")
+        self.assert_db_history_does_not_contain(['checksum code code2.txt in db_1'], "failure not recorded")
+
+    def set_dependent_code(self):
+        """code2 creates vB from vA, created by code3; code1 is independent."""
+        self.fake_db_source.code["1"] = [
+            ("code1.txt", "create view vX as select 1"),
+            ("code2.txt", "create view vB as select * from vA"),
+            ("code3.txt", "create view vA as select 1")
+        ]
+        self.migrator.code_dependency_order = True
+
+    def executed(self):
+        return [x for x in self.fake_db_handler.call_history if x.startswith("execute")]
+
+    def test_code_can_run_in_dependency_order(self):
+        self.set_dependent_code()
+        self.migrator.run_code_definitions("1")
+        self.assertEqual(['execute create view vX as select 1 in db_1',
+                          'execute create view vA as select 1 in db_1',
+                          'execute create view vB as select * from vA in db_1'],
+                         self.executed())
+
+    def test_code_in_dependency_order_runs_on_several_connections(self):
+        self.set_dependent_code()
+        self.migrator.code_workers = 3
+        sessions = set()
+        execute = self.fake_db_handler.execute
+        def record_session(conn_hash, sql):
+            sessions.add(conn_hash.get("session"))
+            time.sleep(0.02)
+            return execute(conn_hash, sql)
+        self.fake_db_handler.execute = record_session
+        self.migrator.run_code_definitions("1", "2")
+        self.assertEqual(5, len(self.executed()), "all run")
+        h = self.fake_db_handler.call_history
+        self.assertTrue(h.index('execute create view vA as select 1 in db_1') <
+                        h.index('execute create view vB as select * from vA in db_1'), "dependency first")
+        self.assertTrue(len(sessions) > 1, "several connections: {0}".format(sessions))
+
+    def test_changed_code_reruns_dependent_code(self):
+        self.set_dependent_code()
+        self.migrator.skip_unchanged = True
+        self.migrator.run_code_definitions("1")
+        self.fake_db_handler.call_history = []
+        self.fake_db_source.code["1"][2] = ("code3.txt", "create view vA as select 2")
+        self.migrator.run_code_definitions("1")
+        self.assertEqual(['execute create view vA as select 2 in db_1',
+                          'execute create view vB as select * from vA in db_1'],
+                         self.executed())
+        self.assert_db_history_contains(['checksum code code2.txt in db_1', 'checksum code code3.txt in db_1'], "recorded")
+
+    def test_unchanged_dependent_code_is_skipped(self):
+        self.set_dependent_code()
+        self.migrator.skip_unchanged = True
+        self.migrator.run_code_definitions("1")
+        self.fake_db_handler.call_history = []
+        self.fake_db_source.code["1"][1] = ("code2.txt", "create view vB as select 2, * from vA")
+        self.migrator.run_code_definitions("1")
+        self.assertEqual(['execute create view vB as select 2, * from vA in db_1'], self.executed())
+
+    def test_circular_code_dependencies_run_nothing(self):
+        self.set_dependent_code()
+        self.fake_db_source.code["1"][2] = ("code3.txt", "create view vA as select * from vB")
+        self.assertRaises(Exception, self.migrator.run_code_definitions, "1")
+        self.assertEqual([], self.executed())
+
+    #####################################
+    # Observers.
+
+    def test_observers_receive_phase_and_script_events(self):
+        r = EventRecorder()
+        self.migrator.add_observer(r)
+        self.fake_db_handler.tracked["db_1"] = set(["mig1.txt"])
+        self.migrator.run_migrations("1")
+        expected = [
+            "start migrations",
+            "queued mig1.txt 1 (8)",
+            "queued mig2.txt 1 (8)",
+            "skipped mig1.txt 1 applied",
+            "started mig2.txt 1",
+            "finished mig2.txt 1",
+            "end migrations"
+        ]
+        self.assertEqual(expected, r.events)
+
+    def test_observers_are_told_of_unchanged_scripts(self):
+        r = EventRecorder()
+        self.migrator.add_observer(r)
+        self.migrator.skip_unchanged = True
+        self.migrator.run_code_definitions("1")
+        r.events = []
+        self.migrator.run_code_definitions("1")
+        skipped = [e for e in r.events if e.startswith("skipped")]
+        self.assertEqual(["skipped code1.txt 1 unchanged", "skipped code2.txt 1 unchanged"], skipped)
+
+    def test_observers_are_told_of_failures(self):
+        r = EventRecorder()
+        self.migrator.add_observer(r)
+        self.fake_db_handler.simulate_exception_on("code2_sql")
+        self.assertRaises(ScriptRunnerException, self.migrator.run_code_definitions, "1")
+        self.assertEqual(["failed code2.txt 1", "end code failed"], r.events[-2:])
+
+    def test_failing_baseline_check_ends_phase(self):
+        r = EventRecorder()
+        self.migrator.add_observer(r)
+        self.fake_db_handler.contains_userdefined_tables = True
+        self.assertRaises(MigrationException, self.migrator.run_baseline_schema, "1")
+        self.assertEqual(["start baseline_schema", "end baseline_schema failed"], r.events)
+
+    def test_failing_observer_does_not_stop_migration(self):
+        class Broken(MigrationObserver):
+            def script_started(self, phase, db_nickname, script_name, size):
+                raise Exception("broken")
+        self.migrator.add_observer(Broken())
+        self.migrator.run_code_definitions("1")
+        self.assert_db_history_contains(['execute code1_sql in db_1', 'execute code2_sql in db_1'], "run")
+
+    #####################################
+    # Planning.
+
+    def assert_plan_scripts(self, expected, db_plan, phase):
+        p = [x for x in db_plan.phases if x.phase == phase][0]
+        self.assertEqual(expected, [s[0] for s in p.scripts], phase)
+        return p
+
+    def test_plan_lists_pending_migrations_without_running_anything(self):
+        self.fake_db_handler.tracked["db_1"] = set(["mig1.txt"])
+        plan = self.migrator.plan(["migrations", "code"], "1", "2")
+        self.assertEqual(["1", "2"], [d.db_nickname for d in plan.databases])
+        p = self.assert_plan_scripts(["mig2.txt"], plan.databases[0], "migrations")
+        self.assertEqual(1, p.skipped, "already applied")
+        self.assertEqual([("mig2.txt", 8, "run")], p.scripts, "sizes")
+        self.assert_plan_scripts(["code1.txt", "code2.txt"], plan.databases[0], "code")
+        self.assert_plan_scripts(["mig3.txt", "mig4.txt"], plan.databases[1], "migrations")
+        executed = [x for x in self.fake_db_handler.call_history if x.startswith("execute") or x.startswith("create")]
+        self.assertEqual([], executed, "nothing run or created")
+
+    def test_plan_reads_tracking_table_once_per_database(self):
+        self.fake_db_handler.tracked["db_1"] = set(["mig1.txt"])
+        self.migrator.plan(["migrations"], "1", "2")
+        self.assertEqual(['get_applied in db_1', 'tracking_tbl_exists in db_1', 'tracking_tbl_exists in db_2'],
+                         sorted(self.fake_db_handler.call_history))
+
+    def test_plan_does_not_read_script_content(self):
+        content = CountingScriptContent("mig1_sql")
+        self.fake_db_source.migrations["1"] = [("mig1.txt", content)]
+        self.fake_db_source.code["1"] = [("code1.txt", content)]
+        self.migrator.plan(["migrations", "code"], "1")
+        self.assertEqual(0, content.reads)
+
+    def test_plan_shows_baseline_refusal(self):
+        self.fake_db_handler.contains_userdefined_tables = True
+        plan = self.migrator.plan(["baseline_schema"], "1")
+        self.assertEqual([("1", "baseline_schema", "Can't run baseline script in non-empty database 1")], plan.refusals())
+
+    def test_plan_for_new_database_includes_everything(self):
+        self.fake_db_handler.contains_userdefined_tables = True
+        self.fake_db_handler.tracked["db_1"] = set(["mig1.txt"])
+        plan = self.migrator.plan(["delete_make_new", "baseline_schema", "migrations"], "1")
+        self.assertEqual([], plan.refusals())
+        self.assert_plan_scripts(["a.txt", "b.txt"], plan.databases[0], "baseline_schema")
+        self.assert_plan_scripts(["mig1.txt", "mig2.txt"], plan.databases[0], "migrations")
+        self.assertEqual([], self.fake_db_handler.call_history, "database not inspected")
+
+    def test_plan_marks_code_as_run_if_changed_when_skipping_unchanged(self):
+        self.migrator.skip_unchanged = True
+        plan = self.migrator.plan(["code"], "1")
+        self.assertEqual(["run_if_changed", "run_if_changed"], [s[2] for s in plan.databases[0].phases[0].scripts])
+
+    def test_plan_records_errors_per_database(self):
+        self.fake_db_source.migrations["2"] = None
+        self.migrator.max_workers = 2
+        plan = self.migrator.plan(["migrations"], "1", "2")
+        self.assertEqual(["2"], [e[0] for e in plan.errors()])
+        self.assert_plan_scripts(["mig1.txt", "mig2.txt"], plan.databases[0], "migrations")
+
+
+    #####################################
+    # Template databases.
+
+    def test_create_from_templates_builds_missing_template_then_copies_it(self):
+        self.migrator.create_from_templates("1")
+        expected = ['create db_1_template',
+                    'execute a_sql in db_1',
+                    'execute mig1_sql in db_1',
+                    'execute code1_sql in db_1',
+                    'execute ref1_sql in db_1',
+                    'mark db_1_template',
+                    'create db_1 from db_1_template']
+        self.assert_db_history_contains(expected, "built and copied")
+        self.assertEqual(self.migrator.get_scripts_checksum("1"), self.fake_db_handler.templates["db_1_template"])
+
+    def test_create_from_templates_reuses_current_template(self):
+        self.migrator.create_from_templates("1", "2")
+        self.fake_db_handler.call_history = []
+        self.migrator.create_from_templates("1", "2")
+        self.assertEqual(['create db_1 from db_1_template', 'create db_2 from db_2_template'], self.fake_db_handler.call_history)
+
+    def test_changed_script_rebuilds_only_its_template(self):
+        self.migrator.create_from_templates("1", "2")
+        self.fake_db_handler.call_history = []
+        self.fake_db_source.code["2"] = [("code3.txt", "changed_sql"), ("code4.txt", "code4_sql")]
+        self.migrator.create_from_templates("1", "2")
+        self.assertTrue('create db_2_template' in self.fake_db_handler.call_history, "rebuilt")
+        self.assertFalse('create db_1_template' in self.fake_db_handler.call_history, "current")
+        self.assert_db_history_contains(['mark db_2_template', 'create db_1 from db_1_template', 'create db_2 from db_2_template'], "copied")
+
+    def test_scripts_checksum_covers_names_and_contents(self):
+        c = self.migrator.get_scripts_checksum("1")
+        self.fake_db_source.reference_data["1"] = [("ref1.txt", "ref1_sql"), ("ref2.txt", "changed")]
+        self.assertNotEqual(c, self.migrator.get_scripts_checksum("1"), "content")
+        c = self.migrator.get_scripts_checksum("1")
+        self.fake_db_source.reference_data["1"] = [("ref1.txt", "ref1_sql"), ("ref3.txt", "changed")]
+        self.assertNotEqual(c, self.migrator.get_scripts_checksum("1"), "name")
+
+    def test_failed_template_build_is_not_marked(self):
+        self.fake_db_handler.simulate_exception_on("mig2_sql")
+        self.assertRaises(Exception, self.migrator.create_from_templates, "1")
+        self.assertEqual({}, self.fake_db_handler.templates)
+        self.assertFalse('create db_1 from db_1_template' in self.fake_db_handler.call_history)
+        self.assertEqual("db_1", self.migrator.database_source.get_db_name_from_nickname("1"), "source restored")
+
+
+    #####################################
+    # Squashing.
+
+    def test_baseline_records_squashed_migrations_as_applied(self):
+        self.fake_db_source.squashed["1"] = ["mig1.txt"]
+        self.migrator.run_baseline_schema("1", "2")
+        self.migrator.run_migrations("1", "2")
+        self.assertEqual(set(["mig1.txt", "mig2.txt"]), self.fake_db_handler.tracked["db_1"])
+        executed = [x for x in self.fake_db_handler.call_history if x.startswith("execute mig")]
+        self.assertEqual(['execute mig2_sql in db_1', 'execute mig3_sql in db_2', 'execute mig4_sql in db_2'], executed)
+
+    def test_squash_builds_scratch_database_and_writes_baseline(self):
+        self.fake_db_source.squashed["1"] = ["mig0.txt"]
+        self.migrator.squash_migrations("1")
+        self.assert_db_history_contains(['create db_1_squash',
+                                         'execute a_sql in db_1',
+                                         'execute mig1_sql in db_1',
+                                         'execute mig2_sql in db_1',
+                                         'dump db_1_squash'], "built and dumped")
+        self.assertFalse('execute code1_sql in db_1' in self.fake_db_handler.call_history, "no code")
+        expected = ("schema of db_1_squash", ["mig0.txt", "mig1.txt", "mig2.txt"])
+        self.assertEqual({ "1": expected }, self.fake_db_source.written_baselines)
+
+    def test_plan_for_new_database_skips_squashed_migrations(self):
+        self.fake_db_source.squashed["1"] = ["mig1.txt"]
+        plan = self.migrator.plan(["delete_make_new", "baseline_schema", "migrations"], "1")
+        p = self.assert_plan_scripts(["mig2.txt"], plan.databases[0], "migrations")
+        self.assertEqual(1, p.skipped)
+
 
 class QueuedScriptCollection_Tests(unittest.TestCase):
 
@@ -208,6 +561,56 @@ class QueuedScriptCollection_Tests(unittest.TestCase):
         self.q.add_script("x" * 255, "1", "255 ok")
         self.assertRaises(ScriptRunnerException, self.q.add_script, "x" * 256, "1", "256 bad")
 
+    def test_sorted_scripts_reflect_scripts_added_after_sorting(self):
+        self.q.add_script("b.txt", "1", "content_b")
+        self.q.get_sorted_scripts()
+        self.q.add_script("a.txt", "1", "content_a")
+        self.assert_sorted_data_equals([("a.txt", "1", "content_a"), ("b.txt", "1", "content_b")])
+
+    def test_sorting_is_by_filename_then_dbname_only(self):
+        self.q.add_script("a!.txt", "1", "x")
+        self.q.add_script("a", "2", "y")
+        self.assert_sorted_data_equals([("a", "2", "y"), ("a!.txt", "1", "x")])
+
+
+class QueuedScriptCollection_ScalingTests(unittest.TestCase):
+    """Queue construction must stay roughly linear for very large trees."""
+
+    longMessage = True
+
+    NUM_DATABASES = 30
+    NUM_SCRIPTS = 120000
+
+    def build_queue(self):
+        q = QueuedScriptCollection()
+        per_db = QueuedScriptCollection_ScalingTests.NUM_SCRIPTS / QueuedScriptCollection_ScalingTests.NUM_DATABASES
+        # Added in reverse order, to make the sort do some work.
+        for i in reversed(range(per_db)):
+            for db in range(QueuedScriptCollection_ScalingTests.NUM_DATABASES):
+                q.add_script("{0:08d}_migration.sql".format(i), "db_{0:02d}".format(db), "sql")
+        return q
+
+    def test_many_scripts_are_queued_and_sorted_quickly(self):
+        start = time.time()
+        q = self.build_queue()
+        d = q.get_sorted_scripts()
+        elapsed = time.time() - start
+        self.assertEqual(QueuedScriptCollection_ScalingTests.NUM_SCRIPTS, len(d), "all queued")
+        self.assertEqual(("00000000_migration.sql", "db_00", "sql"), d[0], "first")
+        self.assertEqual(("00003999_migration.sql", "db_29", "sql"), d[-1], "last")
+        self.assertTrue(elapsed < 10, "took {0} seconds".format(elapsed))
+
+    def test_duplicates_detected_in_large_queue(self):
+        q = self.build_queue()
+        self.assertRaises(ScriptRunnerException, q.add_script, "00002000_migration.sql", "db_15", "sql")
+
+    def test_large_queue_split_by_database(self):
+        q = self.build_queue()
+        by_db = q.get_sorted_scripts_by_db()
+        self.assertEqual(QueuedScriptCollection_ScalingTests.NUM_DATABASES, len(by_db), "all dbs")
+        names = [t[0] for t in by_db["db_07"]]
+        self.assertEqual(sorted(names), names, "sorted within db")
+
 
 class ScriptRunnerTests_Base(unittest.TestCase):
 
@@ -240,7 +643,7 @@ class ScriptRunnerTests_Base(unittest.TestCase):
     def test_migration_table_created_if_runner_is_tracking_scripts(self):
         self.runner.add_script("a", "1", "sql")
         self.runner.execute_scripts(True)
-        self.assert_db_exec_equals("create_track_tbl in 1_c; check a in 1_c; execute sql in 1_c; record a in 1_c", "hist")
+        self.assert_db_exec_equals("create_track_tbl in 1_c; get_applied in 1_c; execute sql in 1_c; record a in 1_c", "hist")
 
     def test_migration_table_not_created_if_runner_is_NOT_tracking_scripts(self):
         self.runner.add_script("a", "1", "sql")
@@ -251,14 +654,14 @@ class ScriptRunnerTests_Base(unittest.TestCase):
         self.runner.add_script("a", "1", "sql")
         self.runner.execute_scripts(True)
         self.runner.execute_scripts(True)
-        self.assert_db_exec_equals("create_track_tbl in 1_c; check a in 1_c; execute sql in 1_c; record a in 1_c; check a in 1_c", "hist")
+        self.assert_db_exec_equals("create_track_tbl in 1_c; get_applied in 1_c; execute sql in 1_c; record a in 1_c; get_applied in 1_c", "hist")
 
     def test_migration_table_is_created_in_every_referenced_database(self):
         self.runner.add_script("a", "1", "sql")
         self.runner.add_script("b", "2", "sql2")
         self.runner.execute_scripts(True)
-        expected = "create_track_tbl in 1_c; check a in 1_c; execute sql in 1_c; record a in 1_c; " \
-                   "create_track_tbl in 2_c; check b in 2_c; execute sql2 in 2_c; record b in 2_c"
+        expected = "create_track_tbl in 1_c; get_applied in 1_c; execute sql in 1_c; record a in 1_c; " \
+                   "create_track_tbl in 2_c; get_applied in 2_c; execute sql2 in 2_c; record b in 2_c"
         self.assert_db_exec_equals(expected, "hist")
 
     def test_tracked_script_is_logged_to_table_when_run(self):
@@ -276,7 +679,7 @@ class ScriptRunnerTests_Base(unittest.TestCase):
         self.runner.execute_scripts(True)
         self.runner.execute_scripts(True)
         self.runner.execute_scripts(True)
-        r = [x for x in self.fake_db_handler.call_history if x == "check a in 1_c"]
+        r = [x for x in self.fake_db_handler.call_history if x == "get_applied in 1_c"]
         self.assertEqual(3, len(r), "checked three times")
         r = [x for x in self.fake_db_handler.call_history if x == "record a in 1_c"]
         self.assertEqual(1, len(r), "only recorded once")
@@ -286,7 +689,7 @@ class ScriptRunnerTests_Base(unittest.TestCase):
         self.runner.execute_scripts(False)
         self.runner.execute_scripts(False)
         self.runner.execute_scripts(False)
-        r = [x for x in self.fake_db_handler.call_history if x == "check a in 1_c"]
+        r = [x for x in self.fake_db_handler.call_history if x == "get_applied in 1_c"]
         self.assertEqual(0, len(r), "not checked")
         r = [x for x in self.fake_db_handler.call_history if x == "execute sql in 1_c"]
         self.assertEqual(3, len(r), "ran three times")
@@ -299,6 +702,161 @@ class ScriptRunnerTests_Base(unittest.TestCase):
         r = [x for x in self.fake_db_handler.call_history if x == "execute changed_sql in 1_c"]
         self.assertEqual(0, len(r), "script with same name not re-run")
 
+    def test_applied_scripts_are_read_once_per_database(self):
+        for i in range(10):
+            self.runner.add_script("a{0}".format(i), "1", "sql{0}".format(i))
+        self.runner.execute_scripts(True)
+        r = [x for x in self.fake_db_handler.call_history if x == "get_applied in 1_c"]
+        self.assertEqual(1, len(r), "single read")
+        r = [x for x in self.fake_db_handler.call_history if x.startswith("check")]
+        self.assertEqual(0, len(r), "no per-script checks")
+
+    def test_already_applied_scripts_are_skipped(self):
+        self.fake_db_handler.tracked["1_c"] = set(["a"])
+        self.runner.add_script("a", "1", "aaa")
+        self.runner.add_script("b", "1", "bbb")
+        self.runner.execute_scripts(True)
+        self.assert_db_exec_equals("create_track_tbl in 1_c; get_applied in 1_c; execute bbb in 1_c; record b in 1_c", "hist")
+
+    def test_tracking_tables_are_flushed_after_tracked_run(self):
+        self.runner.add_script("a", "1", "aaa")
+        self.runner.add_script("b", "2", "bbb")
+        self.runner.execute_scripts(True)
+        self.assertEqual(["1_c", "2_c"], sorted(self.fake_db_handler.flushed))
+
+    def test_tracking_tables_are_not_flushed_after_untracked_run(self):
+        self.runner.add_script("a", "1", "aaa")
+        self.runner.execute_scripts(False)
+        self.assertEqual([], self.fake_db_handler.flushed)
+
+    def test_tracking_table_is_flushed_if_script_fails(self):
+        self.runner.add_script("a", "1", "aaa")
+        self.runner.add_script("b", "1", "some_bad_sql")
+        self.fake_db_handler.simulate_exception_on("some_bad_sql")
+        self.assertRaises(ScriptRunnerException, self.runner.execute_scripts, True)
+        self.assertEqual(["1_c"], self.fake_db_handler.flushed)
+
+    def run_packed(self, pack_size, *scripts):
+        """Runs the (name, sql) scripts tracked, with the handler deferring
+them in packs.  Returns the recorded events, and the exception thrown."""
+        self.fake_db_handler.pack_size = pack_size
+        r = EventRecorder()
+        self.runner.add_observer(r)
+        for name, sql in scripts:
+            self.runner.add_script(name, "1", sql)
+        try:
+            self.runner.execute_scripts(True)
+        except ScriptRunnerException as e:
+            return (r.events[len(scripts):], e)
+        return (r.events[len(scripts):], None)
+
+    def test_deferred_scripts_finish_once_run(self):
+        events, e = self.run_packed(2, ("a", "aaa"), ("b", "bbb"), ("c", "ccc"))
+        self.assertEqual(None, e)
+        expected = ["started a 1", "started b 1", "finished a 1", "finished b 1", "started c 1", "finished c 1"]
+        self.assertEqual(expected, events, "c finished by the final flush")
+        self.assertEqual(set(["a", "b", "c"]), self.fake_db_handler.tracked["1_c"])
+
+    def test_failed_deferred_script_is_named(self):
+        self.fake_db_handler.simulate_exception_on("bbb")
+        events, e = self.run_packed(3, ("a", "aaa"), ("b", "bbb"), ("c", "ccc"))
+        self.assertTrue(str(e).startswith("Error executing b: bad sql (packed with 2 other script(s))"), str(e))
+        expected = ["started a 1", "started b 1", "started c 1", "finished a 1", "failed b 1"]
+        self.assertEqual(expected, events)
+        self.assertEqual(set(["a"]), self.fake_db_handler.tracked["1_c"])
+
+    def test_failure_of_final_deferred_scripts_is_named(self):
+        self.fake_db_handler.simulate_exception_on("bbb")
+        events, e = self.run_packed(10, ("a", "aaa"), ("b", "bbb"), ("c", "ccc"))
+        self.assertTrue(str(e).startswith("Error executing b: "), str(e))
+        expected = ["started a 1", "started b 1", "started c 1", "finished a 1", "failed b 1"]
+        self.assertEqual(expected, events)
+
+    def test_lazy_script_content_is_read_when_executed(self):
+        content = CountingScriptContent("aaa")
+        self.runner.add_script("a", "1", content)
+        self.runner.execute_scripts(False)
+        self.assertEqual(1, content.reads, "read once")
+        self.assert_db_exec_equals("execute aaa in 1_c", "hist")
+
+    def test_lazy_script_content_is_not_read_if_already_applied(self):
+        self.fake_db_handler.tracked["1_c"] = set(["a"])
+        content = CountingScriptContent("aaa")
+        self.runner.add_script("a", "1", content)
+        self.runner.execute_scripts(True)
+        self.assertEqual(0, content.reads, "never read")
+
+    def test_large_script_content_is_streamed_a_statement_at_a_time(self):
+        self.runner.streaming_threshold = 5
+        self.runner.add_script("a", "1", CountingScriptContent("aaa; bbb;\n-- done"))
+        self.runner.add_script("b", "1", "ccc; ddd")
+        self.runner.execute_scripts(True)
+        expected = "create_track_tbl in 1_c; get_applied in 1_c; execute aaa in 1_c; execute bbb in 1_c; record a in 1_c; " \
+                   "execute ccc; ddd in 1_c; record b in 1_c"
+        self.assert_db_exec_equals(expected, "hist")
+
+    def test_streamed_script_failure_identifies_statement(self):
+        self.runner.streaming_threshold = 0
+        self.runner.add_script("a", "1", CountingScriptContent("aaa;\nbad_sql;\nccc"))
+        self.fake_db_handler.simulate_exception_on("bad_sql")
+        try:
+            self.runner.execute_scripts(True)
+            self.fail("should have thrown")
+        except ScriptRunnerException as e:
+            self.assertTrue("Statement 2 at offset 5 failed" in str(e), str(e))
+        self.assertFalse("record a in 1_c" in self.fake_db_handler.call_history, "not recorded")
+
+    def test_bulk_load_content_is_passed_to_handler_bulk_load(self):
+        self.runner.add_script("a.sql", "1", "aaa")
+        self.runner.add_script("b.csv", "1", FakeBulkLoadContent("b"))
+        self.runner.execute_scripts(False)
+        self.assert_db_exec_equals("execute aaa in 1_c; bulk_load b in 1_c", "hist")
+
+    def test_tracked_bulk_load_content_is_recorded(self):
+        self.runner.add_script("b.csv", "1", FakeBulkLoadContent("b"))
+        self.runner.execute_scripts(True)
+        self.assert_db_exec_equals("create_track_tbl in 1_c; get_applied in 1_c; bulk_load b in 1_c; record b.csv in 1_c", "hist")
+
+    def test_tracked_script_is_recorded_with_duration_and_rows_affected(self):
+        self.fake_db_handler.rowcounts["aaa"] = 12
+        self.runner.add_script("a", "1", "aaa")
+        self.runner.execute_scripts(True)
+        duration, rows = self.fake_db_handler.timings["1_c"]["a"]
+        self.assertTrue(duration >= 0, "duration")
+        self.assertEqual(12, rows, "rows")
+
+    def test_streamed_script_rows_affected_are_totalled(self):
+        self.runner.streaming_threshold = 0
+        self.fake_db_handler.rowcounts["aaa"] = 2
+        self.fake_db_handler.rowcounts["bbb"] = 3
+        self.runner.add_script("a", "1", CountingScriptContent("aaa; bbb; ccc"))
+        self.runner.execute_scripts(True)
+        self.assertEqual(5, self.fake_db_handler.timings["1_c"]["a"][1])
+
+    def test_executed_scripts_are_logged_as_structured_records(self):
+        records = []
+        class Capture(logging.Handler):
+            def emit(self, record):
+                records.append(record)
+        h = Capture()
+        logger = logging.getLogger('dbmigrator')
+        old_level = logger.level
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(h)
+        try:
+            self.fake_db_handler.rowcounts["aaa"] = 7
+            self.runner.add_script("a", "1", "aaa")
+            self.runner.execute_scripts(True)
+        finally:
+            logger.removeHandler(h)
+            logger.setLevel(old_level)
+
+        executed = [r for r in records if getattr(r, "event", None) == "script_executed"]
+        self.assertEqual(1, len(executed))
+        r = executed[0]
+        self.assertEqual(("a", "1", True, 7), (r.script_name, r.db_nickname, r.tracked, r.rows_affected))
+        self.assertTrue(r.duration_ms >= 0)
+
     def test_can_run_scripts_in_several_databases(self):
         self.runner.add_script("a", "1", "aaa")
         self.runner.add_script("b", "2", "bbb")
@@ -346,6 +904,56 @@ class ScriptRunnerTests_Base(unittest.TestCase):
         self.assertEqual(len(expected), len(r), "all run")
 
 
+class ScriptRunnerParallelTests(unittest.TestCase):
+
+    longMessage = True
+
+    def setUp(self):
+        self.fake_db_handler = FakeDatabaseHandler()
+        conn_hashes = dict([(str(i), { "dbname": str(i), "conn": "{0}_c".format(i) }) for i in range(1, 5)])
+        self.runner = ScriptRunner(conn_hashes, self.fake_db_handler)
+        self.runner.max_workers = 3
+
+    def history_for(self, conn):
+        return [x for x in self.fake_db_handler.call_history if x.endswith(" in " + conn)]
+
+    def test_scripts_run_in_order_within_each_database(self):
+        for db in ["1", "2", "3", "4"]:
+            for f in ["c", "a", "b"]:
+                self.runner.add_script(f, db, f + "_sql")
+        self.runner.execute_scripts(True)
+        for db in ["1", "2", "3", "4"]:
+            c = db + "_c"
+            expected = ["create_track_tbl in " + c, "get_applied in " + c]
+            for f in ["a", "b", "c"]:
+                expected.extend(["execute {0}_sql in {1}".format(f, c), "record {0} in {1}".format(f, c)])
+            self.assertEqual(expected, self.history_for(c), "db " + db)
+
+    def test_untracked_scripts_run_on_all_databases(self):
+        for db in ["1", "2"]:
+            self.runner.add_script("a", db, "a_sql")
+        self.runner.execute_scripts(False)
+        self.assertEqual(["execute a_sql in 1_c"], self.history_for("1_c"))
+        self.assertEqual(["execute a_sql in 2_c"], self.history_for("2_c"))
+
+    def test_failure_stops_only_its_own_database_and_all_failures_are_reported(self):
+        self.runner.add_script("a", "1", "bad_1")
+        self.runner.add_script("b", "1", "b_1")
+        self.runner.add_script("a", "2", "a_2")
+        self.runner.add_script("b", "2", "b_2")
+        self.runner.add_script("a", "3", "bad_3")
+        self.fake_db_handler.simulate_exception_on("bad_1")
+        self.fake_db_handler.simulate_exception_on("bad_3")
+        try:
+            self.runner.execute_scripts(True)
+            self.fail("should have thrown")
+        except ScriptRunnerException as e:
+            self.assertEqual(["1", "3"], [f[0] for f in e.failures], "failures")
+        self.assertFalse("execute b_1 in 1_c" in self.fake_db_handler.call_history, "1 stopped")
+        self.assertTrue("record b in 2_c" in self.fake_db_handler.call_history, "2 completed")
+        self.assertEqual(["1_c", "2_c", "3_c"], sorted(self.fake_db_handler.flushed), "all flushed")
+
+
 def main():
     unittest.main()
 
@@ -3,6 +3,11 @@ import unittest
 import sys
 import os
 import inspect
+import shutil
+import tempfile
+import threading
+import warnings
+from StringIO import StringIO
 from configobj import ConfigObj
 from warnings import filterwarnings
 from warnings import resetwarnings
@@ -10,6 +15,9 @@ import MySQLdb
 
 # sys.path.append(os.path.abspath(sys.path[0]) + '/../')
 import dbMigrator
+from dbMigrator.migrator import DatabaseHandler, DeferredScriptException
+from dbMigrator.sqlsplitter import SqlStatementException
+from dbMigrator.defaultdatabasesource import DelimitedDataFile
 from dbMigrator.mysqldatabasehandler import MySqlDatabaseHandler
 
 
@@ -42,6 +50,10 @@ class MySqlDatabaseHandler_Tests(unittest.TestCase):
         logger = logging.getLogger('dbmigrator')
         logger.setLevel(logging.CRITICAL)
 
+    def tearDown(self):
+        # Cached connections would otherwise block the drops in setUp.
+        self.handler.close_connections()
+
 
     def __get_open_connection(self, connection_hash):
         """Opens a connection to the database."""
@@ -134,6 +146,16 @@ class MySqlDatabaseHandler_Tests(unittest.TestCase):
         self.assertTrue(self.database_exists(self.db_1_name), "still exists, created anew")
         self.assert_recordcount_equals(0, self.db_1_conn_hash, sql, "table doesn't exist, db was deleted")
 
+    def test_delete_make_new_keeps_warning_filters(self):
+        before = list(warnings.filters)
+        threads = [threading.Thread(target = self.handler.delete_make_new, args = (self.sys_conn_hash, name))
+                   for name in [self.db_1_name, self.db_2_name]]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(before, warnings.filters)
+
     def test_can_check_if_database_contains_user_defined_tables(self):
         self.assertFalse(self.database_exists(self.db_1_name), "doesn't exist")
         self.exec_sys_sql("create database {0}".format(self.db_1_name))
@@ -152,6 +174,12 @@ class MySqlDatabaseHandler_Tests(unittest.TestCase):
         self.assert_table_exists_equals(self.db_1_conn_hash, "__schema_migrations", True, "created")
 
 
+    def test_can_check_if_tracking_table_exists(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.assertFalse(self.handler.tracking_table_exists(self.db_1_conn_hash), "not created yet")
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.assertTrue(self.handler.tracking_table_exists(self.db_1_conn_hash), "created")
+
     def test_can_track_scripts(self):
         self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
         self.handler.create_tracking_table(self.db_1_conn_hash)
@@ -159,6 +187,61 @@ class MySqlDatabaseHandler_Tests(unittest.TestCase):
         self.handler.record_script_in_tracking_table(self.db_1_conn_hash, "a.txt")
         self.assertTrue(self.handler.is_in_tracking_table(self.db_1_conn_hash, "a.txt"), "Has been run")
 
+    def test_tracking_table_records_duration_and_rows_affected(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.handler.execute(self.db_1_conn_hash, "create table dummy(i int)")
+        self.handler.execute_tracked(self.db_1_conn_hash, "a.txt", "insert into dummy values (1), (2)")
+        self.handler.record_script_in_tracking_table(self.db_1_conn_hash, "b.txt", 1234, None)
+        sql = "select script_name, duration_ms, rows_affected from __schema_migrations order by script_name"
+        r = self.exec_sql_get_records(self.__get_open_connection(self.db_1_conn_hash), sql)
+        self.assertEqual("a.txt", r[0][0])
+        self.assertTrue(r[0][1] >= 0, "duration")
+        self.assertEqual(2, r[0][2], "rows")
+        self.assertEqual(("b.txt", 1234, None), tuple(r[1]))
+
+    def test_tracking_table_from_earlier_version_is_upgraded(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        old = "create table __schema_migrations(migration_id serial primary key, script_name varchar(255), date_applied timestamp not null default CURRENT_TIMESTAMP)"
+        self.handler.execute(self.db_1_conn_hash, old)
+        self.handler.execute(self.db_1_conn_hash, "insert into __schema_migrations(script_name) values ('old.txt')")
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.handler.record_script_in_tracking_table(self.db_1_conn_hash, "a.txt", 10, 3)
+        self.assertEqual(set(["old.txt", "a.txt"]), self.handler.get_applied_scripts(self.db_1_conn_hash), "kept old rows")
+
+    def test_can_get_all_applied_scripts(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.assertEqual(set(), self.handler.get_applied_scripts(self.db_1_conn_hash), "Nothing run yet")
+        self.handler.record_script_in_tracking_table(self.db_1_conn_hash, "a.txt")
+        self.handler.record_script_in_tracking_table(self.db_1_conn_hash, "b.txt")
+        self.assertEqual(set(["a.txt", "b.txt"]), self.handler.get_applied_scripts(self.db_1_conn_hash), "Both run")
+
+    def test_tracking_rows_can_be_batched(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.handler.tracking_batch_size = 3
+        self.handler.record_script_in_tracking_table(self.db_1_conn_hash, "a.txt")
+        self.handler.record_script_in_tracking_table(self.db_1_conn_hash, "b.txt")
+        self.assertEqual(set(), self.handler.get_applied_scripts(self.db_1_conn_hash), "Buffered")
+        self.handler.record_script_in_tracking_table(self.db_1_conn_hash, "c.txt")
+        self.handler.record_script_in_tracking_table(self.db_1_conn_hash, "d.txt")
+        self.assertEqual(set(["a.txt", "b.txt", "c.txt"]), self.handler.get_applied_scripts(self.db_1_conn_hash), "Batch full")
+        self.handler.flush_tracking_table(self.db_1_conn_hash)
+        self.assertTrue("d.txt" in self.handler.get_applied_scripts(self.db_1_conn_hash), "Flushed")
+
+    def test_can_record_script_checksums(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.create_checksum_table(self.db_1_conn_hash)
+        self.handler.create_checksum_table(self.db_1_conn_hash)
+        self.assertEqual({}, self.handler.get_script_checksums(self.db_1_conn_hash, "code"), "None yet")
+        self.handler.record_script_checksum(self.db_1_conn_hash, "code", "a.sql", "abc")
+        self.handler.record_script_checksum(self.db_1_conn_hash, "reference_data", "a.sql", "def")
+        self.handler.record_script_checksum(self.db_1_conn_hash, "code", "a.sql", "xyz")
+        self.assertEqual({"a.sql": "xyz"}, self.handler.get_script_checksums(self.db_1_conn_hash, "code"), "updated")
+        self.assertEqual({"a.sql": "def"}, self.handler.get_script_checksums(self.db_1_conn_hash, "reference_data"), "by type")
+
     def test_can_execute_script(self):
         self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
         self.handler.execute(self.db_1_conn_hash, "create table dummy(i int)")
@@ -170,6 +253,86 @@ class MySqlDatabaseHandler_Tests(unittest.TestCase):
         self.assert_table_exists_equals(self.db_1_conn_hash, "dummy", True, "created")
         self.assert_table_exists_equals(self.db_1_conn_hash, "d2", True, "created d2")
 
+    def test_can_execute_stream_of_statements(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        sql = """create table dummy(i int);
+DELIMITER //
+create procedure p()
+begin
+  insert into dummy values (1);
+end //
+DELIMITER ;
+call p();"""
+        self.handler.execute_stream(self.db_1_conn_hash, StringIO(sql))
+        self.assert_recordcount_equals(1, self.db_1_conn_hash, "select * from dummy", "inserted")
+
+    def test_failing_streamed_statement_is_identified(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        try:
+            self.handler.execute_stream(self.db_1_conn_hash, StringIO("create table dummy(i int);\nblah blah;"))
+            self.fail("should have thrown")
+        except SqlStatementException as e:
+            self.assertEqual(2, e.statement.number, "statement number")
+            self.assertEqual(27, e.statement.offset, "offset")
+
+    def test_can_execute_script_with_braces(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.execute(self.db_1_conn_hash, "create table dummy(s varchar(10))")
+        self.handler.execute(self.db_1_conn_hash, "insert into dummy values ('{0}')")
+        self.assert_recordcount_equals(1, self.db_1_conn_hash, "select * from dummy where s = '{0}'", "inserted")
+
+    def write_data_file(self, name, content, manifest = None):
+        d = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, d)
+        path = os.path.join(d, name)
+        with open(path, "w") as f:
+            f.write(content)
+        if manifest is not None:
+            with open(os.path.splitext(path)[0] + ".ini", "w") as f:
+                f.write(manifest)
+        return DelimitedDataFile(path)
+
+    def test_can_bulk_load_csv_replacing_table_contents(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.execute(self.db_1_conn_hash, "create table currency(code varchar(3), name varchar(30)); insert into currency values ('XXX', 'gone')")
+        data = self.write_data_file("currency.csv", "code,name\nCAD,\"Canadian dollar, eh\"\nUSD,US dollar\n")
+        self.handler.bulk_load(self.db_1_conn_hash, data)
+        self.assert_recordcount_equals(2, self.db_1_conn_hash, "select * from currency", "replaced")
+        self.assert_recordcount_equals(1, self.db_1_conn_hash, "select * from currency where name = 'Canadian dollar, eh'", "quoted")
+
+    def test_can_bulk_merge_tsv(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.execute(self.db_1_conn_hash, "create table widget(id int primary key, name varchar(30))")
+        self.handler.execute(self.db_1_conn_hash, "insert into widget values (1, 'old'), (3, 'kept')")
+        data = self.write_data_file("widget.tsv", "id\tname\n1\tsprocket\n2\tgear\n", "mode = merge\nkey = id\n")
+        self.handler.bulk_load(self.db_1_conn_hash, data)
+        self.assert_recordcount_equals(3, self.db_1_conn_hash, "select * from widget", "merged")
+        self.assert_recordcount_equals(1, self.db_1_conn_hash, "select * from widget where id = 1 and name = 'sprocket'", "updated")
+
+    def test_failed_bulk_load_leaves_table_contents(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.execute(self.db_1_conn_hash, "create table currency(code varchar(3) primary key, name varchar(30)) engine=InnoDB")
+        self.handler.execute(self.db_1_conn_hash, "insert into currency values ('XXX', 'kept')")
+        data = self.write_data_file("currency.csv", "code,name\nCAD,Canadian dollar\nCAD,duplicate\n")
+        self.assertRaises(Exception, self.handler.bulk_load, self.db_1_conn_hash, data)
+        self.assert_recordcount_equals(1, self.db_1_conn_hash, "select * from currency where code = 'XXX'", "rolled back")
+
+    def test_bulk_load_reads_manifest_null_string(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.execute(self.db_1_conn_hash, "create table currency(code varchar(3), name varchar(30))")
+        data = self.write_data_file("currency.csv", "code,name\nCAD,NULL\nUSD,\n", "null = NULL\n")
+        self.handler.bulk_load(self.db_1_conn_hash, data)
+        self.assert_recordcount_equals(1, self.db_1_conn_hash, "select * from currency where name is null", "NULL is null")
+        self.assert_recordcount_equals(1, self.db_1_conn_hash, "select * from currency where name = ''", "empty is empty")
+
+    def test_only_bulk_load_connection_can_read_local_files(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.execute(self.db_1_conn_hash, "create table currency(code varchar(3), name varchar(30))")
+        data = self.write_data_file("currency.csv", "code,name\nUSD,US dollar\n")
+        sql = "load data local infile '{0}' into table currency fields terminated by ',' ignore 1 lines".format(data.path)
+        self.assertRaises(Exception, self.handler.execute, self.db_1_conn_hash, sql)
+        self.assertEqual(1, self.handler.bulk_load(self.db_1_conn_hash, data))
+
     def test_bad_script_throws(self):
         self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
         self.assertRaises(Exception, self.handler.execute, self.db_1_conn_hash, "blah blah")
@@ -178,6 +341,125 @@ class MySqlDatabaseHandler_Tests(unittest.TestCase):
         self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
         self.assertRaises(Exception, self.handler.execute, self.db_1_conn_hash, "create table dummy(i int); blah blah")
 
+    def test_all_results_of_multi_statement_script_are_read(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        sql = "create table dummy(i int); insert into dummy values (1), (2); select * from dummy; insert into dummy values (3)"
+        self.assertEqual(3, self.handler.execute(self.db_1_conn_hash, sql), "rows affected")
+        self.handler.execute(self.db_1_conn_hash, "insert into dummy values (4)")
+        self.assert_recordcount_equals(4, self.db_1_conn_hash, "select * from dummy", "connection still usable")
+
+    def test_failing_statement_of_multi_statement_script_is_identified(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        try:
+            self.handler.execute(self.db_1_conn_hash, "create table dummy(i int);\ninsert into dummy values (1);\nblah blah;")
+            self.fail("should have thrown")
+        except SqlStatementException as e:
+            self.assertEqual(3, e.statement.number, "statement number")
+        self.assert_recordcount_equals(1, self.db_1_conn_hash, "select * from dummy", "earlier statements ran")
+
+    def test_can_execute_script_with_delimiter_lines(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        sql = """create table dummy(i int);
+DELIMITER //
+create procedure p()
+begin
+  insert into dummy values (1);
+end //
+DELIMITER ;
+call p();"""
+        self.handler.execute(self.db_1_conn_hash, sql)
+        self.assert_recordcount_equals(1, self.db_1_conn_hash, "select * from dummy", "inserted")
+
+    def test_small_migrations_can_be_packed_into_one_round_trip(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.handler.script_pack_size = 3
+        self.assertEqual(DatabaseHandler.DEFERRED, self.handler.execute_tracked(self.db_1_conn_hash, "a.txt", "create table dummy(i int)"))
+        self.handler.execute_tracked(self.db_1_conn_hash, "b.txt", "insert into dummy values (1); insert into dummy values (2)")
+        self.assert_table_exists_equals(self.db_1_conn_hash, "dummy", False, "packed, not run yet")
+        self.handler.execute_tracked(self.db_1_conn_hash, "c.txt", "insert into dummy values (3)")
+        self.assert_recordcount_equals(3, self.db_1_conn_hash, "select * from dummy", "pack run")
+        sql = "select script_name, rows_affected from __schema_migrations order by migration_id"
+        self.assertEqual([("a.txt", 0), ("b.txt", 2), ("c.txt", 1)], [tuple(r) for r in self.exec_sql_get_records(self.__get_open_connection(self.db_1_conn_hash), sql)])
+        results = self.handler.pop_deferred_results(self.db_1_conn_hash)
+        self.assertEqual([("a.txt", 0), ("b.txt", 2), ("c.txt", 1)], [(r[0], r[2]) for r in results])
+        self.assertEqual([], self.handler.pop_deferred_results(self.db_1_conn_hash), "forgotten")
+
+    def test_failed_pack_records_only_scripts_before_the_failure(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.handler.script_pack_size = 10
+        self.handler.execute_tracked(self.db_1_conn_hash, "a.txt", "create table dummy(i int)")
+        self.handler.execute_tracked(self.db_1_conn_hash, "b.txt", "insert into dummy values (1); blah blah")
+        self.handler.execute_tracked(self.db_1_conn_hash, "c.txt", "insert into dummy values (2)")
+        try:
+            self.handler.flush_tracking_table(self.db_1_conn_hash)
+            self.fail("should have thrown")
+        except DeferredScriptException as e:
+            self.assertEqual("b.txt", e.script_name)
+        self.assertEqual(set(["a.txt"]), self.handler.get_applied_scripts(self.db_1_conn_hash))
+        self.assertEqual(["a.txt"], [r[0] for r in self.handler.pop_deferred_results(self.db_1_conn_hash)])
+        self.assert_recordcount_equals(1, self.db_1_conn_hash, "select * from dummy", "stopped at failure")
+
+    def test_procedure_scripts_are_not_packed(self):
+        self.handler.script_pack_size = 10
+        self.assertTrue(self.handler.can_pack("create table dummy(i int)"))
+        self.assertFalse(self.handler.can_pack("create procedure p() begin select 1; end"))
+        self.assertFalse(self.handler.can_pack("DELIMITER //\ncreate table x(i int) //"))
+        self.assertFalse(self.handler.can_pack("insert into x values ('" + "a" * 20000 + "')"))
+        self.assertFalse(self.handler.can_pack("-- dbmigrator: online-alter\nalter table x add column c int"))
+
+    def test_online_alter_copies_rows_and_swaps_table(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.execute(self.db_1_conn_hash, "create table widget(id int primary key, name varchar(10))")
+        values = ", ".join(["({0}, 'w{0}')".format(i) for i in range(1, 26)])
+        self.handler.execute(self.db_1_conn_hash, "insert into widget values " + values)
+        sql = "-- dbmigrator: online-alter chunk_size=10\nalter table widget add column weight int not null default 7, add index ix_name (name);"
+        self.assertEqual(25, self.handler.execute(self.db_1_conn_hash, sql), "rows copied")
+        rows = self.handler.query(self.db_1_conn_hash, "select id, name, weight from widget order by id")
+        self.assertEqual(25, len(rows))
+        self.assertEqual((25, "w25", 7), rows[-1])
+        self.handler.execute(self.db_1_conn_hash, "insert into widget(id, name) values (26, 'new')")
+        self.assert_recordcount_equals(26, self.db_1_conn_hash, "select * from widget", "no triggers left")
+        for t in ["_widget_new", "_widget_old"]:
+            self.assert_table_exists_equals(self.db_1_conn_hash, t, False, t)
+        self.assert_recordcount_equals(0, self.db_1_conn_hash, "select * from __online_schema_changes", "checkpoint cleared")
+
+    def test_connection_is_reused_across_calls(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.handler.record_script_in_tracking_table(self.db_1_conn_hash, "a.txt")
+        self.handler.is_in_tracking_table(self.db_1_conn_hash, "a.txt")
+        self.assertEqual(2, len(self.handler.connections), "one system and one db connection")
+
+    def test_query_returns_rows(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.execute(self.db_1_conn_hash, "create table dummy(i int, s varchar(10)); insert into dummy values (1, 'a'), (2, null)")
+        self.assertEqual([(1, "a"), (2, None)], self.handler.query(self.db_1_conn_hash, "select i, s from dummy order by i"))
+
+    def test_session_connection_hash_gets_separate_connection(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        session = self.handler.get_session_connection_hash(self.db_1_conn_hash, 1)
+        self.handler.execute(self.db_1_conn_hash, "create table dummy(i int)")
+        self.handler.execute(session, "insert into dummy values (1)")
+        self.assertEqual(3, len(self.handler.connections), "system, db and session connections")
+        self.assert_table_exists_equals(self.db_1_conn_hash, "dummy", True, "same database")
+
+    def test_can_delete_make_new_database_with_open_cached_connection(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.execute(self.db_1_conn_hash, "create table dummy(i int)")
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.assert_table_exists_equals(self.db_1_conn_hash, "dummy", False, "recreated")
+        self.handler.execute(self.db_1_conn_hash, "create table dummy(i int)")
+        self.assert_table_exists_equals(self.db_1_conn_hash, "dummy", True, "new connection used")
+
+    def test_close_connections(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.user_defined_tables_exist(self.db_1_conn_hash)
+        self.handler.close_connections()
+        self.assertEqual(0, len(self.handler.connections), "all closed")
+        self.assertFalse(self.handler.user_defined_tables_exist(self.db_1_conn_hash), "reopens as needed")
+
 
 def main():
     unittest.main()
@@ -0,0 +1,190 @@
+import logging
+import re
+import unittest
+
+import dbMigrator
+from dbMigrator.mysqlonlinealter import MySqlOnlineAlter, OnlineAlterException, sql_literal, quote_name
+
+
+class FakeMySqlHandler(object):
+    """Simulates the server state an online alter of widget(id, name) sees,
+with the given primary key values."""
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.tables = set(["widget"])
+        self.triggers = 0
+        self.checkpoint = None
+        self.foreign_keys = []
+        self.primary_key = ["id"]
+        self.executed = []
+
+    def execute(self, conn_hash, sql):
+        self.executed.append(sql)
+        m = re.match(r"create table `(\w+)` like", sql)
+        if m:
+            self.tables.add(m.group(1))
+        m = re.match(r"drop table if exists `(\w+)`", sql)
+        if m:
+            self.tables.discard(m.group(1))
+        if sql.startswith("rename table"):
+            self.tables = set(["_widget_old", "widget"])
+        if sql.startswith("create trigger"):
+            self.triggers += 1
+        if sql.startswith("drop trigger"):
+            self.triggers = max(0, self.triggers - 1)
+        if sql.startswith("replace into __online_schema_changes"):
+            self.checkpoint = [MySqlOnlineAlter.parse("-- dbmigrator: online-alter\n" + self.alter)[1], "copying", None, 0]
+        if sql.startswith("update __online_schema_changes"):
+            self.checkpoint[1] = re.search(r"status = '(\w+)'", sql).group(1)
+            self.checkpoint[2] = re.search(r"last_key = (NULL|'([^']*)')", sql).group(2)
+            self.checkpoint[3] = int(re.search(r"rows_copied = (\d+)", sql).group(1))
+        if sql.startswith("delete from __online_schema_changes"):
+            self.checkpoint = None
+        if sql.startswith("insert low_priority ignore"):
+            lower = re.search(r"> \((\d+)\)", sql)
+            upper = re.search(r"<= \((\d+)\)", sql)
+            return len([k for k in self.keys if (lower is None or k > int(lower.group(1))) and (upper is None or k <= int(upper.group(1)))])
+        return None
+
+    def query(self, conn_hash, sql):
+        if "information_schema.tables" in sql and "count(*)" in sql:
+            return [(1 if re.search(r"table_name = '(\w+)'", sql).group(1) in self.tables else 0,)]
+        if "table_rows" in sql:
+            return [(len(self.keys),)]
+        if "key_column_usage" in sql:
+            return [(c,) for c in self.primary_key]
+        if "information_schema.columns" in sql:
+            return [("widget", "id"), ("_widget_new", "id"), ("widget", "name"), ("_widget_new", "name"), ("_widget_new", "weight")]
+        if "referential_constraints" in sql:
+            return self.foreign_keys
+        if "information_schema.triggers" in sql:
+            return [(self.triggers,)]
+        if "from __online_schema_changes" in sql:
+            return [] if self.checkpoint is None else [tuple(self.checkpoint)]
+        if "limit 1 offset" in sql:
+            lower = re.search(r"> \((\d+)\)", sql)
+            offset = int(re.search(r"offset (\d+)", sql).group(1))
+            keys = [k for k in self.keys if lower is None or k > int(lower.group(1))]
+            return [(keys[offset],)] if offset < len(keys) else []
+        raise Exception("Unexpected query " + sql)
+
+
+class MySqlOnlineAlter_Tests(unittest.TestCase):
+
+    longMessage = True
+
+    def setUp(self):
+        self.handler = FakeMySqlHandler(range(1, 26))
+        self.handler.alter = "alter table widget add column weight int"
+        self.sql = "-- dbmigrator: online-alter chunk_size=10\n" + self.handler.alter + ";\n"
+        logging.getLogger('dbmigrator').setLevel(logging.CRITICAL)
+
+    def chunks(self):
+        return [re.sub(r"^.* where ", "", s).replace(" lock in share mode", "") for s in self.handler.executed if s.startswith("insert low_priority")]
+
+    def test_marker_is_detected(self):
+        self.assertTrue(MySqlOnlineAlter.is_online_alter(self.sql))
+        self.assertTrue(MySqlOnlineAlter.is_online_alter("/* big */\n  -- DbMigrator: Online-Alter\nalter table t drop column c"))
+        self.assertFalse(MySqlOnlineAlter.is_online_alter("alter table t add column c int -- dbmigrator: online-alter"))
+
+    def test_script_is_parsed(self):
+        self.assertEqual(("widget", "add column weight int"), MySqlOnlineAlter.parse(self.sql))
+        self.assertEqual(("my table", "add index ix (a),\n drop column b"),
+                         MySqlOnlineAlter.parse("/* note */ alter TABLE `my table` add index ix (a),\n drop column b"))
+        self.assertRaises(OnlineAlterException, MySqlOnlineAlter.parse, "alter table a add column c int; alter table b add column c int")
+        self.assertRaises(OnlineAlterException, MySqlOnlineAlter.parse, "create index ix on a(c)")
+
+    def test_settings_on_marker_line_override_defaults(self):
+        a = MySqlOnlineAlter(self.handler, {}, "-- dbmigrator: online-alter sleep=0.5\n" + self.handler.alter, 500, 0, 30)
+        self.assertEqual((500, 0.5, 30), (a.chunk_size, a.sleep, a.progress_interval))
+        self.assertEqual(10, MySqlOnlineAlter(self.handler, {}, self.sql).chunk_size)
+        self.assertRaises(OnlineAlterException, MySqlOnlineAlter, self.handler, {}, "-- dbmigrator: online-alter chunks=5\n" + self.handler.alter)
+        self.assertRaises(OnlineAlterException, MySqlOnlineAlter, self.handler, {}, "-- dbmigrator: online-alter chunk_size=0\n" + self.handler.alter)
+
+    def test_sql_literals(self):
+        self.assertEqual("NULL", sql_literal(None))
+        self.assertEqual("42", sql_literal(42L))
+        self.assertEqual("'it\\'s a \\\\ b'", sql_literal("it's a \\ b"))
+        self.assertEqual("'caf\xc3\xa9'", sql_literal(u"caf\xe9"))
+        self.assertEqual("`a``b`", quote_name("a`b"))
+
+    def test_triggers_mirror_changes_to_shadow_table(self):
+        a = MySqlOnlineAlter(self.handler, {}, self.sql)
+        insert, update, delete = a.get_trigger_sql(["id", "name"], ["id"])
+        self.assertEqual("create trigger `__osc_widget_ins` after insert on `widget` for each row " +
+                         "replace into `_widget_new` (`id`, `name`) values (NEW.`id`, NEW.`name`)", insert)
+        self.assertTrue("begin delete ignore from `_widget_new` where `id` <=> OLD.`id`; replace into" in update, update)
+        self.assertTrue(delete.endswith("delete ignore from `_widget_new` where `id` <=> OLD.`id`"), delete)
+
+    def test_rows_are_copied_in_key_chunks_then_tables_swapped(self):
+        rows = MySqlOnlineAlter(self.handler, {}, self.sql).run()
+        self.assertEqual(25, rows)
+        self.assertEqual(["(`id`) <= (10)", "(`id`) > (10) and (`id`) <= (20)", "(`id`) > (20)"], self.chunks())
+        executed = self.handler.executed
+        self.assertTrue("alter table `_widget_new` add column weight int" in executed)
+        self.assertEqual(3, len([s for s in executed if s.startswith("create trigger")]))
+        rename = executed.index("rename table `widget` to `_widget_old`, `_widget_new` to `widget`")
+        self.assertTrue(rename > executed.index([s for s in executed if s.startswith("insert low_priority")][-1]), "swapped after copy")
+        self.assertEqual(["drop trigger if exists `__osc_widget_del`", "drop trigger if exists `__osc_widget_ins`",
+                          "drop trigger if exists `__osc_widget_upd`", "drop table if exists `_widget_old`"], executed[rename + 1:rename + 5])
+        self.assertEqual(set(["widget"]), self.handler.tables)
+        self.assertEqual(None, self.handler.checkpoint, "checkpoint removed")
+        self.assertEqual(0, self.handler.triggers)
+
+    def test_multi_column_keys_are_compared_as_rows(self):
+        a = MySqlOnlineAlter(self.handler, {}, self.sql)
+        sql = a.get_chunk_sql(["a", "b", "c"], ["a", "b"], ["1", "'x'"], None)
+        self.assertEqual("insert low_priority ignore into `_widget_new` (`a`, `b`, `c`) select `a`, `b`, `c` from `widget` " +
+                         "force index (primary) where (`a`, `b`) > (1, 'x') lock in share mode", sql)
+
+    def test_interrupted_copy_is_resumed_from_checkpoint(self):
+        original = self.handler.query
+        def fail_after_first_chunk(conn_hash, sql):
+            if "offset" in sql and "> (10)" in sql:
+                raise Exception("connection lost")
+            return original(conn_hash, sql)
+        self.handler.query = fail_after_first_chunk
+        self.assertRaises(Exception, MySqlOnlineAlter(self.handler, {}, self.sql).run)
+        self.assertEqual(["add column weight int", "copying", '["10"]', 10], self.handler.checkpoint)
+
+        self.handler.query = original
+        self.handler.executed = []
+        self.assertEqual(25, MySqlOnlineAlter(self.handler, {}, self.sql).run())
+        self.assertEqual(["(`id`) > (10) and (`id`) <= (20)", "(`id`) > (20)"], self.chunks())
+        self.assertFalse([s for s in self.handler.executed if s.startswith("create table `")], "shadow table kept")
+
+    def test_interrupted_swap_is_finished(self):
+        self.handler.checkpoint = ["add column weight int", "copied", '["20"]', 25]
+        self.handler.tables = set(["widget", "_widget_old"])
+        self.handler.triggers = 3
+        self.assertEqual(25, MySqlOnlineAlter(self.handler, {}, self.sql).run())
+        self.assertEqual([], self.chunks())
+        self.assertFalse([s for s in self.handler.executed if s.startswith("rename")], "not swapped again")
+        self.assertEqual(set(["widget"]), self.handler.tables)
+        self.assertEqual(None, self.handler.checkpoint)
+
+    def test_changed_script_restarts(self):
+        self.handler.checkpoint = ["add column height int", "copying", '["10"]', 10]
+        self.handler.tables.add("_widget_new")
+        self.handler.triggers = 3
+        MySqlOnlineAlter(self.handler, {}, self.sql).run()
+        self.assertEqual(3, len(self.chunks()), "copied from the start")
+        self.assertTrue("drop table if exists `_widget_new`" in self.handler.executed)
+
+    def test_tables_without_primary_key_or_with_referencing_foreign_keys_are_rejected(self):
+        self.handler.primary_key = []
+        self.assertRaises(OnlineAlterException, MySqlOnlineAlter(self.handler, {}, self.sql).run)
+        self.handler.primary_key = ["id"]
+        self.handler.foreign_keys = [("part", "fk_part_widget")]
+        with self.assertRaises(OnlineAlterException) as ctx:
+            MySqlOnlineAlter(self.handler, {}, self.sql).run()
+        self.assertTrue("part.fk_part_widget" in str(ctx.exception), str(ctx.exception))
+        self.assertEqual(set(["widget"]), self.handler.tables, "nothing created")
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
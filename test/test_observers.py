@@ -0,0 +1,115 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import dbMigrator
+from dbMigrator.observers import MigrationObserver, ObserverList
+from dbMigrator.observers import JsonLinesObserver, PrometheusTextfileObserver
+
+
+class FailingObserver(MigrationObserver):
+    def phase_started(self, phase, db_nicknames):
+        raise Exception("oops")
+
+
+class RecordingObserver(MigrationObserver):
+    def __init__(self):
+        self.events = []
+    def phase_started(self, phase, db_nicknames):
+        self.events.append(("phase_started", phase))
+
+
+class ObserverListTests(unittest.TestCase):
+
+    longMessage = True
+
+    def test_empty_list_is_false(self):
+        observers = ObserverList()
+        self.assertFalse(observers)
+        observers.add(MigrationObserver())
+        self.assertTrue(observers)
+
+    def test_failing_observer_does_not_stop_others(self):
+        observers = ObserverList()
+        r = RecordingObserver()
+        observers.add(FailingObserver())
+        observers.add(r)
+        observers.notify("phase_started", "code", ["a"])
+        self.assertEqual([("phase_started", "code")], r.events)
+
+
+class BuiltInObserverTests(unittest.TestCase):
+
+    longMessage = True
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_json_lines_observer_writes_one_object_per_event(self):
+        path = os.path.join(self.dir, "events.jsonl")
+        o = JsonLinesObserver(path)
+        o.phase_started("migrations", ["a"])
+        o.script_finished("migrations", "a", "1.sql", 10, 5, 2)
+        o.script_failed("migrations", "a", "2.sql", 10, 1, Exception("bad sql"))
+        o.close()
+
+        with open(path) as f:
+            events = [json.loads(line) for line in f]
+        self.assertEqual(["phase_started", "script_finished", "script_failed"], [e["event"] for e in events])
+        self.assertEqual(("a", "1.sql", 10, 5, 2), tuple([events[1][k] for k in ["db", "script", "size", "duration_ms", "rows_affected"]]))
+        self.assertEqual("bad sql", events[2]["error"])
+
+    def test_json_lines_observer_appends(self):
+        path = os.path.join(self.dir, "events.jsonl")
+        for i in range(2):
+            o = JsonLinesObserver(path)
+            o.phase_started("code", ["a"])
+            o.close()
+        with open(path) as f:
+            self.assertEqual(2, len(f.readlines()))
+
+    def test_prometheus_observer_writes_metrics_at_end_of_phase(self):
+        path = os.path.join(self.dir, "dbmigrator.prom")
+        o = PrometheusTextfileObserver(path, { "env": "test" })
+        o.phase_started("migrations", ["a"])
+        o.script_finished("migrations", "a", "1.sql", 100, 1500, 3)
+        o.script_finished("migrations", "a", "2.sql", 50, 500, None)
+        o.script_skipped("migrations", "a", "0.sql", MigrationObserver.SKIPPED_APPLIED)
+        self.assertFalse(os.path.exists(path), "not written until phase end")
+        o.phase_finished("migrations", ["a"], 2500, None)
+
+        with open(path) as f:
+            text = f.read()
+        lines = text.splitlines()
+        self.assertTrue('dbmigrator_phase_duration_seconds{env="test",phase="migrations"} 2.5' in lines, text)
+        self.assertTrue('dbmigrator_phase_success{env="test",phase="migrations"} 1' in lines, text)
+        self.assertTrue('dbmigrator_scripts_total{db="a",env="test",outcome="executed",phase="migrations"} 2' in lines, text)
+        self.assertTrue('dbmigrator_scripts_total{db="a",env="test",outcome="skipped",phase="migrations"} 1' in lines, text)
+        self.assertTrue('dbmigrator_script_duration_seconds_total{db="a",env="test",phase="migrations"} 2.0' in lines, text)
+        self.assertTrue('dbmigrator_script_bytes_total{db="a",env="test",phase="migrations"} 150' in lines, text)
+        self.assertTrue('dbmigrator_script_rows_affected_total{db="a",env="test",phase="migrations"} 3' in lines, text)
+        self.assertEqual([path], [os.path.join(self.dir, f) for f in os.listdir(self.dir)], "no temp files left")
+
+    def test_prometheus_observer_records_failed_phase(self):
+        path = os.path.join(self.dir, "dbmigrator.prom")
+        o = PrometheusTextfileObserver(path)
+        o.phase_finished("code", ["a"], 10, Exception("failed"))
+        with open(path) as f:
+            lines = f.read().splitlines()
+        self.assertTrue('dbmigrator_phase_success{phase="code"} 0' in lines)
+
+    def test_prometheus_label_values_are_escaped(self):
+        o = PrometheusTextfileObserver("unused")
+        self.assertEqual('{db="a\\"b\\\\c\\nd"}', o.format_labels(db = 'a"b\\c\nd'))
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
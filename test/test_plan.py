@@ -0,0 +1,51 @@
+import unittest
+
+import dbMigrator
+from dbMigrator.plan import MigrationPlan
+
+
+class MigrationPlanTests(unittest.TestCase):
+
+    longMessage = True
+
+    def build_plan(self):
+        plan = MigrationPlan(["migrations", "baseline_schema"])
+        d = plan.add_database("main", "main_db", False)
+        p = d.add_phase("baseline_schema")
+        p.refused = "not empty"
+        p = d.add_phase("migrations")
+        p.add_script("1.sql", 100)
+        p.add_script("2.sql", 3000)
+        p.skipped = 4
+        d = plan.add_database("other", "other_db", True)
+        d.error = "can't connect"
+        return plan
+
+    def test_phases_are_kept_in_run_order(self):
+        self.assertEqual(["baseline_schema", "migrations"], self.build_plan().phases)
+
+    def test_text_report(self):
+        expected = """main (main_db)
+  baseline_schema: REFUSED - not empty
+  migrations: 2 script(s), 3.0 kB, 4 already applied
+    1.sql (100 bytes)
+    2.sql (2.9 kB)
+other (other_db): drop and recreate
+  ERROR: can't connect
+Total: 2 script(s), 3.0 kB, on 2 database(s); 1 refusal(s); 1 error(s)"""
+        self.assertEqual(expected, self.build_plan().format_text())
+
+    def test_dict(self):
+        d = self.build_plan().to_dict()
+        self.assertEqual(["main", "other"], [x["db"] for x in d["databases"]])
+        migrations = d["databases"][0]["phases"][1]
+        self.assertEqual({ "name": "1.sql", "size": 100, "action": "run" }, migrations["scripts"][0])
+        self.assertEqual(4, migrations["skipped"])
+        self.assertEqual("can't connect", d["databases"][1]["error"])
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -3,11 +3,17 @@ import unittest
 import sys
 import os
 import inspect
+import shutil
+import tempfile
+import threading
+from StringIO import StringIO
 from configobj import ConfigObj
 import psycopg2
 import psycopg2.extensions
 
 import dbMigrator
+from dbMigrator.sqlsplitter import SqlStatementException
+from dbMigrator.defaultdatabasesource import DelimitedDataFile
 from dbMigrator.postgresdatabasehandler import PostgresDatabaseHandler
 
 class PostgresDatabaseHandler_Tests(unittest.TestCase):
@@ -43,6 +49,10 @@ class PostgresDatabaseHandler_Tests(unittest.TestCase):
         logger = logging.getLogger('dbmigrator')
         logger.setLevel(logging.CRITICAL)
 
+    def tearDown(self):
+        # Cached connections would otherwise block the drops in setUp.
+        self.handler.close_connections()
+
     def buildConnectionString(self, hsh):
         """Builds postgres db conn string from hash"""
         template = "host='{0}' dbname='{1}' user='{2}' password='{3}'"
@@ -130,6 +140,23 @@ class PostgresDatabaseHandler_Tests(unittest.TestCase):
         self.exec_sql_on_conn(conn, sql)
         self.assertTrue(self.handler.user_defined_tables_exist(self.db_1_conn_hash), "Table exists")
 
+    def test_can_create_database_from_marked_template(self):
+        template_conn_hash = self.db_2_conn_hash
+        self.assertEqual(None, self.handler.get_template_checksum(self.sys_conn_hash, self.db_2_name), "no template")
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_2_name)
+        self.assertEqual(None, self.handler.get_template_checksum(self.sys_conn_hash, self.db_2_name), "not marked")
+        self.handler.execute(template_conn_hash, "create table dummy(i int); insert into dummy values (1)")
+        self.handler.mark_template(self.sys_conn_hash, self.db_2_name, "abc123")
+        self.assertEqual("abc123", self.handler.get_template_checksum(self.sys_conn_hash, self.db_2_name), "marked")
+
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.execute(self.db_1_conn_hash, "create table other(i int)")
+        # Connections to both databases are open, and must be closed for the copy.
+        self.handler.execute(template_conn_hash, "select 1")
+        self.handler.create_from_template(self.sys_conn_hash, self.db_1_name, self.db_2_name)
+        self.assert_recordcount_equals(1, self.db_1_conn_string, "select * from dummy", "copied")
+        self.assert_table_exists_equals(self.db_1_conn_string, "other", False, "old database deleted")
+
     def test_can_create_tracking_table(self):
         self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
         self.assert_table_exists_equals(self.db_1_conn_string, "__schema_migrations", False, "not created yet")
@@ -137,6 +164,20 @@ class PostgresDatabaseHandler_Tests(unittest.TestCase):
         self.assert_table_exists_equals(self.db_1_conn_string, "__schema_migrations", True, "created")
 
 
+    def test_old_server_version_throws(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.check_server_version(self.db_1_conn_hash)
+        original = PostgresDatabaseHandler.MIN_SERVER_VERSION
+        PostgresDatabaseHandler.MIN_SERVER_VERSION = 9990000
+        self.addCleanup(setattr, PostgresDatabaseHandler, "MIN_SERVER_VERSION", original)
+        self.assertRaises(Exception, self.handler.create_tracking_table, self.db_1_conn_hash)
+
+    def test_can_check_if_tracking_table_exists(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.assertFalse(self.handler.tracking_table_exists(self.db_1_conn_hash), "not created yet")
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.assertTrue(self.handler.tracking_table_exists(self.db_1_conn_hash), "created")
+
     def test_can_track_scripts(self):
         self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
         self.handler.create_tracking_table(self.db_1_conn_hash)
@@ -144,6 +185,255 @@ class PostgresDatabaseHandler_Tests(unittest.TestCase):
         self.handler.record_script_in_tracking_table(self.db_1_conn_hash, "a.txt")
         self.assertTrue(self.handler.is_in_tracking_table(self.db_1_conn_hash, "a.txt"), "Has been run")
 
+    def test_tracking_table_records_duration_and_rows_affected(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.handler.execute(self.db_1_conn_hash, "create table dummy(i int)")
+        self.handler.execute_tracked(self.db_1_conn_hash, "a.txt", "insert into dummy values (1), (2)")
+        self.handler.record_script_in_tracking_table(self.db_1_conn_hash, "b.txt", 1234, None)
+        sql = "select script_name, duration_ms, rows_affected from __schema_migrations order by script_name"
+        r = self.exec_sql_get_records(psycopg2.connect(self.db_1_conn_string), sql)
+        self.assertEqual("a.txt", r[0][0])
+        self.assertTrue(r[0][1] >= 0, "duration")
+        self.assertEqual(2, r[0][2], "rows")
+        self.assertEqual(("b.txt", 1234, None), tuple(r[1]))
+
+    def test_tracking_table_from_earlier_version_is_upgraded(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        old = "create table __schema_migrations(migration_id serial primary key, script_name varchar(255), date_applied timestamp not null default CURRENT_TIMESTAMP)"
+        self.handler.execute(self.db_1_conn_hash, old)
+        self.handler.execute(self.db_1_conn_hash, "insert into __schema_migrations(script_name) values ('old.txt')")
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.handler.record_script_in_tracking_table(self.db_1_conn_hash, "a.txt", 10, 3)
+        self.assertEqual(set(["old.txt", "a.txt"]), self.handler.get_applied_scripts(self.db_1_conn_hash), "kept old rows")
+
+    def test_can_get_all_applied_scripts(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.assertEqual(set(), self.handler.get_applied_scripts(self.db_1_conn_hash), "Nothing run yet")
+        self.handler.record_script_in_tracking_table(self.db_1_conn_hash, "a.txt")
+        self.handler.record_script_in_tracking_table(self.db_1_conn_hash, "b.txt")
+        self.assertEqual(set(["a.txt", "b.txt"]), self.handler.get_applied_scripts(self.db_1_conn_hash), "Both run")
+
+    def test_tracking_rows_can_be_batched(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.handler.tracking_batch_size = 3
+        self.handler.record_script_in_tracking_table(self.db_1_conn_hash, "a.txt")
+        self.handler.record_script_in_tracking_table(self.db_1_conn_hash, "b.txt")
+        self.assertEqual(set(), self.handler.get_applied_scripts(self.db_1_conn_hash), "Buffered")
+        self.handler.record_script_in_tracking_table(self.db_1_conn_hash, "c.txt")
+        self.handler.record_script_in_tracking_table(self.db_1_conn_hash, "d.txt")
+        self.assertEqual(set(["a.txt", "b.txt", "c.txt"]), self.handler.get_applied_scripts(self.db_1_conn_hash), "Batch full")
+        self.handler.flush_tracking_table(self.db_1_conn_hash)
+        self.assertTrue("d.txt" in self.handler.get_applied_scripts(self.db_1_conn_hash), "Flushed")
+
+    def test_tracked_script_and_tracking_row_are_committed_together(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.handler.execute_tracked(self.db_1_conn_hash, "a.txt", "create table dummy(i int)")
+        self.assert_table_exists_equals(self.db_1_conn_string, "dummy", True, "created")
+        self.assertEqual(set(["a.txt"]), self.handler.get_applied_scripts(self.db_1_conn_hash), "recorded")
+
+    def test_failed_tracked_script_is_rolled_back_and_not_recorded(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.assertRaises(Exception, self.handler.execute_tracked, self.db_1_conn_hash, "a.txt", "create table dummy(i int); blah blah")
+        self.assert_table_exists_equals(self.db_1_conn_string, "dummy", False, "rolled back")
+        self.assertEqual(set(), self.handler.get_applied_scripts(self.db_1_conn_hash), "not recorded")
+
+    def test_concurrent_index_script_runs_outside_transaction(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.handler.execute(self.db_1_conn_hash, "create table dummy(i int)")
+        self.handler.execute_tracked(self.db_1_conn_hash, "a.txt", "create index concurrently ix_dummy on dummy(i)")
+        self.assertEqual(set(["a.txt"]), self.handler.get_applied_scripts(self.db_1_conn_hash), "recorded")
+
+    def test_no_transaction_marker_is_detected(self):
+        self.assertTrue(self.handler.requires_autocommit("-- dbmigrator: no-transaction\nalter table x add y int"))
+        self.assertTrue(self.handler.requires_autocommit("create index concurrently ix on x(y)"))
+        self.assertFalse(self.handler.requires_autocommit("alter table x add y int -- dbmigrator: no-transaction"))
+
+    def test_statements_in_comments_and_strings_are_ignored(self):
+        self.assertFalse(self.handler.requires_autocommit("-- rebuild later, concurrently\nalter table x add y int"))
+        self.assertFalse(self.handler.requires_autocommit("/* vacuum afterwards */ alter table x add y int"))
+        self.assertFalse(self.handler.requires_autocommit("insert into notes values ('create database is slow')"))
+        self.assertFalse(self.handler.requires_autocommit("insert into notes values ($$\nvacuum$$)"))
+        self.assertTrue(self.handler.requires_autocommit("-- reindex\ncreate table a(i int);\nvacuum a"))
+
+    def get_committed_scripts(self):
+        # Read on a separate connection, which only sees committed rows.
+        r = self.exec_sql_get_records(psycopg2.connect(self.db_1_conn_string), "select script_name from __schema_migrations")
+        return set([row[0] for row in r])
+
+    def test_migrations_can_be_batched_in_one_transaction(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.handler.migration_batch_size = 3
+        self.handler.execute_tracked(self.db_1_conn_hash, "a.txt", "create table dummy(i int)")
+        self.handler.execute_tracked(self.db_1_conn_hash, "b.txt", "insert into dummy values (1)")
+        self.assertEqual(set(), self.get_committed_scripts(), "not committed yet")
+        self.handler.execute_tracked(self.db_1_conn_hash, "c.txt", "insert into dummy values (2)")
+        self.handler.execute_tracked(self.db_1_conn_hash, "d.txt", "insert into dummy values (3)")
+        self.assertEqual(set(["a.txt", "b.txt", "c.txt"]), self.get_committed_scripts(), "batch full")
+        self.handler.flush_tracking_table(self.db_1_conn_hash)
+        self.assertTrue("d.txt" in self.get_committed_scripts(), "flushed")
+        self.assert_recordcount_equals(3, self.db_1_conn_string, "select * from dummy", "inserted")
+
+    def test_failed_batched_migration_rolls_back_whole_batch(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.handler.migration_batch_size = 10
+        self.handler.execute_tracked(self.db_1_conn_hash, "a.txt", "create table dummy(i int)")
+        self.assertRaises(Exception, self.handler.execute_tracked, self.db_1_conn_hash, "b.txt", "blah blah")
+        self.handler.flush_tracking_table(self.db_1_conn_hash)
+        self.assert_table_exists_equals(self.db_1_conn_string, "dummy", False, "rolled back")
+        self.assertEqual(set(), self.handler.get_applied_scripts(self.db_1_conn_hash), "nothing recorded")
+
+    def test_failed_batched_migration_can_roll_back_to_its_savepoint(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.handler.migration_batch_size = 10
+        self.handler.migration_batch_atomic = False
+        self.handler.execute_tracked(self.db_1_conn_hash, "a.txt", "create table dummy(i int)")
+        self.assertRaises(Exception, self.handler.execute_tracked, self.db_1_conn_hash, "b.txt", "create table d2(i int); blah blah")
+        self.assert_table_exists_equals(self.db_1_conn_string, "dummy", True, "earlier script committed")
+        self.assert_table_exists_equals(self.db_1_conn_string, "d2", False, "failed script rolled back")
+        self.assertEqual(set(["a.txt"]), self.get_committed_scripts())
+
+    def test_non_transactional_migration_ends_batch_and_runs_alone(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.handler.migration_batch_size = 10
+        self.handler.execute_tracked(self.db_1_conn_hash, "a.txt", "create table dummy(i int)")
+        self.handler.execute_tracked(self.db_1_conn_hash, "b.txt", "create index concurrently ix_dummy on dummy(i)")
+        self.assertEqual(set(["a.txt", "b.txt"]), self.get_committed_scripts(), "committed")
+        self.handler.execute_tracked(self.db_1_conn_hash, "c.txt", "-- dbmigrator: no-transaction\ninsert into dummy values (1)")
+        self.assertEqual(set(["a.txt", "b.txt", "c.txt"]), self.get_committed_scripts(), "marked script run alone")
+
+    def test_script_mentioning_concurrently_in_a_comment_runs_in_one_transaction(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.handler.execute_tracked(self.db_1_conn_hash, "a.txt", "-- index it concurrently later\ncreate table dummy(i int);\ninsert into dummy values (1)")
+        self.assertEqual(set(["a.txt"]), self.get_committed_scripts(), "recorded")
+        sql = "-- index it concurrently later\ncreate table d2(i int);\nblah blah"
+        self.assertRaises(Exception, self.handler.execute_tracked, self.db_1_conn_hash, "b.txt", sql)
+        self.assert_table_exists_equals(self.db_1_conn_string, "d2", False, "rolled back")
+        self.assertEqual(set(["a.txt"]), self.get_committed_scripts(), "not recorded")
+
+    def test_script_run_a_statement_at_a_time_is_logged_as_not_atomic(self):
+        messages = []
+        class Capture(logging.Handler):
+            def emit(self, record):
+                if record.levelno == logging.WARNING:
+                    messages.append(record.getMessage())
+        h = Capture()
+        logger = logging.getLogger('dbmigrator')
+        logger.addHandler(h)
+        try:
+            self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+            self.handler.create_tracking_table(self.db_1_conn_hash)
+            self.handler.execute(self.db_1_conn_hash, "create table dummy(i int, j int)")
+            self.handler.execute_tracked(self.db_1_conn_hash, "a.txt", "create index concurrently ix_i on dummy(i)")
+            self.assertEqual([], messages, "single statement")
+            self.handler.execute_tracked(self.db_1_conn_hash, "b.txt", "create index concurrently ix_j on dummy(j);\nvacuum dummy")
+        finally:
+            logger.removeHandler(h)
+        self.assertEqual(1, len(messages))
+        self.assertTrue("b.txt" in messages[0], messages[0])
+
+    def test_script_timeouts_override_handler_settings(self):
+        self.handler.lock_timeout = "2s"
+        self.assertEqual({ "lock_timeout": "2s", "statement_timeout": None }, self.handler.get_timeouts("alter table x add y int"))
+        sql = "-- dbmigrator: no-transaction\n-- DbMigrator: statement_timeout=10min lock_timeout=500ms\nalter table x add y int"
+        self.assertEqual({ "lock_timeout": "500ms", "statement_timeout": "10min" }, self.handler.get_timeouts(sql))
+        self.assertEqual("2s", self.handler.get_timeouts("alter table x add y int -- dbmigrator: lock_timeout=1s")["lock_timeout"])
+
+    def test_timeouts_are_set_for_the_script_only(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        default = self.handler.query(self.db_1_conn_hash, "show lock_timeout")
+        self.handler.lock_timeout = "1500ms"
+        self.handler.execute(self.db_1_conn_hash, "create table dummy as select current_setting('lock_timeout') as t")
+        self.handler.execute_tracked(self.db_1_conn_hash, "a.txt", "-- dbmigrator: lock_timeout=3s\ninsert into dummy select current_setting('lock_timeout')")
+        self.assertEqual([("1500ms",), ("3s",)], self.handler.query(self.db_1_conn_hash, "select t from dummy order by t"))
+        self.assertEqual(default, self.handler.query(self.db_1_conn_hash, "show lock_timeout"), "reset")
+
+    def hold_lock(self, table, seconds):
+        """Locks the table on another connection, for the given time."""
+        conn = psycopg2.connect(self.db_1_conn_string)
+        conn.cursor().execute("lock table {0} in access exclusive mode".format(table))
+        timer = threading.Timer(seconds, conn.close)
+        timer.start()
+        self.addCleanup(timer.join)
+
+    def test_lock_timeout_is_retried(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.handler.execute(self.db_1_conn_hash, "create table dummy(i int)")
+        self.handler.lock_timeout = "200ms"
+        self.handler.lock_retry_delay = 0.5
+        self.hold_lock("dummy", 1)
+        self.handler.execute_tracked(self.db_1_conn_hash, "a.txt", "alter table dummy add j int")
+        self.assertEqual(set(["a.txt"]), self.get_committed_scripts(), "applied on retry")
+
+    def test_lock_timeout_throws_when_retries_run_out(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.handler.execute(self.db_1_conn_hash, "create table dummy(i int)")
+        self.handler.lock_retries = 1
+        self.handler.lock_retry_delay = 0.1
+        self.hold_lock("dummy", 2)
+        sql = "-- dbmigrator: lock_timeout=100ms\nalter table dummy add j int"
+        with self.assertRaises(psycopg2.Error) as ctx:
+            self.handler.execute_tracked(self.db_1_conn_hash, "a.txt", sql)
+        self.assertEqual(PostgresDatabaseHandler.LOCK_NOT_AVAILABLE, ctx.exception.pgcode)
+        self.assertEqual(set(), self.get_committed_scripts(), "not recorded")
+
+    def test_non_transactional_script_runs_statement_by_statement(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.handler.execute(self.db_1_conn_hash, "create table dummy(i int, j int)")
+        sql = "create index concurrently ix_i on dummy(i);\ncreate index concurrently ix_j on dummy(j);\n"
+        self.handler.execute_tracked(self.db_1_conn_hash, "a.txt", sql)
+        r = self.handler.query(self.db_1_conn_hash, "select indexname from pg_indexes where tablename = 'dummy' order by 1")
+        self.assertEqual([("ix_i",), ("ix_j",)], r)
+
+    def get_invalid_indexes(self):
+        return self.handler.query(self.db_1_conn_hash, "select c.relname from pg_index i join pg_class c on c.oid = i.indexrelid where not i.indisvalid")
+
+    def test_failed_concurrent_index_build_leaves_no_invalid_index(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.execute(self.db_1_conn_hash, "create table dummy(i int); insert into dummy values (1), (1)")
+        with self.assertRaises(psycopg2.Error) as ctx:
+            self.handler.execute(self.db_1_conn_hash, "create unique index concurrently ix_dummy on dummy(i)")
+        self.assertEqual("23505", ctx.exception.pgcode, "duplicate key")
+        self.assertEqual([], self.get_invalid_indexes(), "dropped")
+
+    def test_invalid_index_from_earlier_run_is_rebuilt(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.execute(self.db_1_conn_hash, "create table dummy(i int); insert into dummy values (1), (1)")
+        self.handler.drop_invalid_indexes = False
+        self.assertRaises(psycopg2.Error, self.handler.execute, self.db_1_conn_hash, "create unique index concurrently ix_dummy on dummy(i)")
+        self.assertEqual([("ix_dummy",)], self.get_invalid_indexes(), "left by failed build")
+        self.handler.drop_invalid_indexes = True
+        self.handler.execute(self.db_1_conn_hash, "delete from dummy; insert into dummy values (1)")
+        self.handler.execute(self.db_1_conn_hash, "create unique index concurrently if not exists ix_dummy on dummy(i)")
+        self.assertEqual([], self.get_invalid_indexes(), "rebuilt rather than skipped")
+        self.assertRaises(psycopg2.Error, self.handler.execute, self.db_1_conn_hash, "insert into dummy values (1)")
+
+    def test_can_record_script_checksums(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.create_checksum_table(self.db_1_conn_hash)
+        self.handler.create_checksum_table(self.db_1_conn_hash)
+        self.assertEqual({}, self.handler.get_script_checksums(self.db_1_conn_hash, "code"), "None yet")
+        self.handler.record_script_checksum(self.db_1_conn_hash, "code", "a.sql", "abc")
+        self.handler.record_script_checksum(self.db_1_conn_hash, "reference_data", "a.sql", "def")
+        self.handler.record_script_checksum(self.db_1_conn_hash, "code", "a.sql", "xyz")
+        self.assertEqual({"a.sql": "xyz"}, self.handler.get_script_checksums(self.db_1_conn_hash, "code"), "updated")
+        self.assertEqual({"a.sql": "def"}, self.handler.get_script_checksums(self.db_1_conn_hash, "reference_data"), "by type")
+
     def test_can_execute_script(self):
         self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
         self.handler.execute(self.db_1_conn_hash, "create table dummy(i int)")
@@ -155,6 +445,84 @@ class PostgresDatabaseHandler_Tests(unittest.TestCase):
         self.assert_table_exists_equals(self.db_1_conn_string, "dummy", True, "created")
         self.assert_table_exists_equals(self.db_1_conn_string, "d2", True, "created d2")
 
+    def test_can_execute_stream_of_statements(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        sql = """create table dummy(i int);
+create function f() returns int as $$ begin return 1; end; $$ language plpgsql;
+insert into dummy values (f());"""
+        self.handler.execute_stream(self.db_1_conn_hash, StringIO(sql))
+        self.assert_recordcount_equals(1, self.db_1_conn_string, "select * from dummy", "inserted")
+
+    def test_failing_streamed_statement_is_identified(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        try:
+            self.handler.execute_stream(self.db_1_conn_hash, StringIO("create table dummy(i int);\nblah blah;"))
+            self.fail("should have thrown")
+        except SqlStatementException as e:
+            self.assertEqual(2, e.statement.number, "statement number")
+            self.assertEqual(27, e.statement.offset, "offset")
+
+    def test_streamed_script_is_run_in_one_transaction(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        sql = "create table dummy(i int);\ninsert into dummy values (1);\nblah blah;"
+        self.assertRaises(SqlStatementException, self.handler.execute_stream, self.db_1_conn_hash, StringIO(sql))
+        self.assert_table_exists_equals(self.db_1_conn_string, "dummy", False, "rolled back")
+
+    def test_streamed_tracked_script_is_recorded_in_its_transaction(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        sql = "-- dbmigrator: lock_timeout=3s\ncreate table dummy(t text);\ninsert into dummy select current_setting('lock_timeout');"
+        self.assertEqual(1, self.handler.execute_stream_tracked(self.db_1_conn_hash, "a.txt", StringIO(sql)))
+        self.assertEqual(set(["a.txt"]), self.get_committed_scripts(), "recorded")
+        self.assertEqual([("3s",)], self.handler.query(self.db_1_conn_hash, "select t from dummy"), "marker applies to all statements")
+        self.assertRaises(SqlStatementException, self.handler.execute_stream_tracked, self.db_1_conn_hash, "b.txt",
+                          StringIO("insert into dummy values ('x');\nblah blah;"))
+        self.assertEqual(set(["a.txt"]), self.get_committed_scripts(), "not recorded")
+        self.assertEqual(1, len(self.handler.query(self.db_1_conn_hash, "select t from dummy")), "rolled back")
+
+    def test_streamed_no_transaction_script_runs_statement_by_statement(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.handler.execute(self.db_1_conn_hash, "create table dummy(i int, j int)")
+        sql = "-- dbmigrator: no-transaction\ncreate index concurrently ix_i on dummy(i);\ncreate index concurrently ix_j on dummy(j);\n"
+        self.handler.execute_stream_tracked(self.db_1_conn_hash, "a.txt", StringIO(sql))
+        self.assertEqual(set(["a.txt"]), self.get_committed_scripts(), "recorded")
+        sql = "alter table dummy add k int;\ncreate index concurrently ix_k on dummy(k);\n"
+        self.assertRaises(SqlStatementException, self.handler.execute_stream, self.db_1_conn_hash, StringIO(sql))
+
+    def test_can_execute_script_with_braces(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.execute(self.db_1_conn_hash, "create table dummy(s varchar(10)); insert into dummy values ('{0}')")
+        self.assert_recordcount_equals(1, self.db_1_conn_string, "select * from dummy where s = '{0}'", "inserted")
+
+    def write_data_file(self, name, content, manifest = None):
+        d = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, d)
+        path = os.path.join(d, name)
+        with open(path, "w") as f:
+            f.write(content)
+        if manifest is not None:
+            with open(os.path.splitext(path)[0] + ".ini", "w") as f:
+                f.write(manifest)
+        return DelimitedDataFile(path)
+
+    def test_can_bulk_load_csv_replacing_table_contents(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.execute(self.db_1_conn_hash, "create table currency(code varchar(3), name varchar(30)); insert into currency values ('XXX', 'gone')")
+        data = self.write_data_file("currency.csv", "code,name\nCAD,\"Canadian dollar, eh\"\nUSD,US dollar\n")
+        self.handler.bulk_load(self.db_1_conn_hash, data)
+        self.assert_recordcount_equals(2, self.db_1_conn_string, "select * from currency", "replaced")
+        self.assert_recordcount_equals(1, self.db_1_conn_string, "select * from currency where name = 'Canadian dollar, eh'", "quoted")
+
+    def test_can_bulk_merge_tsv(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.execute(self.db_1_conn_hash, "create table widget(id int primary key, name varchar(30))")
+        self.handler.execute(self.db_1_conn_hash, "insert into widget values (1, 'old'), (3, 'kept')")
+        data = self.write_data_file("widget.tsv", "id\tname\n1\tsprocket\n2\tgear\n", "mode = merge\nkey = id\n")
+        self.handler.bulk_load(self.db_1_conn_hash, data)
+        self.assert_recordcount_equals(3, self.db_1_conn_string, "select * from widget", "merged")
+        self.assert_recordcount_equals(1, self.db_1_conn_string, "select * from widget where id = 1 and name = 'sprocket'", "updated")
+
     def test_bad_script_throws(self):
         self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
         self.assertRaises(Exception, self.handler.execute, self.db_1_conn_hash, "blah blah")
@@ -163,6 +531,41 @@ class PostgresDatabaseHandler_Tests(unittest.TestCase):
         self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
         self.assertRaises(Exception, self.handler.execute, self.db_1_conn_hash, "create table dummy(i int); blah blah")
 
+    def test_connection_is_reused_across_calls(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.handler.record_script_in_tracking_table(self.db_1_conn_hash, "a.txt")
+        self.handler.is_in_tracking_table(self.db_1_conn_hash, "a.txt")
+        self.assertEqual(2, len(self.handler.connections), "one system and one db connection")
+
+    def test_query_returns_rows(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.execute(self.db_1_conn_hash, "create table dummy(i int, s varchar(10)); insert into dummy values (1, 'a'), (2, null)")
+        self.assertEqual([(1, "a"), (2, None)], self.handler.query(self.db_1_conn_hash, "select i, s from dummy order by i"))
+
+    def test_session_connection_hash_gets_separate_connection(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        session = self.handler.get_session_connection_hash(self.db_1_conn_hash, 1)
+        self.handler.execute(self.db_1_conn_hash, "create table dummy(i int)")
+        self.handler.execute(session, "insert into dummy values (1)")
+        self.assertEqual(3, len(self.handler.connections), "system, db and session connections")
+        self.assert_table_exists_equals(self.db_1_conn_string, "dummy", True, "same database")
+
+    def test_can_delete_make_new_database_with_open_cached_connection(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.execute(self.db_1_conn_hash, "create table dummy(i int)")
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.assert_table_exists_equals(self.db_1_conn_string, "dummy", False, "recreated")
+        self.handler.execute(self.db_1_conn_hash, "create table dummy(i int)")
+        self.assert_table_exists_equals(self.db_1_conn_string, "dummy", True, "new connection used")
+
+    def test_close_connections(self):
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.handler.user_defined_tables_exist(self.db_1_conn_hash)
+        self.handler.close_connections()
+        self.assertEqual(0, len(self.handler.connections), "all closed")
+        self.assertFalse(self.handler.user_defined_tables_exist(self.db_1_conn_hash), "reopens as needed")
+
 
 def main():
     unittest.main()
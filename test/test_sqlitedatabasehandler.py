@@ -0,0 +1,311 @@
+import logging
+import unittest
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+import dbMigrator
+from dbMigrator.migrator import Migrator, DatabaseSource
+from dbMigrator.sqlsplitter import SqlStatementException
+from dbMigrator.defaultdatabasesource import DelimitedDataFile
+from dbMigrator.sqlitedatabasehandler import SqliteDatabaseHandler
+
+class SqliteDatabaseHandler_Tests(unittest.TestCase):
+    """Runs against in-memory databases; see SqliteDatabaseHandler_FileTests
+for file-backed ones."""
+
+    longMessage = True
+
+    def setUp(self):
+        self.sys_conn_hash = { "dbname": "sys" }
+        self.db_1_conn_hash = { "dbname": "testdb_1" }
+        self.db_2_conn_hash = { "dbname": "testdb_2" }
+        self.db_1_name = "testdb_1"
+        self.handler = self.create_handler()
+
+        # Don't pollute test output.
+        logger = logging.getLogger('dbmigrator')
+        logger.setLevel(logging.CRITICAL)
+
+    def create_handler(self):
+        return SqliteDatabaseHandler()
+
+    def tearDown(self):
+        self.handler.close_connections()
+
+    def get_records(self, conn_hash, sql):
+        # Shares the handler's connection, as in-memory databases are per connection.
+        conn = self.handler.connections.get(conn_hash)
+        return conn.execute(sql).fetchall()
+
+    def assert_recordcount_equals(self, expected, sql, msg):
+        self.assertEqual(expected, len(self.get_records(self.db_1_conn_hash, sql)), msg)
+
+    def assert_table_exists_equals(self, table_name, expected, msg):
+        sql = "select name from sqlite_master where type = 'table' and name = '{0}'".format(table_name)
+        self.assert_recordcount_equals(1 if expected else 0, sql, msg)
+
+    # Tests
+
+    def test_delete_make_new_creates_empty_database(self):
+        self.handler.execute(self.db_1_conn_hash, "create table dummy(i int)")
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.assertFalse(self.handler.user_defined_tables_exist(self.db_1_conn_hash), "recreated")
+
+    def test_databases_are_separate(self):
+        self.handler.execute(self.db_1_conn_hash, "create table dummy(i int)")
+        self.assertTrue(self.handler.user_defined_tables_exist(self.db_1_conn_hash), "db 1")
+        self.assertFalse(self.handler.user_defined_tables_exist(self.db_2_conn_hash), "db 2")
+
+    def test_can_create_tracking_table(self):
+        self.assertFalse(self.handler.tracking_table_exists(self.db_1_conn_hash), "not created yet")
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.assertTrue(self.handler.tracking_table_exists(self.db_1_conn_hash), "created")
+
+    def test_can_track_scripts(self):
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.assertFalse(self.handler.is_in_tracking_table(self.db_1_conn_hash, "a.txt"), "Not run yet")
+        self.handler.record_script_in_tracking_table(self.db_1_conn_hash, "a.txt", 12, 3)
+        self.assertTrue(self.handler.is_in_tracking_table(self.db_1_conn_hash, "a.txt"), "Has been run")
+        self.assertEqual(set(["a.txt"]), self.handler.get_applied_scripts(self.db_1_conn_hash))
+        r = self.get_records(self.db_1_conn_hash, "select duration_ms, rows_affected from __schema_migrations")
+        self.assertEqual([(12, 3)], r)
+
+    def test_tracking_table_from_earlier_version_is_upgraded(self):
+        old = "create table __schema_migrations(migration_id integer primary key, script_name varchar(255), date_applied timestamp not null default CURRENT_TIMESTAMP)"
+        self.handler.execute(self.db_1_conn_hash, old + "; insert into __schema_migrations(script_name) values ('old.txt')")
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.handler.record_script_in_tracking_table(self.db_1_conn_hash, "a.txt", 10, 3)
+        self.assertEqual(set(["old.txt", "a.txt"]), self.handler.get_applied_scripts(self.db_1_conn_hash))
+
+    def test_tracked_script_and_tracking_row_are_committed_together(self):
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        rows = self.handler.execute_tracked(self.db_1_conn_hash, "a.txt", "create table dummy(i int); insert into dummy values (1); insert into dummy values (2)")
+        self.assertEqual(2, rows, "rows affected")
+        self.assert_table_exists_equals("dummy", True, "created")
+        r = self.get_records(self.db_1_conn_hash, "select script_name, rows_affected from __schema_migrations")
+        self.assertEqual([("a.txt", 2)], r)
+
+    def test_failed_tracked_script_is_rolled_back_and_not_recorded(self):
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.assertRaises(Exception, self.handler.execute_tracked, self.db_1_conn_hash, "a.txt", "create table dummy(i int); blah blah")
+        self.assert_table_exists_equals("dummy", False, "rolled back")
+        self.assertEqual(set(), self.handler.get_applied_scripts(self.db_1_conn_hash), "not recorded")
+
+    def test_script_managing_its_own_transaction_is_run_as_is(self):
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.handler.execute_tracked(self.db_1_conn_hash, "a.txt", "begin; create table dummy(i int); commit;")
+        self.assert_table_exists_equals("dummy", True, "created")
+        self.assertEqual(set(["a.txt"]), self.handler.get_applied_scripts(self.db_1_conn_hash), "recorded")
+
+    def test_query_returns_rows(self):
+        self.handler.execute(self.db_1_conn_hash, "create table dummy(i int, s varchar(10)); insert into dummy values (1, 'a'), (2, null)")
+        self.assertEqual([(1, "a"), (2, None)], self.handler.query(self.db_1_conn_hash, "select i, s from dummy order by i"))
+
+    def test_can_dump_schema(self):
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.handler.execute(self.db_1_conn_hash, "create table dummy(i int); create index ix_dummy on dummy(i); create view v as select * from dummy")
+        schema = self.handler.dump_schema(self.db_1_conn_hash)
+        self.assertFalse("__schema_migrations" in schema, "tracking table excluded")
+        self.handler.execute(self.db_2_conn_hash, schema)
+        self.assertEqual(self.handler.dump_schema(self.db_1_conn_hash), self.handler.dump_schema(self.db_2_conn_hash))
+
+    def test_can_record_script_checksums(self):
+        self.handler.create_checksum_table(self.db_1_conn_hash)
+        self.handler.create_checksum_table(self.db_1_conn_hash)
+        self.assertEqual({}, self.handler.get_script_checksums(self.db_1_conn_hash, "code"), "None yet")
+        self.handler.record_script_checksum(self.db_1_conn_hash, "code", "a.sql", "abc")
+        self.handler.record_script_checksum(self.db_1_conn_hash, "reference_data", "a.sql", "def")
+        self.handler.record_script_checksum(self.db_1_conn_hash, "code", "a.sql", "xyz")
+        self.assertEqual({"a.sql": "xyz"}, self.handler.get_script_checksums(self.db_1_conn_hash, "code"), "updated")
+        self.assertEqual({"a.sql": "def"}, self.handler.get_script_checksums(self.db_1_conn_hash, "reference_data"), "by type")
+
+    def test_can_execute_script_with_semicolons(self):
+        self.handler.execute(self.db_1_conn_hash, "create table dummy(i int); create table d2(s varchar(10)); insert into d2 values (';')")
+        self.assert_table_exists_equals("dummy", True, "created")
+        self.assert_recordcount_equals(1, "select * from d2 where s = ';'", "inserted")
+
+    def test_trigger_bodies_are_not_split(self):
+        sql = """create table dummy(i int);
+create table log(i int);
+create trigger tr after insert on dummy begin insert into log values (new.i); insert into log values (new.i + 1); end;
+insert into dummy values (1);"""
+        self.handler.execute(self.db_1_conn_hash, sql)
+        self.assert_recordcount_equals(2, "select * from log", "trigger ran")
+
+    def test_execute_returns_rows_affected(self):
+        self.assertEqual(None, self.handler.execute(self.db_1_conn_hash, "create table dummy(i int)"))
+        self.assertEqual(2, self.handler.execute(self.db_1_conn_hash, "insert into dummy values (1); insert into dummy values (2)"))
+
+    def test_rows_affected_are_counted_after_leading_comments(self):
+        self.handler.create_tracking_table(self.db_1_conn_hash)
+        self.handler.execute(self.db_1_conn_hash, "create table dummy(i int)")
+        sql = "-- first row\ninsert into dummy values (1);\n/* second\n row */ insert into dummy values (2);"
+        self.assertEqual(2, self.handler.execute_tracked(self.db_1_conn_hash, "a.txt", sql))
+        r = self.get_records(self.db_1_conn_hash, "select rows_affected from __schema_migrations")
+        self.assertEqual([(2,)], r)
+
+    def test_statement_after_a_comment_is_run_outside_a_transaction(self):
+        self.handler.execute(self.db_1_conn_hash, "create table dummy(i int)")
+        self.handler.execute(self.db_1_conn_hash, "-- reclaim space\nvacuum")
+
+    def test_can_execute_stream_of_statements(self):
+        sql = """create table dummy(i int);
+create trigger tr after insert on dummy begin update dummy set i = i + 1; end;
+insert into dummy values (1);"""
+        self.assertEqual(1, self.handler.execute_stream(self.db_1_conn_hash, StringIO(sql)))
+        self.assert_recordcount_equals(1, "select * from dummy where i = 2", "inserted and triggered")
+
+    def test_failing_streamed_statement_is_identified(self):
+        try:
+            self.handler.execute_stream(self.db_1_conn_hash, StringIO("create table dummy(i int);\nblah blah;"))
+            self.fail("should have thrown")
+        except SqlStatementException as e:
+            self.assertEqual(2, e.statement.number, "statement number")
+            self.assertEqual(27, e.statement.offset, "offset")
+
+    def test_can_execute_script_with_braces(self):
+        self.handler.execute(self.db_1_conn_hash, "create table dummy(s varchar(10)); insert into dummy values ('{0}')")
+        self.assert_recordcount_equals(1, "select * from dummy where s = '{0}'", "inserted")
+
+    def write_data_file(self, name, content, manifest = None):
+        d = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, d)
+        path = os.path.join(d, name)
+        with open(path, "w") as f:
+            f.write(content)
+        if manifest is not None:
+            with open(os.path.splitext(path)[0] + ".ini", "w") as f:
+                f.write(manifest)
+        return DelimitedDataFile(path)
+
+    def test_can_bulk_load_csv_replacing_table_contents(self):
+        self.handler.execute(self.db_1_conn_hash, "create table currency(code varchar(3), name varchar(30)); insert into currency values ('XXX', 'gone')")
+        data = self.write_data_file("currency.csv", "code,name\nCAD,\"Canadian dollar, eh\"\nUSD,\nEUR,Euro\n", "null = \"\"\n")
+        self.assertEqual(3, self.handler.bulk_load(self.db_1_conn_hash, data), "rows loaded")
+        self.assert_recordcount_equals(3, "select * from currency", "replaced")
+        self.assert_recordcount_equals(1, "select * from currency where name = 'Canadian dollar, eh'", "quoted")
+        self.assert_recordcount_equals(1, "select * from currency where name is null", "null")
+
+    def test_can_bulk_merge_tsv(self):
+        self.handler.execute(self.db_1_conn_hash, "create table widget(id int primary key, name varchar(30))")
+        self.handler.execute(self.db_1_conn_hash, "insert into widget values (1, 'old'); insert into widget values (3, 'kept')")
+        data = self.write_data_file("widget.tsv", "id\tname\n1\tsprocket\n2\tgear\n", "mode = merge\nkey = id\n")
+        self.handler.bulk_load(self.db_1_conn_hash, data)
+        self.assert_recordcount_equals(3, "select * from widget", "merged")
+        self.assert_recordcount_equals(1, "select * from widget where id = 1 and name = 'sprocket'", "updated")
+        self.assert_recordcount_equals(1, "select * from widget where id = 3 and name = 'kept'", "kept")
+
+    def test_failed_bulk_load_is_rolled_back(self):
+        self.handler.execute(self.db_1_conn_hash, "create table currency(code varchar(3) not null, name varchar(30)); insert into currency values ('XXX', 'kept')")
+        data = self.write_data_file("currency.csv", "code,name\n,no code\n", "null = \"\"\n")
+        self.assertRaises(Exception, self.handler.bulk_load, self.db_1_conn_hash, data)
+        self.assert_recordcount_equals(1, "select * from currency where code = 'XXX'", "not truncated")
+
+    def test_bad_script_throws(self):
+        self.assertRaises(Exception, self.handler.execute, self.db_1_conn_hash, "blah blah")
+
+    def test_failed_script_is_rolled_back(self):
+        self.assertRaises(Exception, self.handler.execute, self.db_1_conn_hash, "create table dummy(i int); blah blah")
+        self.assert_table_exists_equals("dummy", False, "rolled back")
+
+
+class SqliteDatabaseHandler_FileTests(SqliteDatabaseHandler_Tests):
+    """Runs the tests against file-backed databases."""
+
+    def create_handler(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        return SqliteDatabaseHandler(os.path.join(self.dir, "dbs"))
+
+    def test_databases_persist_across_connections(self):
+        self.handler.execute(self.db_1_conn_hash, "create table dummy(i int)")
+        self.handler.close_connections()
+        self.assertTrue(os.path.exists(os.path.join(self.dir, "dbs", "testdb_1.sqlite3")), "file")
+        self.assertTrue(self.handler.user_defined_tables_exist(self.db_1_conn_hash), "kept")
+
+    def test_delete_make_new_deletes_file(self):
+        self.handler.execute(self.db_1_conn_hash, "create table dummy(i int)")
+        self.handler.delete_make_new(self.sys_conn_hash, self.db_1_name)
+        self.assertFalse(os.path.exists(os.path.join(self.dir, "dbs", "testdb_1.sqlite3")))
+
+    def test_session_connections_share_the_database(self):
+        session = self.handler.get_session_connection_hash(self.db_1_conn_hash, 1)
+        self.handler.execute(self.db_1_conn_hash, "create table dummy(i int)")
+        self.handler.execute(session, "insert into dummy values (1)")
+        self.assertFalse(self.handler.connections.get(session) is self.handler.connections.get(self.db_1_conn_hash), "separate")
+        self.assert_table_exists_equals("dummy", True, "shared")
+
+
+class SqliteMigratorTests(unittest.TestCase):
+    """Full Migrator runs against in-memory databases."""
+
+    longMessage = True
+
+    class Source(DatabaseSource):
+        def __init__(self):
+            self.migrations = [("001.sql", "create table widget(id int primary key, name varchar(30))"),
+                               ("002.sql", "alter table widget add column size int")]
+        def get_db_name_from_nickname(self, nickname):
+            return nickname
+        def get_system_connection_hash(self):
+            return { "dbname": "sys" }
+        def get_connection_hashes(self):
+            return { "a": { "dbname": "a" }, "b": { "dbname": "b" } }
+        def get_baseline_schema_files(self, database_name):
+            return []
+        def get_reference_data_files(self, database_name):
+            return [("widgets.sql", "delete from widget; insert into widget values (1, 'gear', 3)")]
+        def get_code_files(self, database_name):
+            return [("v.sql", "drop view if exists v_big; create view v_big as select * from widget where size > 1")]
+        def get_migrations_files(self, database_name):
+            return self.migrations
+
+    def setUp(self):
+        self.handler = SqliteDatabaseHandler()
+        self.source = SqliteMigratorTests.Source()
+        self.migrator = Migrator(self.source, self.handler)
+        logging.getLogger('dbmigrator').setLevel(logging.CRITICAL)
+
+    def tearDown(self):
+        self.migrator.close()
+
+    def test_can_migrate_in_memory_databases(self):
+        self.migrator.max_workers = 2
+        self.migrator.skip_unchanged = True
+        for i in range(2):
+            self.migrator.run_migrations("a", "b")
+            self.migrator.run_code_definitions("a", "b")
+            self.migrator.run_reference_data("a", "b")
+        for db in ["a", "b"]:
+            conn = self.handler.connections.get({ "dbname": db })
+            self.assertEqual([(1, "gear", 3)], conn.execute("select * from v_big").fetchall(), db)
+            self.assertEqual(set(["001.sql", "002.sql"]), self.handler.get_applied_scripts({ "dbname": db }), db)
+
+    def test_code_runs_in_dependency_order_on_one_connection(self):
+        self.assertEqual(None, self.handler.get_session_connection_hash({ "dbname": "a" }, 1), "in-memory")
+        self.source.get_code_files = lambda db: [
+            ("a.sql", "drop view if exists v_gear; create view v_gear as select * from v_big where name = 'gear'"),
+            ("v.sql", "drop view if exists v_big; create view v_big as select * from widget where size > 1")
+        ]
+        self.migrator.code_dependency_order = True
+        self.migrator.code_workers = 2
+        self.migrator.run_migrations("a")
+        self.migrator.run_reference_data("a")
+        self.migrator.run_code_definitions("a")
+        conn = self.handler.connections.get({ "dbname": "a" })
+        self.assertEqual([(1, "gear", 3)], conn.execute("select * from v_gear").fetchall())
+
+    def test_failing_migration_stops_and_earlier_ones_are_recorded(self):
+        self.source.migrations.append(("003.sql", "alter table nonexistent add column x int"))
+        self.assertRaises(Exception, self.migrator.run_migrations, "a")
+        self.assertEqual(set(["001.sql", "002.sql"]), self.handler.get_applied_scripts({ "dbname": "a" }))
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
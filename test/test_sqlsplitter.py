@@ -0,0 +1,149 @@
+import time
+import unittest
+from StringIO import StringIO
+
+import dbMigrator
+from dbMigrator.sqlsplitter import SqlStatementSplitter, SqlStatement
+
+
+class SqlStatementSplitter_Tests(unittest.TestCase):
+
+    longMessage = True
+
+    def assert_split_equals(self, expected, sql, dialect = "ansi"):
+        """Checks statement text for several chunk sizes, to exercise
+tokens that straddle chunk boundaries."""
+        for chunk_size in [1, 2, 3, 7, 1024]:
+            splitter = SqlStatementSplitter(dialect, chunk_size)
+            actual = [st.sql for st in splitter.split(StringIO(sql))]
+            self.assertEqual(expected, actual, "chunk size {0}".format(chunk_size))
+
+    def test_single_statement(self):
+        self.assert_split_equals(["select 1"], "select 1")
+
+    def test_empty_script(self):
+        self.assert_split_equals([], "")
+        self.assert_split_equals([], "  \n ; ;\n")
+
+    def test_several_statements(self):
+        self.assert_split_equals(["select 1", "select 2"], "select 1;\nselect 2;\n")
+
+    def test_delimiter_in_quotes_is_ignored(self):
+        self.assert_split_equals(["insert into a values ('x;y')", "select \"a;b\" from c"],
+                                 "insert into a values ('x;y'); select \"a;b\" from c")
+
+    def test_doubled_quotes(self):
+        self.assert_split_equals(["select 'it''s; ok'", "select 2"], "select 'it''s; ok'; select 2")
+
+    def test_delimiter_in_comments_is_ignored(self):
+        sql = "-- comment; here\nselect 1; /* block; comment */ select 2"
+        self.assert_split_equals(["-- comment; here\nselect 1", "/* block; comment */ select 2"], sql)
+
+    def test_comment_only_statements_are_skipped(self):
+        self.assert_split_equals(["select 1"], "select 1;\n-- trailing comment\n/* and another */")
+
+    def test_minus_and_slash_are_not_comments(self):
+        self.assert_split_equals(["select 4 - 2 / 1", "select 1"], "select 4 - 2 / 1; select 1")
+
+    def test_postgres_dollar_quoting(self):
+        body = "create function f() returns int as $$ begin return 1; end; $$ language plpgsql"
+        self.assert_split_equals([body, "select f()"], body + "; select f();", "postgres")
+
+    def test_postgres_tagged_dollar_quoting(self):
+        body = "do $body$ begin perform 'x$$;'; end $body$"
+        self.assert_split_equals([body, "select 1"], body + "; select 1", "postgres")
+
+    def test_postgres_escape_strings(self):
+        self.assert_split_equals(["select E'it\\'s;'", "select 2"], "select E'it\\'s;'; select 2", "postgres")
+        self.assert_split_equals(["select e'a\\\\'", "select 2"], "select e'a\\\\'; select 2", "postgres")
+        self.assert_split_equals(["select name'a\\'", "select 2"], "select name'a\\'; select 2", "postgres")
+        self.assert_split_equals(["select E'a\\'", "select 2"], "select E'a\\'; select 2", "ansi")
+
+    def test_dollar_is_not_special_for_mysql(self):
+        self.assert_split_equals(["select '$$'", "select 1"], "select '$$'; select 1", "mysql")
+
+    def test_mysql_backslash_escapes(self):
+        self.assert_split_equals(["select 'a\\';b'", "select 2"], "select 'a\\';b'; select 2", "mysql")
+
+    def test_mysql_hash_comments_and_backticks(self):
+        sql = "# comment; here\nselect `a;b` from t; select 2"
+        self.assert_split_equals(["# comment; here\nselect `a;b` from t", "select 2"], sql, "mysql")
+
+    def test_mysql_delimiter(self):
+        sql = """create table t (i int);
+DELIMITER //
+create procedure p()
+begin
+  select 1;
+  select 2;
+end //
+DELIMITER ;
+call p();
+"""
+        proc = "create procedure p()\nbegin\n  select 1;\n  select 2;\nend"
+        self.assert_split_equals(["create table t (i int)", proc, "call p()"], sql, "mysql")
+
+    def test_delete_statement_is_not_a_delimiter_line(self):
+        self.assert_split_equals(["delete from t", "select 1"], "delete from t; select 1", "mysql")
+
+    def test_statement_numbers_and_offsets(self):
+        sql = "select 1;\n  select 2;"
+        actual = SqlStatementSplitter("ansi", 3).split_string(sql)
+        self.assertEqual([SqlStatement(1, 0, "select 1"), SqlStatement(2, 12, "select 2")], actual)
+
+    def test_unterminated_quote_returns_remainder(self):
+        self.assert_split_equals(["select 'oops; select 2"], "select 'oops; select 2")
+
+    def test_unknown_dialect_throws(self):
+        self.assertRaises(ValueError, SqlStatementSplitter, "oracle")
+
+    def test_large_script_is_read_in_bounded_chunks(self):
+        class CountingStream(object):
+            def __init__(self, n):
+                self.remaining = n
+                self.max_read = 0
+            def read(self, size):
+                self.max_read = max(self.max_read, size)
+                if self.remaining == 0:
+                    return ""
+                self.remaining -= 1
+                return "insert into t values (1);\n"
+        stream = CountingStream(20000)
+        count = 0
+        for st in SqlStatementSplitter("postgres", 4096).split(stream):
+            count += 1
+        self.assertEqual(20000, count, "all statements")
+        self.assertEqual(4096, stream.max_read, "chunked reads")
+
+    def test_code_drops_comments_and_string_contents(self):
+        sql = "-- create index concurrently\ninsert into \"My T\" values ('vacuum', E'it\\'s', $x$ drop database $x$) /* ; */"
+        for chunk_size in [1, 3, 1024]:
+            actual = SqlStatementSplitter("postgres", chunk_size).code(sql)
+            self.assertEqual(" insert into \"My T\" values ('', E'', '')  ", actual, "chunk size {0}".format(chunk_size))
+        self.assertEqual("select   `a#b` from t", SqlStatementSplitter("mysql").code("select # x\n `a#b` from t"))
+
+
+
+class SqlStatementSplitter_ScalingTests(unittest.TestCase):
+    """Splitting must stay linear in the number of statements read in a chunk."""
+
+    longMessage = True
+
+    def time_split(self, n):
+        sql = "insert into t values (1);\n" * n
+        start = time.time()
+        count = sum(1 for st in SqlStatementSplitter("postgres", 4 * 1024 * 1024).split(StringIO(sql)))
+        self.assertEqual(n, count, "all statements")
+        return time.time() - start
+
+    def test_many_small_statements_are_split_in_linear_time(self):
+        small = min(self.time_split(10000), self.time_split(10000))
+        large = self.time_split(40000)
+        # Copying the rest of the buffer for each statement made this ~10x.
+        self.assertTrue(large < small * 8, "4x the statements took {0:.1f}x the time".format(large / small))
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
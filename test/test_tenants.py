@@ -0,0 +1,222 @@
+import logging
+import os
+import shutil
+import signal
+import tempfile
+import unittest
+from configobj import ConfigObj
+
+import dbMigrator
+from dbMigrator.migrator import Migrator, DatabaseSource, MigrationException
+from dbMigrator.sqlitedatabasehandler import SqliteDatabaseHandler
+from dbMigrator.tenants import TenantDatabaseSource, TenantMigrator, FanOutSummary, TenantResult
+from dbMigrator.tenants import read_tenant_file, query_tenants, get_ini_tenants
+from fakedatabasehandler import FakeDatabaseHandler
+
+
+class ScriptSource(DatabaseSource):
+    """Scripts for a single database, "shop"."""
+
+    def __init__(self):
+        self.migrations = [("001.sql", "create table widget(id int)"), ("002.sql", "alter table widget add column size int")]
+    def get_db_name_from_nickname(self, nickname):
+        return nickname
+    def get_system_connection_hash(self):
+        return { "dbname": "sys", "conn": "sys" }
+    def get_connection_hashes(self):
+        return { "shop": { "dbname": "shop", "host": "h", "user": "u", "conn": "shop" } }
+    def get_baseline_schema_files(self, database_name):
+        assert database_name == "shop"
+        return []
+    def get_reference_data_files(self, database_name):
+        assert database_name == "shop"
+        return [("data.sql", "delete from widget; insert into widget values (1, 2)")]
+    def get_code_files(self, database_name):
+        assert database_name == "shop"
+        return []
+    def get_migrations_files(self, database_name):
+        assert database_name == "shop"
+        return self.migrations
+
+
+class TenantSources_Tests(unittest.TestCase):
+
+    longMessage = True
+
+    def setUp(self):
+        self.defaults = ScriptSource().get_connection_hash("shop")
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def test_source_gives_every_tenant_the_same_scripts(self):
+        tenants = [{ "dbname": "t1" }, { "dbname": "t2", "nickname": "second" }]
+        s = TenantDatabaseSource(ScriptSource(), "shop", tenants)
+        self.assertEqual(["second", "t1"], s.get_tenant_nicknames())
+        self.assertEqual("t2", s.get_db_name_from_nickname("second"))
+        self.assertEqual(ScriptSource().get_migrations_files("shop"), s.get_migrations_files("second"))
+        self.assertEqual({ "dbname": "sys", "conn": "sys" }, s.get_system_connection_hash())
+
+    def test_duplicate_tenants_are_rejected(self):
+        self.assertRaises(MigrationException, TenantDatabaseSource, ScriptSource(), "shop", [{ "dbname": "t1" }, { "dbname": "t1" }])
+
+    def test_tenants_can_be_read_from_file(self):
+        path = os.path.join(self.dir, "tenants.txt")
+        with open(path, "w") as f:
+            f.write("# customers\nt1\n\n t2  host=db7 user=x  # moved\n")
+        tenants = read_tenant_file(path, self.defaults)
+        self.assertEqual([{ "dbname": "t1", "host": "h", "user": "u", "conn": "shop" },
+                          { "dbname": "t2", "host": "db7", "user": "x", "conn": "shop" }], tenants)
+
+    def test_bad_tenant_file_line_throws(self):
+        path = os.path.join(self.dir, "tenants.txt")
+        with open(path, "w") as f:
+            f.write("t1 db7\n")
+        self.assertRaises(MigrationException, read_tenant_file, path, self.defaults)
+
+    def test_tenants_can_be_queried(self):
+        handler = SqliteDatabaseHandler()
+        catalog = { "dbname": "catalog" }
+        handler.execute(catalog, "create table tenant(name text, host text); insert into tenant values ('t1', null), ('t2', 'db7')")
+        tenants = query_tenants(handler, catalog, "select name, host from tenant order by name", self.defaults)
+        self.assertEqual(["t1", "t2"], [t["dbname"] for t in tenants])
+        self.assertEqual(["h", "db7"], [t["host"] for t in tenants])
+        handler.close_connections()
+
+    def test_tenants_can_be_read_from_ini(self):
+        config = ConfigObj(["[Tenants]", "one = t1", "[[two]]", "dbname = t2", "host = db7"])
+        tenants = get_ini_tenants(config, self.defaults)
+        self.assertEqual([("one", "t1", "h"), ("two", "t2", "db7")], [(t["nickname"], t["dbname"], t["host"]) for t in tenants])
+        self.assertRaises(MigrationException, get_ini_tenants, ConfigObj([]), self.defaults)
+
+
+class TenantMigrator_Tests(unittest.TestCase):
+
+    longMessage = True
+
+    def setUp(self):
+        self.handler = FakeDatabaseHandler()
+        # Connection => number of times its scripts fail before succeeding.
+        self.fail_first = {}
+        execute = self.handler.execute
+        def flaky_execute(conn_hash, sql):
+            c = conn_hash["conn"]
+            if self.fail_first.get(c, 0) > 0:
+                self.fail_first[c] -= 1
+                raise Exception("connection refused")
+            return execute(conn_hash, sql)
+        self.handler.execute = flaky_execute
+        tenants = [{ "dbname": "t{0}".format(i), "host": "h{0}".format(i % 2), "conn": "t{0}".format(i) } for i in range(4)]
+        self.migrator = Migrator(TenantDatabaseSource(ScriptSource(), "shop", tenants), self.handler)
+        self.tenant_migrator = TenantMigrator(self.migrator)
+        self.tenant_migrator.retry_delay = 0
+        logging.getLogger('dbmigrator').setLevel(logging.CRITICAL)
+
+    def test_phases_run_on_every_tenant(self):
+        summary = self.tenant_migrator.run(["migrations", "reference_data"])
+        self.assertEqual(4, len(summary.results))
+        self.assertEqual([], summary.failed())
+        for i in range(4):
+            c = "t{0}".format(i)
+            self.assertEqual(set(["001.sql", "002.sql"]), self.handler.tracked[c], c)
+            self.assertTrue("execute delete from widget; insert into widget values (1, 2) in " + c in self.handler.call_history, c)
+
+    def test_phases_run_in_order_per_tenant(self):
+        self.tenant_migrator.run(["reference_data", "migrations"], "t2")
+        executed = [h for h in self.handler.call_history if h.startswith("execute")]
+        self.assertEqual(["execute create table widget(id int) in t2",
+                          "execute alter table widget add column size int in t2",
+                          "execute delete from widget; insert into widget values (1, 2) in t2"], executed)
+
+    def test_failed_tenant_is_retried(self):
+        self.fail_first = { "t1": 1 }
+        self.tenant_migrator.retries = 2
+        summary = self.tenant_migrator.run(["migrations"])
+        self.assertEqual([], summary.failed())
+        self.assertEqual(["t1"], [r.nickname for r in summary.retried()])
+        self.assertEqual(2, summary.retried()[0].attempts)
+        self.assertEqual(set(["001.sql", "002.sql"]), self.handler.tracked["t1"])
+
+    def test_failures_are_summarized_not_raised(self):
+        self.fail_first = { "t1": 10, "t3": 1 }
+        self.tenant_migrator.retries = 1
+        summary = self.tenant_migrator.run(["migrations"])
+        self.assertEqual(["t1"], [r.nickname for r in summary.failed()])
+        self.assertEqual(2, summary.failed()[0].attempts)
+        self.assertTrue("connection refused" in summary.failed()[0].error, summary.failed()[0].error)
+        self.assertEqual(set(["001.sql", "002.sql"]), self.handler.tracked["t0"], "others still run")
+        text = summary.format_text()
+        self.assertTrue(text.startswith("4 tenant(s) in 0s: 3 succeeded, 1 failed, 2 retried"), text)
+        self.assertTrue("RETRIED t3 (h1): succeeded on attempt 2" in text, text)
+        self.assertTrue("FAILED t1 (h1) after 2 attempt(s): " in text, text)
+
+    def test_connections_are_closed_after_each_tenant(self):
+        closed = []
+        self.handler.close_connections = lambda: closed.append(True)
+        self.tenant_migrator.run(["migrations"])
+        self.assertEqual(4, len(closed))
+
+    def test_format_duration(self):
+        self.assertEqual("59s", TenantMigrator.format_duration(59.4))
+        self.assertEqual("2m 05s", TenantMigrator.format_duration(125))
+        self.assertEqual("1h 01m", TenantMigrator.format_duration(3660))
+
+
+class DyingDatabaseHandler(SqliteDatabaseHandler):
+    """Kills its process when migrating tenant t1, as the OOM killer would."""
+
+    def execute_tracked(self, conn_hash, script_name, sql):
+        if conn_hash["dbname"] == "t1":
+            os.kill(os.getpid(), signal.SIGKILL)
+        return super(DyingDatabaseHandler, self).execute_tracked(conn_hash, script_name, sql)
+
+
+class TenantMigrator_ProcessTests(unittest.TestCase):
+    """Fan out to file-backed sqlite tenant databases on worker processes."""
+
+    longMessage = True
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.handler = SqliteDatabaseHandler(self.dir)
+        tenants = [{ "dbname": "t{0}".format(i), "host": "h{0}".format(i % 2) } for i in range(6)]
+        self.source = TenantDatabaseSource(ScriptSource(), "shop", tenants)
+        self.migrator = Migrator(self.source, self.handler)
+        self.tenant_migrator = TenantMigrator(self.migrator)
+        self.tenant_migrator.processes = 3
+        self.tenant_migrator.max_per_host = 1
+        logging.getLogger('dbmigrator').setLevel(logging.CRITICAL)
+
+    def test_tenants_are_migrated_by_worker_processes(self):
+        summary = self.tenant_migrator.run(["migrations", "reference_data"])
+        self.assertEqual([], summary.failed())
+        for i in range(6):
+            conn = { "dbname": "t{0}".format(i) }
+            self.assertEqual(set(["001.sql", "002.sql"]), self.handler.get_applied_scripts(conn), str(i))
+            self.assertEqual([(1, 2)], self.handler.query(conn, "select * from widget"), str(i))
+        self.handler.close_connections()
+
+    def test_worker_failures_are_summarized(self):
+        self.source.database_source.migrations.append(("003.sql", "alter table nonexistent add column x int"))
+        summary = self.tenant_migrator.run(["migrations"])
+        self.assertEqual(6, len(summary.failed()))
+        self.assertEqual(set(["001.sql", "002.sql"]), self.handler.get_applied_scripts({ "dbname": "t0" }))
+        self.handler.close_connections()
+
+    def test_worker_that_dies_fails_its_tenant(self):
+        self.migrator.database_handler = DyingDatabaseHandler(self.dir)
+        self.tenant_migrator.retries = 1
+        self.tenant_migrator.retry_delay = 0
+        summary = self.tenant_migrator.run(["migrations"])
+        self.assertEqual(["t1"], [r.nickname for r in summary.failed()])
+        self.assertEqual(2, summary.failed()[0].attempts, "retried")
+        self.assertTrue("died" in summary.failed()[0].error, summary.failed()[0].error)
+        self.assertEqual(set(["001.sql", "002.sql"]), self.handler.get_applied_scripts({ "dbname": "t0" }))
+        self.handler.close_connections()
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()